@@ -10,53 +10,151 @@ import yaml
 from typing import Tuple
 
 from helper import *
+from layout import (
+    SNAPSHOT_LAYOUT,
+    OutputLayout,
+    create_dataset_with_layout,
+    get_dataset_options,
+    narrow_group_ids,
+    parse_output_layout,
+)
 
 
-def read_from_hdf_file(filename: str, handle: str):
+def read_from_hdf_file(filename: str, handle: str, mmap: bool = True, workers: int = 1):
     """
-    Reads the item from the file by opening it temporarily.
+    Reads the item from the file by opening it temporarily. Contiguous,
+    uncompressed, datasets are returned as read-only memory-mapped views
+    if mmap is true. Other datasets are read in parts by workers processes
+    at once.
     """
 
     with h5py.File(filename, "r") as file:
-        return file[handle][...]
+        return read_dataset(file[handle], mmap=mmap, workers=workers)
 
 
-def write_to_hdf_file(filename: str, handle: str, data):
+def write_to_hdf_file(
+    filename: str,
+    handle: str,
+    data,
+    layout: OutputLayout = SNAPSHOT_LAYOUT,
+    workers: int = 1,
+):
     """
     Writes the data to HDF5 file creating the handle if it needs to be
-    created.
+    created, with the layout (and chunks aligned to the ParticleIDs that
+    live alongside it). An existing dataset is patched in place, only
+    writing the blocks that changed (e.g. after re-running one catalogue),
+    unless it has the wrong shape or its dtype cannot hold the data.
+
+    New contiguous datasets are written in parts by workers threads at once,
+    and the chunks of new compressed datasets compressed on workers threads.
     """
 
-    with h5py.File(filename) as file:
-        try:
-            file.create_dataset(handle, data=data)
-        except RuntimeError:
+    with h5py.File(filename, "a") as file:
+        if handle in file:
             # It already exists!
-            file[handle][...] = data
+            existing = file[handle]
+
+            if existing.shape == data.shape and np.can_cast(data.dtype, existing.dtype):
+                patch_dataset(existing, data)
+                return
+
+            del file[handle]
+
+        particle_ids = f"{handle.rsplit('/', 1)[0]}/ParticleIDs"
+        reference_chunks = file[particle_ids].chunks if particle_ids in file else None
+
+        options = get_dataset_options(layout, data.shape, reference_chunks)
+        parallel = workers > 1 and not options and data.size > 0
+
+        if parallel:
+            # Allocate the space now, so that it can be written to directly.
+            dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+            dcpl.set_alloc_time(h5py.h5d.ALLOC_TIME_EARLY)
+
+            file.create_dataset(handle, shape=data.shape, dtype=data.dtype, dcpl=dcpl)
+        else:
+            create_dataset_with_layout(
+                file, handle, data, layout, reference_chunks, workers=workers
+            )
+
+    if parallel:
+        write_dataset_parallel(filename, handle, data, workers)
 
     return
 
 
-def read_and_write_all(catalog_filename, snapshot_filename, name: str):
+def read_and_write_all(
+    catalog_filename,
+    snapshot_filename,
+    name: str,
+    layout: OutputLayout = SNAPSHOT_LAYOUT,
+    workers: int = 1,
+):
     """
-    Reads and writes all particle types.
+    Reads the group IDs of all particle types from the ordered_group_particles
+    file at catalog_filename and writes them to the snapshot with
+    write_groups_to_snapshot, with workers processes or threads reading and
+    writing the parts of each dataset at once.
 
     Name should be the name of the dataset you want to be
     created in PartType<X>/ that contains the IDs.
     """
 
+    groups_snapshot = {
+        particle_type: read_from_hdf_file(
+            catalog_filename, f"PartType{particle_type}/GroupID", workers=workers
+        )
+        for particle_type in get_particle_types_with_particles(snapshot_filename)
+    }
+
+    write_groups_to_snapshot(groups_snapshot, snapshot_filename, name, layout, workers)
+
+    return
+
+
+def get_particle_types_with_particles(snapshot_filename: str) -> list:
+    """
+    Returns the particle types (out of gas, DM, stars and black holes) that
+    have any particles in the snapshot.
+    """
+
     with h5py.File(snapshot_filename, "r") as file:
         particle_numbers = file["Header"].attrs["NumPart_Total"]
 
-    for particle_type in [0, 1, 4, 5]:
-        if not particle_numbers[particle_type]:
-            # If there are none of that particle then skip it
-            continue
+    # If there are none of that particle then skip it
+    return [ptype for ptype in [0, 1, 4, 5] if particle_numbers[ptype]]
+
 
-        ids = read_from_hdf_file(catalog_filename, f"PartType{particle_type}/GroupID")
+def write_groups_to_snapshot(
+    groups_snapshot: dict,
+    snapshot_filename: str,
+    name: str,
+    layout: OutputLayout = SNAPSHOT_LAYOUT,
+    workers: int = 1,
+):
+    """
+    Writes the group IDs, already in memory as created by postprocess.py
+    (i.e. {ptype: GroupID}), to the snapshot, with the narrowest dtype that
+    holds all of the groups, and workers as in write_to_hdf_file.
+
+    Name should be the name of the dataset you want to be
+    created in PartType<X>/ that contains the IDs.
+    """
+
+    number_of_groups = 1 + max(
+        [int(groups.max(initial=-1)) for groups in groups_snapshot.values()] + [-1]
+    )
+
+    for particle_type in get_particle_types_with_particles(snapshot_filename):
+        write_to_hdf_file(
+            snapshot_filename,
+            f"PartType{particle_type}/{name}",
+            narrow_group_ids(groups_snapshot[particle_type], number_of_groups),
+            layout,
+            workers,
+        )
 
-        write_to_hdf_file(snapshot_filename, f"PartType{particle_type}/{name}", ids)
-        
     return
 
 
@@ -101,13 +199,36 @@ if __name__ == "__main__":
         default=None
     )
 
+    PARSER.add_argument(
+        "--layout",
+        help="""
+        Filter for the new datasets: none, gzip, gzip:<level>, or lzf, optionally
+        with +shuffle. Chunks are aligned with the ParticleIDs. Default: none
+        """,
+        required=False,
+        default="none"
+    )
+
+    PARSER.add_argument(
+        "--io-workers",
+        help="""
+        Number of threads or processes that read and write the parts of each
+        dataset (and compress their chunks) at the same time, e.g. to use more of
+        a parallel file system. Default: 1
+        """,
+        required=False,
+        type=int,
+        default=1
+    )
+
     ARGS = vars(PARSER.parse_args())
 
     snapshot = f"{ARGS['snapshot']}.hdf5"
+    layout = parse_output_layout(ARGS["layout"])
 
-    read_and_write_all(ARGS["halos"], snapshot, "VRHaloID")
+    read_and_write_all(ARGS["halos"], snapshot, "VRHaloID", layout, ARGS["io_workers"])
 
     if ARGS["galaxies"] is not None:
-        read_and_write_all(ARGS["galaxies"], snapshot, "VRGalID")
+        read_and_write_all(ARGS["galaxies"], snapshot, "VRGalID", layout, ARGS["io_workers"])
 
 
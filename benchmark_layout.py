@@ -0,0 +1,324 @@
+"""
+Compares the read and write throughput, and the file size, of GroupID
+datasets written with different output layouts (see layout.py) on a
+synthetic snapshot.
+
+Three reads are timed: reading the whole GroupID dataset, and reading it
+alongside the ParticleIDs, one ParticleIDs chunk at a time, which is where
+aligned chunks matter.
+
+For usage information, use python3 benchmark_layout.py -h
+"""
+
+import os
+import time
+import tempfile
+import numpy as np
+import h5py
+
+from typing import NamedTuple
+
+from layout import (
+    OutputLayout,
+    create_dataset_with_layout,
+    narrow_group_ids,
+    parse_output_layout,
+)
+
+DEFAULT_POLICIES = ["none", "gzip", "gzip:1", "shuffle+gzip:4", "lzf", "shuffle+lzf"]
+
+
+class BenchmarkResult(NamedTuple):
+    """
+    The timings (in seconds) and file size (in bytes) for one policy.
+    """
+
+    policy: str
+    dtype: str
+    write_seconds: float
+    read_seconds: float
+    co_read_seconds: float
+    file_bytes: int
+
+
+def create_benchmark_groups(
+    number_of_particles: int, number_of_groups: int, fraction_in_groups: float = 0.5, seed=0
+) -> np.array:
+    """
+    Creates a GroupID array where the particles of each group are mostly in
+    runs, as they are in snapshots ordered along a space-filling curve, with
+    about fraction_in_groups of the particles in a group.
+    """
+
+    random = np.random.default_rng(seed)
+
+    # Group sizes follow a (steep) power law, like halo mass functions.
+    sizes = random.pareto(1.0, size=number_of_groups) + 1
+    sizes *= fraction_in_groups * number_of_particles / sizes.sum()
+    sizes = np.maximum(sizes.astype(np.int64), 1)
+
+    gaps = random.integers(0, 2 * (1 - fraction_in_groups) * sizes.mean() + 1, size=number_of_groups)
+
+    groups = np.full(number_of_particles, -1, dtype=np.int64)
+    position = 0
+
+    for group_id in random.permutation(number_of_groups):
+        position += gaps[group_id]
+        groups[position : position + sizes[group_id]] = group_id
+        position += sizes[group_id]
+
+        if position >= number_of_particles:
+            break
+
+    return groups
+
+
+def create_benchmark_snapshot(filename: str, number_of_particles: int, chunk_size=None):
+    """
+    Creates a snapshot with only PartType1/ParticleIDs, chunked with
+    chunk_size rows (or contiguous if None).
+    """
+
+    with h5py.File(filename, "w") as handle:
+        handle.create_dataset(
+            "PartType1/ParticleIDs",
+            data=np.arange(number_of_particles, dtype=np.uint64),
+            chunks=None if chunk_size is None else (min(chunk_size, number_of_particles),),
+        )
+
+    return
+
+
+def time_layout(
+    snapshot_filename: str,
+    output_filename: str,
+    groups: np.array,
+    layout: OutputLayout,
+    narrow: bool = True,
+    workers: int = 1,
+) -> BenchmarkResult:
+    """
+    Writes the groups with the layout (compressing on workers threads) and
+    times the writes and reads.
+    """
+
+    data = narrow_group_ids(groups) if narrow else groups
+
+    with h5py.File(snapshot_filename, "r") as snapshot:
+        particle_ids = snapshot["PartType1/ParticleIDs"]
+        reference_chunks = particle_ids.chunks
+
+        start = time.perf_counter()
+
+        with h5py.File(output_filename, "w") as handle:
+            create_dataset_with_layout(
+                handle, "PartType1/GroupID", data, layout, reference_chunks, workers=workers
+            )
+
+        write_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+
+        with h5py.File(output_filename, "r") as handle:
+            handle["PartType1/GroupID"][...]
+
+        read_seconds = time.perf_counter() - start
+
+        block = reference_chunks[0] if reference_chunks is not None else 1 << 16
+
+        start = time.perf_counter()
+
+        with h5py.File(output_filename, "r") as handle:
+            group_ids = handle["PartType1/GroupID"]
+
+            for offset in range(0, particle_ids.shape[0], block):
+                particle_ids[offset : offset + block]
+                group_ids[offset : offset + block]
+
+        co_read_seconds = time.perf_counter() - start
+
+    return BenchmarkResult(
+        policy=layout.describe() + ("" if layout.match_chunks else " (auto chunks)"),
+        dtype=str(data.dtype),
+        write_seconds=write_seconds,
+        read_seconds=read_seconds,
+        co_read_seconds=co_read_seconds,
+        file_bytes=os.path.getsize(output_filename),
+    )
+
+
+def run_benchmark(
+    number_of_particles: int,
+    number_of_groups: int,
+    policies=DEFAULT_POLICIES,
+    chunk_size=1 << 16,
+    directory=None,
+    repeats: int = 3,
+    workers: int = 1,
+) -> list:
+    """
+    Runs the benchmark for each of the policies (layout descriptions), plus
+    the old behaviour (int64 with gzip and automatic chunks, compressed by
+    HDF5) as a baseline, keeping the fastest of repeats runs for each timing.
+    The policies are written with workers compression threads.
+    """
+
+    groups = create_benchmark_groups(number_of_particles, number_of_groups)
+
+    layouts = [(OutputLayout(match_chunks=False), False, 1)] + [
+        (parse_output_layout(policy), True, workers) for policy in policies
+    ]
+
+    results = []
+
+    with tempfile.TemporaryDirectory(dir=directory) as temporary_directory:
+        snapshot_filename = os.path.join(temporary_directory, "snapshot.hdf5")
+        output_filename = os.path.join(temporary_directory, "groups.hdf5")
+
+        create_benchmark_snapshot(snapshot_filename, number_of_particles, chunk_size)
+
+        for layout, narrow, layout_workers in layouts:
+            runs = [
+                time_layout(
+                    snapshot_filename, output_filename, groups, layout, narrow, layout_workers
+                )
+                for _ in range(max(repeats, 1))
+            ]
+
+            results.append(
+                runs[0]._replace(
+                    write_seconds=min(run.write_seconds for run in runs),
+                    read_seconds=min(run.read_seconds for run in runs),
+                    co_read_seconds=min(run.co_read_seconds for run in runs),
+                )
+            )
+
+    return results
+
+
+def format_results(results: list, number_of_particles: int) -> str:
+    """
+    Formats the results as a table. Throughputs are in millions of particles
+    per second, so that different dtypes can be compared.
+    """
+
+    lines = [
+        f"{'policy':<28}{'dtype':>8}{'write':>10}{'read':>10}{'co-read':>10}{'size MB':>10}"
+    ]
+
+    for result in results:
+        lines.append(
+            f"{result.policy:<28}{result.dtype:>8}"
+            f"{number_of_particles / result.write_seconds / 1e6:>10.1f}"
+            f"{number_of_particles / result.read_seconds / 1e6:>10.1f}"
+            f"{number_of_particles / result.co_read_seconds / 1e6:>10.1f}"
+            f"{result.file_bytes / 1e6:>10.2f}"
+        )
+
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    # Run in script mode!
+    import argparse as ap
+
+    PARSER = ap.ArgumentParser(
+        description="""
+        Benchmarks writing and reading GroupID datasets with different output
+        layouts on a synthetic snapshot. Throughputs are printed in millions of
+        particles per second.
+        """
+    )
+
+    PARSER.add_argument(
+        "-n",
+        "--particles",
+        help="""
+        Number of particles. Default: 10^7
+        """,
+        required=False,
+        type=int,
+        default=10_000_000,
+    )
+
+    PARSER.add_argument(
+        "-g",
+        "--groups",
+        help="""
+        Number of groups. Default: 10^5
+        """,
+        required=False,
+        type=int,
+        default=100_000,
+    )
+
+    PARSER.add_argument(
+        "-p",
+        "--policies",
+        help="""
+        Layouts to compare (see layout.py). Default: none gzip gzip:1
+        shuffle+gzip:4 lzf shuffle+lzf
+        """,
+        required=False,
+        nargs="+",
+        default=DEFAULT_POLICIES,
+    )
+
+    PARSER.add_argument(
+        "-c",
+        "--chunk-size",
+        help="""
+        Rows per chunk of the synthetic ParticleIDs, or 0 for contiguous.
+        Default: 65536
+        """,
+        required=False,
+        type=int,
+        default=1 << 16,
+    )
+
+    PARSER.add_argument(
+        "-d",
+        "--directory",
+        help="""
+        Directory to write the temporary files in, e.g. on the file system the
+        snapshots live on. Default: the system temporary directory.
+        """,
+        required=False,
+        default=None,
+    )
+
+    PARSER.add_argument(
+        "-r",
+        "--repeats",
+        help="""
+        Number of times to repeat each measurement (the fastest is kept). Default: 3
+        """,
+        required=False,
+        type=int,
+        default=3,
+    )
+
+    PARSER.add_argument(
+        "-w",
+        "--workers",
+        help="""
+        Number of threads compressing the chunks of the gzip policies. Default: 1
+        """,
+        required=False,
+        type=int,
+        default=1,
+    )
+
+    ARGS = vars(PARSER.parse_args())
+
+    results = run_benchmark(
+        number_of_particles=ARGS["particles"],
+        number_of_groups=ARGS["groups"],
+        policies=ARGS["policies"],
+        chunk_size=ARGS["chunk_size"] or None,
+        directory=ARGS["directory"],
+        repeats=ARGS["repeats"],
+        workers=ARGS["workers"],
+    )
+
+    print(format_results(results, ARGS["particles"]))
@@ -0,0 +1,508 @@
+"""
+A local server that loads the postprocess outputs (the GroupID arrays of one
+or more catalogues) and an index of the particle IDs of a snapshot once, and
+keeps them in shared memory for analysis notebooks and batch jobs to use.
+
+Clients ask the server (over a Unix socket) where the arrays are, attach to
+the shared memory without copying anything, and answer their batched queries
+(ID to group, position to group, and group to members) with vectorised
+lookups on those arrays. If no server is running for the snapshot, the
+client library reads the files directly instead, so code using it works
+either way:
+
+    from catalogue_server import open_catalogue_index
+
+    index = open_catalogue_index("snap.hdf5", {"halo": "halo/snap"})
+    groups = index.groups_of_ids("halo", particle_ids)
+
+For usage information, use python3 catalogue_server.py -h
+"""
+
+import os
+import json
+import socket
+import hashlib
+import tempfile
+import socketserver
+import threading
+import numpy as np
+
+from multiprocessing import resource_tracker, shared_memory
+
+from helper import *
+from postprocess import read_ordered_groups_from_file
+
+# The shared memory blocks created by servers in this process.
+_created_blocks = set()
+
+
+def get_default_socket_path(snapshot_filename: str) -> str:
+    """
+    The socket that the server for the snapshot listens on by default, in
+    the temporary directory (Unix socket paths must be short).
+    """
+
+    key = hashlib.sha1(os.path.abspath(snapshot_filename).encode()).hexdigest()[:16]
+
+    return os.path.join(tempfile.gettempdir(), f"catalogue-server-{key}.sock")
+
+
+class CatalogueIndex:
+    """
+    The arrays needed to answer queries about the groups of the particles in
+    a snapshot. The particle types are combined into one long array (see
+    combine_arrays), and for the IDs and each catalogue we hold
+
+        sorted_ids, id_order: the sorted IDs, and their positions
+        <catalogue>/groups: the GroupID of each particle
+        <catalogue>/member_order, <catalogue>/member_offsets: the positions
+            of the particles in each group, sorted by group
+
+    The arrays may live in shared memory; the index only ever reads them.
+    """
+
+    def __init__(
+        self,
+        arrays: dict,
+        particle_types: list,
+        insertion_points: list,
+        source: str,
+        blocks=None,
+    ):
+        self.arrays = arrays
+        self.particle_types = list(particle_types)
+        self.insertion_points = np.array(insertion_points, dtype=np.int64)
+        # Either "files" or "server", for information.
+        self.source = source
+        # The shared memory blocks that the arrays live in, which must stay
+        # attached for as long as the arrays are used.
+        self.blocks = list(blocks) if blocks is not None else []
+
+    @property
+    def catalogues(self) -> list:
+        return [name[: -len("/groups")] for name in self.arrays if name.endswith("/groups")]
+
+    @classmethod
+    def from_files(cls, snapshot_filename: str, catalogue_paths: dict):
+        """
+        Builds the index from the snapshot (including .hdf5) and the
+        ordered_group_particles files of the catalogues, given as
+        {name: catalogue path (without extension)}.
+        """
+
+        particle_ids = read_particle_ids_from_file(snapshot_filename, mmap=False)
+        particle_types = list(particle_ids.keys())
+
+        combined_ids, insertion_points = combine_arrays(
+            [particle_ids[ptype] for ptype in particle_types]
+        )
+
+        id_order = combined_ids.argsort(kind="stable")
+        arrays = {"sorted_ids": combined_ids[id_order], "id_order": id_order}
+
+        for name, catalogue_path in catalogue_paths.items():
+            groups_snapshot = read_ordered_groups_from_file(
+                f"{catalogue_path}.ordered_group_particles"
+            )
+
+            groups, _ = combine_arrays(
+                [
+                    groups_snapshot.get(ptype, np.full(particle_ids[ptype].shape, -1))
+                    for ptype in particle_types
+                ]
+            )
+
+            arrays.update(create_member_index(name, groups))
+
+        return cls(arrays, particle_types, insertion_points, source="files")
+
+    @classmethod
+    def from_shared_memory(cls, layout: dict, particle_types: list, insertion_points: list):
+        """
+        Builds the index from the arrays that a server holds in shared
+        memory, given as {name: {"shm": block name, "dtype", "shape"}}, and
+        keeps the blocks attached for as long as the index exists.
+        """
+
+        arrays = {}
+        blocks = []
+
+        for name, array_layout in layout.items():
+            block = attach_shared_memory(array_layout["shm"])
+            blocks.append(block)
+
+            arrays[name] = np.ndarray(
+                tuple(array_layout["shape"]),
+                dtype=np.dtype(array_layout["dtype"]),
+                buffer=block.buf,
+            )
+
+        return cls(arrays, particle_types, insertion_points, source="server", blocks=blocks)
+
+    def describe(self) -> dict:
+        """
+        Everything except the arrays themselves, as plain python types.
+        """
+
+        return {
+            "particle_types": [int(ptype) for ptype in self.particle_types],
+            "insertion_points": [int(point) for point in self.insertion_points],
+        }
+
+    def split_positions(self, combined_positions: np.array):
+        """
+        Converts positions in the combined array to particle types and
+        positions within the arrays of those particle types.
+        """
+
+        type_index = np.searchsorted(self.insertion_points, combined_positions, side="right") - 1
+
+        return (
+            np.array(self.particle_types, dtype=np.int64)[type_index],
+            combined_positions - self.insertion_points[type_index],
+        )
+
+    def groups_of_ids(self, catalogue: str, particle_ids: np.array) -> np.array:
+        """
+        The GroupID in catalogue of each of the particle IDs, or -1 for those
+        that are not in a group or not in the snapshot.
+        """
+
+        sorted_ids = self.arrays["sorted_ids"]
+        groups = self.arrays[f"{catalogue}/groups"]
+
+        particle_ids = np.asarray(particle_ids)
+        result = np.full(particle_ids.shape, -1, dtype=groups.dtype)
+
+        positions, found = find_in_sorted(particle_ids, sorted_ids)
+
+        result[found] = groups[self.arrays["id_order"][positions[found]]]
+
+        return result
+
+    def groups_of_positions(self, catalogue: str, ptype: int, positions: np.array) -> np.array:
+        """
+        The GroupID in catalogue of the particles of ptype at positions in
+        the snapshot.
+        """
+
+        type_index = self.particle_types.index(ptype)
+
+        return self.arrays[f"{catalogue}/groups"][
+            self.insertion_points[type_index] + np.asarray(positions)
+        ]
+
+    def members(self, catalogue: str, group_ids: np.array):
+        """
+        Finds the particles in each of the groups in catalogue.
+
+        Returns the particle types and positions (in the snapshot) of all of
+        the members, one group after the other, and the number of members of
+        each group.
+        """
+
+        member_order = self.arrays[f"{catalogue}/member_order"]
+        member_offsets = self.arrays[f"{catalogue}/member_offsets"]
+
+        group_ids = np.asarray(group_ids, dtype=np.int64)
+        valid = np.logical_and(group_ids >= 0, group_ids < member_offsets.size - 1)
+
+        starts = np.where(valid, member_offsets[np.where(valid, group_ids, 0)], 0)
+        lengths = np.where(valid, member_offsets[np.where(valid, group_ids, 0) + 1] - starts, 0)
+
+        # All of the ranges at once.
+        output_offsets = np.cumsum(lengths) - lengths
+        members = np.arange(lengths.sum()) + np.repeat(starts - output_offsets, lengths)
+
+        ptypes, positions = self.split_positions(member_order[members])
+
+        return ptypes, positions, lengths
+
+
+def create_member_index(name: str, groups: np.array) -> dict:
+    """
+    Creates the arrays for one catalogue in a CatalogueIndex from the
+    combined GroupID array.
+    """
+
+    number_of_groups = int(groups.max(initial=-1)) + 1
+
+    # Particles outside of groups (-1) sort first, and are dropped.
+    order = groups.argsort(kind="stable")
+    order = order[np.count_nonzero(groups < 0) :]
+
+    counts = np.bincount(groups[groups >= 0], minlength=number_of_groups)
+
+    return {
+        f"{name}/groups": groups,
+        f"{name}/member_order": order,
+        f"{name}/member_offsets": np.concatenate([[0], np.cumsum(counts)]),
+    }
+
+
+def attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    """
+    Attaches to a shared memory block created by the server, without this
+    process taking ownership of (and, on exit, removing) it.
+    """
+
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before python 3.13, attaching registers the block with the
+        # resource tracker, which would unlink it when we exit (unless it is
+        # ours anyway, when the tracker only knows about it once).
+        block = shared_memory.SharedMemory(name=name)
+
+        if block.name not in _created_blocks:
+            resource_tracker.unregister(block._name, "shared_memory")
+
+        return block
+
+
+def send_request(socket_path: str, request: dict, timeout: float = 10.0) -> dict:
+    """
+    Sends a request (one line of JSON) to the server and returns its reply.
+    """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.settimeout(timeout)
+        connection.connect(socket_path)
+        connection.sendall(json.dumps(request).encode() + b"\n")
+
+        with connection.makefile("r") as reader:
+            reply = json.loads(reader.readline())
+
+    if "error" in reply:
+        raise RuntimeError(reply["error"])
+
+    return reply
+
+
+class CatalogueServer:
+    """
+    Holds a CatalogueIndex in shared memory and tells clients, over a Unix
+    socket, where to find it.
+    """
+
+    def __init__(self, index: CatalogueIndex, snapshot_filename: str):
+        self.snapshot_filename = os.path.abspath(snapshot_filename)
+        self.blocks = {}
+        self.layout = {}
+
+        shared_arrays = {}
+
+        for name, array in index.arrays.items():
+            # Zero-sized shared memory is not allowed.
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+            shared[...] = array
+
+            _created_blocks.add(block.name)
+            self.blocks[name] = block
+            self.layout[name] = {
+                "shm": block.name,
+                "dtype": array.dtype.str,
+                "shape": list(array.shape),
+            }
+            shared_arrays[name] = shared
+
+        self.index = CatalogueIndex(
+            shared_arrays, index.particle_types, index.insertion_points, source="server"
+        )
+        self._server = None
+
+    def handle(self, request: dict) -> dict:
+        """
+        Answers one request from a client.
+        """
+
+        command = request.get("command")
+
+        if command == "describe":
+            return {
+                "snapshot": self.snapshot_filename,
+                "arrays": self.layout,
+                **self.index.describe(),
+            }
+        elif command == "ping":
+            return {"ok": True}
+        elif command == "shutdown":
+            if self._server is not None:
+                # shutdown() waits for serve_forever to return, so it cannot
+                # be called from the thread that is handling this request.
+                threading.Thread(target=self._server.shutdown).start()
+
+            return {"ok": True}
+        else:
+            return {"error": f"Unknown command {command}"}
+
+    def serve(self, socket_path: str):
+        """
+        Serves requests on socket_path until a shutdown request is received,
+        then frees the shared memory.
+        """
+
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        reply = server.handle(json.loads(line))
+                    except Exception as error:
+                        reply = {"error": str(error)}
+
+                    self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+        try:
+            with socketserver.ThreadingUnixStreamServer(socket_path, Handler) as unix_server:
+                self._server = unix_server
+                unix_server.serve_forever()
+        finally:
+            self._server = None
+
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+
+            self.close()
+
+        return
+
+    def close(self):
+        """
+        Frees the shared memory. Clients that are attached keep their view
+        until they let go of it.
+        """
+
+        self.index = None
+
+        for block in self.blocks.values():
+            _created_blocks.discard(block.name)
+            block.close()
+            block.unlink()
+
+        self.blocks = {}
+
+        return
+
+
+def connect_to_server(snapshot_filename: str, socket_path=None) -> CatalogueIndex:
+    """
+    Attaches to the shared memory of the server for the snapshot. Raises
+    OSError if there is no server running, and ValueError if the server at
+    socket_path is serving a different snapshot.
+    """
+
+    if socket_path is None:
+        socket_path = get_default_socket_path(snapshot_filename)
+
+    description = send_request(socket_path, {"command": "describe"})
+
+    if description["snapshot"] != os.path.abspath(snapshot_filename):
+        raise ValueError(
+            f"The server at {socket_path} is serving {description['snapshot']}, "
+            f"not {os.path.abspath(snapshot_filename)}."
+        )
+
+    return CatalogueIndex.from_shared_memory(
+        description["arrays"], description["particle_types"], description["insertion_points"]
+    )
+
+
+def open_catalogue_index(
+    snapshot_filename: str, catalogue_paths: dict, socket_path=None
+) -> CatalogueIndex:
+    """
+    Opens the index for the snapshot (including .hdf5): from the server if
+    one is running, and otherwise by reading the snapshot and the
+    ordered_group_particles files of the catalogues ({name: catalogue path}).
+    """
+
+    try:
+        index = connect_to_server(snapshot_filename, socket_path)
+    except (OSError, ValueError):
+        return CatalogueIndex.from_files(snapshot_filename, catalogue_paths)
+
+    if not set(catalogue_paths.keys()) <= set(index.catalogues):
+        # The server does not have everything we need.
+        return CatalogueIndex.from_files(snapshot_filename, catalogue_paths)
+
+    return index
+
+
+if __name__ == "__main__":
+    # Run in script mode!
+    import argparse as ap
+
+    PARSER = ap.ArgumentParser(
+        description="""
+        Loads the GroupID arrays of the given catalogues and an index of the
+        particle IDs of the snapshot into shared memory, and serves them to
+        clients (see open_catalogue_index) until stopped with --stop or ctrl-c.
+        """
+    )
+
+    PARSER.add_argument(
+        "-s",
+        "--snapshot",
+        help="""
+        Snapshot filename (including path and .hdf5). Required.
+        """,
+        required=True,
+    )
+
+    PARSER.add_argument(
+        "-c",
+        "--catalogues",
+        help="""
+        The catalogues to serve, as name=path pairs where the path is to the
+        catalogue without extension, e.g. halo=halo/snap galaxy=galaxy/snap.
+        """,
+        required=False,
+        nargs="+",
+        default=[],
+    )
+
+    PARSER.add_argument(
+        "-S",
+        "--socket",
+        help="""
+        Path of the Unix socket to listen on. Default: one in the temporary
+        directory that the clients find from the snapshot filename.
+        """,
+        required=False,
+        default=None,
+    )
+
+    PARSER.add_argument(
+        "--stop",
+        help="""
+        Stop the server that is running for the snapshot instead.
+        """,
+        action="store_true",
+    )
+
+    ARGS = vars(PARSER.parse_args())
+
+    socket_path = ARGS["socket"] or get_default_socket_path(ARGS["snapshot"])
+
+    if ARGS["stop"]:
+        send_request(socket_path, {"command": "shutdown"})
+        exit(0)
+
+    catalogue_paths = dict(catalogue.split("=", 1) for catalogue in ARGS["catalogues"])
+
+    catalogue_server = CatalogueServer(
+        CatalogueIndex.from_files(ARGS["snapshot"], catalogue_paths), ARGS["snapshot"]
+    )
+
+    print(f"Serving {', '.join(catalogue_paths) or 'the IDs'} on {socket_path}")
+
+    try:
+        catalogue_server.serve(socket_path)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,363 @@
+"""
+Checksums of the ParticleIDs in a snapshot, so that we can check that
+fix_particle_ids.py really did put back the original IDs without keeping a
+copy of them.
+
+The IDs of each particle type are split into blocks (of whole chunks, for
+chunked datasets) and a CRC32 is calculated for each block, over the values
+as little-endian integers so that the checksums do not depend on how the
+data is stored. preprocess.py records the checksums in the duplicates file
+before it changes anything.
+
+Each block is read once, and the hashing (and, for contiguous datasets, the
+reading) happens on a pool of threads, which zlib and the file reads release
+the GIL for.
+
+For usage information, use python3 checksum.py -h
+"""
+
+import os
+import zlib
+import yaml
+import numpy as np
+import h5py
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from helper import *
+
+# Approximate size of the blocks that are checksummed (and read) at once.
+CHECKSUM_BLOCK_BYTES = 16 * 1024 ** 2
+
+
+class ChecksumError(Exception):
+    """Exception raised when the IDs do not match their recorded checksums.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+
+def get_number_of_threads(threads=None) -> int:
+    """
+    The number of threads to use, defaulting to python's default for thread
+    pools (which allows for threads waiting on the disk).
+    """
+
+    if threads is None:
+        return min(32, (os.cpu_count() or 1) + 4)
+
+    return max(threads, 1)
+
+
+def get_block_rows(dataset: h5py.Dataset) -> int:
+    """
+    The number of rows in each checksummed block of dataset: a whole number
+    of chunks for chunked datasets, so that every chunk is read only once,
+    and about CHECKSUM_BLOCK_BYTES otherwise.
+    """
+
+    row_bytes = dataset.dtype.itemsize * int(np.prod(dataset.shape[1:]))
+    block_rows = max(1, CHECKSUM_BLOCK_BYTES // max(row_bytes, 1))
+
+    if dataset.chunks is not None:
+        chunk_rows = dataset.chunks[0]
+        block_rows = chunk_rows * max(1, block_rows // chunk_rows)
+
+    return block_rows
+
+
+def crc32_block(data: np.array) -> int:
+    """
+    The CRC32 of the values in data, as little-endian.
+    """
+
+    data = np.ascontiguousarray(data, dtype=data.dtype.newbyteorder("<"))
+
+    return zlib.crc32(memoryview(data).cast("B"))
+
+
+def combine_block_checksums(blocks: list) -> int:
+    """
+    Combines the checksums of the blocks into one checksum for the dataset.
+    """
+
+    return zlib.crc32(np.array(blocks, dtype="<u4").tobytes())
+
+
+def create_record(dtype, size: int, block_rows: int, blocks: list) -> dict:
+    """
+    The checksum record for one particle type, with plain python types so
+    that it can be written to yaml.
+    """
+
+    return {
+        "dtype": np.dtype(dtype).str,
+        "size": int(size),
+        "block_rows": int(block_rows),
+        "blocks": [int(block) for block in blocks],
+        "crc32": int(combine_block_checksums(blocks)),
+    }
+
+
+def checksum_array(ids: np.array, block_rows: int, threads=None) -> dict:
+    """
+    Checksums the IDs, already in memory, in blocks of block_rows.
+    """
+
+    starts = range(0, ids.shape[0], block_rows)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        blocks = list(
+            pool.map(lambda start: crc32_block(ids[start : start + block_rows]), starts)
+        )
+
+    return create_record(ids.dtype, ids.shape[0], block_rows, blocks)
+
+
+def read_and_checksum_block(
+    filename: str, offset: int, dtype: np.dtype, start: int, end: int
+) -> int:
+    """
+    Reads rows start to end of a contiguous dataset at offset in the file
+    without going through HDF5 (so that the GIL is released), and returns
+    their checksum.
+    """
+
+    data = np.empty(end - start, dtype=dtype)
+    buffer = memoryview(data).cast("B")
+
+    with open(filename, "rb") as handle:
+        handle.seek(offset + start * dtype.itemsize)
+
+        if handle.readinto(buffer) != data.nbytes:
+            raise OSError(f"Unexpected end of file reading {filename}")
+
+    return crc32_block(data)
+
+
+def checksum_dataset(dataset: h5py.Dataset, block_rows=None, threads=None) -> dict:
+    """
+    Checksums the dataset, reading every block once. Contiguous datasets are
+    read directly from the file on the threads; otherwise blocks are read in
+    order through h5py while the earlier ones are hashed on the threads.
+    """
+
+    if block_rows is None:
+        block_rows = get_block_rows(dataset)
+
+    threads = get_number_of_threads(threads)
+
+    size = dataset.shape[0]
+    starts = range(0, size, block_rows)
+    offset = contiguous_dataset_offset(dataset)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        if offset is not None:
+            filename = dataset.file.filename
+
+            futures = [
+                pool.submit(
+                    read_and_checksum_block,
+                    filename,
+                    offset,
+                    dataset.dtype,
+                    start,
+                    min(start + block_rows, size),
+                )
+                for start in starts
+            ]
+        else:
+            # Keep a bounded number of blocks in memory, waiting to be hashed.
+            futures = []
+            in_flight = deque()
+
+            for start in starts:
+                if len(in_flight) >= 2 * threads:
+                    in_flight.popleft().result()
+
+                future = pool.submit(crc32_block, dataset[start : start + block_rows])
+
+                futures.append(future)
+                in_flight.append(future)
+
+        blocks = [future.result() for future in futures]
+
+    return create_record(dataset.dtype, size, block_rows, blocks)
+
+
+def calculate_checksums(filename: str, particle_ids=None, threads=None) -> dict:
+    """
+    Calculates the checksums of the ParticleIDs of each particle type in the
+    snapshot (including .hdf5), as {ptype: record}.
+
+    If particle_ids ({ptype: ids}) is given, the IDs that are already in
+    memory are checksummed instead of reading them again, using the same
+    blocks as if they were read from the file.
+    """
+
+    checksums = {}
+
+    with h5py.File(filename, "r") as handle:
+        for ptype in range(6):
+            try:
+                dataset = handle[f"PartType{ptype}/ParticleIDs"]
+            except KeyError:
+                continue
+
+            if particle_ids is None:
+                checksums[ptype] = checksum_dataset(dataset, threads=threads)
+            else:
+                checksums[ptype] = checksum_array(
+                    np.asarray(particle_ids[ptype]), get_block_rows(dataset), threads=threads
+                )
+
+    return checksums
+
+
+def verify_checksums(filename: str, checksums: dict, threads=None) -> list:
+    """
+    Checks the ParticleIDs in the snapshot (including .hdf5) against the
+    recorded checksums, returning a list of the problems found (empty if
+    everything matches).
+    """
+
+    problems = []
+
+    with h5py.File(filename, "r") as handle:
+        for ptype, record in checksums.items():
+            try:
+                dataset = handle[f"PartType{ptype}/ParticleIDs"]
+            except KeyError:
+                problems.append(f"PartType{ptype}/ParticleIDs is missing")
+                continue
+
+            if dataset.shape[0] != record["size"]:
+                problems.append(
+                    f"PartType{ptype} has {dataset.shape[0]} IDs, not {record['size']}"
+                )
+                continue
+
+            if np.dtype(record["dtype"]).itemsize != dataset.dtype.itemsize:
+                problems.append(f"PartType{ptype} IDs are now {dataset.dtype}")
+                continue
+
+            current = checksum_dataset(dataset, block_rows=record["block_rows"], threads=threads)
+
+            for block, (expected, found) in enumerate(zip(record["blocks"], current["blocks"])):
+                if expected != found:
+                    start = block * record["block_rows"]
+                    problems.append(
+                        f"PartType{ptype} IDs {start} to {start + record['block_rows']} differ"
+                    )
+
+    return problems
+
+
+def read_checksums(filename: str):
+    """
+    Reads the checksums from the duplicates file written by preprocess.py,
+    or returns None if it does not have any (e.g. it was written by an older
+    version).
+    """
+
+    with open(filename, "r") as file:
+        raw_data = yaml.load(file, Loader=yaml.Loader)
+
+    return raw_data.get("checksums")
+
+
+def verify_snapshot(snapshot: str, replaced: str, threads=None):
+    """
+    Verifies the snapshot (including .hdf5) against the checksums in the
+    duplicates file, raising a ChecksumError if they do not match. Returns
+    False if there were no checksums to verify against, and True otherwise.
+    """
+
+    checksums = read_checksums(replaced)
+
+    if checksums is None:
+        return False
+
+    problems = verify_checksums(snapshot, checksums, threads=threads)
+
+    if problems:
+        raise ChecksumError(
+            f"The IDs in {snapshot} do not match those before preprocessing: "
+            + "; ".join(problems)
+        )
+
+    return True
+
+
+if __name__ == "__main__":
+    # Run in script mode!
+    import argparse as ap
+
+    PARSER = ap.ArgumentParser(
+        description="""
+        Verifies that the particle IDs in a snapshot are the same as they were
+        before preprocess.py was run, using the checksums that it recorded. This
+        takes the same arguments as fix_particle_ids.py.
+        """
+    )
+
+    PARSER.add_argument(
+        "-i",
+        "--input",
+        help="""
+        Input HDF5 file to verify, without the file extension. Required.
+        """,
+        required=True,
+    )
+
+    PARSER.add_argument(
+        "-d",
+        "--directory",
+        help="""
+        Directory that the snapshots and halos should live in. Required.
+        """,
+        required=True,
+    )
+
+    PARSER.add_argument(
+        "-o",
+        "--output",
+        help="""
+        Extra string to add onto the output filename for the diffs.
+        """,
+        required=False,
+        default="duplicated",
+    )
+
+    PARSER.add_argument(
+        "-t",
+        "--threads",
+        help="""
+        Number of threads to read and hash with. Default: python's default for
+        thread pools.
+        """,
+        required=False,
+        type=int,
+        default=None,
+    )
+
+    ARGS = vars(PARSER.parse_args())
+
+    filename = f"{ARGS['directory']}/{ARGS['input']}.hdf5"
+    duplicated_filename = f"{ARGS['directory']}/{ARGS['input']}_{ARGS['output']}.yml"
+
+    try:
+        verified = verify_snapshot(filename, duplicated_filename, threads=ARGS["threads"])
+    except ChecksumError as error:
+        print(error.message)
+        exit(1)
+
+    if verified:
+        print(f"The IDs in {filename} match their checksums.")
+    else:
+        print(f"There are no checksums in {duplicated_filename} to verify against.")
@@ -0,0 +1,345 @@
+"""
+Cross-matches two sets of groups that are defined on the same particles.
+
+This can be used to relate the galaxy catalogue to its host halos (both
+ordered_group_particles files are defined on the same snapshot), or to link
+halos between two snapshots once the particles have been matched by ID.
+
+For usage information, use python3 crossmatch.py -h
+"""
+
+import numpy as np
+import h5py
+
+from typing import Tuple
+
+from helper import *
+from layout import narrow_group_ids
+
+
+def load_group_ids(filename: str) -> dict:
+    """
+    Loads the GroupID arrays from an ordered_group_particles file, storing
+    them in a dictionary with the particle type corresponding to the index.
+    """
+
+    group_ids = {}
+
+    with h5py.File(filename, "r") as handle:
+        for ptype in range(6):
+            try:
+                group_ids[ptype] = handle[f"/PartType{ptype}/GroupID"][...]
+            except KeyError:
+                pass
+
+    return group_ids
+
+
+def combine_group_ids(groups_a: dict, groups_b: dict) -> Tuple[np.array]:
+    """
+    Takes two dictionaries of GroupID arrays (one per particle type) that are
+    defined on the same particles and combines them into two long arrays over
+    the particle types that both contain.
+    """
+
+    particle_types = [ptype for ptype in groups_a.keys() if ptype in groups_b]
+
+    for ptype in particle_types:
+        if groups_a[ptype].shape != groups_b[ptype].shape:
+            raise ValueError(
+                f"GroupID arrays for PartType{ptype} have different shapes; "
+                "are they defined on the same particles?"
+            )
+
+    combined_a, _ = combine_arrays([groups_a[ptype] for ptype in particle_types])
+    combined_b, _ = combine_arrays([groups_b[ptype] for ptype in particle_types])
+
+    return combined_a, combined_b
+
+
+def drop_repeated_ids(particle_ids: np.array, groups: np.array) -> Tuple[np.array]:
+    """
+    Removes the particles whose ID is shared with another particle in the
+    same snapshot (as SIMBA's IDs are), returning the IDs and groups of the
+    rest.
+    """
+
+    _, inverse, counts = np.unique(
+        particle_ids, return_inverse=True, return_counts=True
+    )
+    single = counts[inverse.reshape(-1)] == 1
+
+    return particle_ids[single], groups[single]
+
+
+def align_groups_by_particle_ids(
+    particle_ids_a: np.array,
+    groups_a: np.array,
+    particle_ids_b: np.array,
+    groups_b: np.array,
+) -> Tuple[np.array]:
+    """
+    Aligns the group arrays of two snapshots by particle ID, so that the
+    returned arrays are defined on the same particles. Particles that only
+    exist in one of the snapshots are dropped, as are those whose ID is
+    repeated within either snapshot, which cannot be told apart by ID.
+
+    The IDs must be the original ones (i.e. after fix_particle_ids.py), not
+    those written by preprocess.py: its replacement IDs are handed out
+    separately for each snapshot, so the same one may belong to unrelated
+    particles in the two.
+    """
+
+    particle_ids_a, groups_a = drop_repeated_ids(particle_ids_a, groups_a)
+    particle_ids_b, groups_b = drop_repeated_ids(particle_ids_b, groups_b)
+
+    _, indices_a, indices_b = np.intersect1d(
+        particle_ids_a, particle_ids_b, assume_unique=True, return_indices=True
+    )
+
+    return groups_a[indices_a], groups_b[indices_b]
+
+
+def calculate_group_sizes(groups: np.array, number_of_groups: int) -> np.array:
+    """
+    Counts the number of particles in each group, ignoring particles that are
+    not in a group (i.e. those with a GroupID of -1).
+    """
+
+    return np.bincount(groups[groups >= 0], minlength=number_of_groups)
+
+
+def build_contingency_table(groups_a: np.array, groups_b: np.array) -> Tuple[np.array]:
+    """
+    Builds the sparse contingency table of shared particles between the groups
+    in groups_a and the groups in groups_b, in one pass over the particles.
+
+    Returns three arrays of the same length, one entry per non-zero pair:
+    the group in a, the group in b, and the number of particles that they
+    share. The pairs are sorted by group in a, then group in b.
+    """
+
+    in_both = np.logical_and(groups_a >= 0, groups_b >= 0)
+
+    rows = groups_a[in_both].astype(np.int64)
+    columns = groups_b[in_both].astype(np.int64)
+
+    if rows.size == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty.copy(), empty.copy()
+
+    number_of_columns = int(columns.max()) + 1
+
+    if int(rows.max()) + 1 > np.iinfo(np.int64).max // number_of_columns:
+        raise ValueError("Too many groups to encode the pairs in a 64 bit integer.")
+
+    # Encode each pair as a single integer so that one unique call does the
+    # counting, keeping memory proportional to the number of non-zero pairs.
+    pair_keys = rows * number_of_columns + columns
+    del rows, columns
+
+    unique_pairs, shared = np.unique(pair_keys, return_counts=True)
+
+    return unique_pairs // number_of_columns, unique_pairs % number_of_columns, shared
+
+
+def find_best_matches(
+    rows: np.array,
+    columns: np.array,
+    shared: np.array,
+    row_sizes: np.array,
+    column_sizes: np.array,
+) -> Tuple[np.array]:
+    """
+    Finds, for every row group, the column group with the highest merit,
+
+        merit = shared^2 / (size_row * size_column),
+
+    from the sparse contingency table given by build_contingency_table.
+
+    Returns the best match, the fraction of the row group's particles that
+    are shared with the best match, and the merit, for each row group. Groups
+    without any match have a best match of -1 and zero fraction and merit.
+    """
+
+    number_of_groups = row_sizes.size
+
+    best_match = np.full(number_of_groups, -1, dtype=np.int64)
+    shared_fraction = np.zeros(number_of_groups, dtype=np.float64)
+    merit = np.zeros(number_of_groups, dtype=np.float64)
+
+    if rows.size == 0:
+        return best_match, shared_fraction, merit
+
+    pair_shared = shared.astype(np.float64)
+    pair_merit = pair_shared ** 2 / (
+        row_sizes[rows].astype(np.float64) * column_sizes[columns]
+    )
+
+    # Sort by row, then by descending merit; ties go to the lowest column as
+    # the pairs are already sorted by column and lexsort is stable.
+    order = np.lexsort((-pair_merit, rows))
+    matched_rows, first = np.unique(rows[order], return_index=True)
+    best = order[first]
+
+    best_match[matched_rows] = columns[best]
+    shared_fraction[matched_rows] = pair_shared[best] / row_sizes[matched_rows]
+    merit[matched_rows] = pair_merit[best]
+
+    return best_match, shared_fraction, merit
+
+
+def cross_match(groups_a: np.array, groups_b: np.array) -> dict:
+    """
+    Cross-matches the groups in groups_a against the groups in groups_b (two
+    GroupID arrays defined on the same particles), in both directions.
+
+    Returns a dictionary,
+
+    {
+        "a_to_b": (best_match, shared_fraction, merit),
+        "b_to_a": (best_match, shared_fraction, merit),
+    }
+
+    where each entry is described in find_best_matches.
+    """
+
+    number_of_groups_a = int(groups_a.max(initial=-1)) + 1
+    number_of_groups_b = int(groups_b.max(initial=-1)) + 1
+
+    sizes_a = calculate_group_sizes(groups_a, number_of_groups_a)
+    sizes_b = calculate_group_sizes(groups_b, number_of_groups_b)
+
+    rows, columns, shared = build_contingency_table(groups_a, groups_b)
+
+    a_to_b = find_best_matches(rows, columns, shared, sizes_a, sizes_b)
+    # The transposed table is no longer sorted by row, but find_best_matches
+    # sorts the pairs itself so we can re-use it.
+    b_to_a = find_best_matches(columns, rows, shared, sizes_b, sizes_a)
+
+    return {"a_to_b": a_to_b, "b_to_a": b_to_a}
+
+
+def write_matches_to_file(filename: str, matches: dict):
+    """
+    Writes the output of cross_match to a HDF5 file with filename.
+    """
+
+    with h5py.File(filename, "w") as handle:
+        for direction, (best_match, shared_fraction, merit) in matches.items():
+            current_group = handle.create_group(direction)
+            current_group.create_dataset("BestMatch", data=narrow_group_ids(best_match))
+            current_group.create_dataset("SharedFraction", data=shared_fraction)
+            current_group.create_dataset("Merit", data=merit)
+
+    return
+
+
+def load_data_and_write_matches(
+    groups_a_filename: str,
+    groups_b_filename: str,
+    output_filename: str,
+    snapshot_a_filename=None,
+    snapshot_b_filename=None,
+) -> None:
+    """
+    Loads two ordered_group_particles files, cross-matches them, and writes
+    the matches to output_filename.
+
+    If the snapshot filenames are given, the particles are first matched by
+    ID between the two snapshots (i.e. for linking halos between outputs).
+    Otherwise the two files must be defined on the same snapshot.
+    """
+
+    groups_a = load_group_ids(groups_a_filename)
+    groups_b = load_group_ids(groups_b_filename)
+
+    if snapshot_a_filename is None or snapshot_b_filename is None:
+        combined_a, combined_b = combine_group_ids(groups_a, groups_b)
+    else:
+        particle_ids_a = read_particle_ids_from_file(snapshot_a_filename)
+        particle_ids_b = read_particle_ids_from_file(snapshot_b_filename)
+
+        particle_types_a = [ptype for ptype in particle_ids_a.keys() if ptype in groups_a]
+        particle_types_b = [ptype for ptype in particle_ids_b.keys() if ptype in groups_b]
+
+        # Particles may change type between snapshots (e.g. gas to stars), so
+        # we match across all types at once.
+        combined_a, combined_b = align_groups_by_particle_ids(
+            combine_arrays([particle_ids_a[ptype] for ptype in particle_types_a])[0],
+            combine_arrays([groups_a[ptype] for ptype in particle_types_a])[0],
+            combine_arrays([particle_ids_b[ptype] for ptype in particle_types_b])[0],
+            combine_arrays([groups_b[ptype] for ptype in particle_types_b])[0],
+        )
+
+    matches = cross_match(combined_a, combined_b)
+
+    write_matches_to_file(output_filename, matches)
+
+    return
+
+
+if __name__ == "__main__":
+    # Run in script mode!
+    import argparse as ap
+
+    PARSER = ap.ArgumentParser(
+        description="""
+        Cross-matches the groups in two ordered_group_particles files, e.g. the
+        galaxy catalogue against the halo catalogue for the same snapshot, or
+        the halo catalogues of two different snapshots. For each group, the
+        best match, shared particle fraction and merit are written to file.
+        """
+    )
+
+    PARSER.add_argument(
+        "-a",
+        "--groups-a",
+        help="""
+        Path to the first .ordered_group_particles file (e.g. galaxies). Required.
+        """,
+        required=True,
+    )
+
+    PARSER.add_argument(
+        "-b",
+        "--groups-b",
+        help="""
+        Path to the second .ordered_group_particles file (e.g. halos). Required.
+        """,
+        required=True,
+    )
+
+    PARSER.add_argument(
+        "-o",
+        "--output",
+        help="""
+        Output filename for the matches. Required.
+        """,
+        required=True,
+    )
+
+    PARSER.add_argument(
+        "-s",
+        "--snapshots",
+        help="""
+        The two snapshot filenames (including .hdf5) that the group files were
+        created from. Only required if they are different snapshots, in which
+        case the particles are matched by ID first. The snapshots must hold the
+        original IDs (i.e. after fix_particle_ids.py); particles whose ID is
+        repeated within either snapshot are left out of the match.
+        """,
+        required=False,
+        nargs=2,
+        default=[None, None],
+    )
+
+    ARGS = vars(PARSER.parse_args())
+
+    load_data_and_write_matches(
+        groups_a_filename=ARGS["groups_a"],
+        groups_b_filename=ARGS["groups_b"],
+        output_filename=ARGS["output"],
+        snapshot_a_filename=ARGS["snapshots"][0],
+        snapshot_b_filename=ARGS["snapshots"][1],
+    )
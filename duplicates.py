@@ -0,0 +1,243 @@
+"""
+An indexed table of the particles with duplicated IDs, written by
+preprocess.py next to the yaml diff as {snapshot}_{extra}.hdf5, so that the
+duplicates (e.g. spawned stars and wind particles) can be looked up without
+loading the snapshot.
+
+The table has one row for every particle whose original ID is shared with
+another particle (including the one that kept the ID), sorted by original ID
+and then position:
+
+    /Duplicates/OriginalID, NewID, ParticleType, Position
+    /Duplicates/GroupID_<catalogue>  (added by postprocess.py)
+
+with an index over the distinct original IDs:
+
+    /DuplicateIDs/OriginalID (sorted), Multiplicity, Offset
+
+so that looking up a set of IDs is a binary search in /DuplicateIDs followed
+by reading their rows.
+
+The smallest and largest ID of each particle type (after the duplicates are
+replaced) are stored as attributes PartTypeX = [min, max] of /ParticleIDRange,
+so that postprocess.py can skip particle types that cannot be in a catalogue
+without reading their IDs.
+"""
+
+import numpy as np
+import h5py
+
+from helper import *
+
+
+def create_duplicate_table(
+    particle_types: list, id_array_list: list, old_position_dict: dict, new_position_dict: dict
+) -> dict:
+    """
+    Creates the table from the IDs of each of the particle types, after the
+    duplicates have been replaced, and the position dictionaries from
+    preprocess.find_and_replace_non_unique_ids (whose positions are in the
+    combined array).
+
+    Returns a dictionary of columns, with the rows under their names and the
+    index under DuplicateIDs/<name>.
+    """
+
+    insertion_points = np.cumsum([0] + [ids.size for ids in id_array_list])
+    id_dtype = np.result_type(*id_array_list) if id_array_list else np.uint64
+
+    replaced_positions = np.fromiter(old_position_dict.keys(), dtype=np.int64)
+    original_ids = np.fromiter(old_position_dict.values(), dtype=id_dtype)
+    new_ids = np.fromiter(
+        (new_position_dict[position] for position in old_position_dict.keys()), dtype=id_dtype
+    )
+
+    duplicated_ids = np.unique(original_ids)
+
+    # The particles that kept their (duplicated) ID; the replacements are all
+    # larger than any original ID, so they are never found here.
+    kept = [is_in_sorted(ids, duplicated_ids) for ids in id_array_list]
+
+    kept_positions = np.concatenate(
+        [np.zeros(0, dtype=np.int64)]
+        + [
+            np.where(mask)[0] + offset
+            for mask, offset in zip(kept, insertion_points[:-1])
+        ]
+    )
+    kept_ids = np.concatenate(
+        [np.zeros(0, dtype=id_dtype)]
+        + [ids[mask] for ids, mask in zip(id_array_list, kept)]
+    )
+
+    return create_duplicate_table_from_rows(
+        particle_types,
+        insertion_points,
+        np.concatenate([kept_positions, replaced_positions]),
+        np.concatenate([kept_ids, original_ids]),
+        np.concatenate([kept_ids, new_ids]),
+    )
+
+
+def create_duplicate_table_from_rows(
+    particle_types: list,
+    insertion_points: np.array,
+    positions: np.array,
+    original: np.array,
+    new: np.array,
+) -> dict:
+    """
+    Creates the table from its rows, in any order: the positions (in the
+    combined array, with the boundaries between the particle types at
+    insertion_points), original IDs and new IDs of the particles.
+    """
+
+    insertion_points = np.asarray(insertion_points, dtype=np.int64)
+
+    order = np.lexsort((positions, original))
+    positions = positions[order]
+
+    type_index = np.searchsorted(insertion_points, positions, side="right") - 1
+
+    unique_ids, offsets, multiplicity = np.unique(
+        original[order], return_index=True, return_counts=True
+    )
+
+    return {
+        "OriginalID": original[order],
+        "NewID": new[order],
+        "ParticleType": np.array(particle_types, dtype=np.int8)[type_index],
+        "Position": positions - insertion_points[type_index],
+        "DuplicateIDs/OriginalID": unique_ids,
+        "DuplicateIDs/Multiplicity": multiplicity.astype(np.int32),
+        "DuplicateIDs/Offset": offsets.astype(np.int64),
+    }
+
+
+def calculate_particle_id_ranges(particle_types: list, id_array_list: list) -> dict:
+    """
+    The smallest and largest ID of each particle type that has any particles,
+    as {ptype: (min, max)}.
+    """
+
+    return {
+        ptype: (ids.min(), ids.max())
+        for ptype, ids in zip(particle_types, id_array_list)
+        if ids.size > 0
+    }
+
+
+def write_duplicate_table(filename: str, table: dict, particle_id_ranges=None):
+    """
+    Writes the table (see create_duplicate_table) to the HDF5 file at
+    filename, replacing anything already there, along with the ranges of the
+    IDs of each particle type (see calculate_particle_id_ranges), if given.
+    """
+
+    with h5py.File(filename, "w") as handle:
+        for name, column in table.items():
+            if name.startswith("DuplicateIDs/"):
+                handle.create_dataset(name, data=column)
+            else:
+                handle.create_dataset(f"Duplicates/{name}", data=column)
+
+        if particle_id_ranges is not None:
+            ranges = handle.create_group("ParticleIDRange")
+
+            for ptype, id_range in particle_id_ranges.items():
+                ranges.attrs[f"PartType{ptype}"] = np.array(id_range)
+
+    return
+
+
+def read_particle_id_ranges(filename: str):
+    """
+    Reads the ranges of the IDs of each particle type, {ptype: (min, max)},
+    from the table at filename, or None if they were not recorded.
+    """
+
+    with h5py.File(filename, "r") as handle:
+        if "ParticleIDRange" not in handle:
+            return None
+
+        return {
+            int(name[len("PartType") :]): tuple(id_range)
+            for name, id_range in handle["ParticleIDRange"].attrs.items()
+        }
+
+
+def read_duplicate_table(filename: str) -> dict:
+    """
+    Reads the whole table back, in the same form as create_duplicate_table
+    (plus any GroupID columns).
+    """
+
+    table = {}
+
+    with h5py.File(filename, "r") as handle:
+        for name, dataset in handle["Duplicates"].items():
+            table[name] = dataset[...]
+
+        for name, dataset in handle["DuplicateIDs"].items():
+            table[f"DuplicateIDs/{name}"] = dataset[...]
+
+    return table
+
+
+def lookup_duplicates(filename: str, particle_ids: np.array) -> dict:
+    """
+    Looks up the (original) particle IDs in the table at filename, returning
+    the rows for those that were duplicated, as {column: values}. IDs that
+    were not duplicated are ignored.
+    """
+
+    with h5py.File(filename, "r") as handle:
+        index = handle["DuplicateIDs"]
+        duplicated_ids = index["OriginalID"][...]
+
+        particle_ids = np.unique(np.asarray(particle_ids, dtype=duplicated_ids.dtype))
+
+        positions, found = find_in_sorted(particle_ids, duplicated_ids)
+        positions = positions[found]
+
+        offsets = index["Offset"][...][positions]
+        multiplicity = index["Multiplicity"][...][positions]
+
+        # The rows of each ID are consecutive, and the IDs are sorted.
+        output_offsets = np.cumsum(multiplicity) - multiplicity
+        rows = np.arange(multiplicity.sum()) + np.repeat(offsets - output_offsets, multiplicity)
+
+        return {
+            name: dataset[rows] if rows.size > 0 else dataset[0:0]
+            for name, dataset in handle["Duplicates"].items()
+        }
+
+
+def add_groups_to_duplicate_table(filename: str, catalogue: str, groups_snapshot: dict):
+    """
+    Adds (or replaces) the GroupID_<catalogue> column of the table at
+    filename, from the GroupIDs of the snapshot ({ptype: GroupID}) written
+    by postprocess.py. Particles of types that are not in groups_snapshot
+    are given -1.
+    """
+
+    with h5py.File(filename, "r+") as handle:
+        rows = handle["Duplicates"]
+        particle_types = rows["ParticleType"][...]
+        positions = rows["Position"][...]
+
+        dtype = np.result_type(*groups_snapshot.values()) if groups_snapshot else np.int8
+        groups = np.full(positions.shape, -1, dtype=dtype)
+
+        for ptype, particle_groups in groups_snapshot.items():
+            mask = particle_types == ptype
+            groups[mask] = particle_groups[positions[mask]]
+
+        name = f"GroupID_{catalogue}"
+
+        if name in rows:
+            del rows[name]
+
+        rows.create_dataset(name, data=groups)
+
+    return
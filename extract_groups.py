@@ -0,0 +1,413 @@
+"""
+Extracts the particles of a subset of the groups (e.g. the most massive N
+halos or galaxies) from a snapshot into a much smaller file in the same
+format, so that they can be analysed without opening the full snapshot.
+
+The groups are selected using the GroupID arrays written by postprocess.py.
+All of the fields of the selected particles are copied, with the particles of
+each group stored contiguously (largest group first), and an offset table,
+
+    /Groups/GroupID  (the original ID of each extracted group)
+    /Groups/Offset   (shape [number of groups, 6], first particle per type)
+    /Groups/Length   (shape [number of groups, 6], particles per type)
+
+Alongside the snapshot, an ordered_group_particles file for the extracted
+particles is written so that the other scripts can be run on the output.
+
+For usage information, use python3 extract_groups.py -h
+"""
+
+import numpy as np
+import h5py
+
+from typing import Tuple
+
+from helper import *
+from postprocess import InputError, read_ordered_groups_from_file, write_ordered_groups_to_file
+
+# Size of the reads of contiguous datasets, which have no chunks to align to.
+READ_BLOCK_BYTES = 64 * 1024 ** 2
+
+
+def calculate_group_particle_numbers(groups_snapshot: dict) -> np.array:
+    """
+    Counts the particles (of all types) in each group, ignoring particles
+    that are not in a group.
+    """
+
+    number_of_groups = 1 + max(
+        [int(groups.max(initial=-1)) for groups in groups_snapshot.values()] + [-1]
+    )
+
+    group_sizes = np.zeros(number_of_groups, dtype=np.int64)
+
+    for groups in groups_snapshot.values():
+        group_sizes += np.bincount(groups[groups >= 0], minlength=number_of_groups)
+
+    return group_sizes
+
+
+def select_groups(
+    group_sizes: np.array, number=None, minimum_particles=0, group_ids=None
+) -> np.array:
+    """
+    Selects the groups to extract, returning their IDs in the order that they
+    will be stored. Either the given group_ids (in ascending order), or the
+    number largest groups (largest first, ties going to the lowest ID) with at
+    least minimum_particles particles, or all such groups if number is None.
+    """
+
+    if group_ids is not None:
+        group_ids = np.unique(np.array(group_ids, dtype=np.int64))
+
+        if group_ids.size and (group_ids[0] < 0 or group_ids[-1] >= group_sizes.size):
+            raise InputError(
+                f"Group IDs must be between 0 and {group_sizes.size - 1} for this catalogue."
+            )
+
+        return group_ids
+
+    # Stable, so that equal sizes keep ascending IDs.
+    order = np.argsort(-group_sizes, kind="stable")
+    order = order[group_sizes[order] >= max(minimum_particles, 1)]
+
+    if number is not None:
+        order = order[:number]
+
+    return order.astype(np.int64)
+
+
+def create_extraction_order(groups: np.array, selected_groups: np.array) -> Tuple[np.array]:
+    """
+    Finds the particles (of one type) that are in the selected groups.
+
+    Returns the positions of those particles in the snapshot (ascending, for
+    reading), the permutation that takes them from that order to the order
+    in which they are stored (grouped by selected_groups, keeping the order
+    of the snapshot within each group), and the number of particles in each
+    selected group.
+    """
+
+    number_of_groups = int(max(groups.max(initial=-1), selected_groups.max(initial=-1))) + 1
+
+    rank = np.full(number_of_groups + 1, -1, dtype=np.int64)
+    rank[selected_groups] = np.arange(selected_groups.size)
+
+    # GroupID -1 (not in a group) picks up the extra -1 at the end of rank.
+    particle_rank = rank[groups]
+
+    positions = np.where(particle_rank >= 0)[0]
+    particle_rank = particle_rank[positions]
+
+    order = np.argsort(particle_rank, kind="stable")
+    lengths = np.bincount(particle_rank, minlength=selected_groups.size)
+
+    return positions, order, lengths
+
+
+def get_rows_per_read(dataset: h5py.Dataset) -> int:
+    """
+    The number of rows in READ_BLOCK_BYTES of dataset, the most that is read
+    in one call.
+    """
+
+    row_bytes = dataset.dtype.itemsize * int(np.prod(dataset.shape[1:]))
+
+    return max(1, READ_BLOCK_BYTES // max(row_bytes, 1))
+
+
+def get_read_block_rows(dataset: h5py.Dataset) -> int:
+    """
+    The number of rows in the blocks that dataset is read in: one chunk for
+    chunked datasets, so that every read decompresses whole chunks exactly
+    once, and READ_BLOCK_BYTES worth otherwise.
+    """
+
+    if dataset.chunks is not None:
+        return dataset.chunks[0]
+
+    return get_rows_per_read(dataset)
+
+
+def gather_rows(dataset: h5py.Dataset, positions: np.array) -> np.array:
+    """
+    Reads the rows of dataset at positions (ascending), using bulk reads of
+    whole blocks aligned to the chunks of the dataset rather than accessing
+    individual particles. Blocks without any of the positions are skipped,
+    and consecutive blocks that are needed are read together.
+    """
+
+    output = np.empty((positions.size,) + dataset.shape[1:], dtype=dataset.dtype)
+
+    if positions.size == 0:
+        return output
+
+    block_rows = get_read_block_rows(dataset)
+    blocks_per_read = max(1, get_rows_per_read(dataset) // block_rows)
+
+    blocks = positions // block_rows
+    needed_blocks, first_in_block = np.unique(blocks, return_index=True)
+
+    # Split the needed blocks into runs of consecutive blocks, each of which
+    # is read with (up to blocks_per_read blocks per) a single call.
+    run_starts = np.where(np.diff(needed_blocks, prepend=needed_blocks[0] - 2) != 1)[0]
+
+    for run_start, run_end in zip(run_starts, list(run_starts[1:]) + [needed_blocks.size]):
+        for read_start in range(run_start, run_end, blocks_per_read):
+            read_end = min(read_start + blocks_per_read, run_end)
+
+            start_row = needed_blocks[read_start] * block_rows
+            end_row = min((needed_blocks[read_end - 1] + 1) * block_rows, dataset.shape[0])
+
+            first = first_in_block[read_start]
+            last = first_in_block[read_end] if read_end < needed_blocks.size else positions.size
+
+            data = dataset[start_row:end_row]
+            output[first:last] = data[positions[first:last] - start_row]
+
+    return output
+
+
+def copy_dataset_subset(
+    source: h5py.Dataset,
+    destination: h5py.Group,
+    positions: np.array,
+    order: np.array,
+):
+    """
+    Copies the rows of source at positions, permuted by order, to a new
+    dataset in destination with the same name, attributes and filters.
+    """
+
+    data = gather_rows(source, positions)[order]
+
+    filters = {}
+
+    if source.chunks is not None and data.shape[0] > 0:
+        filters = dict(
+            chunks=True,
+            compression=source.compression,
+            compression_opts=source.compression_opts,
+            shuffle=source.shuffle,
+            fletcher32=source.fletcher32,
+        )
+
+    name = source.name.split("/")[-1]
+    destination.create_dataset(name, data=data, **filters)
+
+    for key, value in source.attrs.items():
+        destination[name].attrs[key] = value
+
+    return
+
+
+def write_header(source: h5py.File, destination: h5py.File, particle_numbers: np.array):
+    """
+    Copies the header (and any other metadata groups) from source, updating
+    the particle numbers to those of the extracted particles.
+    """
+
+    for name in source.keys():
+        if not name.startswith("PartType"):
+            source.copy(name, destination)
+
+    attributes = destination["Header"].attrs
+
+    for key in ["NumPart_ThisFile", "NumPart_Total"]:
+        if key in attributes:
+            dtype = attributes[key].dtype
+            attributes[key] = (particle_numbers & 0xFFFFFFFF).astype(dtype)
+
+    if "NumPart_Total_HighWord" in attributes:
+        dtype = attributes["NumPart_Total_HighWord"].dtype
+        attributes["NumPart_Total_HighWord"] = (particle_numbers >> 32).astype(dtype)
+
+    if "NumFilesPerSnapshot" in attributes:
+        attributes["NumFilesPerSnapshot"] = 1
+
+    return
+
+
+def extract_groups(
+    snapshot_filename: str,
+    groups_snapshot: dict,
+    selected_groups: np.array,
+    output_filename: str,
+) -> dict:
+    """
+    Writes the particles of the selected_groups (in that order) from the
+    snapshot (including .hdf5) to output_filename, using the GroupID arrays
+    in groups_snapshot ({ptype: GroupID}, as written by postprocess.py).
+
+    Returns the GroupID arrays of the extracted particles.
+    """
+
+    lengths = np.zeros((selected_groups.size, 6), dtype=np.int64)
+    extracted_groups = {}
+
+    with h5py.File(snapshot_filename, "r") as source, h5py.File(
+        output_filename, "w"
+    ) as destination:
+        for ptype in range(6):
+            name = f"PartType{ptype}"
+
+            if name not in source:
+                continue
+
+            groups = groups_snapshot.get(ptype)
+
+            if groups is None:
+                # Not in the catalogue, so none of these are in a group.
+                groups = np.full(source[name]["ParticleIDs"].shape[0], -1, dtype=np.int64)
+
+            positions, order, lengths[:, ptype] = create_extraction_order(
+                groups, selected_groups
+            )
+
+            current_group = destination.create_group(name)
+
+            for dataset in source[name].values():
+                if isinstance(dataset, h5py.Dataset):
+                    copy_dataset_subset(dataset, current_group, positions, order)
+
+            extracted_groups[ptype] = groups[positions][order]
+
+        particle_numbers = lengths.sum(axis=0)
+        write_header(source, destination, particle_numbers)
+
+        offsets = np.cumsum(lengths, axis=0) - lengths
+
+        table = destination.create_group("Groups")
+        table.create_dataset("GroupID", data=selected_groups)
+        table.create_dataset("Offset", data=offsets)
+        table.create_dataset("Length", data=lengths)
+
+    return extracted_groups
+
+
+def load_data_and_extract_groups(
+    snapshot_filename: str,
+    groups_filename: str,
+    output_filename: str,
+    number=None,
+    minimum_particles=0,
+    group_ids=None,
+):
+    """
+    Extracts the selected groups (see select_groups) in the
+    ordered_group_particles file at groups_filename from the snapshot
+    (excluding .hdf5), writing the new snapshot to output_filename (excluding
+    .hdf5) and its groups to output_filename.ordered_group_particles.
+    """
+
+    groups_snapshot = read_ordered_groups_from_file(groups_filename)
+
+    selected_groups = select_groups(
+        calculate_group_particle_numbers(groups_snapshot),
+        number=number,
+        minimum_particles=minimum_particles,
+        group_ids=group_ids,
+    )
+
+    extracted_groups = extract_groups(
+        f"{snapshot_filename}.hdf5",
+        groups_snapshot,
+        selected_groups,
+        f"{output_filename}.hdf5",
+    )
+
+    write_ordered_groups_to_file(
+        f"{output_filename}.ordered_group_particles", extracted_groups
+    )
+
+    return selected_groups
+
+
+if __name__ == "__main__":
+    # Run in script mode!
+    import argparse as ap
+
+    PARSER = ap.ArgumentParser(
+        description="""
+        Extracts all particles in a subset of the groups (by default the
+        largest) from a snapshot into a smaller file of the same format, with
+        the particles of each group stored contiguously and an offset table
+        in /Groups.
+        """
+    )
+
+    PARSER.add_argument(
+        "-s",
+        "--snapshot",
+        help="""
+        Snapshot filename (including path, but excluding .hdf5). Required.
+        """,
+        required=True,
+    )
+
+    PARSER.add_argument(
+        "-g",
+        "--groups",
+        help="""
+        Path to the .ordered_group_particles file for the halos or galaxies.
+        Required.
+        """,
+        required=True,
+    )
+
+    PARSER.add_argument(
+        "-o",
+        "--output",
+        help="""
+        Output snapshot filename (excluding .hdf5). Required.
+        """,
+        required=True,
+    )
+
+    PARSER.add_argument(
+        "-n",
+        "--number",
+        help="""
+        Number of groups to extract, largest first. Default: all groups with
+        at least --min-particles particles.
+        """,
+        required=False,
+        type=int,
+        default=None,
+    )
+
+    PARSER.add_argument(
+        "-m",
+        "--min-particles",
+        help="""
+        Only extract groups with at least this many particles. Default: 0.
+        """,
+        required=False,
+        type=int,
+        default=0,
+    )
+
+    PARSER.add_argument(
+        "-i",
+        "--group-ids",
+        help="""
+        Extract exactly these groups instead (by GroupID).
+        """,
+        required=False,
+        type=int,
+        nargs="+",
+        default=None,
+    )
+
+    ARGS = vars(PARSER.parse_args())
+
+    selected_groups = load_data_and_extract_groups(
+        snapshot_filename=ARGS["snapshot"],
+        groups_filename=ARGS["groups"],
+        output_filename=ARGS["output"],
+        number=ARGS["number"],
+        minimum_particles=ARGS["min_particles"],
+        group_ids=ARGS["group_ids"],
+    )
+
+    print(f"Extracted {selected_groups.size} groups to {ARGS['output']}.hdf5")
@@ -10,6 +10,7 @@ import yaml
 from typing import Tuple
 
 from helper import *
+from checksum import ChecksumError, verify_snapshot
 
 
 def read_yaml_file(filename: str) -> Tuple[dict]:
@@ -21,7 +22,9 @@ def read_yaml_file(filename: str) -> Tuple[dict]:
     """
 
     with open(filename, "r") as file:
-        raw_data = yaml.load(file)
+        # Older versions of preprocess.py wrote numpy scalars, which need
+        # the full loader.
+        raw_data = yaml.load(file, Loader=yaml.Loader)
 
     old_positions = raw_data["old_positions"]
     new_positions = raw_data["new_positions"]
@@ -32,46 +35,93 @@ def read_yaml_file(filename: str) -> Tuple[dict]:
 def recreate_old_array(ids: np.array, old_positions: dict) -> np.array:
     """
     Recreates the old array by performing essentially a find and replace.
+    If there is nothing to replace, ids is returned unchanged.
     """
 
+    if not old_positions:
+        return ids
+
     indices = np.array(list(old_positions.keys()))
     values = np.array(list(old_positions.values()))
 
-    if indices.size == 0:
-        print(
-            "We don't need to fix anything; you never had any duplicated IDs in the first place!"
-        )
-        exit(0)
-    else:
-        ids[indices] = values
+    ids[indices] = values
 
-        return ids
+    return ids
 
 
-def open_fix_and_write(snapshot: str, replaced: str):
+def fix_and_write(
+    snapshot: str,
+    replaced: str,
+    existing_particle_types: list,
+    combined_ids: np.array,
+    insertion_points: np.array,
+    old_positions: dict,
+    verify: bool = True,
+    threads=None,
+) -> StageStatus:
+    """
+    Puts the old IDs (old_positions, as read from the replacement file at
+    replaced) back into combined_ids, the IDs of existing_particle_types
+    combined as by combine_arrays, in place, and writes them to the snapshot.
+
+    If old_positions is empty, nothing is written and
+    StageStatus.NOTHING_TO_DO is returned.
+
+    If verify is true and preprocess.py recorded checksums of the original
+    IDs, the IDs written back are checked against them afterwards, raising
+    a ChecksumError if they differ.
+    """
+
+    if not old_positions:
+        return StageStatus.NOTHING_TO_DO
+
+    old_array = recreate_old_array(combined_ids, old_positions)
+
+    new_id_list = split_arrays(old_array, insertion_points)
+
+    write_all_id_arrays(snapshot, new_id_list, existing_particle_types)
+
+    if verify:
+        verify_snapshot(snapshot, replaced, threads=threads)
+
+    return StageStatus.COMPLETED
+
+
+def open_fix_and_write(
+    snapshot: str, replaced: str, verify: bool = True, threads=None
+) -> StageStatus:
     """
     Takes the two filenames, the snapshot filename and the filename
     of the replacement file (yaml).
 
     This opens those two files and fixes-up the ID array in the original
-    snapshot back to how it originally was.
+    snapshot back to how it originally was (see fix_and_write).
+
+    The replacement file is read first, and if it is empty the snapshot is
+    never opened and StageStatus.NOTHING_TO_DO is returned.
     """
 
+    old_positions, _ = read_yaml_file(replaced)
+
+    if not old_positions:
+        return StageStatus.NOTHING_TO_DO
+
     existing_particle_types, original_id_list = zip(
         *read_particle_ids_from_file(snapshot).items()
     )
 
-    old_positions, _ = read_yaml_file(replaced)
-
     combined_ids, insertion_points = combine_arrays(original_id_list)
 
-    old_array = recreate_old_array(combined_ids, old_positions)
-
-    new_id_list = split_arrays(old_array, insertion_points)
-
-    write_all_id_arrays(snapshot, new_id_list, existing_particle_types)
-
-    return
+    return fix_and_write(
+        snapshot,
+        replaced,
+        existing_particle_types,
+        combined_ids,
+        insertion_points,
+        old_positions,
+        verify=verify,
+        threads=threads,
+    )
 
 
 if __name__ == "__main__":
@@ -113,9 +163,29 @@ if __name__ == "__main__":
         default="duplicated",
     )
 
+    PARSER.add_argument(
+        "--no-verify",
+        help="""
+        Do not check the restored IDs against the checksums recorded by preprocess.py.
+        """,
+        required=False,
+        action="store_true",
+    )
+
     ARGS = vars(PARSER.parse_args())
 
     filename = f"{ARGS['directory']}/{ARGS['input']}.hdf5"
     duplicated_filename = f"{ARGS['directory']}/{ARGS['input']}_{ARGS['output']}.yml"
 
-    open_fix_and_write(filename, duplicated_filename)
+    try:
+        status = open_fix_and_write(
+            filename, duplicated_filename, verify=not ARGS["no_verify"]
+        )
+    except ChecksumError as error:
+        print(error.message)
+        exit(1)
+
+    if status == StageStatus.NOTHING_TO_DO:
+        print(
+            "We don't need to fix anything; you never had any duplicated IDs in the first place!"
+        )
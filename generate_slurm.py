@@ -0,0 +1,501 @@
+"""
+Generates Slurm array jobs that run the pipeline over all of the snapshots
+in a directory, with the memory, cores and wall time of each array estimated
+from the particle numbers in the snapshot headers.
+
+Snapshots are binned by the resources they need, so that small snapshots do
+not have to wait for (and waste) nodes sized for the largest ones. Each bin
+is written as one array job script along with a manifest of its snapshots.
+The tasks run pipeline.py with --resume, so failed or timed-out tasks can
+simply be resubmitted.
+
+The estimates can be calibrated with records of past runs, given as a file
+with one JSON object per line, each containing at least:
+
+    {"number_of_particles": [<NumPart_Total>], "peak_memory_bytes": ...,
+     "wall_time_seconds": ..., "threads": ...}
+
+For usage information, use python3 generate_slurm.py -h
+"""
+
+import os
+import glob
+import json
+import subprocess
+
+import numpy as np
+
+from typing import NamedTuple
+
+from velociraptor_config import (
+    estimate_resources,
+    read_config,
+    read_particle_numbers,
+)
+
+# Memory per particle held by the pipeline itself (the IDs, their index,
+# and the group arrays for both catalogues).
+PIPELINE_BYTES_PER_PARTICLE = 48
+# Time per particle for the python stages (reading, matching and writing).
+PIPELINE_SECONDS_PER_PARTICLE = 5e-7
+
+DEFAULT_COMMAND = (
+    "python3 -u {tools}/pipeline.py -i {snapshot} -d {directory} -t {threads} "
+    "-C {halo_config} -G {galaxy_config} --resume"
+)
+
+
+class TaskResources(NamedTuple):
+    """
+    The resources requested for running the pipeline on one snapshot.
+    """
+
+    snapshot: str
+    threads: int
+    memory_bytes: int
+    wall_time_seconds: int
+
+
+def find_snapshots(directory: str, pattern: str = "*.hdf5") -> list:
+    """
+    Finds the snapshots in directory, i.e. the files matching pattern that
+    have a header with NumPart_Total. Returns their names without the .hdf5.
+    """
+
+    snapshots = []
+
+    for filename in sorted(glob.glob(os.path.join(directory, pattern))):
+        try:
+            read_particle_numbers(filename)
+        except (OSError, KeyError):
+            continue
+
+        snapshots.append(os.path.basename(filename)[: -len(".hdf5")])
+
+    return snapshots
+
+
+def read_instrumentation_records(filename: str) -> list:
+    """
+    Reads the records of past runs, one JSON object per line.
+    """
+
+    with open(filename, "r") as handle:
+        return [json.loads(line) for line in handle if line.strip()]
+
+
+def calibrate(records: list, configs: list, maximum_threads: int) -> tuple:
+    """
+    Compares the records of past runs with what estimate_task would have
+    predicted for them, returning the factors (for memory and wall time) to
+    scale the estimates by. These are the largest measured/estimated ratios,
+    so that the calibrated estimates would have covered every past run.
+    Without any records both factors are 1.
+    """
+
+    memory_factor = 1.0
+    time_factor = 1.0
+
+    for record in records:
+        estimate = estimate_task(
+            "",
+            np.array(record["number_of_particles"], dtype=np.int64),
+            configs,
+            record.get("threads", maximum_threads),
+        )
+
+        if "peak_memory_bytes" in record:
+            memory_factor = max(
+                memory_factor, record["peak_memory_bytes"] / estimate.memory_bytes
+            )
+
+        if "wall_time_seconds" in record:
+            time_factor = max(
+                time_factor, record["wall_time_seconds"] / estimate.wall_time_seconds
+            )
+
+    return memory_factor, time_factor
+
+
+def estimate_task(
+    snapshot: str,
+    particle_numbers: np.array,
+    configs: list,
+    maximum_threads: int,
+    memory_factor: float = 1.0,
+    time_factor: float = 1.0,
+) -> TaskResources:
+    """
+    Estimates the resources for running the pipeline on one snapshot, with a
+    VELOCIraptor run for each of configs (as read by read_config). The runs
+    happen one after the other, so the memory is that of the largest run,
+    and the time is the sum of all of them.
+    """
+
+    estimates = [
+        estimate_resources(particle_numbers, config, maximum_threads=maximum_threads)
+        for config in configs
+    ]
+
+    number_of_particles = int(np.sum(particle_numbers))
+
+    memory_bytes = max(
+        [estimate.memory_bytes for estimate in estimates]
+        + [PIPELINE_BYTES_PER_PARTICLE * number_of_particles]
+    )
+
+    wall_time_seconds = sum(estimate.wall_time_seconds for estimate in estimates) + (
+        PIPELINE_SECONDS_PER_PARTICLE * number_of_particles
+    )
+
+    return TaskResources(
+        snapshot=snapshot,
+        threads=max(estimate.threads for estimate in estimates),
+        memory_bytes=int(memory_bytes * memory_factor),
+        wall_time_seconds=int(wall_time_seconds * time_factor),
+    )
+
+
+def bin_tasks(tasks: list, number_of_bins: int) -> list:
+    """
+    Splits the tasks into at most number_of_bins bins of similar memory
+    requirements (equal numbers of tasks, in order of memory). Returns a
+    list of lists of tasks.
+    """
+
+    if not tasks:
+        return []
+
+    ordered = sorted(tasks, key=lambda task: (task.memory_bytes, task.wall_time_seconds))
+
+    number_of_bins = min(number_of_bins, len(ordered))
+    boundaries = np.linspace(0, len(ordered), number_of_bins + 1).astype(int)
+
+    return [ordered[start:end] for start, end in zip(boundaries[:-1], boundaries[1:])]
+
+
+def format_slurm_time(seconds: int) -> str:
+    """
+    Formats seconds as a Slurm time limit, D-HH:MM:SS.
+    """
+
+    seconds = int(np.ceil(seconds))
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+
+    return f"{days}-{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+
+def render_array_script(
+    job_name: str,
+    manifest_filename: str,
+    tasks: list,
+    directory: str,
+    tools_directory: str,
+    config_filenames: list,
+    command: str = DEFAULT_COMMAND,
+    partition=None,
+    account=None,
+) -> str:
+    """
+    Renders the Slurm array job script for the tasks (all from the same bin)
+    whose snapshots are listed, one per line, in manifest_filename. Every
+    task requests the largest resources in the bin.
+
+    The command is formatted with {snapshot}, {directory}, {threads},
+    {tools}, {halo_config} and {galaxy_config}, the last two being the
+    filenames in config_filenames (the same configurations that the tasks
+    were estimated for; galaxy_config is none if there is only one). The
+    snapshot is read from the manifest at run time.
+    """
+
+    if len(config_filenames) not in [1, 2]:
+        raise ValueError("Give one halo and at most one galaxy configuration file.")
+
+    halo_config, galaxy_config = (list(config_filenames) + ["none"])[:2]
+
+    threads = max(task.threads for task in tasks)
+    memory_gigabytes = int(np.ceil(max(task.memory_bytes for task in tasks) / 1024 ** 3))
+    wall_time = format_slurm_time(max(task.wall_time_seconds for task in tasks))
+
+    lines = [
+        "#!/bin/bash",
+        "",
+        "# Generated by generate_slurm.py",
+        f"#SBATCH -J {job_name}",
+        "#SBATCH -N 1",
+        "#SBATCH -n 1",
+        f"#SBATCH --cpus-per-task={threads}",
+        f"#SBATCH --mem={memory_gigabytes}G",
+        f"#SBATCH -t {wall_time}",
+        f"#SBATCH --array=0-{len(tasks) - 1}",
+        f"#SBATCH -o {job_name}_%A_%a.out",
+        f"#SBATCH -e {job_name}_%A_%a.err",
+    ]
+
+    if partition is not None:
+        lines.append(f"#SBATCH -p {partition}")
+
+    if account is not None:
+        lines.append(f"#SBATCH -A {account}")
+
+    lines += [
+        "",
+        "set -e",
+        "",
+        f'snapname=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" {manifest_filename})',
+        "",
+        command.format(
+            snapshot="$snapname",
+            directory=directory,
+            threads=threads,
+            tools=tools_directory,
+            halo_config=halo_config,
+            galaxy_config=galaxy_config,
+        ),
+        "",
+    ]
+
+    return "\n".join(lines)
+
+
+def generate_array_jobs(
+    directory: str,
+    output_directory: str,
+    tools_directory: str,
+    config_filenames: list,
+    number_of_bins: int = 1,
+    maximum_threads: int = 16,
+    records=None,
+    job_name: str = "SIMBA-VELOCIRAPTOR",
+    command: str = DEFAULT_COMMAND,
+    partition=None,
+    account=None,
+    pattern: str = "*.hdf5",
+) -> list:
+    """
+    Scans directory for snapshots, estimates the resources for each (with
+    config_filenames the VELOCIraptor configuration files that the tasks run,
+    the halo one first, and records the records of past runs, if any), bins
+    them, and writes one array job script and manifest per bin to
+    output_directory.
+
+    Returns the filenames of the scripts, along with the tasks in each, as a
+    list of (script filename, tasks).
+    """
+
+    configs = [read_config(filename) for filename in config_filenames]
+
+    memory_factor, time_factor = calibrate(records or [], configs, maximum_threads)
+
+    tasks = [
+        estimate_task(
+            snapshot,
+            read_particle_numbers(os.path.join(directory, f"{snapshot}.hdf5")),
+            configs,
+            maximum_threads,
+            memory_factor=memory_factor,
+            time_factor=time_factor,
+        )
+        for snapshot in find_snapshots(directory, pattern)
+    ]
+
+    os.makedirs(output_directory, exist_ok=True)
+
+    jobs = []
+
+    for index, bin in enumerate(bin_tasks(tasks, number_of_bins)):
+        name = f"{job_name}_{index}"
+
+        manifest_filename = os.path.abspath(
+            os.path.join(output_directory, f"{name}.manifest")
+        )
+        script_filename = os.path.join(output_directory, f"{name}.slurm")
+
+        with open(manifest_filename, "w") as handle:
+            handle.writelines(f"{task.snapshot}\n" for task in bin)
+
+        with open(script_filename, "w") as handle:
+            handle.write(
+                render_array_script(
+                    name,
+                    manifest_filename,
+                    bin,
+                    directory=directory,
+                    tools_directory=tools_directory,
+                    config_filenames=config_filenames,
+                    command=command,
+                    partition=partition,
+                    account=account,
+                )
+            )
+
+        jobs.append((script_filename, bin))
+
+    return jobs
+
+
+def run_task_locally(script_filename: str, task_id: int, environment=None):
+    """
+    Runs one task of an array job script through the local shell, as Slurm
+    would, for testing. Returns the subprocess.CompletedProcess.
+    """
+
+    task_environment = dict(os.environ)
+    task_environment.update(
+        {
+            "SLURM_ARRAY_TASK_ID": str(task_id),
+            "SLURM_ARRAY_JOB_ID": "local",
+            "SLURM_JOB_ID": "local",
+        }
+    )
+
+    if environment is not None:
+        task_environment.update(environment)
+
+    return subprocess.run(
+        ["bash", script_filename],
+        env=task_environment,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+
+
+if __name__ == "__main__":
+    # Run in script mode!
+    import argparse as ap
+
+    PARSER = ap.ArgumentParser(
+        description="""
+        Generates Slurm array jobs that run the pipeline on every snapshot in a
+        directory, with the resources for each estimated from the snapshot
+        headers (and, optionally, calibrated with records of past runs).
+        Snapshots are binned by size, with one array job per bin.
+        """
+    )
+
+    PARSER.add_argument(
+        "-d",
+        "--directory",
+        help="""
+        Directory that the snapshots and halos should live in. Required.
+        """,
+        required=True,
+    )
+
+    PARSER.add_argument(
+        "-o",
+        "--output",
+        help="""
+        Directory to write the job scripts and manifests to. Default: ./jobs
+        """,
+        required=False,
+        default="jobs",
+    )
+
+    PARSER.add_argument(
+        "-T",
+        "--tools",
+        help="""
+        Path to this toolkit, as seen from the compute nodes. Defaults to the
+        directory that this script is in.
+        """,
+        required=False,
+        default=os.path.dirname(os.path.abspath(__file__)),
+    )
+
+    PARSER.add_argument(
+        "-C",
+        "--config",
+        help="""
+        Velociraptor configuration files that each task runs: the halo one and,
+        optionally, the galaxy one. They must be readable at the same path from
+        the compute nodes. Default: velociraptor.cfg velociraptor_galaxy.cfg
+        """,
+        required=False,
+        nargs="+",
+        default=["velociraptor.cfg", "velociraptor_galaxy.cfg"],
+    )
+
+    PARSER.add_argument(
+        "-b",
+        "--bins",
+        help="""
+        Number of size bins (i.e. array jobs) to split the snapshots into. Default: 3
+        """,
+        required=False,
+        type=int,
+        default=3,
+    )
+
+    PARSER.add_argument(
+        "-t",
+        "--max-threads",
+        help="""
+        Maximal number of cores per task. Default: 16
+        """,
+        required=False,
+        type=int,
+        default=16,
+    )
+
+    PARSER.add_argument(
+        "-r",
+        "--records",
+        help="""
+        File of records of past runs (one JSON object per line) to calibrate
+        the estimates with.
+        """,
+        required=False,
+        default=None,
+    )
+
+    PARSER.add_argument(
+        "-p",
+        "--partition",
+        help="""
+        Slurm partition to submit to. Optional.
+        """,
+        required=False,
+        default=None,
+    )
+
+    PARSER.add_argument(
+        "-A",
+        "--account",
+        help="""
+        Slurm account to charge. Optional.
+        """,
+        required=False,
+        default=None,
+    )
+
+    PARSER.add_argument(
+        "-J",
+        "--job-name",
+        help="Name of the jobs. Default: SIMBA-VELOCIRAPTOR",
+        required=False,
+        default="SIMBA-VELOCIRAPTOR",
+    )
+
+    ARGS = vars(PARSER.parse_args())
+
+    jobs = generate_array_jobs(
+        directory=os.path.abspath(ARGS["directory"]),
+        output_directory=ARGS["output"],
+        tools_directory=ARGS["tools"],
+        config_filenames=[os.path.abspath(config) for config in ARGS["config"]],
+        number_of_bins=ARGS["bins"],
+        maximum_threads=ARGS["max_threads"],
+        records=None
+        if ARGS["records"] is None
+        else read_instrumentation_records(ARGS["records"]),
+        job_name=ARGS["job_name"],
+        partition=ARGS["partition"],
+        account=ARGS["account"],
+    )
+
+    for script_filename, tasks in jobs:
+        print(f"sbatch {script_filename}  # {len(tasks)} snapshots")
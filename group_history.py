@@ -0,0 +1,500 @@
+"""
+Builds a single store of the group (halo and galaxy) of every particle at
+every snapshot, so that the history of a particle can be read without
+opening and matching each snapshot in turn.
+
+Particles are identified across snapshots by a stable key made from their
+original ID and, for SIMBA's duplicated IDs, a copy index:
+
+    key = original ID << 16 | copy index
+
+where the copy index is the rank of the particle among those sharing its
+original ID, ordered by particle type and then position (so a gas particle
+comes before the star spawned from it). The original IDs and copy indices
+are read from the table of duplicated particles written by preprocess.py
+(see duplicates.py), so the keys are the same whether or not the IDs in the
+snapshot have been restored.
+
+The store holds
+
+    /ParticleKey                (particles, in the order they were added)
+    /SortedOrder                (the order that sorts ParticleKey)
+    /Snapshots                  (the name of each column)
+    /GroupID_<catalogue>        (particles x snapshots)
+
+with GroupIDs of -1 for particles that are not in a group and MISSING for
+those that are not in that snapshot. Each snapshot is appended as one
+column; particles seen for the first time are added as new rows. The
+GroupID datasets are chunked as blocks of HISTORY_CHUNK_ROWS particles by
+HISTORY_CHUNK_SNAPSHOTS snapshots, so that one particle's whole history is
+read from a handful of small chunks.
+
+For usage information, use python3 group_history.py -h
+"""
+
+import os
+import numpy as np
+import h5py
+
+from helper import *
+from duplicates import read_duplicate_table
+from postprocess import read_ordered_groups_from_file
+
+# GroupID of particles that are not in a snapshot.
+MISSING = -2
+
+COPY_BITS = 16
+
+HISTORY_CHUNK_ROWS = 1024
+HISTORY_CHUNK_SNAPSHOTS = 64
+
+# Rows of a column written at once when appending a snapshot.
+APPEND_BLOCK_ROWS = 256 * HISTORY_CHUNK_ROWS
+
+
+class HistoryError(Exception):
+    """Exception raised for particles that cannot be given a stable key.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+
+def make_particle_keys(particle_ids: np.array, copy_indices=0) -> np.array:
+    """
+    Combines the original particle IDs and copy indices into keys.
+    """
+
+    particle_ids = np.asarray(particle_ids).astype(np.uint64)
+    copy_indices = np.broadcast_to(
+        np.asarray(copy_indices, dtype=np.uint64), particle_ids.shape
+    )
+
+    if particle_ids.size and particle_ids.max() >> np.uint64(64 - COPY_BITS):
+        raise HistoryError(f"Particle IDs must be below 2^{64 - COPY_BITS} to be keyed.")
+
+    if copy_indices.size and copy_indices.max() >> np.uint64(COPY_BITS):
+        raise HistoryError(f"Particle IDs may be shared by at most 2^{COPY_BITS} particles.")
+
+    return (particle_ids << np.uint64(COPY_BITS)) | copy_indices
+
+
+def split_particle_keys(keys: np.array):
+    """
+    The original particle IDs and copy indices of the keys.
+    """
+
+    keys = np.asarray(keys, dtype=np.uint64)
+
+    return keys >> np.uint64(COPY_BITS), keys & np.uint64((1 << COPY_BITS) - 1)
+
+
+def rank_within_duplicates(particle_ids: np.array) -> np.array:
+    """
+    The copy index of each of particle_ids: the number of earlier particles
+    with the same ID.
+    """
+
+    order = np.argsort(particle_ids, kind="stable")
+    sorted_ids = particle_ids[order]
+
+    starts = np.concatenate([[True], sorted_ids[1:] != sorted_ids[:-1]])
+    run_starts = np.maximum.accumulate(np.where(starts, np.arange(sorted_ids.size), 0))
+
+    copy_indices = np.empty(particle_ids.size, dtype=np.int64)
+    copy_indices[order] = np.arange(sorted_ids.size) - run_starts
+
+    return copy_indices
+
+
+def create_particle_keys(particle_ids_snapshot: dict, duplicate_table=None) -> dict:
+    """
+    Creates the key of every particle in the snapshot ({ptype: ParticleIDs},
+    as they currently are in the file).
+
+    If duplicate_table (the file written by preprocess.py) is given, the
+    original IDs and copy indices of the duplicated particles are taken from
+    it; otherwise the IDs are assumed to be the original ones and ranked.
+    """
+
+    particle_types = sorted(particle_ids_snapshot.keys())
+
+    if duplicate_table is None:
+        particle_ids, insertion_points = combine_arrays(
+            [np.asarray(particle_ids_snapshot[ptype]) for ptype in particle_types]
+        )
+        keys = make_particle_keys(particle_ids, rank_within_duplicates(particle_ids))
+
+        return dict(zip(particle_types, split_arrays(keys, insertion_points)))
+
+    table = read_duplicate_table(duplicate_table)
+
+    # Rows are sorted by original ID then by type and position, so the copy
+    # index is the row within the ID's block.
+    copy_indices = np.arange(table["OriginalID"].size) - np.repeat(
+        table["DuplicateIDs/Offset"], table["DuplicateIDs/Multiplicity"]
+    )
+
+    keys = {}
+
+    for ptype in particle_types:
+        particle_ids = np.array(particle_ids_snapshot[ptype], dtype=np.uint64)
+        copies = np.zeros(particle_ids.size, dtype=np.int64)
+
+        rows = table["ParticleType"] == ptype
+        positions = table["Position"][rows]
+
+        particle_ids[positions] = table["OriginalID"][rows]
+        copies[positions] = copy_indices[rows]
+
+        keys[ptype] = make_particle_keys(particle_ids, copies)
+
+    return keys
+
+
+def create_history_file(filename: str):
+    """
+    Creates an empty store at filename.
+    """
+
+    with h5py.File(filename, "w") as handle:
+        for name, dtype in [("ParticleKey", np.uint64), ("SortedOrder", np.int64)]:
+            handle.create_dataset(
+                name,
+                shape=(0,),
+                maxshape=(None,),
+                dtype=dtype,
+                chunks=(APPEND_BLOCK_ROWS,),
+                compression="gzip",
+                shuffle=True,
+            )
+
+        handle.create_dataset(
+            "Snapshots",
+            shape=(0,),
+            maxshape=(None,),
+            dtype=h5py.string_dtype(),
+            chunks=(HISTORY_CHUNK_SNAPSHOTS,),
+        )
+
+    return
+
+
+def get_history_dataset(handle: h5py.File, catalogue: str) -> h5py.Dataset:
+    """
+    The GroupID dataset for the catalogue, created (with every entry
+    MISSING) if it does not exist yet.
+    """
+
+    name = f"GroupID_{catalogue}"
+
+    if name not in handle:
+        handle.create_dataset(
+            name,
+            shape=(handle["ParticleKey"].shape[0], handle["Snapshots"].shape[0]),
+            maxshape=(None, None),
+            dtype=np.int32,
+            chunks=(HISTORY_CHUNK_ROWS, HISTORY_CHUNK_SNAPSHOTS),
+            fillvalue=MISSING,
+            compression="gzip",
+            shuffle=True,
+        )
+
+    return handle[name]
+
+
+def find_rows(handle: h5py.File, keys: np.array) -> np.array:
+    """
+    The rows of the store that hold the keys, or -1 for those that it does
+    not have.
+    """
+
+    stored_keys = handle["ParticleKey"][...]
+    order = handle["SortedOrder"][...]
+
+    rows = np.full(keys.size, -1, dtype=np.int64)
+
+    positions, found = find_in_sorted(keys, stored_keys[order])
+    rows[found] = order[positions[found]]
+
+    return rows
+
+
+def append_snapshot(
+    filename: str,
+    snapshot_name: str,
+    keys_snapshot: dict,
+    catalogues: dict,
+    block_rows: int = APPEND_BLOCK_ROWS,
+):
+    """
+    Adds the column for snapshot_name to the store at filename (created if
+    needed), or replaces it if the snapshot has been added before.
+
+    keys_snapshot ({ptype: keys}, see create_particle_keys) identifies the
+    particles, and catalogues ({catalogue: {ptype: GroupID}}) gives their
+    groups. Particles of types without GroupIDs in a catalogue are given -1.
+    The column is written block_rows rows at a time.
+    """
+
+    particle_types = sorted(keys_snapshot.keys())
+
+    keys, insertion_points = combine_arrays([keys_snapshot[ptype] for ptype in particle_types])
+
+    if np.unique(keys).size != keys.size:
+        raise HistoryError(f"The particle keys of {snapshot_name} are not unique.")
+
+    if not os.path.exists(filename):
+        create_history_file(filename)
+
+    with h5py.File(filename, "r+") as handle:
+        snapshots = list(handle["Snapshots"].asstr()[...])
+
+        if snapshot_name in snapshots:
+            column = snapshots.index(snapshot_name)
+        else:
+            column = len(snapshots)
+            handle["Snapshots"].resize((column + 1,))
+            handle["Snapshots"][column] = snapshot_name
+
+        rows = find_rows(handle, keys)
+
+        new = rows < 0
+        number_of_rows = handle["ParticleKey"].shape[0]
+
+        if new.any():
+            rows[new] = number_of_rows + np.arange(new.sum())
+            number_of_rows += int(new.sum())
+
+            stored_keys = np.concatenate([handle["ParticleKey"][...], keys[new]])
+
+            for name, data in [
+                ("ParticleKey", stored_keys),
+                ("SortedOrder", np.argsort(stored_keys, kind="stable")),
+            ]:
+                handle[name].resize((number_of_rows,))
+                handle[name][...] = data
+
+        for catalogue, groups_snapshot in catalogues.items():
+            dataset = get_history_dataset(handle, catalogue)
+            dataset.resize((number_of_rows, max(dataset.shape[1], column + 1)))
+
+            groups = np.full(keys.size, -1, dtype=np.int32)
+
+            for index, ptype in enumerate(particle_types):
+                if ptype in groups_snapshot:
+                    start, end = insertion_points[index], insertion_points[index + 1]
+                    groups[start:end] = groups_snapshot[ptype]
+
+            values = np.full(number_of_rows, MISSING, dtype=np.int32)
+            values[rows] = groups
+
+            for start in range(0, number_of_rows, block_rows):
+                dataset[start : start + block_rows, column] = values[start : start + block_rows]
+
+        # Catalogues that were not given for this snapshot need to grow too.
+        for name in handle.keys():
+            if name.startswith("GroupID_"):
+                dataset = handle[name]
+                dataset.resize((number_of_rows, max(dataset.shape[1], column + 1)))
+
+    return
+
+
+def read_particle_history(filename: str, keys: np.array) -> dict:
+    """
+    Reads the history of the particles with the given keys (see
+    make_particle_keys) from the store at filename.
+
+    Returns {catalogue: GroupIDs (keys x snapshots)}, with the snapshot names
+    under "Snapshots". Keys that are not in the store have a history of
+    MISSING.
+    """
+
+    keys = np.asarray(keys, dtype=np.uint64)
+
+    with h5py.File(filename, "r") as handle:
+        rows = find_rows(handle, keys)
+        found = rows >= 0
+
+        # h5py needs increasing (and unique) rows.
+        unique_rows, inverse = np.unique(rows[found], return_inverse=True)
+
+        history = {"Snapshots": list(handle["Snapshots"].asstr()[...])}
+
+        for name, dataset in handle.items():
+            if not name.startswith("GroupID_"):
+                continue
+
+            values = np.full((keys.size, dataset.shape[1]), MISSING, dtype=dataset.dtype)
+
+            if unique_rows.size > 0:
+                values[found] = dataset[unique_rows, :][inverse]
+
+            history[name[len("GroupID_") :]] = values
+
+    return history
+
+
+def load_data_and_append_snapshot(
+    history_filename: str,
+    snapshot_filename: str,
+    catalogue_paths: dict,
+    duplicate_table=None,
+    snapshot_name=None,
+):
+    """
+    Appends the snapshot (excluding .hdf5) to the store at history_filename,
+    with the groups from the ordered_group_particles files of the catalogues
+    ({catalogue: path excluding .ordered_group_particles}) and the table of
+    duplicated particles, if given. The column is named snapshot_name
+    (default: the name of the snapshot file).
+    """
+
+    if snapshot_name is None:
+        snapshot_name = os.path.basename(snapshot_filename)
+
+    keys_snapshot = create_particle_keys(
+        LazyParticleIDs(f"{snapshot_filename}.hdf5"), duplicate_table
+    )
+
+    catalogues = {
+        catalogue: read_ordered_groups_from_file(f"{path}.ordered_group_particles")
+        for catalogue, path in catalogue_paths.items()
+    }
+
+    append_snapshot(history_filename, snapshot_name, keys_snapshot, catalogues)
+
+    return
+
+
+if __name__ == "__main__":
+    import argparse as ap
+
+    PARSER = ap.ArgumentParser(
+        description="""
+        Appends snapshots to a store of the group of every particle at every
+        snapshot, keyed by the original particle IDs, or prints the history of
+        some particles from it.
+        """
+    )
+
+    PARSER.add_argument(
+        "-H",
+        "--history",
+        help="""
+        The history store (created if it does not exist). Required.
+        """,
+        required=True,
+    )
+
+    PARSER.add_argument(
+        "-i",
+        "--input",
+        help="""
+        Snapshot filenames, WITHOUT the .hdf5, to append in turn.
+        """,
+        required=False,
+        nargs="+",
+        default=[],
+    )
+
+    PARSER.add_argument(
+        "-d",
+        "--directory",
+        help="""
+        Directory that the snapshots and halos live in. Default: .
+        """,
+        required=False,
+        default=".",
+    )
+
+    PARSER.add_argument(
+        "-c",
+        "--catalogues",
+        help="""
+        Names of the catalogues (i.e. the directories that they exist in) to store.
+        Default: halo galaxy
+        """,
+        required=False,
+        nargs="+",
+        default=["halo", "galaxy"],
+    )
+
+    PARSER.add_argument(
+        "--duplicates",
+        help="""
+        Extra string on the filename of the table of duplicated particles written
+        by preprocess.py. Default: duplicated
+        """,
+        required=False,
+        default="duplicated",
+    )
+
+    PARSER.add_argument(
+        "-q",
+        "--query",
+        help="""
+        Print the history of the particles with these (original) IDs.
+        """,
+        required=False,
+        type=int,
+        nargs="+",
+        default=None,
+    )
+
+    PARSER.add_argument(
+        "--copy",
+        help="""
+        The copy index of the queried particles, for IDs that are shared by
+        several particles (0 is the first by type and position). Default: 0
+        """,
+        required=False,
+        type=int,
+        default=0,
+    )
+
+    ARGS = vars(PARSER.parse_args())
+
+    for input in ARGS["input"]:
+        catalogue_paths = {
+            catalogue: f"{ARGS['directory']}/{catalogue}/{input}"
+            for catalogue in ARGS["catalogues"]
+            if os.path.exists(
+                f"{ARGS['directory']}/{catalogue}/{input}.ordered_group_particles"
+            )
+        }
+
+        duplicate_table = f"{ARGS['directory']}/{input}_{ARGS['duplicates']}.hdf5"
+
+        load_data_and_append_snapshot(
+            ARGS["history"],
+            f"{ARGS['directory']}/{input}",
+            catalogue_paths,
+            duplicate_table=duplicate_table if os.path.exists(duplicate_table) else None,
+            snapshot_name=input,
+        )
+
+        print(f"Appended {input} ({', '.join(catalogue_paths.keys())})")
+
+    if ARGS["query"] is not None:
+        history = read_particle_history(
+            ARGS["history"], make_particle_keys(ARGS["query"], ARGS["copy"])
+        )
+
+        snapshots = history.pop("Snapshots")
+
+        for index, particle_id in enumerate(ARGS["query"]):
+            print(f"Particle {particle_id}:")
+
+            for catalogue, values in history.items():
+                print(
+                    f"  {catalogue}: "
+                    + " ".join(
+                        f"{snapshot}={value}"
+                        for snapshot, value in zip(snapshots, values[index])
+                    )
+                )
@@ -3,11 +3,30 @@ Some helper functions that deal with the splitting and re-forming
 of particle ID arrays.
 """
 
+import os
+import tempfile
 import numpy as np
 import h5py
 
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from enum import Enum
+from multiprocessing import get_context
 from typing import Tuple
 
+# Rows compared (and, if they differ, written) at once by patch_dataset for
+# contiguous datasets.
+PATCH_BLOCK_ROWS = 1 << 20
+
+
+class StageStatus(Enum):
+    """
+    The outcome of running one of the stages (preprocess, fix-up, etc.).
+    """
+
+    COMPLETED = "completed"
+    NOTHING_TO_DO = "nothing to do"
+
 
 def combine_arrays(id_array_list: list) -> Tuple[np.ndarray, list]:
     """
@@ -41,7 +60,393 @@ def split_arrays(id_array: np.array, insertion_points: list) -> list:
     return id_array_list
 
 
-def read_particle_ids_from_file(filename: str) -> dict:
+def find_in_sorted(ids: np.array, sorted_ids: np.array) -> Tuple[np.array, np.array]:
+    """
+    Finds each of ids in sorted_ids with a binary search, returning their
+    positions in sorted_ids and whether they were found. The positions of the
+    ids that were not found are meaningless (but valid indices).
+    """
+
+    if sorted_ids.size == 0:
+        return np.zeros(ids.shape, dtype=np.int64), np.zeros(ids.shape, dtype=bool)
+
+    positions = np.searchsorted(sorted_ids, ids)
+    positions[positions == sorted_ids.size] = 0
+
+    return positions, sorted_ids[positions] == ids
+
+
+def is_in_sorted(ids: np.array, sorted_ids: np.array) -> np.array:
+    """
+    Whether each of ids is in sorted_ids, with a binary search (which is much
+    cheaper than np.isin when sorted_ids is small).
+    """
+
+    return find_in_sorted(ids, sorted_ids)[1]
+
+
+def contiguous_dataset_offset(dataset: h5py.Dataset):
+    """
+    Returns the offset (in bytes) of the raw data of dataset within its file,
+    if it can be memory-mapped directly. This is only the case for datasets
+    that are contiguous (and hence uncompressed), already allocated, stored in
+    the file itself, and of a plain numeric type. Returns None otherwise.
+    """
+
+    if dataset.id.get_create_plist().get_layout() != h5py.h5d.CONTIGUOUS:
+        return None
+
+    if dataset.external is not None or dataset.dtype.kind not in "biuf":
+        return None
+
+    # This is None for datasets that have not had any storage allocated.
+    return dataset.id.get_offset()
+
+
+def memmap_dataset(dataset: h5py.Dataset, mode: str = "r"):
+    """
+    Returns an np.memmap view of dataset, without copying anything into
+    memory, or None if the dataset's layout does not allow this (see
+    contiguous_dataset_offset). Use mode="r+" for a writable view.
+    """
+
+    offset = contiguous_dataset_offset(dataset)
+
+    if offset is None:
+        return None
+
+    return np.memmap(
+        dataset.file.filename,
+        dtype=dataset.dtype,
+        mode=mode,
+        offset=offset,
+        shape=dataset.shape,
+    )
+
+
+def get_hyperslabs(dataset: h5py.Dataset, number: int) -> list:
+    """
+    Splits the rows of dataset into (at most) number ranges of about the same
+    size, as (start, end) pairs, with boundaries on chunk boundaries for
+    chunked datasets.
+    """
+
+    rows = dataset.shape[0]
+    unit = dataset.chunks[0] if dataset.chunks is not None else 1
+    units = -(-rows // unit)
+
+    boundaries = np.unique(np.linspace(0, units, max(number, 1) + 1).astype(np.int64))
+    boundaries = np.minimum(boundaries * unit, rows)
+
+    return [
+        (int(start), int(end)) for start, end in zip(boundaries[:-1], boundaries[1:]) if end > start
+    ]
+
+
+def get_row_bytes(dataset) -> int:
+    return dataset.dtype.itemsize * int(np.prod(dataset.shape[1:]))
+
+
+def transfer_rows(function, fd: int, buffer: memoryview, offset: int):
+    """
+    Calls function (os.preadv or os.pwritev) until all of buffer has been
+    read or written at offset in the file.
+    """
+
+    while buffer.nbytes > 0:
+        transferred = function(fd, [buffer], offset)
+
+        if transferred == 0:
+            raise OSError("Unexpected end of file")
+
+        buffer = buffer[transferred:]
+        offset += transferred
+
+    return
+
+
+def read_contiguous_dataset(dataset: h5py.Dataset, workers: int = 1):
+    """
+    Reads a contiguous dataset (see contiguous_dataset_offset) straight from
+    the file into memory, without going through HDF5. Unlike h5py, this does
+    not hold the GIL while waiting for the disk, so it can overlap with work
+    on other threads. Returns None if the layout does not allow this.
+
+    With more than one worker, the dataset is split into that many parts
+    which are read at the same time, on a pool of threads.
+    """
+
+    offset = contiguous_dataset_offset(dataset)
+
+    if offset is None:
+        return None
+
+    data = np.empty(dataset.shape, dtype=dataset.dtype)
+
+    if workers <= 1:
+        with open(dataset.file.filename, "rb") as handle:
+            handle.seek(offset)
+
+            if handle.readinto(memoryview(data).cast("B")) != data.nbytes:
+                raise OSError(f"Unexpected end of file reading {dataset.name}")
+
+        return data
+
+    buffer = memoryview(data).cast("B")
+    row_bytes = get_row_bytes(dataset)
+
+    fd = os.open(dataset.file.filename, os.O_RDONLY)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(
+                    transfer_rows,
+                    os.preadv,
+                    fd,
+                    buffer[start * row_bytes : end * row_bytes],
+                    offset + start * row_bytes,
+                )
+                for start, end in get_hyperslabs(dataset, workers)
+            ]
+
+            for future in futures:
+                future.result()
+    finally:
+        os.close(fd)
+
+    return data
+
+
+def read_hyperslab_into_file(
+    filename: str, name: str, output: str, dtype: str, shape: tuple, start: int, end: int
+):
+    """
+    Reads rows start to end of the dataset name in the HDF5 file into the
+    same rows of the raw array (of dtype and shape) in the file output. This
+    runs in a worker process, with its own HDF5 file handle.
+    """
+
+    with h5py.File(filename, "r") as handle:
+        data = np.memmap(output, dtype=np.dtype(dtype), mode="r+", shape=tuple(shape))
+        handle[name].read_direct(data, np.s_[start:end], np.s_[start:end])
+        data.flush()
+
+    return
+
+
+def read_dataset_parallel(dataset: h5py.Dataset, workers: int) -> np.array:
+    """
+    Reads any dataset (e.g. a chunked, compressed one) with workers processes,
+    each of which reads a chunk-aligned part of the dataset (with its own
+    file handle, as HDF5 only allows one thread in the library at a time)
+    into one array in shared memory.
+    """
+
+    filename = dataset.file.filename
+    shape = dataset.shape
+    dtype = dataset.dtype
+
+    if dataset.size == 0 or workers <= 1:
+        return dataset[...]
+
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    handle, output = tempfile.mkstemp(dir=directory, suffix=".hyperslabs")
+
+    try:
+        os.ftruncate(handle, dtype.itemsize * dataset.size)
+        os.close(handle)
+
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+            futures = [
+                pool.submit(
+                    read_hyperslab_into_file,
+                    filename,
+                    dataset.name,
+                    output,
+                    dtype.str,
+                    shape,
+                    start,
+                    end,
+                )
+                for start, end in get_hyperslabs(dataset, workers)
+            ]
+
+            for future in futures:
+                future.result()
+
+        # The mapping lives on (as long as the array does) after the file is
+        # removed.
+        data = np.memmap(output, dtype=dtype, mode="r+", shape=shape)
+    finally:
+        os.remove(output)
+
+    return data.view(np.ndarray)
+
+
+def write_dataset_parallel(filename: str, name: str, data: np.array, workers: int = 1):
+    """
+    Writes data to the existing dataset name in the HDF5 file. If it is
+    contiguous (and of the same shape), the data is written straight to the
+    file in workers parts at the same time, on a pool of threads; otherwise
+    it is written through h5py.
+    """
+
+    with h5py.File(filename, "r") as handle:
+        dataset = handle[name]
+        offset = contiguous_dataset_offset(dataset)
+        hyperslabs = get_hyperslabs(dataset, workers)
+        row_bytes = get_row_bytes(dataset)
+        compatible = dataset.shape == data.shape
+        dtype = dataset.dtype
+
+    if offset is None or not compatible:
+        with h5py.File(filename, "a") as handle:
+            handle[name][...] = data
+
+        return
+
+    data = np.ascontiguousarray(data, dtype=dtype)
+    buffer = memoryview(data).cast("B")
+
+    fd = os.open(filename, os.O_WRONLY)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            futures = [
+                pool.submit(
+                    transfer_rows,
+                    os.pwritev,
+                    fd,
+                    buffer[start * row_bytes : end * row_bytes],
+                    offset + start * row_bytes,
+                )
+                for start, end in hyperslabs
+            ]
+
+            for future in futures:
+                future.result()
+    finally:
+        os.close(fd)
+
+    return
+
+
+def read_dataset(dataset: h5py.Dataset, mmap: bool = True, workers: int = 1) -> np.array:
+    """
+    Reads the dataset, returning a read-only memory-mapped view if mmap
+    is true and the layout allows it, and falling back to a normal read for
+    chunked or compressed data. With more than one worker, datasets that are
+    read are split into parts that are read at the same time.
+    """
+
+    if mmap:
+        view = memmap_dataset(dataset)
+
+        if view is not None:
+            return view
+    else:
+        data = read_contiguous_dataset(dataset, workers=workers)
+
+        if data is not None:
+            return data
+
+    return read_dataset_parallel(dataset, workers)
+
+
+class LazyParticleIDs(Mapping):
+    """
+    A read-only dictionary of particle IDs, keyed by particle type, that only
+    reads the ParticleIDs for a particle type from the file the first time
+    that it is accessed. The shapes of all of the datasets are available,
+    without reading them, in the shapes attribute.
+    """
+
+    def __init__(
+        self, filename: str, particle_types=None, mmap: bool = True, workers: int = 1
+    ):
+        self.filename = filename
+        self.mmap = mmap
+        self.workers = workers
+        self.shapes = {}
+        self._particle_ids = {}
+
+        with h5py.File(filename, "r") as handle:
+            for ptype in range(6):
+                if particle_types is not None and ptype not in particle_types:
+                    continue
+
+                try:
+                    self.shapes[ptype] = handle[f"/PartType{ptype}/ParticleIDs"].shape
+                except KeyError:
+                    pass
+
+    def __getitem__(self, ptype: int) -> np.array:
+        if ptype not in self.shapes:
+            raise KeyError(ptype)
+
+        if ptype not in self._particle_ids:
+            with h5py.File(self.filename, "r") as handle:
+                self._particle_ids[ptype] = read_dataset(
+                    handle[f"/PartType{ptype}/ParticleIDs"], mmap=self.mmap, workers=self.workers
+                )
+
+        return self._particle_ids[ptype]
+
+    def __iter__(self):
+        return iter(self.shapes)
+
+    def __len__(self) -> int:
+        return len(self.shapes)
+
+    def is_loaded(self, ptype: int) -> bool:
+        """
+        Whether the IDs for ptype have already been read from file.
+        """
+
+        return ptype in self._particle_ids
+
+    def load(self, particle_types=None):
+        """
+        Reads the IDs for particle_types (default: all) now, rather than on
+        first access.
+        """
+
+        for ptype in self.shapes.keys():
+            if particle_types is None or ptype in particle_types:
+                self[ptype]
+
+        return
+
+    def nbytes(self, particle_types=None) -> int:
+        """
+        The memory required to hold the IDs for particle_types (default:
+        all), whether or not they have been read.
+        """
+
+        with h5py.File(self.filename, "r") as handle:
+            return sum(
+                handle[f"/PartType{ptype}/ParticleIDs"].dtype.itemsize * int(np.prod(shape))
+                for ptype, shape in self.shapes.items()
+                if particle_types is None or ptype in particle_types
+            )
+
+
+def get_particle_id_shapes(particle_ids: Mapping) -> dict:
+    """
+    Returns the shape of the ID array for each particle type, without reading
+    the IDs if particle_ids is a LazyParticleIDs.
+    """
+
+    try:
+        return dict(particle_ids.shapes)
+    except AttributeError:
+        return {ptype: ids.shape for ptype, ids in particle_ids.items()}
+
+
+def read_particle_ids_from_file(
+    filename: str, mmap: bool = True, particle_types=None, workers: int = 1
+) -> dict:
     """
     Reads the particle IDs from file. Stores them in a dictionary
     with the particle type corresponding to the index, i.e.
@@ -50,30 +455,99 @@ def read_particle_ids_from_file(filename: str) -> dict:
         0: <pids for PartType0,
         ...
     }
-    """
-
-    particle_ids = {}
 
-    with h5py.File(filename, "r") as handle:
-        for ptype in range(6):
-            try:
-                particle_ids[ptype] = handle[f"/PartType{ptype}/ParticleIDs"][...]
-            except KeyError:
-                pass
+    If mmap is true, contiguous datasets are returned as read-only
+    memory-mapped views rather than being read into memory. If
+    particle_types is given, only those particle types are read. The IDs
+    that are read are read by workers threads or processes at once (see
+    read_dataset).
+    """
 
-    return particle_ids
+    return dict(
+        LazyParticleIDs(filename, particle_types=particle_types, mmap=mmap, workers=workers)
+    )
 
 
 def write_all_id_arrays(
-    filename: str, new_id_array_list: list, particle_types: list
+    filename: str,
+    new_id_array_list: list,
+    particle_types: list,
+    mmap: bool = True,
+    workers: int = 1,
 ) -> None:
     """
     Writes all particle type ID arrays that exist (given in particle types) to file
     from the new_id_array_list.
+
+    If mmap is true, contiguous datasets are updated in place through a
+    writable memory map, so that only the pages that actually change are
+    written back. Other datasets are written through h5py, or, with more
+    than one worker, in parts at the same time (see write_dataset_parallel).
     """
 
-    with h5py.File(filename, "a") as file:
+    to_write_with_h5py = []
+    offsets = {}
+
+    with h5py.File(filename, "r") as file:
         for ids, ptype in zip(new_id_array_list, particle_types):
-            file[f"/PartType{ptype}/ParticleIDs"][...] = ids
+            dataset = file[f"/PartType{ptype}/ParticleIDs"]
+            offset = contiguous_dataset_offset(dataset) if mmap else None
+
+            if offset is None or dataset.shape != ids.shape:
+                to_write_with_h5py.append((ids, ptype))
+            else:
+                offsets[ptype] = (offset, dataset.dtype, dataset.shape)
+
+    # The file is closed before we touch the raw data so that h5py does not
+    # hold any stale state about it.
+    for ids, ptype in zip(new_id_array_list, particle_types):
+        if ptype not in offsets:
+            continue
+
+        offset, dtype, shape = offsets[ptype]
+        view = np.memmap(filename, dtype=dtype, mode="r+", offset=offset, shape=shape)
+
+        # Only touch the elements that differ, so clean pages stay clean.
+        changed = np.where(view != ids)[0]
+        view[changed] = ids[changed]
+        view.flush()
+
+        del view
+
+    if to_write_with_h5py and workers > 1:
+        for ids, ptype in to_write_with_h5py:
+            write_dataset_parallel(filename, f"/PartType{ptype}/ParticleIDs", ids, workers)
+    elif to_write_with_h5py:
+        with h5py.File(filename, "a") as file:
+            for ids, ptype in to_write_with_h5py:
+                file[f"/PartType{ptype}/ParticleIDs"][...] = ids
 
     return
+
+
+def patch_dataset(dataset: h5py.Dataset, data: np.array, current=None) -> int:
+    """
+    Updates dataset to hold data, only writing the blocks (of one chunk, or
+    of PATCH_BLOCK_ROWS rows for contiguous datasets) that have changed.
+    current is the data that is in the dataset already, if it is in memory;
+    otherwise it is read block by block for the comparison.
+
+    Returns the number of rows that were written.
+    """
+
+    if dataset.shape != data.shape:
+        raise ValueError(f"Cannot patch {dataset.name} of shape {dataset.shape} with {data.shape}")
+
+    block_rows = dataset.chunks[0] if dataset.chunks is not None else PATCH_BLOCK_ROWS
+    rows_written = 0
+
+    for start in range(0, data.shape[0], block_rows):
+        end = min(start + block_rows, data.shape[0])
+
+        existing = current[start:end] if current is not None else dataset[start:end]
+
+        if not np.array_equal(existing, data[start:end]):
+            dataset[start:end] = data[start:end]
+            rows_written += end - start
+
+    return rows_written
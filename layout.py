@@ -0,0 +1,274 @@
+"""
+The output layout policy: the dtype, chunking and filters that the GroupID
+style datasets written by these scripts (ordered_group_particles files, and
+VRHaloID/VRGalID in the snapshots) are created with.
+
+GroupIDs are stored with the narrowest signed integer type that can hold all
+of the groups (and -1). Chunked outputs use the same chunk shape as the
+ParticleIDs of the snapshot, so that reading both together touches aligned
+chunks. The filter can be chosen, as e.g. "none", "gzip", "gzip:6", "lzf" or
+"shuffle+gzip:4".
+
+Use benchmark_layout.py to compare the policies on your own system.
+
+libhdf5 compresses the chunks of a dataset one after the other on one
+thread; create_dataset_with_layout instead compresses gzip chunks on a pool
+of threads with zlib and writes them with write_direct_chunk. The files are
+the same as those written by h5py, and readable by any HDF5 tool.
+"""
+
+import zlib
+import numpy as np
+import h5py
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+from typing import NamedTuple
+
+# The gzip level that h5py uses when none is given.
+DEFAULT_GZIP_LEVEL = 4
+
+
+class LayoutError(Exception):
+    """Exception raised for invalid layout descriptions.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+
+class OutputLayout(NamedTuple):
+    """
+    How to store a dataset. compression is None, "gzip" or "lzf", with the
+    gzip level in compression_opts. If match_chunks is true, chunked
+    datasets use the chunk shape of the reference dataset (ParticleIDs).
+    """
+
+    compression: str = "gzip"
+    compression_opts: int = None
+    shuffle: bool = False
+    match_chunks: bool = True
+
+    @property
+    def chunked(self) -> bool:
+        return self.compression is not None or self.shuffle
+
+    def describe(self) -> str:
+        """
+        The description of this layout, as understood by parse_output_layout.
+        """
+
+        parts = ["shuffle"] if self.shuffle else []
+
+        if self.compression is None:
+            parts.append("none")
+        elif self.compression_opts is None:
+            parts.append(self.compression)
+        else:
+            parts.append(f"{self.compression}:{self.compression_opts}")
+
+        return "+".join(parts)
+
+
+# The layout used when nothing else is given, which is what these scripts
+# have always written for the ordered_group_particles files.
+DEFAULT_LAYOUT = OutputLayout()
+# Datasets added to the snapshots are not compressed by default, so that the
+# snapshot stays as fast to read as it was.
+SNAPSHOT_LAYOUT = OutputLayout(compression=None)
+
+
+def parse_output_layout(description: str) -> OutputLayout:
+    """
+    Parses a layout description: a "+"-separated list of a filter ("none",
+    "gzip", "gzip:<level>" or "lzf") and optionally "shuffle".
+    """
+
+    compression = None
+    compression_opts = None
+    shuffle = False
+
+    for part in description.lower().split("+"):
+        name, _, level = part.strip().partition(":")
+
+        if name == "shuffle":
+            shuffle = True
+        elif name == "none":
+            compression = None
+        elif name == "lzf" and not level:
+            compression = "lzf"
+        elif name == "gzip":
+            compression = "gzip"
+
+            if level:
+                try:
+                    compression_opts = int(level)
+                except ValueError:
+                    raise LayoutError(f"Invalid gzip level in layout {description}.")
+
+                if not 0 <= compression_opts <= 9:
+                    raise LayoutError(f"The gzip level must be 0-9, not {compression_opts}.")
+        else:
+            raise LayoutError(
+                f"Unknown layout {description}; use e.g. none, gzip, gzip:6, lzf, shuffle+gzip."
+            )
+
+    return OutputLayout(compression=compression, compression_opts=compression_opts, shuffle=shuffle)
+
+
+def smallest_group_dtype(number_of_groups: int) -> np.dtype:
+    """
+    The narrowest signed integer type that can hold GroupIDs from -1 up to
+    number_of_groups - 1.
+    """
+
+    for dtype in [np.int8, np.int16, np.int32, np.int64]:
+        if number_of_groups - 1 <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+
+    raise ValueError(f"Too many groups ({number_of_groups}) to store as GroupIDs.")
+
+
+def narrow_group_ids(groups: np.array, number_of_groups=None) -> np.array:
+    """
+    Returns the GroupID array with the dtype given by smallest_group_dtype,
+    without copying if it already has that dtype. The number of groups is
+    found from the array if not given.
+    """
+
+    if number_of_groups is None:
+        number_of_groups = int(groups.max(initial=-1)) + 1
+
+    return groups.astype(smallest_group_dtype(number_of_groups), copy=False)
+
+
+def get_dataset_options(layout: OutputLayout, shape: tuple, reference_chunks=None) -> dict:
+    """
+    The keyword arguments to create_dataset for a dataset of shape with the
+    layout. reference_chunks is the chunk shape (or None, if contiguous) of
+    the dataset it will be read alongside, e.g. the ParticleIDs.
+    """
+
+    if shape[0] == 0:
+        # Empty datasets cannot be chunked usefully.
+        return {}
+
+    if layout.match_chunks and reference_chunks is not None:
+        # Chunks may not be larger than the dataset.
+        chunks = tuple(
+            max(1, min(chunk, size)) for chunk, size in zip(reference_chunks, shape)
+        ) + tuple(shape[len(reference_chunks) :])
+    elif layout.chunked:
+        chunks = True
+    else:
+        return {}
+
+    options = dict(chunks=chunks)
+
+    if layout.compression is not None:
+        options["compression"] = layout.compression
+
+        if layout.compression_opts is not None:
+            options["compression_opts"] = layout.compression_opts
+
+    if layout.shuffle:
+        options["shuffle"] = True
+
+    return options
+
+
+def read_particle_id_chunks(snapshot_filename: str) -> dict:
+    """
+    Reads the chunk shape of the ParticleIDs of each particle type in the
+    snapshot (including .hdf5), or None for those that are contiguous.
+    """
+
+    chunks = {}
+
+    with h5py.File(snapshot_filename, "r") as handle:
+        for ptype in range(6):
+            try:
+                chunks[ptype] = handle[f"PartType{ptype}/ParticleIDs"].chunks
+            except KeyError:
+                pass
+
+    return chunks
+
+
+def compress_chunk(chunk: np.array, chunk_shape: tuple, level: int, shuffle: bool) -> bytes:
+    """
+    Applies the HDF5 shuffle (if shuffle) and deflate filters to one chunk,
+    padding edge chunks to the full chunk shape as HDF5 does.
+    """
+
+    if chunk.shape != tuple(chunk_shape):
+        padded = np.zeros(chunk_shape, dtype=chunk.dtype)
+        padded[tuple(slice(0, size) for size in chunk.shape)] = chunk
+        chunk = padded
+
+    raw = np.ascontiguousarray(chunk).reshape(-1).view(np.uint8)
+
+    if shuffle:
+        # The first bytes of every element, then the second bytes, etc.
+        raw = np.ascontiguousarray(raw.reshape(-1, chunk.dtype.itemsize).T)
+
+    return zlib.compress(raw, level)
+
+
+def get_chunk_offsets(shape: tuple, chunks: tuple) -> list:
+    """
+    The offsets of all of the chunks of a dataset of shape, in order.
+    """
+
+    return list(product(*[range(0, size, chunk) for size, chunk in zip(shape, chunks)]))
+
+
+def create_dataset_with_layout(
+    group: h5py.Group,
+    name: str,
+    data: np.array,
+    layout: OutputLayout,
+    reference_chunks=None,
+    workers: int = 1,
+) -> h5py.Dataset:
+    """
+    The same as group.create_dataset(name, data=data, **get_dataset_options(
+    layout, data.shape, reference_chunks)), but with more than one worker,
+    gzip-compressed chunks are compressed on that many threads at once and
+    written directly.
+    """
+
+    options = get_dataset_options(layout, data.shape, reference_chunks)
+
+    if workers <= 1 or options.get("compression") != "gzip":
+        return group.create_dataset(name, data=data, **options)
+
+    data = np.ascontiguousarray(data)
+    dataset = group.create_dataset(name, shape=data.shape, dtype=data.dtype, **options)
+
+    chunks = dataset.chunks
+    level = DEFAULT_GZIP_LEVEL if layout.compression_opts is None else layout.compression_opts
+
+    def compress(offset):
+        selection = tuple(slice(start, start + chunk) for start, chunk in zip(offset, chunks))
+
+        return compress_chunk(data[selection], chunks, level, layout.shuffle)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Keep a bounded number of compressed chunks waiting to be written.
+        in_flight = deque()
+
+        for offset in get_chunk_offsets(data.shape, chunks):
+            if len(in_flight) >= 2 * workers:
+                dataset.id.write_direct_chunk(*in_flight.popleft().result())
+
+            in_flight.append(pool.submit(lambda offset: (offset, compress(offset)), offset))
+
+        while in_flight:
+            dataset.id.write_direct_chunk(*in_flight.popleft().result())
+
+    return dataset
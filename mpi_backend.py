@@ -0,0 +1,686 @@
+"""
+An MPI backend (using mpi4py) for the ID matching in preprocess.py and
+postprocess.py, for boxes whose IDs do not fit in the memory of one node.
+
+Each rank reads a contiguous slice of the snapshot IDs (combined over the
+particle types) and of the catalogue. The IDs are then partitioned across
+the ranks by a hash of the ID, so that every copy of an ID, and its entry in
+the catalogue, ends up on the same rank. That rank finds the duplicates, or
+joins the IDs to their groups, locally. The results are sent back to the
+rank that read each position, which writes them.
+
+The outputs are the same as those of the serial scripts. Run with e.g.
+
+    mpirun -n 4 python3 mpi_backend.py --stage preprocess -i snap -d .
+    mpirun -n 4 python3 mpi_backend.py --stage postprocess -i snap -d . -c halo
+
+For usage information, use python3 mpi_backend.py -h
+"""
+
+import numpy as np
+import h5py
+
+from typing import Tuple
+
+from helper import *
+from checksum import calculate_checksums
+from duplicates import create_duplicate_table_from_rows, write_duplicate_table
+from layout import (
+    DEFAULT_LAYOUT,
+    OutputLayout,
+    get_dataset_options,
+    parse_output_layout,
+    read_particle_id_chunks,
+    smallest_group_dtype,
+)
+from postprocess import (
+    calculate_catalogue_hashes,
+    hash_particle_ids,
+    load_velociraptor_particle_types,
+    select_particle_types,
+    write_group_hashes,
+)
+from preprocess import write_data
+
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
+
+
+def get_communicator(comm=None):
+    """
+    The communicator to use: comm if given, and otherwise COMM_WORLD.
+    """
+
+    if comm is not None:
+        return comm
+
+    if MPI is None:
+        raise ImportError(
+            "The MPI backend requires mpi4py; please install it with pip install mpi4py."
+        )
+
+    return MPI.COMM_WORLD
+
+
+def get_range_boundaries(total: int, size: int) -> np.array:
+    """
+    The boundaries of the contiguous ranges of positions (out of total) that
+    each of the size ranks reads, in rank order.
+    """
+
+    return (np.arange(size + 1, dtype=np.int64) * total) // size
+
+
+def get_id_owners(ids: np.array, size: int) -> np.array:
+    """
+    The rank that owns each of the IDs.
+    """
+
+    return (hash_particle_ids(ids) % np.uint64(size)).astype(np.int64)
+
+
+def get_position_owners(positions: np.array, boundaries: np.array) -> np.array:
+    """
+    The rank that read (and writes) each of the positions.
+    """
+
+    return np.searchsorted(boundaries, positions, side="right") - 1
+
+
+def exchange(comm, destinations: np.array, *arrays) -> list:
+    """
+    Sends the elements of each of the arrays to the ranks in destinations.
+    Returns the arrays of the elements received, from each rank in turn (in
+    the order that they were sent).
+    """
+
+    order = np.argsort(destinations, kind="stable")
+
+    send_counts = np.bincount(destinations, minlength=comm.size).astype(np.int64)
+    receive_counts = np.empty_like(send_counts)
+    comm.Alltoall(send_counts, receive_counts)
+
+    received = []
+
+    for array in arrays:
+        send = np.ascontiguousarray(array[order])
+        receive = np.empty(receive_counts.sum(), dtype=array.dtype)
+
+        itemsize = array.dtype.itemsize
+
+        comm.Alltoallv(
+            [
+                send.view(np.uint8),
+                (send_counts * itemsize, (np.cumsum(send_counts) - send_counts) * itemsize),
+                MPI.BYTE,
+            ],
+            [
+                receive.view(np.uint8),
+                (
+                    receive_counts * itemsize,
+                    (np.cumsum(receive_counts) - receive_counts) * itemsize,
+                ),
+                MPI.BYTE,
+            ],
+        )
+
+        received.append(receive)
+
+    return received
+
+
+def read_snapshot_layout(filename: str) -> Tuple:
+    """
+    The particle types, the boundaries between them in the combined array,
+    and the dtype of the ParticleIDs of the snapshot (including .hdf5).
+    """
+
+    particle_types = []
+    sizes = []
+    dtype = np.dtype(np.uint64)
+
+    with h5py.File(filename, "r") as handle:
+        for ptype in range(6):
+            try:
+                dataset = handle[f"PartType{ptype}/ParticleIDs"]
+            except KeyError:
+                continue
+
+            particle_types.append(ptype)
+            sizes.append(dataset.shape[0])
+            dtype = dataset.dtype
+
+    return particle_types, np.cumsum([0] + sizes), dtype
+
+
+def read_snapshot_slice(
+    filename: str,
+    particle_types: list,
+    insertion_points: np.array,
+    dtype: np.dtype,
+    start: int,
+    end: int,
+) -> Tuple[np.array]:
+    """
+    Reads positions start to end of the combined ParticleIDs (of dtype) of
+    the snapshot, returning the IDs and their particle types.
+    """
+
+    ids = []
+    types = []
+
+    with h5py.File(filename, "r") as handle:
+        for ptype, first, last in zip(
+            particle_types, insertion_points[:-1], insertion_points[1:]
+        ):
+            low = max(start, first)
+            high = min(end, last)
+
+            if low >= high:
+                continue
+
+            ids.append(handle[f"PartType{ptype}/ParticleIDs"][low - first : high - first])
+            types.append(np.full(high - low, ptype, dtype=np.int8))
+
+    return (
+        np.concatenate([np.zeros(0, dtype=dtype)] + ids),
+        np.concatenate([np.zeros(0, dtype=np.int8)] + types),
+    )
+
+
+def find_duplicates_distributed(ids: np.array, start: int, boundaries: np.array, comm):
+    """
+    Finds the duplicated IDs, given the slice of the combined IDs that this
+    rank read (from position start). As in preprocess.find_non_unique_ids,
+    the first occurrence of each ID keeps it.
+
+    Returns, for the positions read by this rank whose ID is duplicated, the
+    positions (in increasing order), the IDs, and whether they kept their ID.
+    """
+
+    positions = start + np.arange(ids.size, dtype=np.int64)
+
+    owned_ids, owned_positions = exchange(
+        comm, get_id_owners(ids, comm.size), ids, positions
+    )
+
+    order = np.lexsort((owned_positions, owned_ids))
+    sorted_ids = owned_ids[order]
+    sorted_positions = owned_positions[order]
+
+    repeat = np.zeros(sorted_ids.size, dtype=bool)
+    repeat[1:] = sorted_ids[1:] == sorted_ids[:-1]
+
+    # The first occurrences of the IDs that are repeated.
+    kept = np.zeros(sorted_ids.size, dtype=bool)
+    kept[:-1] = np.logical_and(~repeat[:-1], repeat[1:])
+
+    duplicated = np.logical_or(repeat, kept)
+
+    positions, duplicate_ids, kept = exchange(
+        comm,
+        get_position_owners(sorted_positions[duplicated], boundaries),
+        sorted_positions[duplicated],
+        sorted_ids[duplicated],
+        kept[duplicated],
+    )
+
+    order = np.argsort(positions)
+
+    return positions[order], duplicate_ids[order], kept[order]
+
+
+def get_particle_id_ranges_distributed(
+    ids: np.array, start: int, particle_types: list, insertion_points: np.array, comm
+) -> dict:
+    """
+    The distributed version of duplicates.calculate_particle_id_ranges, given
+    the slice of the combined IDs that this rank holds (from position start).
+    """
+
+    particle_id_ranges = {}
+
+    for index, ptype in enumerate(particle_types):
+        if insertion_points[index + 1] == insertion_points[index]:
+            continue
+
+        low = max(int(insertion_points[index]), start) - start
+        high = min(int(insertion_points[index + 1]), start + ids.size) - start
+        local = ids[low : max(low, high)]
+
+        minimum = comm.allreduce(
+            int(local.min(initial=np.iinfo(ids.dtype).max)), op=MPI.MIN
+        )
+        maximum = comm.allreduce(
+            int(local.max(initial=np.iinfo(ids.dtype).min)), op=MPI.MAX
+        )
+
+        particle_id_ranges[ptype] = (ids.dtype.type(minimum), ids.dtype.type(maximum))
+
+    return particle_id_ranges
+
+
+def preprocess_distributed(
+    filename: str, output_filename_extra="duplicated", comm=None
+) -> StageStatus:
+    """
+    The distributed version of preprocess.load_hdf5_replace_and_dump, for the
+    snapshot at filename (without the .hdf5). Every rank must call this.
+
+    Only the (few) duplicates are gathered on the root rank, which writes the
+    duplicates files and the replaced IDs.
+    """
+
+    comm = get_communicator(comm)
+    snapshot_filename = f"{filename}.hdf5"
+
+    particle_types, insertion_points, dtype = read_snapshot_layout(snapshot_filename)
+    boundaries = get_range_boundaries(int(insertion_points[-1]), comm.size)
+    start, end = boundaries[comm.rank], boundaries[comm.rank + 1]
+
+    ids, _ = read_snapshot_slice(
+        snapshot_filename, particle_types, insertion_points, dtype, start, end
+    )
+
+    positions, original_ids, kept = find_duplicates_distributed(ids, start, boundaries, comm)
+
+    # The replacement IDs are handed out in order of position, as they are
+    # in preprocess.generate_new_ids.
+    number_replaced = int(np.count_nonzero(~kept))
+    first_replacement = comm.exscan(number_replaced) or 0
+    maximum_id = comm.allreduce(int(ids.max(initial=0)), op=MPI.MAX)
+
+    new_ids = original_ids.copy()
+    new_ids[~kept] = np.arange(number_replaced, dtype=dtype) + dtype.type(
+        maximum_id + 1 + first_replacement
+    )
+
+    # The ranges are those of the IDs after the replacement, as in
+    # preprocess.dump_replaced_ids.
+    ids[positions[~kept] - start] = new_ids[~kept]
+    particle_id_ranges = get_particle_id_ranges_distributed(
+        ids, start, particle_types, insertion_points, comm
+    )
+
+    del ids
+
+    gathered = comm.gather((positions, original_ids, new_ids, kept), root=0)
+
+    status = None
+
+    if comm.rank == 0:
+        positions, original_ids, new_ids, kept = [
+            np.concatenate(arrays) for arrays in zip(*gathered)
+        ]
+        replaced = ~kept
+
+        status = StageStatus.COMPLETED if replaced.any() else StageStatus.NOTHING_TO_DO
+
+        # Before anything is written back.
+        checksums = calculate_checksums(snapshot_filename)
+
+        write_data(
+            f"{filename}_{output_filename_extra}.yml",
+            dict(zip(positions[replaced], original_ids[replaced])),
+            dict(zip(positions[replaced], new_ids[replaced])),
+            checksums,
+        )
+
+        write_duplicate_table(
+            f"{filename}_{output_filename_extra}.hdf5",
+            create_duplicate_table_from_rows(
+                particle_types, insertion_points, positions, original_ids, new_ids
+            ),
+            particle_id_ranges,
+        )
+
+        if status == StageStatus.COMPLETED:
+            write_replaced_ids(
+                snapshot_filename,
+                particle_types,
+                insertion_points,
+                positions[replaced],
+                new_ids[replaced],
+            )
+
+    return comm.bcast(status, root=0)
+
+
+def write_replaced_ids(
+    filename: str,
+    particle_types: list,
+    insertion_points: np.array,
+    positions: np.array,
+    new_ids: np.array,
+):
+    """
+    Writes only the replaced IDs (at positions, increasing, in the combined
+    array) to the snapshot.
+    """
+
+    with h5py.File(filename, "r+") as handle:
+        for ptype, first, last in zip(
+            particle_types, insertion_points[:-1], insertion_points[1:]
+        ):
+            mask = np.logical_and(positions >= first, positions < last)
+
+            if mask.any():
+                handle[f"PartType{ptype}/ParticleIDs"][positions[mask] - first] = new_ids[mask]
+
+    return
+
+
+def read_catalogue_slice(catalogue_path: str, unbound: bool, comm) -> Tuple[np.array]:
+    """
+    Reads this rank's slice of the bound (or unbound) particles of the
+    catalogue, returning their IDs and GroupIDs (as create_group_array would
+    give them).
+    """
+
+    extension = "catalog_particles.unbound" if unbound else "catalog_particles"
+    offset_name = "Offset_unbound" if unbound else "Offset"
+
+    with h5py.File(f"{catalogue_path}.{extension}", "r") as handle:
+        dataset = handle["Particle_IDs"]
+        boundaries = get_range_boundaries(dataset.shape[0], comm.size)
+        start, end = boundaries[comm.rank], boundaries[comm.rank + 1]
+
+        particle_ids = dataset[start:end]
+
+    with h5py.File(f"{catalogue_path}.catalog_groups", "r") as handle:
+        offsets = handle[offset_name][...]
+
+    groups = np.searchsorted(offsets, np.arange(start, end), side="right") - 1
+
+    return particle_ids, groups.astype(np.int64)
+
+
+def create_ordered_groups_file(
+    filename: str,
+    shapes: dict,
+    dtype: np.dtype,
+    layout: OutputLayout,
+    reference_chunks: dict,
+    group_hashes,
+):
+    """
+    Creates the ordered_group_particles file, as write_ordered_groups_to_file
+    would, but with the GroupID datasets full of -1 so that each rank can
+    then write its part.
+    """
+
+    with h5py.File(filename, "w") as handle:
+        for ptype, shape in shapes.items():
+            handle.create_dataset(
+                f"PartType{ptype}/GroupID",
+                shape=shape,
+                dtype=dtype,
+                fillvalue=-1,
+                **get_dataset_options(layout, shape, reference_chunks.get(ptype)),
+            )
+
+        write_group_hashes(handle, group_hashes)
+
+    return
+
+
+def postprocess_distributed(
+    snapshot_filename: str,
+    catalogue_path: str,
+    include_unbound: bool,
+    particle_types=None,
+    layout: OutputLayout = DEFAULT_LAYOUT,
+    comm=None,
+):
+    """
+    The distributed version of postprocess.load_data_and_write_new_catalog.
+    Every rank must call this.
+
+    The snapshot IDs and the catalogue are sent to the ranks that own their
+    IDs, which join them; the GroupIDs are then sent back to the ranks that
+    read their positions, which write them to the output in turn.
+    """
+
+    comm = get_communicator(comm)
+
+    snapshot_types, insertion_points, dtype = read_snapshot_layout(snapshot_filename)
+    boundaries = get_range_boundaries(int(insertion_points[-1]), comm.size)
+    start, end = boundaries[comm.rank], boundaries[comm.rank + 1]
+
+    ids, types = read_snapshot_slice(
+        snapshot_filename, snapshot_types, insertion_points, dtype, start, end
+    )
+    positions = start + np.arange(ids.size, dtype=np.int64)
+
+    owned_ids, owned_positions, owned_types = exchange(
+        comm, get_id_owners(ids, comm.size), ids, positions, types
+    )
+
+    del ids, types, positions
+
+    catalogue = [(*read_catalogue_slice(catalogue_path, False, comm), False)]
+
+    if include_unbound:
+        catalogue.append((*read_catalogue_slice(catalogue_path, True, comm), True))
+
+    number_of_groups = 1 + comm.allreduce(
+        max(int(groups.max(initial=-1)) for _, groups, _ in catalogue), op=MPI.MAX
+    )
+
+    local_hashes = calculate_catalogue_hashes(
+        [(particle_ids, groups, None) for particle_ids, groups, _ in catalogue],
+        include_unbound,
+        number_of_groups,
+    )
+
+    # Sums of the hashes wrap around, as they do in serial.
+    group_hashes = local_hashes._replace(
+        hashes=np.empty_like(local_hashes.hashes), sizes=np.empty_like(local_hashes.sizes)
+    )
+    comm.Allreduce(local_hashes.hashes, group_hashes.hashes, op=MPI.SUM)
+    comm.Allreduce(local_hashes.sizes, group_hashes.sizes, op=MPI.SUM)
+
+    groups_local = np.full(end - start, -1, dtype=np.int64)
+
+    # The unbound particles are matched after (and so take precedence over)
+    # the bound ones, as in serial.
+    for catalogue_ids, catalogue_groups, unbound in catalogue:
+        owned_catalogue_ids, owned_catalogue_groups = exchange(
+            comm,
+            get_id_owners(catalogue_ids, comm.size),
+            catalogue_ids.astype(owned_ids.dtype),
+            catalogue_groups,
+        )
+
+        allowed_types = select_particle_types(
+            load_velociraptor_particle_types(catalogue_path, unbound=unbound), particle_types
+        )
+
+        candidates = (
+            np.ones(owned_ids.size, dtype=bool)
+            if allowed_types is None
+            else np.isin(owned_types, list(allowed_types))
+        )
+
+        order = owned_catalogue_ids.argsort(kind="stable")
+        sorted_catalogue_ids = owned_catalogue_ids[order]
+
+        indices, found = find_in_sorted(owned_ids[candidates], sorted_catalogue_ids)
+
+        matched_positions = owned_positions[candidates][found]
+        matched_groups = owned_catalogue_groups[order][indices[found]]
+
+        returned_positions, returned_groups = exchange(
+            comm,
+            get_position_owners(matched_positions, boundaries),
+            matched_positions,
+            matched_groups,
+        )
+
+        groups_local[returned_positions - start] = returned_groups
+
+    # As write_ordered_groups_to_file, narrow to the groups that are present.
+    present_groups = 1 + comm.allreduce(int(groups_local.max(initial=-1)), op=MPI.MAX)
+    groups_local = groups_local.astype(smallest_group_dtype(present_groups))
+
+    filename = f"{catalogue_path}.ordered_group_particles"
+
+    if comm.rank == 0:
+        create_ordered_groups_file(
+            filename,
+            {
+                ptype: (int(last - first),)
+                for ptype, first, last in zip(
+                    snapshot_types, insertion_points[:-1], insertion_points[1:]
+                )
+            },
+            groups_local.dtype,
+            layout,
+            read_particle_id_chunks(snapshot_filename),
+            group_hashes,
+        )
+
+    # Without parallel HDF5, the ranks take turns to write their part.
+    for rank in range(comm.size):
+        comm.Barrier()
+
+        if rank != comm.rank:
+            continue
+
+        with h5py.File(filename, "r+") as handle:
+            for ptype, first, last in zip(
+                snapshot_types, insertion_points[:-1], insertion_points[1:]
+            ):
+                low = max(start, first)
+                high = min(end, last)
+
+                if low < high:
+                    handle[f"PartType{ptype}/GroupID"][low - first : high - first] = groups_local[
+                        low - start : high - start
+                    ]
+
+    comm.Barrier()
+
+    return
+
+
+if __name__ == "__main__":
+    # Run in script mode!
+    import argparse as ap
+
+    PARSER = ap.ArgumentParser(
+        description="""
+        Runs preprocess.py or postprocess.py on one snapshot across MPI ranks, with
+        the IDs partitioned between them, for snapshots too large for one node.
+        Run with e.g. mpirun -n 4 python3 mpi_backend.py --stage preprocess ...
+        The outputs are the same as those of the serial scripts.
+        """
+    )
+
+    PARSER.add_argument(
+        "--stage",
+        help="""
+        The stage to run: preprocess or postprocess. Required.
+        """,
+        required=True,
+        choices=["preprocess", "postprocess"],
+    )
+
+    PARSER.add_argument(
+        "-i",
+        "--input",
+        help="""
+        Input snapshot filename, without the .hdf5. Required.
+        """,
+        required=True,
+    )
+
+    PARSER.add_argument(
+        "-d",
+        "--directory",
+        help="""
+        Directory that the snapshots and halos should live in. Required.
+        """,
+        required=True,
+    )
+
+    PARSER.add_argument(
+        "-o",
+        "--output",
+        help="""
+        For preprocess, the extra string to add onto the output filename for the
+        diffs (default: duplicated). For postprocess, the prepended path to the
+        velociraptor output (default: {-c}/<snapshot>).
+        """,
+        required=False,
+        default=None,
+    )
+
+    PARSER.add_argument(
+        "-c",
+        "--catalogue",
+        help="""
+        Name of the catalogue (i.e. the directory that it exists in) for postprocess.
+        Defaults to 'halo'.
+        """,
+        required=False,
+        default="halo",
+    )
+
+    PARSER.add_argument(
+        "-b",
+        "--unbound",
+        help="""
+        Include unbound particles? Give this 0 if you wish to not have unbound particles
+        in your final output.
+        """,
+        required=False,
+        type=int,
+        default=1,
+    )
+
+    PARSER.add_argument(
+        "-p",
+        "--particle-types",
+        help="""
+        Only match the given particle types in postprocess. Defaults to all of the
+        particle types in the catalogue.
+        """,
+        required=False,
+        type=int,
+        nargs="+",
+        default=None,
+    )
+
+    PARSER.add_argument(
+        "--layout",
+        help="""
+        Filter for the GroupID datasets written by postprocess; see postprocess.py.
+        Default: gzip
+        """,
+        required=False,
+        default="gzip",
+    )
+
+    ARGS = vars(PARSER.parse_args())
+
+    if ARGS["stage"] == "preprocess":
+        status = preprocess_distributed(
+            f"{ARGS['directory']}/{ARGS['input']}",
+            output_filename_extra=ARGS["output"] or "duplicated",
+        )
+
+        if status == StageStatus.NOTHING_TO_DO and get_communicator().rank == 0:
+            print(f"There are no duplicated IDs in {ARGS['input']}; it has been left untouched.")
+    else:
+        output = ARGS["output"] or f"{ARGS['catalogue']}/{ARGS['input']}"
+
+        postprocess_distributed(
+            snapshot_filename=f"{ARGS['directory']}/{ARGS['input']}.hdf5",
+            catalogue_path=f"{ARGS['directory']}/{output}",
+            include_unbound=bool(ARGS["unbound"]),
+            particle_types=ARGS["particle_types"],
+            layout=parse_output_layout(ARGS["layout"]),
+        )
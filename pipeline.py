@@ -0,0 +1,702 @@
+"""
+Runs the whole toolkit (preprocess, velociraptor, postprocess, fix-up and
+adding the information to the snapshot) on one snapshot from python.
+
+The snapshot IDs are read once and kept in memory, along with the map of
+replaced duplicates and a sorted index of the IDs, and passed between the
+stages as arrays. Files are only written where they are needed: the unique
+IDs for VELOCIraptor, the outputs of each stage, and the original IDs at
+the end. Each stage calls the same functions as the script of the same
+name, with the IDs passed in rather than read.
+
+For usage information, use python3 pipeline.py -h
+"""
+
+import os
+import numpy as np
+
+from helper import *
+
+import yaml
+
+import preprocess
+import postprocess
+import layout
+import fix_particle_ids
+import add_info_to_snapshots
+import checksum
+import group_history
+import repack_catalogue
+import run_velociraptor as velociraptor
+
+
+class Snapshot:
+    """
+    The particle IDs of a snapshot, held in memory.
+
+    Attributes:
+        filename -- path to the snapshot without the .hdf5
+        particle_types -- the particle types in the snapshot
+        ids -- the (combined over particle types) IDs as they currently are
+            in the snapshot file
+        insertion_points -- the boundaries between particle types in ids
+        old_positions -- {position in ids: original ID} for the replaced
+            duplicates, as written by preprocess.py
+        new_positions -- {position in ids: unique ID} for the same particles
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+
+        particle_types, id_array_list = zip(
+            *read_particle_ids_from_file(self.hdf5_filename).items()
+        )
+
+        self.particle_types = list(particle_types)
+        # This is a copy (not a memory map) so that it is unaffected by us
+        # writing to the snapshot later.
+        self.ids, self.insertion_points = combine_arrays(id_array_list)
+
+        self.old_positions = {}
+        self.new_positions = {}
+
+        self._index = None
+
+    @property
+    def hdf5_filename(self) -> str:
+        return f"{self.filename}.hdf5"
+
+    def duplicates_filename(self, output_filename_extra="duplicated") -> str:
+        return f"{self.filename}_{output_filename_extra}.yml"
+
+    def duplicate_table_filename(self, output_filename_extra="duplicated") -> str:
+        return f"{self.filename}_{output_filename_extra}.hdf5"
+
+    @property
+    def has_replaced_ids(self) -> bool:
+        """
+        Whether the IDs currently held are the unique ones (i.e. whether any
+        duplicates have been replaced).
+        """
+
+        return len(self.old_positions) > 0
+
+    def particle_ids(self) -> dict:
+        """
+        The IDs as they are currently held, split by particle type, i.e.
+
+        {
+            0: <pids for PartType0>,
+            ...
+        }
+        """
+
+        return dict(
+            zip(self.particle_types, split_arrays(self.ids, self.insertion_points))
+        )
+
+    def particle_id_index(self) -> dict:
+        """
+        The sorted index over the current IDs for each particle type, as used
+        by postprocess.match_catalogue_to_snapshot. It is only created once.
+        """
+
+        if self._index is None:
+            self._index = {
+                ptype: postprocess.create_particle_id_index(ids)
+                for ptype, ids in self.particle_ids().items()
+            }
+
+        return self._index
+
+    def make_ids_unique(self) -> StageStatus:
+        """
+        Replaces the non-unique IDs, in memory only, with unique ones (see
+        preprocess.replace_non_unique_ids).
+        """
+
+        status, self.old_positions, self.new_positions = preprocess.replace_non_unique_ids(
+            self.ids
+        )
+
+        if status == StageStatus.COMPLETED:
+            self._index = None
+
+        return status
+
+    def forget_duplicates(self):
+        """
+        Forgets the replaced duplicates, once the original IDs are back in
+        ids (see fix_particle_ids.fix_and_write).
+        """
+
+        self.old_positions = {}
+        self.new_positions = {}
+
+        self._index = None
+
+        return
+
+    def read_duplicates(self, output_filename_extra="duplicated"):
+        """
+        Reads the map of the replaced duplicates written by preprocess, for
+        when the IDs in the snapshot file are already the unique ones.
+        """
+
+        self.old_positions, self.new_positions = fix_particle_ids.read_yaml_file(
+            self.duplicates_filename(output_filename_extra)
+        )
+
+        return
+
+
+class Pipeline:
+    """
+    Runs the stages of the toolkit on one snapshot, holding the IDs in memory
+    (in a Snapshot) and passing the group arrays between the stages.
+
+    The snapshot is given as a directory and a filename without .hdf5, and the
+    catalogues are stored in {directory}/{catalogue}/{snapshot}, just as with
+    the scripts.
+    """
+
+    def __init__(
+        self,
+        snapshot: str,
+        directory: str = ".",
+        velociraptor_path: str = "./stf",
+        omp_num_threads: int = -1,
+        output_filename_extra: str = "duplicated",
+        output_layout: layout.OutputLayout = layout.DEFAULT_LAYOUT,
+        snapshot_layout: layout.OutputLayout = layout.SNAPSHOT_LAYOUT,
+        io_workers: int = 1,
+        memory_limit=None,
+        time_limit=None,
+    ):
+        if snapshot[-5:] == ".hdf5":
+            raise postprocess.InputError(
+                "Please remove the .hdf5 at the end of your snapshot input filename."
+            )
+
+        self.snapshot_name = snapshot
+        self.directory = directory
+        self.velociraptor_path = velociraptor_path
+        self.omp_num_threads = omp_num_threads
+        self.output_filename_extra = output_filename_extra
+        # The layouts of the ordered_group_particles files and of the group
+        # IDs added to the snapshot; see layout.py.
+        self.output_layout = output_layout
+        self.snapshot_layout = snapshot_layout
+        # Threads that compress (and write) the group outputs at once.
+        self.io_workers = io_workers
+        # Limits (bytes and seconds) on each VELOCIraptor run.
+        self.memory_limit = memory_limit
+        self.time_limit = time_limit
+
+        self.snapshot = Snapshot(f"{directory}/{snapshot}")
+
+        # The GroupID arrays, {catalogue: {ptype: GroupID}}.
+        self.groups = {}
+
+    def catalogue_path(self, catalogue: str) -> str:
+        return f"{self.directory}/{catalogue}/{self.snapshot_name}"
+
+    def preprocess(self) -> StageStatus:
+        """
+        Replaces the non-unique IDs in the snapshot, and writes the map of
+        the replaced duplicates along with the checksums of the original IDs,
+        as preprocess.py does. The snapshot is only written to if there were
+        any duplicates.
+        """
+
+        checksums = checksum.calculate_checksums(
+            self.snapshot.hdf5_filename, self.snapshot.particle_ids()
+        )
+
+        status = self.snapshot.make_ids_unique()
+
+        preprocess.dump_replaced_ids(
+            self.snapshot.filename,
+            self.output_filename_extra,
+            status,
+            self.snapshot.particle_types,
+            split_arrays(self.snapshot.ids, self.snapshot.insertion_points),
+            self.snapshot.old_positions,
+            self.snapshot.new_positions,
+            checksums=checksums,
+            workers=self.io_workers,
+        )
+
+        return status
+
+    def run_velociraptor(
+        self, catalogue: str = "halo", config="velociraptor.cfg", autotune: bool = False
+    ):
+        """
+        Runs VELOCIraptor with the configuration file config, writing the
+        output to the catalogue directory. If autotune is true, the
+        configuration (and, if not set, the number of threads) is first tuned
+        to the size of the snapshot; see velociraptor_config.py.
+
+        Raises a run_velociraptor.VelociraptorError if the run fails or is
+        stopped for going over the limits, so that the stage is not recorded
+        as completed. Returns the RunResult otherwise.
+        """
+
+        catalogue_path = self.catalogue_path(catalogue)
+
+        _, directory = velociraptor.parse_output_path(catalogue_path)
+        velociraptor.create_directory_if_not_exists(directory)
+
+        omp_num_threads = self.omp_num_threads
+
+        if autotune:
+            omp_num_threads, config, _ = velociraptor.autotune_velociraptor(
+                snapshot_filename=self.snapshot.filename,
+                output_path=catalogue_path,
+                omp_num_threads=omp_num_threads,
+                velociraptor_options_file_path=config,
+            )
+
+        result = velociraptor.run_velociraptor(
+            snapshot_filename=self.snapshot.filename,
+            velociraptor_path=self.velociraptor_path,
+            output_path=catalogue_path,
+            omp_num_threads=omp_num_threads,
+            velociraptor_options_file_path=config,
+            memory_limit=self.memory_limit,
+            time_limit=self.time_limit,
+        )
+
+        if not result.succeeded:
+            raise velociraptor.VelociraptorError(result.describe(), result)
+
+        return result
+
+    def repack_catalogue(self, catalogue: str = "halo"):
+        """
+        Repacks the VELOCIraptor output for the catalogue into a sorted
+        archive, which postprocess (and later runs) then read instead of the
+        raw files; see repack_catalogue.py.
+        """
+
+        repack_catalogue.repack_catalogue(
+            self.catalogue_path(catalogue), workers=self.io_workers
+        )
+
+        return
+
+    def postprocess(
+        self, catalogue: str = "halo", include_unbound: bool = True
+    ) -> dict:
+        """
+        Matches the catalogue (or its repacked archive, if there is one)
+        against the in-memory IDs and their index, as postprocess.py does,
+        keeping the resulting GroupID arrays and writing them to the
+        ordered_group_particles file (and to the table of duplicated
+        particles, if there is one).
+        """
+
+        duplicate_table = self.snapshot.duplicate_table_filename(self.output_filename_extra)
+
+        groups_snapshot = postprocess.load_data_and_write_new_catalog(
+            snapshot_filename=self.snapshot.hdf5_filename,
+            catalogue_path=self.catalogue_path(catalogue),
+            include_unbound=include_unbound,
+            layout=self.output_layout,
+            duplicate_table=duplicate_table if os.path.exists(duplicate_table) else None,
+            catalogue_name=catalogue,
+            workers=self.io_workers,
+            particle_ids_snapshot=self.snapshot.particle_ids(),
+            particle_id_index=self.snapshot.particle_id_index(),
+        )
+
+        self.groups[catalogue] = groups_snapshot
+
+        return groups_snapshot
+
+    def fix_particle_ids(self) -> StageStatus:
+        """
+        Writes the original (non-unique) IDs back to the snapshot, if they
+        were ever changed, and checks them against the checksums recorded by
+        preprocess (raising a checksum.ChecksumError if they differ), as
+        fix_particle_ids.py does.
+        """
+
+        status = fix_particle_ids.fix_and_write(
+            self.snapshot.hdf5_filename,
+            self.snapshot.duplicates_filename(self.output_filename_extra),
+            self.snapshot.particle_types,
+            self.snapshot.ids,
+            self.snapshot.insertion_points,
+            self.snapshot.old_positions,
+        )
+
+        self.snapshot.forget_duplicates()
+
+        return status
+
+    def add_info_to_snapshot(self, names=None):
+        """
+        Writes the group IDs of the catalogues that have been postprocessed to
+        the snapshot, with names giving the dataset name for each catalogue
+        (default: VRHaloID for halo and VRGalID for galaxy).
+        """
+
+        if names is None:
+            names = {"halo": "VRHaloID", "galaxy": "VRGalID"}
+
+        for catalogue, name in names.items():
+            if catalogue not in self.groups:
+                continue
+
+            add_info_to_snapshots.write_groups_to_snapshot(
+                self.groups[catalogue],
+                self.snapshot.hdf5_filename,
+                name,
+                layout=self.snapshot_layout,
+                workers=self.io_workers,
+            )
+
+        return
+
+    def append_to_history(self, history_filename: str):
+        """
+        Appends the groups of the catalogues that have been postprocessed to
+        the store of particle histories at history_filename; see
+        group_history.py.
+        """
+
+        duplicate_table = self.snapshot.duplicate_table_filename(self.output_filename_extra)
+
+        group_history.append_snapshot(
+            history_filename,
+            self.snapshot_name,
+            group_history.create_particle_keys(
+                self.snapshot.particle_ids(),
+                duplicate_table if os.path.exists(duplicate_table) else None,
+            ),
+            self.groups,
+        )
+
+        return
+
+    @property
+    def state_filename(self) -> str:
+        return f"{self.snapshot.filename}.pipeline_state.yml"
+
+    def read_completed_stages(self) -> list:
+        """
+        Reads the stages that have been completed by earlier runs.
+        """
+
+        try:
+            with open(self.state_filename, "r") as handle:
+                return yaml.safe_load(handle)["completed"]
+        except FileNotFoundError:
+            return []
+
+    def write_completed_stages(self, completed: list):
+        """
+        Records the stages that have been completed, so that they can be
+        skipped if the pipeline is resumed.
+        """
+
+        with open(self.state_filename, "w") as handle:
+            yaml.safe_dump({"completed": completed}, handle)
+
+        return
+
+    def run(
+        self,
+        configs=None,
+        include_unbound: bool = True,
+        autotune: bool = False,
+        resume: bool = False,
+        repack: bool = False,
+        history=None,
+    ):
+        """
+        Runs all of the stages, with one VELOCIraptor run (and postprocess) for
+        each of the catalogues in configs ({catalogue: config file}, default:
+        velociraptor.cfg for halo and velociraptor_galaxy.cfg for galaxy).
+
+        The completed stages are recorded next to the snapshot. If resume is
+        true, the stages that were completed by an earlier run (e.g. one that
+        ran out of time) are skipped, and their outputs read back in as needed.
+
+        If repack is true, each catalogue is repacked (see repack_catalogue.py)
+        straight after VELOCIraptor has run. If history (a filename) is given,
+        the groups are appended to that store of particle histories at the end.
+        """
+
+        if configs is None:
+            configs = {"halo": "velociraptor.cfg", "galaxy": "velociraptor_galaxy.cfg"}
+
+        completed = self.read_completed_stages() if resume else []
+
+        if "preprocess" in completed and "fix_particle_ids" not in completed:
+            # The IDs in the snapshot file are the unique ones.
+            self.snapshot.read_duplicates(self.output_filename_extra)
+
+        for catalogue in configs.keys():
+            if f"postprocess_{catalogue}" in completed and (
+                "add_info" not in completed
+                or (history is not None and "history" not in completed)
+            ):
+                self.groups[catalogue] = postprocess.read_ordered_groups_from_file(
+                    f"{self.catalogue_path(catalogue)}.ordered_group_particles"
+                )
+
+        stages = [("preprocess", self.preprocess, {})]
+
+        stages += [
+            (
+                f"velociraptor_{catalogue}",
+                self.run_velociraptor,
+                dict(catalogue=catalogue, config=config, autotune=autotune),
+            )
+            for catalogue, config in configs.items()
+        ]
+
+        if repack:
+            stages += [
+                (f"repack_{catalogue}", self.repack_catalogue, dict(catalogue=catalogue))
+                for catalogue in configs.keys()
+            ]
+
+        stages += [
+            (
+                f"postprocess_{catalogue}",
+                self.postprocess,
+                dict(catalogue=catalogue, include_unbound=include_unbound),
+            )
+            for catalogue in configs.keys()
+        ]
+
+        stages += [
+            ("fix_particle_ids", self.fix_particle_ids, {}),
+            ("add_info", self.add_info_to_snapshot, {}),
+        ]
+
+        if history is not None:
+            stages.append(("history", self.append_to_history, dict(history_filename=history)))
+
+        for name, stage, kwargs in stages:
+            if name in completed:
+                continue
+
+            stage(**kwargs)
+
+            completed.append(name)
+            self.write_completed_stages(completed)
+
+        return
+
+
+if __name__ == "__main__":
+    # Run in script mode!
+    import argparse as ap
+
+    PARSER = ap.ArgumentParser(
+        description="""
+        Runs the whole toolkit on a snapshot: preprocess, VELOCIraptor for the
+        halos and galaxies, postprocess, fix-up and adding the group IDs to the
+        snapshot. The particle IDs are only read from the snapshot once.
+        """
+    )
+
+    PARSER.add_argument(
+        "-i",
+        "--input",
+        help="Input snapshot filename. This should be provided WITHOUT the .hdf5. Required.",
+        required=True,
+    )
+
+    PARSER.add_argument(
+        "-d",
+        "--directory",
+        help="""
+        Directory that the snapshots and halos should live in. Required.
+        """,
+        required=True,
+    )
+
+    PARSER.add_argument(
+        "-v",
+        "--velociraptor",
+        help="""
+        The path to the velociraptor stf binary. Defaults to "./stf".
+        """,
+        required=False,
+        default="./stf",
+    )
+
+    PARSER.add_argument(
+        "-t",
+        "--threads",
+        help="""
+        Number of OMP threads to use. If not set, then this will use the current
+        default on your system.
+        """,
+        required=False,
+        type=int,
+        default=-1,
+    )
+
+    PARSER.add_argument(
+        "-C",
+        "--config",
+        help="""
+        Velociraptor configuration file for the halos. Defaults to velociraptor.cfg.
+        """,
+        required=False,
+        default="velociraptor.cfg",
+    )
+
+    PARSER.add_argument(
+        "-G",
+        "--galaxy-config",
+        help="""
+        Velociraptor configuration file for the galaxies. Defaults to
+        velociraptor_galaxy.cfg. Give 'none' to skip the galaxy catalogue.
+        """,
+        required=False,
+        default="velociraptor_galaxy.cfg",
+    )
+
+    PARSER.add_argument(
+        "-o",
+        "--output",
+        help="""
+        Extra string to add onto the output filename for the diffs. Default: duplicated
+        """,
+        required=False,
+        default="duplicated",
+    )
+
+    PARSER.add_argument(
+        "-a",
+        "--autotune",
+        help="""
+        Tune the VELOCIraptor configuration files and, if -t is not set, the
+        number of threads to the size of the snapshot.
+        """,
+        required=False,
+        action="store_true",
+    )
+
+    PARSER.add_argument(
+        "-r",
+        "--resume",
+        help="""
+        Skip the stages that were completed by an earlier run on this snapshot.
+        """,
+        required=False,
+        action="store_true",
+    )
+
+    PARSER.add_argument(
+        "--layout",
+        help="""
+        Filter for the ordered_group_particles files: none, gzip, gzip:<level>, or
+        lzf, optionally with +shuffle. Default: gzip
+        """,
+        required=False,
+        default="gzip",
+    )
+
+    PARSER.add_argument(
+        "--snapshot-layout",
+        help="""
+        Filter for the group IDs added to the snapshot, as for --layout.
+        Default: none
+        """,
+        required=False,
+        default="none",
+    )
+
+    PARSER.add_argument(
+        "--io-workers",
+        help="""
+        Number of threads that compress and write the group outputs at the same
+        time. Default: 1
+        """,
+        required=False,
+        type=int,
+        default=1,
+    )
+
+    PARSER.add_argument(
+        "-m",
+        "--memory-limit",
+        help="""
+        Stop each VELOCIraptor run if its resident memory goes over this many GB.
+        Default: no limit.
+        """,
+        required=False,
+        type=float,
+        default=None,
+    )
+
+    PARSER.add_argument(
+        "-w",
+        "--time-limit",
+        help="""
+        Stop each VELOCIraptor run if it is still running after this many hours.
+        Default: no limit.
+        """,
+        required=False,
+        type=float,
+        default=None,
+    )
+
+    PARSER.add_argument(
+        "--repack",
+        help="""
+        Repack each catalogue into a sorted archive (see repack_catalogue.py) after
+        VELOCIraptor has run, which postprocess then reads instead.
+        """,
+        required=False,
+        action="store_true",
+    )
+
+    PARSER.add_argument(
+        "--history",
+        help="""
+        Append the groups of this snapshot to the store of particle histories at
+        this filename (see group_history.py).
+        """,
+        required=False,
+        default=None,
+    )
+
+    ARGS = vars(PARSER.parse_args())
+
+    configs = {"halo": ARGS["config"]}
+
+    if ARGS["galaxy_config"].lower() != "none":
+        configs["galaxy"] = ARGS["galaxy_config"]
+
+    pipeline = Pipeline(
+        snapshot=ARGS["input"],
+        directory=ARGS["directory"],
+        velociraptor_path=ARGS["velociraptor"],
+        omp_num_threads=ARGS["threads"],
+        output_filename_extra=ARGS["output"],
+        output_layout=layout.parse_output_layout(ARGS["layout"]),
+        snapshot_layout=layout.parse_output_layout(ARGS["snapshot_layout"]),
+        io_workers=ARGS["io_workers"],
+        memory_limit=None
+        if ARGS["memory_limit"] is None
+        else int(ARGS["memory_limit"] * 1e9),
+        time_limit=None if ARGS["time_limit"] is None else ARGS["time_limit"] * 3600,
+    )
+
+    pipeline.run(
+        configs=configs,
+        autotune=ARGS["autotune"],
+        resume=ARGS["resume"],
+        repack=ARGS["repack"],
+        history=ARGS["history"],
+    )
@@ -4,12 +4,24 @@ the particles contained in each halo by _position in the file_ rather than
 particle ID.
 """
 
+import os
 import numpy as np
 import h5py
 
-from typing import Tuple
+from typing import NamedTuple, Tuple
 
 from helper import *
+from layout import (
+    DEFAULT_LAYOUT,
+    OutputLayout,
+    create_dataset_with_layout,
+    narrow_group_ids,
+    parse_output_layout,
+    read_particle_id_chunks,
+    smallest_group_dtype,
+)
+from prefetch import Prefetcher, BackgroundWriter
+from duplicates import add_groups_to_duplicate_table, read_particle_id_ranges
 
 
 class InputError(Exception):
@@ -23,6 +35,17 @@ class InputError(Exception):
         self.message = message
 
 
+class GroupHashes(NamedTuple):
+    """
+    A fingerprint of the membership of each group in a catalogue: the sum of
+    the hashes of the IDs of its particles, and its number of particles.
+    """
+
+    hashes: np.array
+    sizes: np.array
+    include_unbound: bool
+
+
 def calculate_group_sizes_array(offsets: np.array, total_size: int) -> np.array:
     """
     Calculates the group sizes array from the offsets and total size, i.e. it
@@ -81,6 +104,29 @@ def load_velociraptor_data_unbound(filename: str) -> np.array:
     return particle_ids, group_sizes
 
 
+def load_velociraptor_particle_types(filename: str, unbound: bool = False):
+    """
+    Loads the particle types that are present in the velociraptor catalogue
+    from the .catalog_parttypes (or .catalog_parttypes.unbound) file.
+
+    Give filename the path without the .<> file, as we need multiple.
+
+    Returns a set of the particle types, or None if the file does not exist
+    (i.e. velociraptor was not asked to write it), in which case all types
+    should be assumed to be present.
+    """
+
+    extension = "catalog_parttypes.unbound" if unbound else "catalog_parttypes"
+
+    try:
+        with h5py.File(f"{filename}.{extension}", "r") as handle:
+            particle_types = handle["Particle_types"][...]
+    except (OSError, KeyError):
+        return None
+
+    return set(int(ptype) for ptype in np.unique(particle_types))
+
+
 def create_group_array(group_sizes: np.array) -> np.array:
     """
     Creates an array that looks like:
@@ -108,16 +154,18 @@ def create_group_array(group_sizes: np.array) -> np.array:
     return groups
 
 
-def initialise_groups_dictionary(particle_ids_snapshot: dict) -> dict:
+def initialise_groups_dictionary(particle_ids_snapshot: dict, dtype=int) -> dict:
     """
-    Initialises the groups dictionary with all group numbers of -1.
+    Initialises the groups dictionary with all group numbers of -1, with
+    the given (signed integer) dtype.
     """
 
     groups_snapshot = {}
 
-    for ptype, particle_ids in particle_ids_snapshot.items():
+    # Uses the shapes only, so that lazily loaded IDs are not read here.
+    for ptype, shape in get_particle_id_shapes(particle_ids_snapshot).items():
 
-        empty_group = np.empty(particle_ids.shape, dtype=int)
+        empty_group = np.empty(shape, dtype=dtype)
         # Particles outside of groups have -1 as a groupid
         empty_group[...] = -1
 
@@ -131,6 +179,7 @@ def create_positions_groups_correspondance(
     group_array_velociraptor: np.array,
     particle_ids_snapshot: dict,
     groups_snapshot: dict,
+    particle_types=None,
 ):
     """
     Modifies a dictionary, similar to positions_snapshot, i.e. that each contains
@@ -139,9 +188,36 @@ def create_positions_groups_correspondance(
 
     You need to run initialise_groups_dictionary first, and pass the result of 
     that to groups_snapshot.
+
+    If particle_types is given, only those particle types are matched (and, if
+    particle_ids_snapshot is a LazyParticleIDs, read). Every other particle
+    type is read in full, so particle types that cannot be in the catalogue
+    should be left out of particle_types (see select_particle_types_by_id_range).
     """
 
-    for ptype, particle_ids in particle_ids_snapshot.items():
+    if particle_ids_velociraptor.size == 0:
+        return groups_snapshot
+
+    # Catalogues read from a repacked archive are already sorted, so the
+    # snapshot IDs can be looked up directly rather than sorted together.
+    presorted = is_sorted(particle_ids_velociraptor)
+
+    for ptype in particle_ids_snapshot.keys():
+        if particle_types is not None and ptype not in particle_types:
+            continue
+
+        particle_ids = particle_ids_snapshot[ptype]
+
+        if particle_ids.size == 0:
+            continue
+
+        if presorted:
+            positions, found = find_in_sorted(particle_ids, particle_ids_velociraptor)
+
+            groups_snapshot[ptype][found] = group_array_velociraptor[positions[found]]
+
+            continue
+
         # This runs the ID matching
         _, indices_v, indices_p = np.intersect1d(
             particle_ids_velociraptor,
@@ -155,57 +231,777 @@ def create_positions_groups_correspondance(
     return groups_snapshot
 
 
-def write_ordered_groups_to_file(filename: str, groups_snapshot: dict):
+def is_sorted(array: np.array) -> bool:
+    """
+    Whether the array is sorted in ascending order.
+    """
+
+    return bool((array[1:] >= array[:-1]).all())
+
+
+def create_particle_id_index(particle_ids: np.array) -> Tuple[np.array]:
+    """
+    Creates an index over the (unique) snapshot particle IDs for one particle
+    type, so that they only need to be sorted once no matter how many
+    catalogues are matched against them.
+
+    Returns the sorted IDs and the positions that sort the original array.
+    """
+
+    order = particle_ids.argsort(kind="stable")
+
+    return particle_ids[order], order
+
+
+def create_positions_groups_correspondance_from_index(
+    particle_ids_velociraptor: np.array,
+    group_array_velociraptor: np.array,
+    particle_id_index: dict,
+    groups_snapshot: dict,
+    particle_types=None,
+):
+    """
+    The same as create_positions_groups_correspondance, but matches against
+    the index created (per particle type) by create_particle_id_index rather
+    than sorting the snapshot IDs again, i.e. particle_id_index looks like
+
+    {
+        0: (<sorted pids for PartType0>, <order for PartType0>),
+        ...
+    }
+    """
+
+    for ptype, (sorted_ids, order) in particle_id_index.items():
+        if particle_types is not None and ptype not in particle_types:
+            continue
+
+        positions, found = find_in_sorted(particle_ids_velociraptor, sorted_ids)
+
+        groups_snapshot[ptype][order[positions[found]]] = group_array_velociraptor[found]
+
+    return groups_snapshot
+
+
+def write_group_hashes(handle: h5py.File, group_hashes: GroupHashes):
+    """
+    Stores group_hashes (see calculate_catalogue_hashes) in the /Catalogue
+    group of the open ordered_group_particles file, replacing any that are
+    there already. They are read back by read_group_hashes_from_file.
+    """
+
+    if "Catalogue" in handle:
+        del handle["Catalogue"]
+
+    current_group = handle.create_group("Catalogue")
+    current_group.attrs["IncludeUnbound"] = group_hashes.include_unbound
+    current_group.create_dataset("GroupHash", data=group_hashes.hashes)
+    current_group.create_dataset("GroupSize", data=group_hashes.sizes)
+
+    return
+
+
+def write_ordered_groups_to_file(
+    filename: str,
+    groups_snapshot: dict,
+    layout: OutputLayout = DEFAULT_LAYOUT,
+    reference_chunks=None,
+    group_hashes: GroupHashes = None,
+    workers: int = 1,
+):
     """
-    Writes the ordered groups to a HDF5 file with filename.
+    Writes the ordered groups to a HDF5 file with filename, using the
+    narrowest dtype that holds all of the groups and the given layout.
+    reference_chunks ({ptype: chunks}, see read_particle_id_chunks) are the
+    chunk shapes of the snapshot's ParticleIDs to align the chunks with.
+    With more than one worker, the chunks are compressed on that many
+    threads (see create_dataset_with_layout).
+
+    If group_hashes (see calculate_catalogue_hashes) are given, they are
+    stored in /Catalogue so that the file can later be updated incrementally.
     """
 
+    number_of_groups = 1 + max(
+        [int(groups.max(initial=-1)) for groups in groups_snapshot.values()] + [-1]
+    )
+
+    if reference_chunks is None:
+        reference_chunks = {}
+
     with h5py.File(filename, "w") as handle:
         for ptype, particle_groups in groups_snapshot.items():
             current_group = handle.create_group(f"PartType{ptype}")
-            current_group.create_dataset(f"GroupID", data=particle_groups, compression="gzip")
+            create_dataset_with_layout(
+                current_group,
+                "GroupID",
+                narrow_group_ids(particle_groups, number_of_groups),
+                layout,
+                reference_chunks.get(ptype),
+                workers=workers,
+            )
+
+        if group_hashes is not None:
+            write_group_hashes(handle, group_hashes)
 
     return
 
 
-def load_data_and_write_new_catalog(
-    snapshot_filename: str, catalogue_path: str, include_unbound: bool
-) -> None:
+def select_particle_types(catalogue_types, requested_types):
     """
-    Load the data in from file, parse it, and write out the new catalogue.
+    Combines the particle types present in the catalogue (or None if unknown)
+    with those requested by the user (or None for all of them).
     """
 
-    velociraptor_particle_ids, velociraptor_group_sizes = load_velociraptor_data(
-        catalogue_path
-    )
-    group_array = create_group_array(velociraptor_group_sizes)
+    if catalogue_types is None:
+        return requested_types
 
-    particle_ids = read_particle_ids_from_file(snapshot_filename)
+    if requested_types is None:
+        return catalogue_types
 
-    groups_snapshot = initialise_groups_dictionary(particle_ids)
+    return set(catalogue_types) & set(requested_types)
 
-    groups_snapshot = create_positions_groups_correspondance(
-        velociraptor_particle_ids, group_array, particle_ids, groups_snapshot
-    )
+
+def select_particle_types_by_id_range(catalogue: list, particle_id_ranges) -> list:
+    """
+    Restricts the particle types of each part of the catalogue (loaded by
+    load_catalogue) to those whose snapshot IDs, with the ranges
+    particle_id_ranges ({ptype: (min, max)}, as recorded by preprocess.py;
+    see duplicates.read_particle_id_ranges), overlap with the IDs in that
+    part, so that the other particle types are never read. Returns the
+    catalogue unchanged if particle_id_ranges is None.
+    """
+
+    if particle_id_ranges is None:
+        return catalogue
+
+    selected = []
+
+    for velociraptor_particle_ids, group_array, particle_types in catalogue:
+        if velociraptor_particle_ids.size == 0:
+            overlapping = set()
+        else:
+            minimum_id = velociraptor_particle_ids.min()
+            maximum_id = velociraptor_particle_ids.max()
+
+            overlapping = {
+                ptype
+                for ptype, (minimum, maximum) in particle_id_ranges.items()
+                if maximum >= minimum_id and minimum <= maximum_id
+            }
+
+        selected.append(
+            (
+                velociraptor_particle_ids,
+                group_array,
+                select_particle_types(particle_types, overlapping),
+            )
+        )
+
+    return selected
+
+
+def load_catalogue(
+    catalogue_path: str, include_unbound: bool, particle_types=None
+) -> list:
+    """
+    Loads the bound (and, if include_unbound, unbound) particles of the
+    velociraptor catalogue at catalogue_path.
+
+    Returns a list with, for the bound and then unbound particles, a tuple of
+    the particle IDs, the group array (see create_group_array), and the
+    particle types to match them against (None for all; see
+    select_particle_types).
+    """
+
+    catalogue = []
+
+    loaders = [(load_velociraptor_data, False)]
 
     if include_unbound:
-        velociraptor_particle_ids_unbound, velociraptor_group_sizes_unbound = load_velociraptor_data_unbound(
-            catalogue_path
+        loaders.append((load_velociraptor_data_unbound, True))
+
+    for loader, unbound in loaders:
+        velociraptor_particle_ids, velociraptor_group_sizes = loader(catalogue_path)
+
+        catalogue.append(
+            (
+                velociraptor_particle_ids,
+                create_group_array(velociraptor_group_sizes),
+                select_particle_types(
+                    load_velociraptor_particle_types(catalogue_path, unbound=unbound),
+                    particle_types,
+                ),
+            )
         )
-        group_array_unbound = create_group_array(velociraptor_group_sizes_unbound)
+
+    return catalogue
+
+
+def load_catalogue_and_hashes(
+    catalogue_path: str,
+    include_unbound: bool,
+    particle_types=None,
+    duplicate_table=None,
+) -> Tuple[list, GroupHashes]:
+    """
+    Loads the catalogue at catalogue_path, as load_catalogue, along with the
+    hashes of its groups (see calculate_catalogue_hashes). If the catalogue
+    has been repacked (see repack_catalogue.py), the archive is read instead
+    of the raw velociraptor files.
+
+    If duplicate_table (written by preprocess.py) is given, the particle
+    types are also restricted to those whose IDs overlap with the catalogue
+    (see select_particle_types_by_id_range).
+    """
+
+    # Imported here as repack_catalogue.py uses the loaders above.
+    from repack_catalogue import find_repacked_catalogue, load_repacked_catalogue
+
+    filename = find_repacked_catalogue(catalogue_path)
+
+    if filename is not None:
+        catalogue, group_hashes = load_repacked_catalogue(
+            filename, include_unbound, particle_types
+        )
+    else:
+        catalogue = load_catalogue(catalogue_path, include_unbound, particle_types)
+        group_hashes = calculate_catalogue_hashes(catalogue, include_unbound)
+
+    if duplicate_table is not None:
+        catalogue = select_particle_types_by_id_range(
+            catalogue, read_particle_id_ranges(duplicate_table)
+        )
+
+    return catalogue, group_hashes
+
+
+def get_required_particle_types(catalogue: list):
+    """
+    The particle types that need to be read from the snapshot to match the
+    catalogue loaded by load_catalogue (None for all of them).
+    """
+
+    required = set()
+
+    for _, _, particle_types in catalogue:
+        if particle_types is None:
+            return None
+
+        required |= set(particle_types)
+
+    return required
+
+
+def match_catalogue_to_snapshot(
+    catalogue: list, particle_ids_snapshot, particle_id_index=None
+) -> dict:
+    """
+    Matches the catalogue loaded by load_catalogue against the snapshot IDs,
+    returning the groups dictionary (see create_positions_groups_correspondance),
+    with the narrowest dtype that can hold all of the groups.
+
+    If particle_id_index (see create_particle_id_index) is given, the IDs are
+    looked up in it rather than sorted again.
+    """
+
+    number_of_groups = 1 + max(
+        [int(group_array.max(initial=-1)) for _, group_array, _ in catalogue] + [-1]
+    )
+
+    groups_snapshot = initialise_groups_dictionary(
+        particle_ids_snapshot, dtype=smallest_group_dtype(number_of_groups)
+    )
+
+    for velociraptor_particle_ids, group_array, particle_types in catalogue:
+        if particle_id_index is not None:
+            groups_snapshot = create_positions_groups_correspondance_from_index(
+                velociraptor_particle_ids,
+                group_array,
+                particle_id_index,
+                groups_snapshot,
+                particle_types=particle_types,
+            )
+            continue
 
         groups_snapshot = create_positions_groups_correspondance(
-            velociraptor_particle_ids_unbound,
-            group_array_unbound,
-            particle_ids,
+            velociraptor_particle_ids,
+            group_array,
+            particle_ids_snapshot,
+            groups_snapshot,
+            particle_types=particle_types,
+        )
+
+    return groups_snapshot
+
+
+def read_ordered_groups_from_file(filename: str) -> dict:
+    """
+    Reads the ordered groups written by write_ordered_groups_to_file back
+    into a dictionary of {ptype: GroupID}.
+    """
+
+    groups_snapshot = {}
+
+    with h5py.File(filename, "r") as handle:
+        for ptype in range(6):
+            try:
+                groups_snapshot[ptype] = handle[f"PartType{ptype}/GroupID"][...]
+            except KeyError:
+                pass
+
+    return groups_snapshot
+
+
+def hash_particle_ids(particle_ids: np.array) -> np.array:
+    """
+    Hashes the particle IDs (with the splitmix64 finaliser), so that sums of
+    the hashes identify sets of particles.
+    """
+
+    hashes = particle_ids.astype(np.uint64)
+
+    hashes = (hashes ^ (hashes >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    hashes = (hashes ^ (hashes >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+
+    return hashes ^ (hashes >> np.uint64(31))
+
+
+def calculate_catalogue_hashes(
+    catalogue: list, include_unbound: bool, number_of_groups=None
+) -> GroupHashes:
+    """
+    Calculates the hash and size of each group in the catalogue loaded by
+    load_catalogue, over both the bound and unbound particles (these share
+    the same GroupID). The hashes do not depend on the order of the particles.
+    """
+
+    if number_of_groups is None:
+        number_of_groups = 1 + max(
+            [int(group_array.max(initial=-1)) for _, group_array, _ in catalogue] + [-1]
+        )
+
+    hashes = np.zeros(number_of_groups, dtype=np.uint64)
+    sizes = np.zeros(number_of_groups, dtype=np.int64)
+
+    group_ids = np.arange(number_of_groups)
+
+    for particle_ids, group_array, _ in catalogue:
+        # The group array is sorted (see create_group_array), so each group is
+        # a contiguous range, and its sum is a difference of the cumulative
+        # sum (which, like the sums themselves, wraps around).
+        starts = np.searchsorted(group_array, group_ids, side="left")
+        ends = np.searchsorted(group_array, group_ids, side="right")
+
+        cumulative = np.concatenate(
+            [np.zeros(1, dtype=np.uint64), np.cumsum(hash_particle_ids(particle_ids))]
+        )
+
+        hashes += cumulative[ends] - cumulative[starts]
+        sizes += ends - starts
+
+    return GroupHashes(hashes=hashes, sizes=sizes, include_unbound=include_unbound)
+
+
+def read_group_hashes_from_file(filename: str):
+    """
+    Reads the group hashes stored by write_ordered_groups_to_file, or returns
+    None if the file does not exist or does not contain any.
+    """
+
+    if not os.path.exists(filename):
+        return None
+
+    with h5py.File(filename, "r") as handle:
+        if "Catalogue" not in handle:
+            return None
+
+        current_group = handle["Catalogue"]
+
+        return GroupHashes(
+            hashes=current_group["GroupHash"][...],
+            sizes=current_group["GroupSize"][...],
+            include_unbound=bool(current_group.attrs["IncludeUnbound"]),
+        )
+
+
+def match_unchanged_groups(old: GroupHashes, new: GroupHashes) -> np.array:
+    """
+    Finds the groups whose particles are exactly the same in the old and new
+    catalogues (by their hashes and sizes), even if their IDs have changed.
+
+    Returns, for each old group, the ID of the same group in the new
+    catalogue, or -1 if its membership has changed. Empty groups are always
+    treated as changed.
+    """
+
+    old_to_new = np.full(old.hashes.size, -1, dtype=np.int64)
+
+    if old.hashes.size == 0 or new.hashes.size == 0:
+        return old_to_new
+
+    order = np.lexsort((old.sizes, old.hashes))
+    sorted_hashes = old.hashes[order]
+
+    positions = np.searchsorted(sorted_hashes, new.hashes)
+    positions[positions == sorted_hashes.size] = 0
+
+    candidates = order[positions]
+
+    same = np.logical_and.reduce(
+        [
+            old.hashes[candidates] == new.hashes,
+            old.sizes[candidates] == new.sizes,
+            new.sizes > 0,
+        ]
+    )
+
+    old_to_new[candidates[same]] = np.where(same)[0]
+
+    return old_to_new
+
+
+def update_groups_snapshot(
+    old_groups_snapshot: dict,
+    old_to_new: np.array,
+    catalogue: list,
+    particle_ids_snapshot,
+    number_of_groups: int,
+) -> Tuple[dict, int]:
+    """
+    Creates the groups dictionary for the new catalogue (loaded by
+    load_catalogue) from the one for the old catalogue, given the map of
+    unchanged groups from match_unchanged_groups.
+
+    Particles in unchanged groups simply get their new GroupID. Only the
+    particles of the new groups that changed are matched against the
+    snapshot IDs, which is a single pass over the IDs rather than a sort.
+
+    Returns the new groups dictionary and the number of particles matched.
+    """
+
+    # The extra -1 at the end maps GroupID -1 to itself.
+    remap = np.concatenate([old_to_new, [-1]])
+
+    groups_snapshot = {
+        ptype: remap[groups].astype(smallest_group_dtype(number_of_groups))
+        for ptype, groups in old_groups_snapshot.items()
+    }
+
+    changed = np.ones(number_of_groups, dtype=bool)
+    changed[old_to_new[old_to_new >= 0]] = False
+
+    number_matched = 0
+
+    for velociraptor_particle_ids, group_array, particle_types in catalogue:
+        in_changed_group = changed[group_array]
+
+        changed_ids = velociraptor_particle_ids[in_changed_group]
+        changed_groups = group_array[in_changed_group]
+
+        number_matched += changed_ids.size
+
+        if changed_ids.size == 0:
+            continue
+
+        order = changed_ids.argsort()
+        changed_ids = changed_ids[order]
+        changed_groups = changed_groups[order]
+
+        for ptype in groups_snapshot.keys():
+            if particle_types is not None and ptype not in particle_types:
+                continue
+
+            particle_ids = particle_ids_snapshot[ptype]
+
+            if particle_ids.size == 0:
+                continue
+
+            positions, found = find_in_sorted(particle_ids, changed_ids)
+
+            groups_snapshot[ptype][found] = changed_groups[positions[found]]
+
+    return groups_snapshot, number_matched
+
+
+def load_data_and_update_catalog(
+    snapshot_filename: str,
+    catalogue_path: str,
+    include_unbound: bool,
+    particle_types=None,
+    layout: OutputLayout = DEFAULT_LAYOUT,
+    duplicate_table=None,
+    catalogue_name: str = "halo",
+    workers: int = 1,
+):
+    """
+    Updates the ordered_group_particles file of a catalogue that has been
+    re-created (e.g. with different VELOCIraptor parameters), re-using the
+    previous output for the groups whose particles have not changed, and
+    only re-writing the chunks of the file that changed.
+
+    Falls back to load_data_and_write_new_catalog, and returns None, if there
+    is no previous output with group hashes to compare against (or it was
+    made with different settings). Otherwise returns a dictionary with the
+    number of unchanged and changed groups, the number of particles that
+    were matched, and the number of rows that were re-written.
+    """
+
+    filename = f"{catalogue_path}.ordered_group_particles"
+
+    old_hashes = read_group_hashes_from_file(filename)
+
+    if old_hashes is None or old_hashes.include_unbound != include_unbound:
+        load_data_and_write_new_catalog(
+            snapshot_filename,
+            catalogue_path,
+            include_unbound,
+            particle_types,
+            layout,
+            duplicate_table=duplicate_table,
+            catalogue_name=catalogue_name,
+            workers=workers,
+        )
+
+        return None
+
+    catalogue, new_hashes = load_catalogue_and_hashes(
+        catalogue_path, include_unbound, particle_types, duplicate_table
+    )
+    number_of_groups = new_hashes.hashes.size
+
+    old_to_new = match_unchanged_groups(old_hashes, new_hashes)
+
+    old_groups_snapshot = read_ordered_groups_from_file(filename)
+
+    groups_snapshot, number_matched = update_groups_snapshot(
+        old_groups_snapshot,
+        old_to_new,
+        catalogue,
+        LazyParticleIDs(snapshot_filename, workers=workers),
+        number_of_groups,
+    )
+
+    rows_written = 0
+
+    with h5py.File(filename, "r+") as handle:
+        fits = all(
+            handle[f"PartType{ptype}/GroupID"].dtype.itemsize >= groups.dtype.itemsize
+            for ptype, groups in groups_snapshot.items()
+        )
+
+        if fits:
+            for ptype, groups in groups_snapshot.items():
+                rows_written += patch_dataset(
+                    handle[f"PartType{ptype}/GroupID"],
+                    groups,
+                    current=old_groups_snapshot[ptype],
+                )
+
+            write_group_hashes(handle, new_hashes)
+
+    if not fits:
+        # There are now too many groups for the old dtype.
+        write_ordered_groups_to_file(
+            filename,
             groups_snapshot,
+            layout=layout,
+            reference_chunks=read_particle_id_chunks(snapshot_filename),
+            group_hashes=new_hashes,
+            workers=workers,
         )
 
+        rows_written = sum(groups.size for groups in groups_snapshot.values())
+
+    if duplicate_table is not None:
+        add_groups_to_duplicate_table(duplicate_table, catalogue_name, groups_snapshot)
+
+    number_unchanged = int((old_to_new >= 0).sum())
+
+    return {
+        "unchanged_groups": number_unchanged,
+        "changed_groups": number_of_groups - number_unchanged,
+        "matched_particles": number_matched,
+        "rows_written": rows_written,
+    }
+
+
+def write_new_catalog(
+    snapshot_filename: str,
+    catalogue_path: str,
+    groups_snapshot: dict,
+    group_hashes: GroupHashes,
+    layout: OutputLayout = DEFAULT_LAYOUT,
+    duplicate_table=None,
+    catalogue_name: str = "halo",
+    workers: int = 1,
+):
+    """
+    Writes the groups dictionary for the catalogue at catalogue_path to its
+    ordered_group_particles file, with the layout and chunks aligned to those
+    of the snapshot's ParticleIDs, and (if duplicate_table is given) adds the
+    GroupIDs of the duplicated particles to the table.
+    """
+
     write_ordered_groups_to_file(
         filename=f"{catalogue_path}.ordered_group_particles",
         groups_snapshot=groups_snapshot,
+        layout=layout,
+        reference_chunks=read_particle_id_chunks(snapshot_filename),
+        group_hashes=group_hashes,
+        workers=workers,
     )
 
+    if duplicate_table is not None:
+        add_groups_to_duplicate_table(duplicate_table, catalogue_name, groups_snapshot)
+
+    return
+
+
+def load_data_and_write_new_catalog(
+    snapshot_filename: str,
+    catalogue_path: str,
+    include_unbound: bool,
+    particle_types=None,
+    layout: OutputLayout = DEFAULT_LAYOUT,
+    duplicate_table=None,
+    catalogue_name: str = "halo",
+    workers: int = 1,
+    particle_ids_snapshot=None,
+    particle_id_index=None,
+) -> dict:
+    """
+    Load the data in from file, parse it, and write out the new catalogue.
+
+    Only the particle types in particle_types (default: all) that are present
+    in the catalogue (and, with a duplicate_table, whose ID range overlaps
+    with the catalogue) are matched; the IDs of all other particle types are
+    never read, and all of their particles are given a group ID of -1.
+
+    The output is written with the layout, with chunks aligned to those of
+    the snapshot's ParticleIDs. If duplicate_table (the table of duplicated
+    particles written by preprocess.py) is given, their GroupIDs are added
+    to it as GroupID_<catalogue_name>.
+
+    With more than one worker, chunked snapshot IDs are read, and the output
+    compressed, by that many processes or threads at once.
+
+    If the snapshot IDs are already in memory, they can be given as
+    particle_ids_snapshot ({ptype: ParticleIDs}), along with their
+    particle_id_index (see match_catalogue_to_snapshot), rather than being
+    read from snapshot_filename again.
+
+    Returns the groups dictionary.
+    """
+
+    catalogue, group_hashes = load_catalogue_and_hashes(
+        catalogue_path, include_unbound, particle_types, duplicate_table
+    )
+
+    if particle_ids_snapshot is None:
+        particle_ids_snapshot = LazyParticleIDs(snapshot_filename, workers=workers)
+
+    groups_snapshot = match_catalogue_to_snapshot(
+        catalogue, particle_ids_snapshot, particle_id_index
+    )
+
+    write_new_catalog(
+        snapshot_filename,
+        catalogue_path,
+        groups_snapshot,
+        group_hashes,
+        layout=layout,
+        duplicate_table=duplicate_table,
+        catalogue_name=catalogue_name,
+        workers=workers,
+    )
+
+    return groups_snapshot
+
+
+def load_data_and_write_new_catalog_batch(
+    snapshot_filenames: list,
+    catalogue_paths: list,
+    include_unbound: bool,
+    particle_types=None,
+    max_prefetch: int = 1,
+    max_pending_writes: int = 1,
+    memory_limit=None,
+    layout: OutputLayout = DEFAULT_LAYOUT,
+    duplicate_tables=None,
+    catalogue_name: str = "halo",
+    workers: int = 1,
+) -> None:
+    """
+    Runs load_data_and_write_new_catalog for each pair of snapshot filename
+    and catalogue path (and, if given, the table of duplicated particles for
+    each snapshot, or None for those without one), reading the catalogue and
+    snapshot IDs of the next snapshots and writing the output of the previous
+    ones on background threads while the current one is matched.
+
+    At most max_prefetch snapshots are read ahead, and at most
+    max_pending_writes are waiting to be written. If memory_limit (in bytes)
+    is given, no more snapshots are read ahead than fit in it together with
+    those that are being matched or waiting to be written. workers is as in
+    load_data_and_write_new_catalog.
+    """
+
+    def read(item):
+        snapshot_filename, catalogue_path = item
+
+        catalogue, group_hashes = load_catalogue_and_hashes(
+            catalogue_path, include_unbound, particle_types, tables[item]
+        )
+
+        particle_ids_snapshot = LazyParticleIDs(snapshot_filename, mmap=False, workers=workers)
+        particle_ids_snapshot.load(get_required_particle_types(catalogue))
+
+        return catalogue, group_hashes, particle_ids_snapshot
+
+    def size(item):
+        snapshot_filename, catalogue_path = item
+
+        # The IDs, plus the catalogue and the groups, which are about the same
+        # size as the IDs again.
+        return 2 * LazyParticleIDs(snapshot_filename).nbytes() + sum(
+            os.path.getsize(f"{catalogue_path}.{extension}")
+            for extension in [
+                "catalog_particles",
+                "catalog_particles.unbound",
+                "catalog_repacked",
+            ]
+            if os.path.exists(f"{catalogue_path}.{extension}")
+        )
+
+    if duplicate_tables is None:
+        duplicate_tables = [None] * len(snapshot_filenames)
+
+    tables = dict(zip(zip(snapshot_filenames, catalogue_paths), duplicate_tables))
+
+    prefetcher = Prefetcher(
+        list(zip(snapshot_filenames, catalogue_paths)),
+        read,
+        max_prefetch=max_prefetch,
+        memory_limit=memory_limit,
+        size=size,
+    )
+
+    with BackgroundWriter(max_pending=max_pending_writes) as writer:
+        for item, (catalogue, group_hashes, particle_ids_snapshot) in prefetcher:
+            groups_snapshot = match_catalogue_to_snapshot(catalogue, particle_ids_snapshot)
+
+            del catalogue, particle_ids_snapshot
+
+            writer.submit(
+                write_new_catalog,
+                *item,
+                groups_snapshot,
+                group_hashes,
+                layout=layout,
+                duplicate_table=tables[item],
+                catalogue_name=catalogue_name,
+                workers=workers,
+                callback=lambda item=item: prefetcher.release(item),
+            )
+
     return
 
 
@@ -224,8 +1020,13 @@ if __name__ == "__main__":
     PARSER.add_argument(
         "-i",
         "--input",
-        help="Input snapshot filename. This should be provided WITHOUT the .hdf5. Required.",
+        help="""
+        Input snapshot filename. This should be provided WITHOUT the .hdf5. Give
+        several to process them in turn, reading the next one while the current one
+        is processed. Required.
+        """,
         required=True,
+        nargs="+",
     )
 
     PARSER.add_argument(
@@ -272,20 +1073,168 @@ if __name__ == "__main__":
         default="halo"
     )
 
+    PARSER.add_argument(
+        "-p",
+        "--particle-types",
+        help="""
+        Only match the given particle types (e.g. -p 0 4 5 for a galaxy catalogue).
+        Particles of all other types are given a group ID of -1, and their IDs are
+        never read. Defaults to all of the particle types in the catalogue.
+        """,
+        required=False,
+        type=int,
+        nargs="+",
+        default=None,
+    )
+
+    PARSER.add_argument(
+        "--prefetch",
+        help="""
+        Number of snapshots to read ahead when given several. Default: 1
+        """,
+        required=False,
+        type=int,
+        default=1,
+    )
+
+    PARSER.add_argument(
+        "--pending-writes",
+        help="""
+        Number of processed snapshots that may wait to be written when given
+        several. Default: 1
+        """,
+        required=False,
+        type=int,
+        default=1,
+    )
+
+    PARSER.add_argument(
+        "--memory-limit",
+        help="""
+        Limit, in GB, on the (estimated) data held in memory at once (read ahead,
+        being processed, or waiting to be written) when given several snapshots.
+        Default: no limit.
+        """,
+        required=False,
+        type=float,
+        default=None,
+    )
+
+    PARSER.add_argument(
+        "--layout",
+        help="""
+        Filter for the GroupID datasets: none, gzip, gzip:<level>, or lzf, optionally
+        with +shuffle (e.g. shuffle+gzip:4). Chunks are aligned with the snapshot's
+        ParticleIDs. Default: gzip
+        """,
+        required=False,
+        default="gzip",
+    )
+
+    PARSER.add_argument(
+        "--incremental",
+        help="""
+        Update the existing output for a re-created catalogue, re-using the groups
+        whose particles have not changed and only re-writing the parts of the file
+        that differ. Falls back to a full run if there is no previous output.
+        """,
+        required=False,
+        action="store_true",
+    )
+
+    PARSER.add_argument(
+        "--duplicates",
+        help="""
+        Extra string on the filename of the duplicates files written by preprocess.py.
+        If the snapshot has a table of duplicated particles, their GroupIDs are added
+        to it. Default: duplicated
+        """,
+        required=False,
+        default="duplicated",
+    )
+
+    PARSER.add_argument(
+        "--io-workers",
+        help="""
+        Number of threads or processes that read the snapshot IDs (if they are
+        chunked) and compress the GroupID chunks at the same time. Default: 1
+        """,
+        required=False,
+        type=int,
+        default=1,
+    )
 
     ARGS = vars(PARSER.parse_args())
 
-    if ARGS["input"][-5:] == ".hdf5":
-        raise InputError(
-            "Please remove the .hdf5 at the end of your snapshot input filename, this is added automatically by VELOCIraptor."
-        )
+    layout = parse_output_layout(ARGS["layout"])
+
+    for input in ARGS["input"]:
+        if input[-5:] == ".hdf5":
+            raise InputError(
+                "Please remove the .hdf5 at the end of your snapshot input filename, this is added automatically by VELOCIraptor."
+            )
 
     if ARGS["output"] == "DEFAULT":
         # Set to the actual default option.
-        ARGS["output"] = f"{ARGS['catalogue']}/{ARGS['input']}"
-
-    load_data_and_write_new_catalog(
-        snapshot_filename=f"{ARGS['directory']}/{ARGS['input']}.hdf5",
-        catalogue_path=f"{ARGS['directory']}/{ARGS['output']}",
-        include_unbound=ARGS["unbound"],
-    )
+        outputs = [f"{ARGS['catalogue']}/{input}" for input in ARGS["input"]]
+    elif len(ARGS["input"]) == 1:
+        outputs = [ARGS["output"]]
+    else:
+        raise InputError("Please do not give --output when postprocessing several snapshots.")
+
+    duplicate_tables = [
+        f"{ARGS['directory']}/{input}_{ARGS['duplicates']}.hdf5" for input in ARGS["input"]
+    ]
+    duplicate_tables = [table if os.path.exists(table) else None for table in duplicate_tables]
+
+    if ARGS["incremental"]:
+        for input, output, duplicate_table in zip(ARGS["input"], outputs, duplicate_tables):
+            changes = load_data_and_update_catalog(
+                snapshot_filename=f"{ARGS['directory']}/{input}.hdf5",
+                catalogue_path=f"{ARGS['directory']}/{output}",
+                include_unbound=ARGS["unbound"],
+                particle_types=ARGS["particle_types"],
+                layout=layout,
+                duplicate_table=duplicate_table,
+                catalogue_name=ARGS["catalogue"],
+                workers=ARGS["io_workers"],
+            )
+
+            if changes is None:
+                print(f"No previous output to update for {input}, ran in full.")
+            else:
+                print(
+                    f"{input}: {changes['unchanged_groups']} groups unchanged, "
+                    f"{changes['changed_groups']} changed, "
+                    f"{changes['matched_particles']} particles re-matched, "
+                    f"{changes['rows_written']} rows re-written."
+                )
+    elif len(ARGS["input"]) == 1:
+        load_data_and_write_new_catalog(
+            snapshot_filename=f"{ARGS['directory']}/{ARGS['input'][0]}.hdf5",
+            catalogue_path=f"{ARGS['directory']}/{outputs[0]}",
+            include_unbound=ARGS["unbound"],
+            particle_types=ARGS["particle_types"],
+            layout=layout,
+            duplicate_table=duplicate_tables[0],
+            catalogue_name=ARGS["catalogue"],
+            workers=ARGS["io_workers"],
+        )
+    else:
+        load_data_and_write_new_catalog_batch(
+            snapshot_filenames=[
+                f"{ARGS['directory']}/{input}.hdf5" for input in ARGS["input"]
+            ],
+            catalogue_paths=[f"{ARGS['directory']}/{output}" for output in outputs],
+            include_unbound=ARGS["unbound"],
+            particle_types=ARGS["particle_types"],
+            max_prefetch=ARGS["prefetch"],
+            max_pending_writes=ARGS["pending_writes"],
+            memory_limit=None
+            if ARGS["memory_limit"] is None
+            else int(ARGS["memory_limit"] * 1e9),
+            layout=layout,
+            duplicate_tables=duplicate_tables,
+            catalogue_name=ARGS["catalogue"],
+            workers=ARGS["io_workers"],
+        )
@@ -0,0 +1,229 @@
+"""
+Machinery for streaming through many snapshots, overlapping the reading of the
+next snapshot and the writing of the previous one with the processing of the
+current one.
+
+Reading happens on a background thread pool, and at most max_prefetch items are
+read ahead. Writing happens on a separate background thread, with at most
+max_pending writes queued. The total (estimated) size of the items that have
+been read but not yet released can be capped with a memory limit.
+"""
+
+import queue
+import threading
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class MemoryBudget:
+    """
+    A counting semaphore over bytes. One allocation is always allowed when
+    nothing else is held, so that a single item larger than the limit can
+    still be processed (on its own).
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.used = 0
+        self._allocations = 0
+        self._condition = threading.Condition()
+
+    def _fits(self, size: int) -> bool:
+        return (
+            self.limit is None
+            or self._allocations == 0
+            or self.used + size <= self.limit
+        )
+
+    def try_acquire(self, size: int) -> bool:
+        """
+        Acquires size bytes if they fit, without blocking. Returns whether
+        they were acquired.
+        """
+
+        with self._condition:
+            if not self._fits(size):
+                return False
+
+            self.used += size
+            self._allocations += 1
+
+            return True
+
+    def acquire(self, size: int):
+        """
+        Acquires size bytes, blocking until they fit.
+        """
+
+        with self._condition:
+            self._condition.wait_for(lambda: self._fits(size))
+
+            self.used += size
+            self._allocations += 1
+
+        return
+
+    def release(self, size: int):
+        """
+        Releases size bytes that were acquired earlier.
+        """
+
+        with self._condition:
+            self.used -= size
+            self._allocations -= 1
+            self._condition.notify_all()
+
+        return
+
+
+class Prefetcher:
+    """
+    Iterates over (item, read(item)) for all items, reading up to max_prefetch
+    items ahead of the one currently being processed on background threads.
+
+    If memory_limit (in bytes) is given, size(item) is used to estimate the
+    memory required by each item, and reads are held back until they fit.
+    Every item that is yielded keeps its memory until release(item) is called,
+    e.g. once it has been written out.
+    """
+
+    def __init__(
+        self,
+        items,
+        read,
+        max_prefetch: int = 1,
+        memory_limit=None,
+        size=None,
+        readers: int = 1,
+    ):
+        self.items = list(items)
+        self.read = read
+        self.max_prefetch = max(max_prefetch, 0)
+        self.readers = max(readers, 1)
+
+        self.budget = MemoryBudget(memory_limit)
+        self.sizes = [
+            size(item) if size is not None and memory_limit is not None else 0
+            for item in self.items
+        ]
+
+        self._held = {}
+
+    def __iter__(self):
+        pending = deque()
+        next_index = 0
+
+        with ThreadPoolExecutor(max_workers=self.readers) as pool:
+
+            def submit(index):
+                pending.append(
+                    (index, pool.submit(self.read, self.items[index]))
+                )
+
+            while next_index < len(self.items) or pending:
+                if not pending:
+                    # Nothing in flight, so we must wait for memory to be
+                    # released (by the writer) before reading anything.
+                    self.budget.acquire(self.sizes[next_index])
+                    submit(next_index)
+                    next_index += 1
+
+                index, future = pending.popleft()
+
+                # Top up the reads before handing over the current item, so
+                # that they happen while it is being processed.
+                while (
+                    next_index < len(self.items)
+                    and len(pending) < self.max_prefetch
+                    and self.budget.try_acquire(self.sizes[next_index])
+                ):
+                    submit(next_index)
+                    next_index += 1
+
+                self._held.setdefault(self.items[index], []).append(self.sizes[index])
+
+                yield self.items[index], future.result()
+
+        return
+
+    def release(self, item):
+        """
+        Releases the memory held by item, allowing further reads.
+        """
+
+        sizes = self._held.get(item)
+
+        if sizes:
+            self.budget.release(sizes.pop(0))
+
+        return
+
+
+class BackgroundWriter:
+    """
+    Runs write functions, in order, on a separate thread. At most max_pending
+    writes are queued; submitting more blocks until there is space. Any
+    exception raised by a write is re-raised on the next submit or on close.
+    """
+
+    def __init__(self, max_pending: int = 1):
+        self._queue = queue.Queue(maxsize=max(max_pending, 1))
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+
+            if job is None:
+                return
+
+            function, args, kwargs, callback = job
+
+            try:
+                if self._error is None:
+                    function(*args, **kwargs)
+            except BaseException as error:
+                self._error = error
+            finally:
+                if callback is not None:
+                    callback()
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+        return
+
+    def submit(self, function, *args, callback=None, **kwargs):
+        """
+        Queues function(*args, **kwargs) to be run on the writer thread, and
+        then callback() (even if the write failed).
+        """
+
+        self._raise_if_failed()
+        self._queue.put((function, args, kwargs, callback))
+
+        return
+
+    def close(self):
+        """
+        Waits for all of the queued writes to finish.
+        """
+
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_if_failed()
+
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+        return False
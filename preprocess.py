@@ -11,6 +11,13 @@ import numpy as np
 from typing import Tuple
 
 from helper import *
+from checksum import calculate_checksums
+from duplicates import (
+    calculate_particle_id_ranges,
+    create_duplicate_table,
+    write_duplicate_table,
+)
+from prefetch import Prefetcher, BackgroundWriter
 
 
 def find_non_unique_ids(ids: np.array) -> Tuple[np.array]:
@@ -21,7 +28,9 @@ def find_non_unique_ids(ids: np.array) -> Tuple[np.array]:
     positions in the original ids array, respectively.
     """
 
-    args = ids.argsort()
+    # A stable sort means that the first occurrence of each ID is the one
+    # that keeps it, independent of the sorting algorithm numpy picks.
+    args = ids.argsort(kind="stable")
     mask = np.empty(args.shape, dtype=bool)
     sorted_ids = ids[args]
 
@@ -44,6 +53,80 @@ def find_non_unique_ids(ids: np.array) -> Tuple[np.array]:
     return duplicate_ids, duplicate_positions
 
 
+def has_duplicate_ids(ids: np.array, memory_factor: int = 4) -> bool:
+    """
+    Checks whether there are any duplicates in the ids array in O(N) time,
+    without sorting, so that clean snapshots can be skipped cheaply.
+
+    If the IDs span a compact range (less than memory_factor times the number
+    of IDs), every ID is marked in an occupancy map over that range. Otherwise
+    the IDs are hashed into a map of memory_factor buckets per ID; only the
+    (few) IDs that land in shared buckets are then checked exactly.
+    """
+
+    if ids.size < 2:
+        return False
+
+    minimum_id = int(ids.min())
+    maximum_id = int(ids.max())
+    id_range = maximum_id - minimum_id + 1
+
+    if id_range < ids.size:
+        # Pigeonhole; there must be a repeat.
+        return True
+
+    if id_range <= memory_factor * ids.size:
+        seen = np.zeros(id_range, dtype=bool)
+        seen[ids - minimum_id] = True
+
+        return np.count_nonzero(seen) != ids.size
+
+    return has_duplicate_ids_hashed(ids, memory_factor=memory_factor)
+
+
+def has_duplicate_ids_hashed(
+    ids: np.array, memory_factor: int = 4, block_size: int = 1 << 20
+) -> bool:
+    """
+    The hashed variant of has_duplicate_ids, for sparse ID ranges. Streams
+    through ids in blocks, marking the buckets that are hit once and more
+    than once, and then checks the IDs in shared buckets exactly.
+    """
+
+    number_of_bits = int(np.ceil(np.log2(memory_factor * ids.size)))
+    number_of_buckets = 1 << number_of_bits
+
+    def buckets(block):
+        # Fibonacci hashing; the multiplication wraps around, as intended.
+        hashed = block.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+        return (hashed >> np.uint64(64 - number_of_bits)).astype(np.int64)
+
+    seen = np.zeros(number_of_buckets, dtype=bool)
+    seen_twice = np.zeros(number_of_buckets, dtype=bool)
+
+    for start in range(0, ids.size, block_size):
+        block_buckets = buckets(ids[start : start + block_size])
+
+        seen_twice[block_buckets[seen[block_buckets]]] = True
+
+        unique_buckets, counts = np.unique(block_buckets, return_counts=True)
+        seen_twice[unique_buckets[counts > 1]] = True
+        seen[unique_buckets] = True
+
+    if not seen_twice.any():
+        return False
+
+    candidates = []
+
+    for start in range(0, ids.size, block_size):
+        block = ids[start : start + block_size]
+        candidates.append(block[seen_twice[buckets(block)]])
+
+    candidates = np.sort(np.concatenate(candidates))
+
+    return bool((candidates[1:] == candidates[:-1]).any())
+
+
 def generate_new_ids(ids: np.array, n_required: int) -> np.array:
     """
     Generates the new IDs. Assumes that all ids are contained in the
@@ -80,13 +163,23 @@ def find_and_replace_non_unique_ids(ids: np.array) -> Tuple[np.array, dict]:
     return new_ids, old_position_dict, new_position_dict
 
 
-def write_data(filename: str, old_position: dict, new_position: dict) -> None:
+def write_data(
+    filename: str, old_position: dict, new_position: dict, checksums=None
+) -> None:
     """
     Serialises the data from the output from find_and_replace_non_unique_ids
-    to file, using yaml.
+    to file, using yaml, along with the checksums of the original IDs (see
+    checksum.py) if they are given.
     """
 
-    combined = {"old_positions": old_position, "new_positions": new_position}
+    # Plain python integers keep the file readable by any yaml loader.
+    combined = {
+        "old_positions": {int(k): int(v) for k, v in old_position.items()},
+        "new_positions": {int(k): int(v) for k, v in new_position.items()},
+    }
+
+    if checksums is not None:
+        combined["checksums"] = {int(k): v for k, v in checksums.items()}
 
     with open(filename, "w") as f:
         yaml.dump(combined, f)
@@ -94,30 +187,183 @@ def write_data(filename: str, old_position: dict, new_position: dict) -> None:
     return
 
 
-def load_hdf5_replace_and_dump(filename: str, output_filename_extra="duplicated"):
+def replace_non_unique_ids(ids: np.array) -> Tuple:
+    """
+    Finds and replaces the non-unique IDs in the (combined over particle
+    types) ids array, in place.
+
+    Returns the status, and the old and new position dictionaries (see
+    find_and_replace_non_unique_ids). If there are no duplicates, the status
+    is StageStatus.NOTHING_TO_DO and ids is left untouched.
+    """
+
+    if not has_duplicate_ids(ids):
+        return StageStatus.NOTHING_TO_DO, {}, {}
+
+    _, old_position_dict, new_position_dict = find_and_replace_non_unique_ids(ids)
+
+    return StageStatus.COMPLETED, old_position_dict, new_position_dict
+
+
+def replace_non_unique_ids_in_arrays(id_array_list: list) -> Tuple:
+    """
+    Concatenates the ID arrays for all of the particle types into one array,
+    finds duplicates and replaces them (see replace_non_unique_ids).
+
+    Returns the status, the new ID arrays (split back up by particle type),
+    and the old and new position dictionaries. If there are no duplicates,
+    the arrays are returned untouched.
+    """
+
+    id_array, insertion_points = combine_arrays(id_array_list)
+
+    status, old_position_dict, new_position_dict = replace_non_unique_ids(id_array)
+
+    if status == StageStatus.NOTHING_TO_DO:
+        return status, list(id_array_list), {}, {}
+
+    new_id_array_list = split_arrays(id_array, insertion_points)
+
+    return status, new_id_array_list, old_position_dict, new_position_dict
+
+
+def dump_replaced_ids(
+    filename: str,
+    output_filename_extra: str,
+    status: StageStatus,
+    existing_particle_types: list,
+    new_id_array_list: list,
+    old_position_dict: dict,
+    new_position_dict: dict,
+    checksums=None,
+    workers: int = 1,
+) -> None:
+    """
+    Saves the duplicates file (with the checksums of the original IDs, if
+    given) and the table of the duplicated particles, with the range of the
+    new IDs of each particle type (see duplicates.py) and,
+    if anything was replaced, writes the new IDs to the HDF5 file at filename
+    (without the .hdf5), with workers threads writing parts of each dataset.
+    """
+
+    duplicated_filename = f"{filename}_{output_filename_extra}.yml"
+    write_data(duplicated_filename, old_position_dict, new_position_dict, checksums)
+
+    write_duplicate_table(
+        f"{filename}_{output_filename_extra}.hdf5",
+        create_duplicate_table(
+            existing_particle_types, new_id_array_list, old_position_dict, new_position_dict
+        ),
+        calculate_particle_id_ranges(existing_particle_types, new_id_array_list),
+    )
+
+    if status == StageStatus.COMPLETED:
+        write_all_id_arrays(
+            f"{filename}.hdf5", new_id_array_list, existing_particle_types, workers=workers
+        )
+
+    return
+
+
+def load_hdf5_replace_and_dump(
+    filename: str, output_filename_extra="duplicated", workers: int = 1
+) -> StageStatus:
     """
     Reads the IDs from the HDF5 file at filename, concatenates all of the particle
     types into one array, finds duplicates, fixes them, saves the duplicates file,
     and writes to the original HDF5 file.
+
+    If there are no duplicates, the (empty) duplicates file is saved but the
+    snapshot is left untouched, and StageStatus.NOTHING_TO_DO is returned.
+
+    The checksums of the original IDs are saved in the duplicates file too,
+    so that fix_particle_ids.py can check that it restored them.
+
+    IDs that have to be read or written (rather than memory-mapped) are split
+    into parts that workers threads or processes handle at once.
     """
 
-    existing_particle_types, id_array_list = zip(
-        *read_particle_ids_from_file(f"{filename}.hdf5").items()
+    particle_ids = read_particle_ids_from_file(f"{filename}.hdf5", workers=workers)
+    existing_particle_types, id_array_list = zip(*particle_ids.items())
+
+    # Calculated from the IDs in memory, before anything is written back.
+    checksums = calculate_checksums(f"{filename}.hdf5", particle_ids)
+
+    status, *replaced = replace_non_unique_ids_in_arrays(id_array_list)
+
+    dump_replaced_ids(
+        filename,
+        output_filename_extra,
+        status,
+        existing_particle_types,
+        *replaced,
+        checksums=checksums,
+        workers=workers,
     )
-    id_array, insertion_points = combine_arrays(id_array_list)
 
-    new_id_array, old_position_dict, new_position_dict = find_and_replace_non_unique_ids(
-        id_array
+    return status
+
+
+def load_hdf5_replace_and_dump_batch(
+    filenames: list,
+    output_filename_extra="duplicated",
+    max_prefetch: int = 1,
+    max_pending_writes: int = 1,
+    memory_limit=None,
+    workers: int = 1,
+) -> list:
+    """
+    Runs load_hdf5_replace_and_dump on each of the files in filenames (without
+    the .hdf5), reading the IDs of the next snapshots and writing those of the
+    previous ones on background threads while the current one is processed.
+
+    At most max_prefetch snapshots are read ahead, and at most
+    max_pending_writes are waiting to be written. If memory_limit (in bytes)
+    is given, no more snapshots are read ahead than fit in it together with
+    those that are being processed or waiting to be written. Each dataset is
+    read and written in parts by workers threads or processes at once.
+
+    Returns the status for each snapshot.
+    """
+
+    def read(filename):
+        particle_ids = read_particle_ids_from_file(
+            f"{filename}.hdf5", mmap=False, workers=workers
+        )
+
+        return (
+            *zip(*particle_ids.items()),
+            calculate_checksums(f"{filename}.hdf5", particle_ids),
+        )
+
+    def size(filename):
+        return LazyParticleIDs(f"{filename}.hdf5").nbytes()
+
+    prefetcher = Prefetcher(
+        filenames, read, max_prefetch=max_prefetch, memory_limit=memory_limit, size=size
     )
 
-    new_id_array_list = split_arrays(new_id_array, insertion_points)
+    statuses = []
 
-    duplicated_filename = f"{filename}_{output_filename_extra}.yml"
-    write_data(duplicated_filename, old_position_dict, new_position_dict)
+    with BackgroundWriter(max_pending=max_pending_writes) as writer:
+        for filename, (existing_particle_types, id_array_list, checksums) in prefetcher:
+            status, *replaced = replace_non_unique_ids_in_arrays(id_array_list)
 
-    write_all_id_arrays(f"{filename}.hdf5", new_id_array_list, existing_particle_types)
+            writer.submit(
+                dump_replaced_ids,
+                filename,
+                output_filename_extra,
+                status,
+                existing_particle_types,
+                *replaced,
+                checksums=checksums,
+                workers=workers,
+                callback=lambda filename=filename: prefetcher.release(filename),
+            )
 
-    return
+            statuses.append(status)
+
+    return statuses
 
 
 if __name__ == "__main__":
@@ -137,9 +383,11 @@ if __name__ == "__main__":
         "-i",
         "--input",
         help="""
-        Input HDF5 file to preprocess, without the file extension.
+        Input HDF5 file to preprocess, without the file extension. Give several to
+        process them in turn, reading the next one while the current one is processed.
         """,
         required=True,
+        nargs="+",
     )
 
     PARSER.add_argument(
@@ -161,8 +409,73 @@ if __name__ == "__main__":
         default="duplicated",
     )
 
-    ARGS = vars(PARSER.parse_args())
+    PARSER.add_argument(
+        "--prefetch",
+        help="""
+        Number of snapshots to read ahead when given several. Default: 1
+        """,
+        required=False,
+        type=int,
+        default=1,
+    )
 
-    load_hdf5_replace_and_dump(
-        filename=f"{ARGS['directory']}/{ARGS['input']}", output_filename_extra=ARGS["output"]
+    PARSER.add_argument(
+        "--pending-writes",
+        help="""
+        Number of processed snapshots that may wait to be written when given
+        several. Default: 1
+        """,
+        required=False,
+        type=int,
+        default=1,
     )
+
+    PARSER.add_argument(
+        "--memory-limit",
+        help="""
+        Limit, in GB, on the particle IDs held in memory at once (read ahead,
+        being processed, or waiting to be written) when given several snapshots.
+        Default: no limit.
+        """,
+        required=False,
+        type=float,
+        default=None,
+    )
+
+    PARSER.add_argument(
+        "--io-workers",
+        help="""
+        Number of threads or processes that read and write the parts of each ID
+        dataset at the same time, e.g. to use more of a parallel file system.
+        Default: 1
+        """,
+        required=False,
+        type=int,
+        default=1,
+    )
+
+    ARGS = vars(PARSER.parse_args())
+
+    if len(ARGS["input"]) == 1:
+        statuses = [
+            load_hdf5_replace_and_dump(
+                filename=f"{ARGS['directory']}/{ARGS['input'][0]}",
+                output_filename_extra=ARGS["output"],
+                workers=ARGS["io_workers"],
+            )
+        ]
+    else:
+        statuses = load_hdf5_replace_and_dump_batch(
+            filenames=[f"{ARGS['directory']}/{input}" for input in ARGS["input"]],
+            output_filename_extra=ARGS["output"],
+            max_prefetch=ARGS["prefetch"],
+            max_pending_writes=ARGS["pending_writes"],
+            memory_limit=None
+            if ARGS["memory_limit"] is None
+            else int(ARGS["memory_limit"] * 1e9),
+            workers=ARGS["io_workers"],
+        )
+
+    for input, status in zip(ARGS["input"], statuses):
+        if status == StageStatus.NOTHING_TO_DO:
+            print(f"There are no duplicated IDs in {input}; it has been left untouched.")
@@ -0,0 +1,362 @@
+"""
+Writes a copy of a snapshot with the particles of each type sorted by group,
+so that all of the particles of any halo (or galaxy) can be read with one
+contiguous slice of each field.
+
+The order is given by the GroupID arrays written by postprocess.py: groups
+in ascending GroupID, particles not in a group last, and the original order
+kept within each group. Alongside the reordered PartTypeX datasets (and an
+unchanged copy of the header) the output holds
+
+    /Groups/Offset   (shape [number of groups, 6], first particle per type)
+    /Groups/Length   (shape [number of groups, 6], particles per type)
+    /Reordering/PartTypeX/OriginalIndex  (position in the original snapshot
+                                          of each reordered particle)
+    /Reordering/PartTypeX/NewIndex       (the inverse: the position in the
+                                          output of each original particle)
+
+and an ordered_group_particles file is written next to it. The particles
+not in a group start at Length.sum(axis=0).
+
+The permutation is applied out of core: each field of the original snapshot
+is read once, a block of whole chunks at a time, with its rows spilled to
+temporary files (next to the output) for the output blocks that they move
+to, and each output block is then written once. No field is ever held in
+memory in full, and no chunk is read or written more than once.
+
+For usage information, use python3 reorder_snapshot.py -h
+"""
+
+import os
+import tempfile
+import numpy as np
+import h5py
+
+from typing import Tuple
+
+from helper import *
+from extract_groups import get_rows_per_read, write_header
+from layout import OutputLayout, create_dataset_with_layout
+from postprocess import read_ordered_groups_from_file, write_ordered_groups_to_file
+
+# The permutations are integers that rise through the file, so shuffle well.
+PERMUTATION_LAYOUT = OutputLayout(compression="gzip", shuffle=True)
+
+
+def create_group_order(groups: np.array, number_of_groups: int) -> Tuple[np.array]:
+    """
+    Finds the stable permutation that sorts the particles (of one type) by
+    their GroupID, with those not in a group (-1) last.
+
+    Returns the permutation (the original position of each particle in the
+    new order) and the number of particles in each group.
+    """
+
+    # Sort -1 after all of the groups.
+    keys = np.where(groups < 0, number_of_groups, groups)
+    order = np.argsort(keys, kind="stable")
+
+    lengths = np.bincount(groups[groups >= 0], minlength=number_of_groups)
+
+    return order, lengths
+
+
+def invert_permutation(order: np.array) -> np.array:
+    """
+    The inverse of the permutation order, i.e. the new position of the
+    particle at each original position.
+    """
+
+    inverse = np.empty_like(order)
+    inverse[order] = np.arange(order.size, dtype=order.dtype)
+
+    return inverse
+
+
+def get_block_rows(dataset: h5py.Dataset) -> int:
+    """
+    The number of rows of the output written at once: as many whole chunks
+    as fit in extract_groups.READ_BLOCK_BYTES (at least one), or that many
+    bytes of rows for contiguous datasets.
+    """
+
+    rows = get_rows_per_read(dataset)
+
+    if dataset.chunks is None:
+        return rows
+
+    return max(1, rows // dataset.chunks[0]) * dataset.chunks[0]
+
+
+def create_reordered_dataset(source: h5py.Dataset, destination: h5py.Group) -> h5py.Dataset:
+    """
+    Creates an empty dataset in destination with the same name, shape,
+    dtype, chunks, filters and attributes as source.
+    """
+
+    filters = {}
+
+    if source.chunks is not None and source.shape[0] > 0:
+        filters = dict(
+            chunks=source.chunks,
+            compression=source.compression,
+            compression_opts=source.compression_opts,
+            shuffle=source.shuffle,
+            fletcher32=source.fletcher32,
+        )
+
+    name = source.name.split("/")[-1]
+    dataset = destination.create_dataset(
+        name, shape=source.shape, dtype=source.dtype, **filters
+    )
+
+    for key, value in source.attrs.items():
+        dataset.attrs[key] = value
+
+    return dataset
+
+
+def copy_dataset_reordered(
+    source: h5py.Dataset,
+    destination: h5py.Group,
+    order: np.array,
+    block_rows=None,
+    inverse=None,
+    temporary_directory=None,
+):
+    """
+    Copies source to destination with its rows permuted by order (see
+    create_group_order), in blocks of block_rows rows (default: see
+    get_block_rows).
+
+    The source is read once, one block at a time in file order, and each of
+    its rows is appended to a spill file for the output block that it moves
+    to (found from inverse, the inverse of order, if already known). Each
+    output block is then assembled from its spill file and written once. The
+    spill files (as large as the dataset in total) are kept in a temporary
+    directory inside temporary_directory.
+    """
+
+    dataset = create_reordered_dataset(source, destination)
+
+    number_of_rows = source.shape[0]
+
+    if block_rows is None:
+        block_rows = get_block_rows(source)
+
+    if inverse is None:
+        inverse = invert_permutation(order)
+
+    number_of_blocks = -(-number_of_rows // block_rows)
+
+    record_dtype = np.dtype(
+        [("position", np.int64), ("row", source.dtype, source.shape[1:])]
+    )
+
+    with tempfile.TemporaryDirectory(dir=temporary_directory) as directory:
+        spill_filenames = [
+            os.path.join(directory, f"block_{index}") for index in range(number_of_blocks)
+        ]
+
+        for start in range(0, number_of_rows, block_rows):
+            data = source[start : start + block_rows]
+            new_positions = inverse[start : start + data.shape[0]]
+
+            blocks = new_positions // block_rows
+            spill_order = np.argsort(blocks, kind="stable")
+            boundaries = np.searchsorted(blocks[spill_order], np.arange(number_of_blocks + 1))
+
+            for index in np.flatnonzero(np.diff(boundaries)):
+                rows = spill_order[boundaries[index] : boundaries[index + 1]]
+
+                records = np.empty(rows.size, dtype=record_dtype)
+                records["position"] = new_positions[rows]
+                records["row"] = data[rows]
+
+                with open(spill_filenames[index], "ab") as handle:
+                    records.tofile(handle)
+
+        for index, start in enumerate(range(0, number_of_rows, block_rows)):
+            records = np.fromfile(spill_filenames[index], dtype=record_dtype)
+            os.remove(spill_filenames[index])
+
+            block = np.empty((records.size,) + source.shape[1:], dtype=source.dtype)
+            block[records["position"] - start] = records["row"]
+
+            dataset[start : start + records.size] = block
+
+    return
+
+
+def reorder_snapshot(
+    snapshot_filename: str, groups_snapshot: dict, output_filename: str, block_rows=None
+) -> dict:
+    """
+    Writes the snapshot (including .hdf5) to output_filename with the
+    particles of each type sorted by the GroupIDs in groups_snapshot
+    ({ptype: GroupID}, as written by postprocess.py). Particle types that are
+    not in groups_snapshot are copied in their original order.
+
+    Returns the GroupID arrays of the reordered particles.
+    """
+
+    temporary_directory = os.path.dirname(os.path.abspath(output_filename))
+
+    number_of_groups = 1 + max(
+        [int(groups.max(initial=-1)) for groups in groups_snapshot.values()] + [-1]
+    )
+
+    lengths = np.zeros((number_of_groups, 6), dtype=np.int64)
+    reordered_groups = {}
+
+    with h5py.File(snapshot_filename, "r") as source, h5py.File(
+        output_filename, "w"
+    ) as destination:
+        particle_numbers = np.zeros(6, dtype=np.int64)
+
+        for ptype in range(6):
+            name = f"PartType{ptype}"
+
+            if name not in source:
+                continue
+
+            number_of_particles = source[name]["ParticleIDs"].shape[0]
+            particle_numbers[ptype] = number_of_particles
+
+            groups = groups_snapshot.get(ptype)
+
+            if groups is None:
+                groups = np.full(number_of_particles, -1, dtype=np.int8)
+
+            order, lengths[:, ptype] = create_group_order(groups, number_of_groups)
+            inverse = invert_permutation(order)
+
+            current_group = destination.create_group(name)
+
+            for key, value in source[name].attrs.items():
+                current_group.attrs[key] = value
+
+            for dataset in source[name].values():
+                if isinstance(dataset, h5py.Dataset):
+                    copy_dataset_reordered(
+                        dataset,
+                        current_group,
+                        order,
+                        block_rows,
+                        inverse=inverse,
+                        temporary_directory=temporary_directory,
+                    )
+
+            permutation_group = destination.create_group(f"Reordering/{name}")
+            reference_chunks = source[name]["ParticleIDs"].chunks
+
+            for permutation_name, permutation in [
+                ("OriginalIndex", order),
+                ("NewIndex", inverse),
+            ]:
+                create_dataset_with_layout(
+                    permutation_group,
+                    permutation_name,
+                    permutation,
+                    PERMUTATION_LAYOUT,
+                    reference_chunks,
+                )
+
+            reordered_groups[ptype] = groups[order]
+
+        write_header(source, destination, particle_numbers)
+
+        table = destination.create_group("Groups")
+        table.create_dataset("Offset", data=np.cumsum(lengths, axis=0) - lengths)
+        table.create_dataset("Length", data=lengths)
+
+    return reordered_groups
+
+
+def read_group_particles(filename: str, group_id: int, ptype: int, field: str) -> np.array:
+    """
+    Reads field (e.g. Coordinates) of the particles of one type in the group
+    group_id from the reordered snapshot at filename (including .hdf5), with
+    a single contiguous read.
+    """
+
+    with h5py.File(filename, "r") as handle:
+        offset = handle["Groups/Offset"][group_id, ptype]
+        length = handle["Groups/Length"][group_id, ptype]
+
+        return handle[f"PartType{ptype}/{field}"][offset : offset + length]
+
+
+def load_data_and_reorder_snapshot(
+    snapshot_filename: str, groups_filename: str, output_filename: str
+):
+    """
+    Reorders the snapshot (excluding .hdf5) by the groups in the
+    ordered_group_particles file at groups_filename, writing the new snapshot
+    to output_filename (excluding .hdf5) and its groups to
+    output_filename.ordered_group_particles.
+    """
+
+    groups_snapshot = read_ordered_groups_from_file(groups_filename)
+
+    reordered_groups = reorder_snapshot(
+        f"{snapshot_filename}.hdf5", groups_snapshot, f"{output_filename}.hdf5"
+    )
+
+    write_ordered_groups_to_file(
+        f"{output_filename}.ordered_group_particles", reordered_groups
+    )
+
+    return
+
+
+if __name__ == "__main__":
+    # Run in script mode!
+    import argparse as ap
+
+    PARSER = ap.ArgumentParser(
+        description="""
+        Writes a copy of a snapshot with the particles sorted by group (those not
+        in a group last), with offset and length tables in /Groups so that each
+        group can be read with one contiguous slice per field, and the
+        permutation (both ways) in /Reordering.
+        """
+    )
+
+    PARSER.add_argument(
+        "-s",
+        "--snapshot",
+        help="""
+        Snapshot filename (including path, but excluding .hdf5). Required.
+        """,
+        required=True,
+    )
+
+    PARSER.add_argument(
+        "-g",
+        "--groups",
+        help="""
+        Path to the .ordered_group_particles file for the halos or galaxies to
+        sort by. Required.
+        """,
+        required=True,
+    )
+
+    PARSER.add_argument(
+        "-o",
+        "--output",
+        help="""
+        Output snapshot filename (excluding .hdf5). Required.
+        """,
+        required=True,
+    )
+
+    ARGS = vars(PARSER.parse_args())
+
+    load_data_and_reorder_snapshot(
+        snapshot_filename=ARGS["snapshot"],
+        groups_filename=ARGS["groups"],
+        output_filename=ARGS["output"],
+    )
+
+    print(f"Wrote {ARGS['output']}.hdf5")
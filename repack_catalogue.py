@@ -0,0 +1,441 @@
+"""
+Repacks a VELOCIraptor catalogue, once after run_velociraptor.py, into a
+single compact archive next to it, {catalogue}.catalog_repacked, holding
+everything that postprocess.py (and any later join against the catalogue)
+needs, already sorted:
+
+    /Particles/ParticleIDs    sorted, bound and unbound together
+    /Particles/GroupID        the group of each particle
+    /Particles/Bound          whether the particle is bound
+    /Particles/ParticleType   (only if VELOCIraptor wrote .catalog_parttypes)
+    /Groups/BoundSize, UnboundSize, BoundHash, UnboundHash
+
+All of the integer columns are stored with the narrowest dtype that holds
+them (the IDs are read back with VELOCIraptor's dtype). Once the archive
+exists, postprocess.py reads it instead of re-building the groups from the
+.catalog_particles(.unbound) and .catalog_groups files and sorting the IDs
+again, so the raw files can be archived. An archive that is older than the
+raw files (e.g. after VELOCIraptor is re-run) is ignored.
+
+For usage information, use python3 repack_catalogue.py -h
+"""
+
+import os
+import numpy as np
+import h5py
+
+from typing import NamedTuple, Tuple
+
+from helper import *
+from layout import (
+    OutputLayout,
+    create_dataset_with_layout,
+    parse_output_layout,
+    smallest_group_dtype,
+)
+from postprocess import (
+    GroupHashes,
+    calculate_catalogue_hashes,
+    create_group_array,
+    load_velociraptor_data,
+    load_velociraptor_data_unbound,
+    select_particle_types,
+)
+
+# Sorted IDs compress far better once their bytes are shuffled.
+REPACKED_LAYOUT = OutputLayout(compression="gzip", shuffle=True, match_chunks=False)
+
+
+class RepackedCatalogue(NamedTuple):
+    """
+    The contents of a repacked catalogue. The particle columns are sorted by
+    ID. particle_types is None if VELOCIraptor did not write the types, and
+    bound_types and unbound_types are the sets of particle types present (or
+    None if unknown).
+    """
+
+    particle_ids: np.array
+    group_ids: np.array
+    bound: np.array
+    particle_types: np.array
+    bound_sizes: np.array
+    unbound_sizes: np.array
+    bound_hashes: np.array
+    unbound_hashes: np.array
+    bound_types: set = None
+    unbound_types: set = None
+
+    @property
+    def number_of_groups(self) -> int:
+        return self.bound_sizes.size
+
+
+def get_repacked_filename(catalogue_path: str) -> str:
+    return f"{catalogue_path}.catalog_repacked"
+
+
+def get_raw_catalogue_filenames(catalogue_path: str) -> list:
+    """
+    The raw VELOCIraptor files that the archive replaces.
+    """
+
+    return [
+        f"{catalogue_path}.{extension}"
+        for extension in [
+            "catalog_particles",
+            "catalog_particles.unbound",
+            "catalog_groups",
+            "catalog_parttypes",
+            "catalog_parttypes.unbound",
+        ]
+    ]
+
+
+def find_repacked_catalogue(catalogue_path: str):
+    """
+    The filename of the archive for the catalogue, or None if there is none,
+    or if it is older than any of the raw files that are still there.
+    """
+
+    filename = get_repacked_filename(catalogue_path)
+
+    if not os.path.exists(filename):
+        return None
+
+    modified = os.path.getmtime(filename)
+
+    for raw_filename in get_raw_catalogue_filenames(catalogue_path):
+        if os.path.exists(raw_filename) and os.path.getmtime(raw_filename) > modified:
+            return None
+
+    return filename
+
+
+def smallest_unsigned_dtype(maximum: int) -> np.dtype:
+    """
+    The narrowest unsigned integer type that can hold values up to maximum.
+    """
+
+    for dtype in [np.uint8, np.uint16, np.uint32, np.uint64]:
+        if maximum <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+
+    raise ValueError(f"{maximum} is too large to store.")
+
+
+def narrow_unsigned(array: np.array) -> np.array:
+    """
+    Returns the (non-negative) array with the dtype given by
+    smallest_unsigned_dtype, or unchanged if it has negative values.
+    """
+
+    if array.size > 0 and array.min() < 0:
+        return array
+
+    return array.astype(smallest_unsigned_dtype(int(array.max(initial=0))), copy=False)
+
+
+def read_velociraptor_particle_types(filename: str, unbound: bool = False):
+    """
+    Reads the particle type of each particle in the .catalog_particles (or
+    .unbound) file, or None if VELOCIraptor did not write them.
+    """
+
+    extension = "catalog_parttypes.unbound" if unbound else "catalog_parttypes"
+
+    try:
+        with h5py.File(f"{filename}.{extension}", "r") as handle:
+            return handle["Particle_types"][...]
+    except (OSError, KeyError):
+        return None
+
+
+def create_repacked_catalogue(catalogue_path: str) -> RepackedCatalogue:
+    """
+    Reads the raw VELOCIraptor catalogue at catalogue_path (without the
+    extensions) and sorts it into a RepackedCatalogue. Catalogues without a
+    .catalog_particles.unbound file are treated as having no unbound
+    particles.
+    """
+
+    parts = [(False, load_velociraptor_data)]
+
+    if os.path.exists(f"{catalogue_path}.catalog_particles.unbound"):
+        parts.append((True, load_velociraptor_data_unbound))
+
+    ids, groups, bound, types, sizes, hashes, type_sets = [], [], [], [], {}, {}, {}
+
+    for unbound, loader in parts:
+        particle_ids, group_sizes = loader(catalogue_path)
+        group_array = create_group_array(group_sizes)
+
+        ids.append(particle_ids)
+        groups.append(group_array)
+        bound.append(np.full(particle_ids.size, not unbound))
+        types.append(read_velociraptor_particle_types(catalogue_path, unbound=unbound))
+
+        sizes[unbound] = group_sizes
+        hashes[unbound] = calculate_catalogue_hashes(
+            [(particle_ids, group_array, None)], True, number_of_groups=group_sizes.size
+        ).hashes
+        type_sets[unbound] = (
+            None if types[-1] is None else set(int(ptype) for ptype in np.unique(types[-1]))
+        )
+
+    number_of_groups = sizes[False].size
+
+    if True not in sizes:
+        sizes[True] = np.zeros(number_of_groups, dtype=int)
+        hashes[True] = np.zeros(number_of_groups, dtype=np.uint64)
+        type_sets[True] = set()
+
+    particle_ids = np.concatenate(ids)
+    order = particle_ids.argsort(kind="stable")
+
+    if any(particle_types is None for particle_types in types):
+        particle_types = None
+    else:
+        particle_types = np.concatenate(types)[order].astype(np.int8)
+
+    return RepackedCatalogue(
+        particle_ids=particle_ids[order],
+        group_ids=np.concatenate(groups)[order].astype(smallest_group_dtype(number_of_groups)),
+        bound=np.concatenate(bound)[order],
+        particle_types=particle_types,
+        bound_sizes=narrow_unsigned(sizes[False]),
+        unbound_sizes=narrow_unsigned(sizes[True]),
+        bound_hashes=hashes[False],
+        unbound_hashes=hashes[True],
+        bound_types=type_sets[False],
+        unbound_types=type_sets[True],
+    )
+
+
+def write_repacked_catalogue(
+    filename: str,
+    repacked: RepackedCatalogue,
+    layout: OutputLayout = REPACKED_LAYOUT,
+    workers: int = 1,
+):
+    """
+    Writes the repacked catalogue to the HDF5 file at filename, with the
+    particle and group columns stored with the layout (see layout.py).
+    """
+
+    particle_columns = {
+        "ParticleIDs": narrow_unsigned(repacked.particle_ids),
+        "GroupID": repacked.group_ids,
+        "Bound": repacked.bound,
+        "ParticleType": repacked.particle_types,
+    }
+
+    group_columns = {
+        "BoundSize": repacked.bound_sizes,
+        "UnboundSize": repacked.unbound_sizes,
+        "BoundHash": repacked.bound_hashes,
+        "UnboundHash": repacked.unbound_hashes,
+    }
+
+    with h5py.File(filename, "w") as handle:
+        for group_name, columns in [("Particles", particle_columns), ("Groups", group_columns)]:
+            current_group = handle.create_group(group_name)
+
+            for name, column in columns.items():
+                if column is not None:
+                    create_dataset_with_layout(
+                        current_group, name, column, layout, workers=workers
+                    )
+
+        for name, particle_types in [
+            ("BoundParticleTypes", repacked.bound_types),
+            ("UnboundParticleTypes", repacked.unbound_types),
+        ]:
+            if particle_types is not None:
+                handle["Particles"].attrs[name] = np.array(
+                    sorted(particle_types), dtype=np.int8
+                )
+
+        handle["Particles/ParticleIDs"].attrs["OriginalDtype"] = repacked.particle_ids.dtype.str
+        handle["Groups"].attrs["NumberOfGroups"] = repacked.number_of_groups
+
+    return
+
+
+def read_repacked_catalogue(filename: str, include_unbound: bool = True) -> RepackedCatalogue:
+    """
+    Reads the archive written by write_repacked_catalogue, keeping only the
+    bound particles unless include_unbound.
+    """
+
+    with h5py.File(filename, "r") as handle:
+        particles = handle["Particles"]
+        groups = handle["Groups"]
+
+        columns = {
+            name: particles[name][...] if name in particles else None
+            for name in ["ParticleIDs", "GroupID", "Bound", "ParticleType"]
+        }
+
+        type_sets = [
+            set(int(ptype) for ptype in particles.attrs[name])
+            if name in particles.attrs
+            else None
+            for name in ["BoundParticleTypes", "UnboundParticleTypes"]
+        ]
+
+        repacked = RepackedCatalogue(
+            particle_ids=columns["ParticleIDs"].astype(
+                particles["ParticleIDs"].attrs["OriginalDtype"], copy=False
+            ),
+            group_ids=columns["GroupID"],
+            bound=columns["Bound"].astype(bool),
+            particle_types=columns["ParticleType"],
+            bound_sizes=groups["BoundSize"][...],
+            unbound_sizes=groups["UnboundSize"][...],
+            bound_hashes=groups["BoundHash"][...],
+            unbound_hashes=groups["UnboundHash"][...],
+            bound_types=type_sets[0],
+            unbound_types=type_sets[1],
+        )
+
+    if include_unbound:
+        return repacked
+
+    bound = repacked.bound
+
+    return repacked._replace(
+        particle_ids=repacked.particle_ids[bound],
+        group_ids=repacked.group_ids[bound],
+        bound=bound[bound],
+        particle_types=None
+        if repacked.particle_types is None
+        else repacked.particle_types[bound],
+    )
+
+
+def load_repacked_catalogue(
+    filename: str, include_unbound: bool, particle_types=None
+) -> Tuple[list, GroupHashes]:
+    """
+    Loads the archive in the same form as postprocess.load_catalogue (with
+    the bound and unbound particles as one entry, sorted by ID) along with
+    the group hashes that postprocess.calculate_catalogue_hashes would give.
+    """
+
+    repacked = read_repacked_catalogue(filename, include_unbound)
+
+    hashes = repacked.bound_hashes.copy()
+    sizes = repacked.bound_sizes.astype(np.int64)
+    catalogue_types = repacked.bound_types
+
+    if include_unbound:
+        hashes += repacked.unbound_hashes
+        sizes += repacked.unbound_sizes
+
+        if catalogue_types is not None and repacked.unbound_types is not None:
+            catalogue_types = catalogue_types | repacked.unbound_types
+        else:
+            catalogue_types = None
+
+    catalogue = [
+        (
+            repacked.particle_ids,
+            repacked.group_ids,
+            select_particle_types(catalogue_types, particle_types),
+        )
+    ]
+
+    return catalogue, GroupHashes(hashes=hashes, sizes=sizes, include_unbound=include_unbound)
+
+
+def repack_catalogue(
+    catalogue_path: str, layout: OutputLayout = REPACKED_LAYOUT, workers: int = 1
+) -> str:
+    """
+    Repacks the raw catalogue at catalogue_path into its archive, returning
+    the filename of the archive.
+    """
+
+    filename = get_repacked_filename(catalogue_path)
+
+    write_repacked_catalogue(
+        filename, create_repacked_catalogue(catalogue_path), layout, workers=workers
+    )
+
+    return filename
+
+
+if __name__ == "__main__":
+    import argparse as ap
+
+    PARSER = ap.ArgumentParser(
+        description="""
+        Repacks the VELOCIraptor catalogues of snapshots into compact archives of
+        the particle IDs (sorted), their groups and whether they are bound, and
+        the group sizes, which postprocess.py then reads instead of the raw
+        catalogue files. Run this once after run_velociraptor.py.
+        """
+    )
+
+    PARSER.add_argument(
+        "-i",
+        "--input",
+        help="""
+        Input snapshot filename. This should be provided WITHOUT the .hdf5. Give
+        several to repack the catalogues of each. Required.
+        """,
+        required=True,
+        nargs="+",
+    )
+
+    PARSER.add_argument(
+        "-d",
+        "--directory",
+        help="""
+        Directory that the snapshots and halos should live in. Required.
+        """,
+        required=True,
+    )
+
+    PARSER.add_argument(
+        "-c",
+        "--catalogue",
+        help="""
+        Name of the catalogue (i.e. the directory that it exists in). Defaults
+        to 'halo'.
+        """,
+        required=False,
+        default="halo",
+    )
+
+    PARSER.add_argument(
+        "--layout",
+        help="""
+        Filter for the archive, as in postprocess.py. Default: shuffle+gzip
+        """,
+        required=False,
+        default="shuffle+gzip",
+    )
+
+    PARSER.add_argument(
+        "--io-workers",
+        help="""
+        Number of threads that compress the archive at the same time. Default: 1
+        """,
+        required=False,
+        type=int,
+        default=1,
+    )
+
+    ARGS = vars(PARSER.parse_args())
+
+    layout = parse_output_layout(ARGS["layout"])._replace(match_chunks=False)
+
+    for input in ARGS["input"]:
+        filename = repack_catalogue(
+            f"{ARGS['directory']}/{ARGS['catalogue']}/{input}",
+            layout=layout,
+            workers=ARGS["io_workers"],
+        )
+
+        print(f"Wrote {filename}")
@@ -1,14 +1,42 @@
 """
 This python script runs velociraptor on a given snapshot.
 
-This is a really thin wrapper, but is nicely shell-agnostic, and the function
-run_velociraptor can be scripted.
+This is a thin wrapper, but is nicely shell-agnostic, and the function
+run_velociraptor can be scripted. VELOCIraptor is run as a watched child
+process: its memory (RSS), CPU use and output files are sampled from /proc,
+its log is followed to report which stage it is in, and it is stopped
+cleanly if it goes over the memory or wall-clock limits (or stops making any
+progress), so that failures show up straight away rather than as missing
+catalogue files later on.
 """
 
 import os
+import re
+import sys
+import glob
+import json
+import time
+import signal
 import pathlib
+import subprocess
 
-from typing import Tuple
+from typing import NamedTuple, Tuple
+
+# The catalogue files that postprocess.py needs from a successful run.
+REQUIRED_OUTPUTS = ["catalog_particles", "catalog_groups"]
+
+# Messages in the (Verbose=1) log that mark the start of each stage, checked
+# case-insensitively in order; a line matching several is given the last.
+STAGE_PATTERNS = [
+    ("reading snapshot", re.compile(r"\bread", re.IGNORECASE)),
+    ("finding groups", re.compile(r"\bfof\b|search", re.IGNORECASE)),
+    ("finding substructure", re.compile(r"substructure", re.IGNORECASE)),
+    ("calculating properties", re.compile(r"\bpropert", re.IGNORECASE)),
+    ("writing output", re.compile(r"\bwrit", re.IGNORECASE)),
+]
+
+# Time given to VELOCIraptor to exit after SIGTERM before it is killed.
+TERMINATE_TIMEOUT = 10.0
 
 
 class InputError(Exception):
@@ -22,36 +50,392 @@ class InputError(Exception):
         self.message = message
 
 
+class VelociraptorError(Exception):
+    """Exception raised when a VELOCIraptor run does not complete.
+
+    Attributes:
+        message -- explanation of the error
+        result -- the RunResult of the run
+    """
+
+    def __init__(self, message, result):
+        self.message = message
+        self.result = result
+
+
+class ResourceSample(NamedTuple):
+    """
+    One sample of a running VELOCIraptor (and any processes it started).
+    cpu_use is the average number of busy cores since the previous sample.
+    """
+
+    elapsed_seconds: float
+    rss_bytes: int
+    cpu_seconds: float
+    cpu_use: float
+    output_bytes: int
+    log_bytes: int
+    stage: str
+
+
+class RunResult(NamedTuple):
+    """
+    The outcome of a VELOCIraptor run. status is one of "completed",
+    "failed" (non-zero exit, or missing outputs), "memory_limit",
+    "time_limit" or "stalled"; the last three mean that it was stopped.
+    """
+
+    status: str
+    return_code: int
+    wall_time_seconds: float
+    peak_memory_bytes: int
+    cpu_seconds: float
+    output_bytes: int
+    stage: str
+    missing_outputs: list
+    log_filename: str
+
+    @property
+    def succeeded(self) -> bool:
+        return self.status == "completed"
+
+    def describe(self) -> str:
+        return (
+            f"VELOCIraptor {self.status} (exit code {self.return_code}) after "
+            f"{self.wall_time_seconds:.0f} s in stage '{self.stage}', peak memory "
+            f"{self.peak_memory_bytes / 1e9:.2f} GB, {self.cpu_seconds:.0f} s CPU, "
+            f"{self.output_bytes / 1e9:.2f} GB written. Log: {self.log_filename}"
+        )
+
+
+def get_process_tree(pid: int) -> list:
+    """
+    The pid and those of all of its (living) descendants.
+    """
+
+    pids = [pid]
+
+    for current in pids:
+        for children in glob.glob(f"/proc/{current}/task/*/children"):
+            try:
+                with open(children, "r") as handle:
+                    pids += [int(child) for child in handle.read().split()]
+            except (OSError, ValueError):
+                pass
+
+    return pids
+
+
+def read_process_usage(pid: int) -> Tuple[int, float]:
+    """
+    The resident memory (bytes) and CPU time (seconds) used so far by the
+    process, or zeros if it has gone.
+    """
+
+    try:
+        with open(f"/proc/{pid}/stat", "r") as handle:
+            # The command name may contain spaces, so split after it.
+            fields = handle.read().rsplit(")", 1)[1].split()
+    except (OSError, IndexError):
+        return 0, 0.0
+
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    rss_bytes = int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+
+    return rss_bytes, cpu_seconds
+
+
+def get_output_bytes(output_path: str, exclude=()) -> int:
+    """
+    The total size of the files written so far at output_path.*, except
+    those in exclude.
+    """
+
+    total = 0
+
+    for filename in glob.glob(f"{glob.escape(output_path)}.*"):
+        if filename in exclude:
+            continue
+
+        try:
+            total += os.path.getsize(filename)
+        except OSError:
+            pass
+
+    return total
+
+
+def find_stage(lines: list, stage: str) -> str:
+    """
+    The stage that VELOCIraptor is in after printing lines, given that it
+    was in stage before them (see STAGE_PATTERNS).
+    """
+
+    for line in lines:
+        for name, pattern in STAGE_PATTERNS:
+            if pattern.search(line):
+                stage = name
+
+    return stage
+
+
+def find_missing_outputs(output_path: str) -> list:
+    """
+    The files in REQUIRED_OUTPUTS that were not written to output_path.
+    """
+
+    return [
+        extension
+        for extension in REQUIRED_OUTPUTS
+        if not os.path.exists(f"{output_path}.{extension}")
+    ]
+
+
+def stop_process_group(process: subprocess.Popen, timeout: float = TERMINATE_TIMEOUT):
+    """
+    Sends SIGTERM to the process group of process (i.e. VELOCIraptor and
+    anything it started), and SIGKILL if it has not exited after timeout.
+    """
+
+    for sent, wait in [(signal.SIGTERM, timeout), (signal.SIGKILL, None)]:
+        try:
+            os.killpg(process.pid, sent)
+        except ProcessLookupError:
+            return
+
+        try:
+            process.wait(timeout=wait)
+            return
+        except subprocess.TimeoutExpired:
+            continue
+
+    return
+
+
 def run_velociraptor(
     snapshot_filename: str,
     velociraptor_path: str,
     output_path: str,
     omp_num_threads: int,
     velociraptor_options_file_path="velociraptor.cfg",
-) -> None:
+    memory_limit=None,
+    time_limit=None,
+    stall_limit=None,
+    log_filename=None,
+    sample_interval: float = 1.0,
+    progress=None,
+) -> RunResult:
     """
-    Runs VELOCIRAPTOR with omp_num_threads.
+    Runs VELOCIRAPTOR with omp_num_threads (or the default if -1), writing
+    its output to log_filename (default: {output_path}.log).
+
+    Every sample_interval seconds the memory, CPU use and output of the run
+    are sampled, and passed (as a ResourceSample) to progress, if given. The
+    run is stopped if its memory goes over memory_limit (bytes), if it runs
+    for longer than time_limit (seconds), or if neither the log nor the
+    output files grow for stall_limit seconds.
+
+    Returns a RunResult; this does not raise if the run fails.
     """
 
+    environment = dict(os.environ)
+
     if omp_num_threads != -1:
-        os.environ["OMP_NUM_THREADS"] = f"{omp_num_threads}"
-
-    os.system(
-        " ".join(
-            [
-                velociraptor_path,
-                "-I 2",
-                "-i",
-                snapshot_filename,
-                "-C",
-                velociraptor_options_file_path,
-                "-o",
-                output_path,
-            ]
+        environment["OMP_NUM_THREADS"] = f"{omp_num_threads}"
+
+    if log_filename is None:
+        log_filename = f"{output_path}.log"
+
+    arguments = [
+        velociraptor_path,
+        "-I",
+        "2",
+        "-i",
+        snapshot_filename,
+        "-C",
+        velociraptor_options_file_path,
+        "-o",
+        output_path,
+    ]
+
+    start = time.monotonic()
+    last_sample = start
+    last_growth = start
+    last_cpu_seconds = 0.0
+    last_sizes = (0, 0)
+
+    peak_memory_bytes = 0
+    output_bytes = 0
+    stage = "starting"
+    status = None
+    log_offset = 0
+    partial_line = ""
+
+    with open(log_filename, "wb") as log:
+        # A new session, so that the whole group can be stopped at once.
+        process = subprocess.Popen(
+            arguments,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            env=environment,
+            start_new_session=True,
         )
+
+    with open(log_filename, "r", errors="replace") as log:
+        while True:
+            # wait4 rather than poll, for the resource use of the child.
+            pid, wait_status, usage = os.wait4(process.pid, os.WNOHANG)
+
+            if pid != 0:
+                process.returncode = os.waitstatus_to_exitcode(wait_status)
+                break
+
+            usages = [read_process_usage(child) for child in get_process_tree(process.pid)]
+            rss_bytes = sum(rss for rss, _ in usages)
+            cpu_seconds = sum(cpu for _, cpu in usages)
+
+            text = partial_line + log.read()
+            log_offset = log.tell()
+            lines = text.split("\n")
+            partial_line = lines.pop()
+            stage = find_stage(lines, stage)
+
+            output_bytes = get_output_bytes(output_path, exclude=(log_filename,))
+
+            now = time.monotonic()
+            peak_memory_bytes = max(peak_memory_bytes, rss_bytes)
+
+            if (output_bytes, log_offset) != last_sizes:
+                last_sizes = (output_bytes, log_offset)
+                last_growth = now
+
+            if progress is not None:
+                progress(
+                    ResourceSample(
+                        elapsed_seconds=now - start,
+                        rss_bytes=rss_bytes,
+                        cpu_seconds=cpu_seconds,
+                        cpu_use=(cpu_seconds - last_cpu_seconds)
+                        / max(now - last_sample, 1e-9),
+                        output_bytes=output_bytes,
+                        log_bytes=log_offset,
+                        stage=stage,
+                    )
+                )
+
+            last_sample = now
+            last_cpu_seconds = cpu_seconds
+
+            if memory_limit is not None and rss_bytes > memory_limit:
+                status = "memory_limit"
+            elif time_limit is not None and now - start > time_limit:
+                status = "time_limit"
+            elif stall_limit is not None and now - last_growth > stall_limit:
+                status = "stalled"
+
+            if status is not None:
+                stop_process_group(process)
+                usage = None
+                break
+
+            time.sleep(sample_interval)
+
+        stage = find_stage((partial_line + log.read()).split("\n"), stage)
+
+    wall_time_seconds = time.monotonic() - start
+
+    if usage is not None:
+        # ru_maxrss is in kB, and covers descendants that were waited for.
+        peak_memory_bytes = max(peak_memory_bytes, usage.ru_maxrss * 1024)
+        cpu_seconds = usage.ru_utime + usage.ru_stime
+    else:
+        cpu_seconds = last_cpu_seconds
+
+    missing_outputs = find_missing_outputs(output_path)
+
+    if status is None:
+        status = "completed" if process.returncode == 0 and not missing_outputs else "failed"
+
+    return RunResult(
+        status=status,
+        return_code=process.returncode,
+        wall_time_seconds=wall_time_seconds,
+        peak_memory_bytes=peak_memory_bytes,
+        cpu_seconds=cpu_seconds,
+        output_bytes=get_output_bytes(output_path, exclude=(log_filename,)),
+        stage=stage,
+        missing_outputs=missing_outputs,
+        log_filename=log_filename,
     )
 
 
+def format_sample(sample: ResourceSample) -> str:
+    return (
+        f"[{sample.elapsed_seconds:8.0f} s] {sample.stage}: "
+        f"{sample.rss_bytes / 1e9:.2f} GB resident, {sample.cpu_use:.1f} cores busy, "
+        f"{sample.output_bytes / 1e9:.2f} GB written"
+    )
+
+
+def write_run_record(
+    filename: str, result: RunResult, snapshot_filename: str, omp_num_threads: int
+):
+    """
+    Appends a record of the run to filename (one JSON object per line), in
+    the form that generate_slurm.py calibrates its estimates with.
+    """
+
+    from velociraptor_config import read_particle_numbers
+
+    record = dict(
+        snapshot=snapshot_filename,
+        number_of_particles=[
+            int(number) for number in read_particle_numbers(f"{snapshot_filename}.hdf5")
+        ],
+        peak_memory_bytes=result.peak_memory_bytes,
+        wall_time_seconds=result.wall_time_seconds,
+        threads=omp_num_threads if omp_num_threads != -1 else os.cpu_count(),
+        status=result.status,
+    )
+
+    with open(filename, "a") as handle:
+        handle.write(json.dumps(record) + "\n")
+
+    return
+
+
+def autotune_velociraptor(
+    snapshot_filename: str,
+    output_path: str,
+    omp_num_threads: int,
+    velociraptor_options_file_path="velociraptor.cfg",
+):
+    """
+    Writes a copy of the configuration file tuned to the size of the snapshot
+    (given without the .hdf5) to {output_path}.autotuned.cfg, and picks the
+    number of threads if omp_num_threads is -1.
+
+    Returns the number of threads, the path to the tuned configuration file,
+    and the resource estimate (see velociraptor_config.py).
+    """
+
+    from velociraptor_config import create_tuned_config
+
+    tuned_config_path = f"{output_path}.autotuned.cfg"
+
+    estimate = create_tuned_config(
+        snapshot_filename=f"{snapshot_filename}.hdf5",
+        template_filename=velociraptor_options_file_path,
+        output_filename=tuned_config_path,
+        maximum_threads=None if omp_num_threads == -1 else omp_num_threads,
+    )
+
+    if omp_num_threads == -1:
+        omp_num_threads = estimate.threads
+
+    return omp_num_threads, tuned_config_path, estimate
+
+
 def parse_output_path(output_path: str) -> Tuple[str]:
     """
     Parses the output path into the "filename" bit, and the
@@ -84,7 +468,8 @@ if __name__ == "__main__":
         A very thin wrapper around VELOCIraptor in python. Used for scripting.
         You will need to have pre-compiled velociraptor, and found the stf
         binary. You should compile VELOCIraptor without MPI, but with OMP
-        support.
+        support. The run is watched, its progress printed, and it is stopped if
+        it goes over the given limits; the exit code is non-zero if it failed.
         """
     )
 
@@ -159,6 +544,73 @@ if __name__ == "__main__":
         default="halo"
     )
 
+    PARSER.add_argument(
+        "-a",
+        "--autotune",
+        help="""
+        Tune the configuration file (buffer sizes) and, if -t is not set, the
+        number of threads to the size of the snapshot, and print the estimated
+        memory and wall time for the run.
+        """,
+        required=False,
+        action="store_true",
+    )
+
+    PARSER.add_argument(
+        "-m",
+        "--memory-limit",
+        help="""
+        Stop VELOCIraptor if its resident memory goes over this many GB. Default:
+        no limit.
+        """,
+        required=False,
+        type=float,
+        default=None,
+    )
+
+    PARSER.add_argument(
+        "-w",
+        "--time-limit",
+        help="""
+        Stop VELOCIraptor if it is still running after this many hours. Default:
+        no limit.
+        """,
+        required=False,
+        type=float,
+        default=None,
+    )
+
+    PARSER.add_argument(
+        "--stall-limit",
+        help="""
+        Stop VELOCIraptor if neither its log nor its output files grow for this
+        many minutes. Default: no limit.
+        """,
+        required=False,
+        type=float,
+        default=None,
+    )
+
+    PARSER.add_argument(
+        "--report-interval",
+        help="""
+        Print the stage and resource use of the run at least this often, in
+        seconds (and whenever the stage changes). Default: 60
+        """,
+        required=False,
+        type=float,
+        default=60.0,
+    )
+
+    PARSER.add_argument(
+        "--records",
+        help="""
+        Append a record of the run (particle numbers, peak memory, wall time and
+        threads) to this file, for calibrating generate_slurm.py.
+        """,
+        required=False,
+        default=None,
+    )
 
     ARGS = vars(PARSER.parse_args())
 
@@ -185,4 +637,55 @@ if __name__ == "__main__":
         velociraptor_options_file_path=ARGS["config"],
     )
 
-    run_velociraptor(**runtime_options)
+    if ARGS["autotune"]:
+        from velociraptor_config import format_estimate
+
+        threads, config, estimate = autotune_velociraptor(
+            snapshot_filename=runtime_options["snapshot_filename"],
+            output_path=runtime_options["output_path"],
+            omp_num_threads=runtime_options["omp_num_threads"],
+            velociraptor_options_file_path=runtime_options["velociraptor_options_file_path"],
+        )
+
+        print(format_estimate(estimate))
+
+        runtime_options["omp_num_threads"] = threads
+        runtime_options["velociraptor_options_file_path"] = config
+
+    last_report = {"elapsed_seconds": None, "stage": None}
+
+    def report(sample: ResourceSample):
+        if (
+            sample.stage != last_report["stage"]
+            or last_report["elapsed_seconds"] is None
+            or sample.elapsed_seconds - last_report["elapsed_seconds"]
+            >= ARGS["report_interval"]
+        ):
+            print(format_sample(sample), flush=True)
+            last_report.update(elapsed_seconds=sample.elapsed_seconds, stage=sample.stage)
+
+    result = run_velociraptor(
+        **runtime_options,
+        memory_limit=None
+        if ARGS["memory_limit"] is None
+        else int(ARGS["memory_limit"] * 1e9),
+        time_limit=None if ARGS["time_limit"] is None else ARGS["time_limit"] * 3600,
+        stall_limit=None if ARGS["stall_limit"] is None else ARGS["stall_limit"] * 60,
+        progress=report,
+    )
+
+    print(result.describe())
+
+    if ARGS["records"] is not None:
+        write_run_record(
+            ARGS["records"],
+            result,
+            runtime_options["snapshot_filename"],
+            runtime_options["omp_num_threads"],
+        )
+
+    if not result.succeeded:
+        if result.missing_outputs:
+            print(f"Missing outputs: {', '.join(result.missing_outputs)}")
+
+        sys.exit(result.return_code if result.return_code > 0 else 1)
@@ -0,0 +1,549 @@
+"""
+Builds a periodic cell-linked list over the particle coordinates in a
+snapshot, stored alongside it, and uses it to find every particle (of any
+type, bound or not) within some radius of each halo or galaxy centre.
+
+The box is split into cells_per_dimension^3 cells, and the particles of each
+type are sorted by cell. An aperture query then only has to look at the
+particles in the cells that overlap the sphere, with distances computed in
+the periodic box given by Header/BoxSize.
+
+The centres can be calculated from the GroupID arrays written by
+postprocess.py (periodic centres of mass), or read from the VELOCIraptor
+.properties file.
+
+For usage information, use python3 spatial_index.py -h
+"""
+
+import os
+import numpy as np
+import h5py
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
+
+from helper import *
+
+# Aim for this many particles (of all types) per cell on average.
+PARTICLES_PER_CELL = 8
+# The cell offsets are stored for every cell, so cap their number.
+MAXIMUM_CELLS_PER_DIMENSION = 256
+
+
+def read_box_size(snapshot_filename: str) -> np.array:
+    """
+    Reads Header/BoxSize from the snapshot as an array with the size of the
+    box along each axis.
+    """
+
+    with h5py.File(snapshot_filename, "r") as handle:
+        box_size = np.array(handle["Header"].attrs["BoxSize"], dtype=np.float64)
+
+    return np.broadcast_to(box_size, (3,)).copy()
+
+
+def choose_cells_per_dimension(number_of_particles: int) -> int:
+    """
+    The number of cells along each axis, so that there are roughly
+    PARTICLES_PER_CELL particles per cell.
+    """
+
+    cells = int(np.cbrt(number_of_particles / PARTICLES_PER_CELL))
+
+    return int(np.clip(cells, 1, MAXIMUM_CELLS_PER_DIMENSION))
+
+
+def wrap_separations(separations: np.array, box_size: np.array) -> np.array:
+    """
+    Wraps separations into [-box_size / 2, box_size / 2).
+    """
+
+    return (separations + 0.5 * box_size) % box_size - 0.5 * box_size
+
+
+def calculate_cell_indices(
+    coordinates: np.array, box_size: np.array, cells_per_dimension: int
+) -> np.array:
+    """
+    Calculates the (flattened) cell that each particle is in, wrapping any
+    particles outside of the box back into it.
+    """
+
+    cell_size = box_size / cells_per_dimension
+
+    cells = np.floor((coordinates % box_size) / cell_size).astype(np.int64)
+    # Rounding can put particles at the very edge into the next cell.
+    np.clip(cells, 0, cells_per_dimension - 1, out=cells)
+
+    return (
+        cells[:, 0] * cells_per_dimension + cells[:, 1]
+    ) * cells_per_dimension + cells[:, 2]
+
+
+class SpatialIndex:
+    """
+    A periodic cell-linked list over the coordinates of the particles of each
+    type. For each particle type,
+
+        order[cell_offsets[c]:cell_offsets[c + 1]]
+
+    are the positions in the snapshot of the particles in cell c, and
+    coordinates holds their coordinates in the same (sorted) order.
+    """
+
+    def __init__(self, box_size: np.array, cells_per_dimension: int):
+        self.box_size = np.broadcast_to(np.array(box_size, dtype=np.float64), (3,)).copy()
+        self.cells_per_dimension = cells_per_dimension
+
+        self.cell_offsets = {}
+        self.order = {}
+        self.coordinates = {}
+
+    @property
+    def cell_size(self) -> np.array:
+        return self.box_size / self.cells_per_dimension
+
+    @property
+    def particle_types(self) -> list:
+        return sorted(self.order.keys())
+
+    def add_particles(self, ptype: int, coordinates: np.array):
+        """
+        Sorts the particles of ptype, with coordinates in snapshot order, into
+        their cells.
+        """
+
+        cells = calculate_cell_indices(coordinates, self.box_size, self.cells_per_dimension)
+
+        # Stable, so that particles within a cell stay in snapshot order.
+        order = np.argsort(cells, kind="stable")
+        counts = np.bincount(cells, minlength=self.cells_per_dimension ** 3)
+
+        self.cell_offsets[ptype] = np.concatenate([[0], np.cumsum(counts)])
+        self.order[ptype] = order
+        self.coordinates[ptype] = coordinates[order]
+
+        return
+
+    @classmethod
+    def from_snapshot(cls, snapshot_filename: str, cells_per_dimension=None):
+        """
+        Builds the index for all particle types with coordinates in the
+        snapshot (including .hdf5).
+        """
+
+        box_size = read_box_size(snapshot_filename)
+
+        with h5py.File(snapshot_filename, "r") as handle:
+            particle_types = [
+                ptype for ptype in range(6) if f"PartType{ptype}/Coordinates" in handle
+            ]
+
+            if cells_per_dimension is None:
+                cells_per_dimension = choose_cells_per_dimension(
+                    sum(handle[f"PartType{ptype}/Coordinates"].shape[0] for ptype in particle_types)
+                )
+
+            index = cls(box_size, cells_per_dimension)
+
+            for ptype in particle_types:
+                index.add_particles(ptype, handle[f"PartType{ptype}/Coordinates"][...])
+
+        return index
+
+    def write(self, filename: str, snapshot_filename=None):
+        """
+        Writes the index to a HDF5 file. If snapshot_filename is given, its
+        size and modification time are stored so that stale indices can be
+        detected by is_up_to_date.
+        """
+
+        with h5py.File(filename, "w") as handle:
+            handle.attrs["BoxSize"] = self.box_size
+            handle.attrs["CellsPerDimension"] = self.cells_per_dimension
+
+            if snapshot_filename is not None:
+                status = os.stat(snapshot_filename)
+                handle.attrs["SnapshotSize"] = status.st_size
+                handle.attrs["SnapshotModificationTime"] = status.st_mtime
+
+            for ptype in self.particle_types:
+                current_group = handle.create_group(f"PartType{ptype}")
+                current_group.create_dataset("CellOffsets", data=self.cell_offsets[ptype])
+                current_group.create_dataset("Order", data=self.order[ptype])
+                current_group.create_dataset("Coordinates", data=self.coordinates[ptype])
+
+        return
+
+    @classmethod
+    def read(cls, filename: str, mmap: bool = True):
+        """
+        Reads an index written by write. The (large) sorted coordinates and
+        order are memory-mapped if mmap is true.
+        """
+
+        with h5py.File(filename, "r") as handle:
+            index = cls(handle.attrs["BoxSize"], int(handle.attrs["CellsPerDimension"]))
+
+            for ptype in range(6):
+                if f"PartType{ptype}" not in handle:
+                    continue
+
+                current_group = handle[f"PartType{ptype}"]
+                index.cell_offsets[ptype] = current_group["CellOffsets"][...]
+                index.order[ptype] = read_dataset(current_group["Order"], mmap=mmap)
+                index.coordinates[ptype] = read_dataset(current_group["Coordinates"], mmap=mmap)
+
+        return index
+
+    def find_cells(self, centre: np.array, radius: float) -> np.array:
+        """
+        Finds the (flattened) cells that overlap the sphere of radius around
+        centre, accounting for the periodic box.
+        """
+
+        cells_per_dimension = self.cells_per_dimension
+
+        ranges = []
+
+        for axis in range(3):
+            low = int(np.floor((centre[axis] - radius) / self.cell_size[axis]))
+            high = int(np.floor((centre[axis] + radius) / self.cell_size[axis]))
+
+            if high - low + 1 >= cells_per_dimension:
+                ranges.append(np.arange(cells_per_dimension))
+            else:
+                ranges.append(np.arange(low, high + 1) % cells_per_dimension)
+
+        x, y, z = np.meshgrid(*ranges, indexing="ij")
+
+        return ((x * cells_per_dimension + y) * cells_per_dimension + z).ravel()
+
+    def query(self, centre: np.array, radius: float, ptype: int) -> np.array:
+        """
+        Finds the particles of ptype within radius of centre. Returns their
+        positions in the snapshot, in ascending order.
+        """
+
+        cell_offsets = self.cell_offsets[ptype]
+        cells = self.find_cells(centre, radius)
+
+        starts = cell_offsets[cells]
+        lengths = cell_offsets[cells + 1] - starts
+
+        # All of the candidates at once: a range for every cell.
+        candidate_offsets = np.cumsum(lengths) - lengths
+        candidates = np.arange(lengths.sum()) + np.repeat(starts - candidate_offsets, lengths)
+
+        separations = wrap_separations(
+            self.coordinates[ptype][candidates] - centre, self.box_size
+        )
+        inside = np.einsum("ij,ij->i", separations, separations) <= radius ** 2
+
+        return np.sort(self.order[ptype][candidates[inside]])
+
+    def query_apertures(
+        self, centres: np.array, radii, particle_types=None, threads=None
+    ) -> dict:
+        """
+        Finds the particles within radii (one per centre, or a single radius)
+        of each of the centres, for each of particle_types (default: all),
+        spreading the queries over a pool of threads.
+
+        Returns a dictionary of {ptype: [positions for each centre]}.
+        """
+
+        centres = np.atleast_2d(centres)
+        radii = np.broadcast_to(radii, (centres.shape[0],))
+
+        if particle_types is None:
+            particle_types = self.particle_types
+
+        particle_types = [ptype for ptype in particle_types if ptype in self.order]
+
+        def query_centre(index):
+            return [
+                self.query(centres[index], radii[index], ptype) for ptype in particle_types
+            ]
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            results = list(pool.map(query_centre, range(centres.shape[0])))
+
+        return {
+            ptype: [result[type_index] for result in results]
+            for type_index, ptype in enumerate(particle_types)
+        }
+
+
+def is_up_to_date(index_filename: str, snapshot_filename: str) -> bool:
+    """
+    Whether the index at index_filename exists and was built from the
+    current version of the snapshot.
+    """
+
+    if not os.path.exists(index_filename):
+        return False
+
+    status = os.stat(snapshot_filename)
+
+    with h5py.File(index_filename, "r") as handle:
+        return bool(
+            handle.attrs.get("SnapshotSize") == status.st_size
+            and handle.attrs.get("SnapshotModificationTime") == status.st_mtime
+        )
+
+
+def load_or_build_index(
+    snapshot_filename: str, cells_per_dimension=None, rebuild: bool = False
+) -> SpatialIndex:
+    """
+    Reads the index for the snapshot (excluding .hdf5) from
+    snapshot_filename.spatial_index, building and writing it first if it does
+    not exist, is out of date, or rebuild is true.
+    """
+
+    index_filename = f"{snapshot_filename}.spatial_index"
+    hdf5_filename = f"{snapshot_filename}.hdf5"
+
+    if rebuild or not is_up_to_date(index_filename, hdf5_filename):
+        index = SpatialIndex.from_snapshot(hdf5_filename, cells_per_dimension)
+        index.write(index_filename, snapshot_filename=hdf5_filename)
+
+    return SpatialIndex.read(index_filename)
+
+
+def calculate_group_centres(
+    coordinates: dict, masses: dict, groups_snapshot: dict, box_size: np.array
+) -> Tuple[np.array]:
+    """
+    Calculates the centre of mass of each group from the coordinates and
+    masses ({ptype: array}) of the particles and their GroupID arrays
+    (as written by postprocess.py), accounting for groups that straddle the
+    edge of the periodic box.
+
+    Returns the group IDs that have any particles and their centres.
+    """
+
+    particle_types = [ptype for ptype in groups_snapshot.keys() if ptype in coordinates]
+
+    groups, _ = combine_arrays([groups_snapshot[ptype] for ptype in particle_types])
+    positions, _ = combine_arrays([coordinates[ptype] for ptype in particle_types])
+    weights, _ = combine_arrays([masses[ptype] for ptype in particle_types])
+
+    in_group = groups >= 0
+    groups = groups[in_group]
+    positions = positions[in_group]
+    weights = weights[in_group].astype(np.float64)
+
+    group_ids, first = np.unique(groups, return_index=True)
+    group_index = np.searchsorted(group_ids, groups)
+
+    # Measure every particle relative to one particle in the same group, so
+    # that groups across the box edge are not averaged across the box.
+    reference = positions[first]
+    separations = wrap_separations(positions - reference[group_index], box_size)
+
+    total_weights = np.bincount(group_index, weights=weights, minlength=group_ids.size)
+
+    centres = np.empty((group_ids.size, 3), dtype=np.float64)
+
+    for axis in range(3):
+        centres[:, axis] = (
+            np.bincount(group_index, weights=weights * separations[:, axis], minlength=group_ids.size)
+            / total_weights
+        )
+
+    return group_ids, (reference + centres) % box_size
+
+
+def read_coordinates_and_masses(snapshot_filename: str, particle_types: list) -> Tuple[dict]:
+    """
+    Reads the coordinates and masses of particle_types from the snapshot
+    (including .hdf5). Particle types without a Masses dataset use the mass
+    from Header/MassTable.
+    """
+
+    coordinates = {}
+    masses = {}
+
+    with h5py.File(snapshot_filename, "r") as handle:
+        mass_table = handle["Header"].attrs.get("MassTable", np.ones(6))
+
+        for ptype in particle_types:
+            try:
+                coordinates[ptype] = handle[f"PartType{ptype}/Coordinates"][...]
+            except KeyError:
+                continue
+
+            try:
+                masses[ptype] = handle[f"PartType{ptype}/Masses"][...]
+            except KeyError:
+                masses[ptype] = np.full(coordinates[ptype].shape[0], mass_table[ptype])
+
+    return coordinates, masses
+
+
+def load_velociraptor_centres(filename: str, length_unit: float = 1.0) -> Tuple[np.array]:
+    """
+    Reads the centres (Xc, Yc, Zc) of the groups from the VELOCIraptor
+    .properties file, multiplied by length_unit to convert them to the units
+    of the snapshot coordinates. Returns the group IDs (their positions in
+    the catalogue, as in the GroupID arrays) and the centres.
+    """
+
+    with h5py.File(f"{filename}.properties", "r") as handle:
+        centres = np.stack(
+            [handle[name][...] for name in ["Xc", "Yc", "Zc"]], axis=1
+        ) * length_unit
+
+    return np.arange(centres.shape[0]), centres
+
+
+def write_apertures_to_file(
+    filename: str, group_ids: np.array, centres: np.array, radii, apertures: dict
+):
+    """
+    Writes the results of SpatialIndex.query_apertures to a HDF5 file. The
+    particles of each type are stored as one Index array of positions in the
+    snapshot, with the Offset and Length for each centre.
+    """
+
+    with h5py.File(filename, "w") as handle:
+        handle.create_dataset("GroupID", data=group_ids)
+        handle.create_dataset("Centres", data=centres)
+        handle.create_dataset("Radii", data=np.broadcast_to(radii, (centres.shape[0],)))
+
+        for ptype, positions in apertures.items():
+            lengths = np.array([x.size for x in positions], dtype=np.int64)
+
+            current_group = handle.create_group(f"PartType{ptype}")
+            current_group.create_dataset("Offset", data=np.cumsum(lengths) - lengths)
+            current_group.create_dataset("Length", data=lengths)
+            current_group.create_dataset(
+                "Index",
+                data=np.concatenate(positions) if positions else np.empty(0, dtype=np.int64),
+            )
+
+    return
+
+
+if __name__ == "__main__":
+    # Run in script mode!
+    import argparse as ap
+
+    from postprocess import InputError, read_ordered_groups_from_file
+
+    PARSER = ap.ArgumentParser(
+        description="""
+        Finds all particles, of every type, within a radius of the centre of
+        each group. The spatial index for the snapshot is built (and stored
+        as <snapshot>.spatial_index) the first time it is needed.
+        """
+    )
+
+    PARSER.add_argument(
+        "-s",
+        "--snapshot",
+        help="""
+        Snapshot filename (including path, but excluding .hdf5). Required.
+        """,
+        required=True,
+    )
+
+    PARSER.add_argument(
+        "-g",
+        "--groups",
+        help="""
+        Path to the .ordered_group_particles file to calculate the centres
+        (of mass) of the groups from.
+        """,
+        required=False,
+        default=None,
+    )
+
+    PARSER.add_argument(
+        "-c",
+        "--catalogue",
+        help="""
+        Path to the VELOCIraptor catalogue (without extension) to read the
+        centres from instead, from its .properties file.
+        """,
+        required=False,
+        default=None,
+    )
+
+    PARSER.add_argument(
+        "-u",
+        "--length-unit",
+        help="""
+        Factor to convert the VELOCIraptor centres to the units of the
+        snapshot coordinates. Default: 1.
+        """,
+        required=False,
+        type=float,
+        default=1.0,
+    )
+
+    PARSER.add_argument(
+        "-r",
+        "--radius",
+        help="""
+        Radius of the apertures, in the units of the snapshot coordinates.
+        Required.
+        """,
+        required=True,
+        type=float,
+    )
+
+    PARSER.add_argument(
+        "-o",
+        "--output",
+        help="""
+        Output filename for the particles in each aperture. Required.
+        """,
+        required=True,
+    )
+
+    PARSER.add_argument(
+        "-t",
+        "--threads",
+        help="""
+        Number of threads to run the queries on. Default: number of CPUs.
+        """,
+        required=False,
+        type=int,
+        default=None,
+    )
+
+    PARSER.add_argument(
+        "--rebuild",
+        help="""
+        Rebuild the spatial index even if an up to date one exists.
+        """,
+        action="store_true",
+    )
+
+    ARGS = vars(PARSER.parse_args())
+
+    snapshot_filename = f"{ARGS['snapshot']}.hdf5"
+
+    if ARGS["groups"] is not None:
+        groups_snapshot = read_ordered_groups_from_file(ARGS["groups"])
+        coordinates, masses = read_coordinates_and_masses(
+            snapshot_filename, list(groups_snapshot.keys())
+        )
+        group_ids, centres = calculate_group_centres(
+            coordinates, masses, groups_snapshot, read_box_size(snapshot_filename)
+        )
+    elif ARGS["catalogue"] is not None:
+        group_ids, centres = load_velociraptor_centres(
+            ARGS["catalogue"], ARGS["length_unit"]
+        )
+    else:
+        raise InputError("Please give either the groups (-g) or the catalogue (-c).")
+
+    index = load_or_build_index(ARGS["snapshot"], rebuild=ARGS["rebuild"])
+
+    apertures = index.query_apertures(centres, ARGS["radius"], threads=ARGS["threads"])
+
+    write_apertures_to_file(ARGS["output"], group_ids, centres, ARGS["radius"], apertures)
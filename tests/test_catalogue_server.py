@@ -0,0 +1,157 @@
+"""
+Tests the functions in catalogue_server.py
+"""
+
+import shutil
+import threading
+
+import pytest
+
+from catalogue_server import *
+
+
+def create_test_files(directory):
+    """
+    Creates a snapshot and the ordered_group_particles file of a "halo"
+    catalogue for it, returning the snapshot filename, catalogue paths, and
+    the IDs and groups that were written.
+    """
+
+    snapshot_filename = f"{directory}/snap.hdf5"
+    catalogue_path = f"{directory}/halo"
+
+    random = np.random.default_rng(3)
+    ids = random.permutation(np.arange(1000, 1100, dtype=np.uint64))
+    particle_ids = {0: ids[:60], 1: ids[60:]}
+    groups = {
+        0: random.integers(-1, 5, size=60).astype(np.int8),
+        1: random.integers(-1, 5, size=40).astype(np.int8),
+    }
+
+    with h5py.File(snapshot_filename, "w") as handle:
+        for ptype, data in particle_ids.items():
+            handle.create_dataset(f"PartType{ptype}/ParticleIDs", data=data)
+
+    with h5py.File(f"{catalogue_path}.ordered_group_particles", "w") as handle:
+        for ptype, data in groups.items():
+            handle.create_dataset(f"PartType{ptype}/GroupID", data=data)
+
+    return snapshot_filename, {"halo": catalogue_path}, particle_ids, groups
+
+
+def check_queries(index, particle_ids, groups):
+    """
+    Checks the answers of index against the IDs and groups.
+    """
+
+    # The IDs of both types, and one that does not exist.
+    query = np.array([particle_ids[1][5], particle_ids[0][7], 5], dtype=np.uint64)
+    assert (
+        index.groups_of_ids("halo", query) == [groups[1][5], groups[0][7], -1]
+    ).all()
+
+    assert (index.groups_of_positions("halo", 1, [0, 3]) == groups[1][[0, 3]]).all()
+
+    ptypes, positions, lengths = index.members("halo", [2, 99, 0])
+
+    assert lengths[1] == 0
+
+    for group_id, start, length in zip([2, 0], [0, lengths[0]], [lengths[0], lengths[2]]):
+        found = {
+            (ptype, position)
+            for ptype, position in zip(
+                ptypes[start : start + length], positions[start : start + length]
+            )
+        }
+        expected = {
+            (ptype, position)
+            for ptype in groups
+            for position in np.where(groups[ptype] == group_id)[0]
+        }
+
+        assert found == expected
+
+    return
+
+
+def test_from_files_0(tmp_path):
+    """
+    The index built from the files answers the queries.
+    """
+
+    snapshot_filename, catalogue_paths, particle_ids, groups = create_test_files(tmp_path)
+
+    index = CatalogueIndex.from_files(snapshot_filename, catalogue_paths)
+
+    assert index.catalogues == ["halo"]
+    check_queries(index, particle_ids, groups)
+
+
+def test_open_catalogue_index_0(tmp_path):
+    """
+    Without a server, the index is read from the files.
+    """
+
+    snapshot_filename, catalogue_paths, particle_ids, groups = create_test_files(tmp_path)
+
+    index = open_catalogue_index(
+        snapshot_filename, catalogue_paths, socket_path=f"{tmp_path}/missing.sock"
+    )
+
+    assert index.source == "files"
+    check_queries(index, particle_ids, groups)
+
+
+def test_open_catalogue_index_1(tmp_path):
+    """
+    With a server running for the snapshot, the index is attached to its
+    shared memory.
+    """
+
+    snapshot_filename, catalogue_paths, particle_ids, groups = create_test_files(tmp_path)
+    socket_path = f"{tmp_path}/server.sock"
+
+    server = CatalogueServer(
+        CatalogueIndex.from_files(snapshot_filename, catalogue_paths), snapshot_filename
+    )
+    thread = threading.Thread(target=server.serve, args=(socket_path,))
+    thread.start()
+
+    try:
+        for _ in range(100):
+            if os.path.exists(socket_path):
+                break
+
+            thread.join(0.05)
+
+        index = open_catalogue_index(snapshot_filename, catalogue_paths, socket_path)
+
+        assert index.source == "server"
+        check_queries(index, particle_ids, groups)
+
+        # Catalogues that the server does not have are read from the files.
+        other = open_catalogue_index(
+            snapshot_filename, {**catalogue_paths, "galaxy": catalogue_paths["halo"]}, socket_path
+        )
+
+        assert other.source == "files"
+
+        # A server for another snapshot is never used for this one.
+        other_snapshot_filename = f"{tmp_path}/other.hdf5"
+        shutil.copy(snapshot_filename, other_snapshot_filename)
+
+        with pytest.raises(ValueError):
+            connect_to_server(other_snapshot_filename, socket_path)
+
+        other = open_catalogue_index(other_snapshot_filename, catalogue_paths, socket_path)
+
+        assert other.source == "files"
+        assert index.blocks and not other.blocks
+    finally:
+        send_request(socket_path, {"command": "shutdown"})
+        thread.join()
+
+    assert not os.path.exists(socket_path)
+
+    # The client keeps its view of the arrays after the server has gone.
+    check_queries(index, particle_ids, groups)
@@ -0,0 +1,128 @@
+"""
+Tests the functions in checksum.py
+"""
+
+from checksum import *
+
+import pytest
+
+import checksum
+
+from preprocess import load_hdf5_replace_and_dump
+from fix_particle_ids import open_fix_and_write
+
+
+def create_test_snapshot(filename, ids, chunks=None, dtype=np.uint64):
+    """
+    Creates a snapshot with the given IDs for PartType0 and PartType1.
+    """
+
+    with h5py.File(filename, "w") as handle:
+        handle.create_dataset(
+            "PartType0/ParticleIDs", data=np.array(ids, dtype=dtype), chunks=chunks
+        )
+        handle.create_dataset(
+            "PartType1/ParticleIDs", data=np.arange(1000, 1050, dtype=dtype), chunks=chunks
+        )
+
+    return
+
+
+def test_checksum_dataset_0(tmp_path, monkeypatch):
+    """
+    Tests that the checksums do not depend on the layout or byte order, and
+    match those of the same IDs in memory.
+    """
+
+    monkeypatch.setattr(checksum, "CHECKSUM_BLOCK_BYTES", 80)
+
+    ids = np.arange(100, dtype=np.uint64)[::-1]
+
+    create_test_snapshot(tmp_path / "contiguous.hdf5", ids)
+    create_test_snapshot(tmp_path / "chunked.hdf5", ids, chunks=(5,), dtype=">u8")
+
+    from_memory = calculate_checksums(
+        tmp_path / "contiguous.hdf5", {0: ids, 1: np.arange(1000, 1050, dtype=np.uint64)}
+    )
+    contiguous = calculate_checksums(tmp_path / "contiguous.hdf5", threads=2)
+    chunked = calculate_checksums(tmp_path / "chunked.hdf5", threads=2)
+
+    assert from_memory == contiguous
+    assert contiguous[0]["block_rows"] == 10
+    assert len(contiguous[0]["blocks"]) == 10
+    assert [record["crc32"] for record in contiguous.values()] == [
+        record["crc32"] for record in chunked.values()
+    ]
+
+
+def test_verify_checksums_0(tmp_path, monkeypatch):
+    """
+    Tests that changes are found and pinned down to their block.
+    """
+
+    monkeypatch.setattr(checksum, "CHECKSUM_BLOCK_BYTES", 80)
+
+    filename = tmp_path / "snapshot.hdf5"
+    create_test_snapshot(filename, np.arange(100))
+
+    checksums = calculate_checksums(filename)
+
+    assert verify_checksums(filename, checksums) == []
+
+    with h5py.File(filename, "a") as handle:
+        handle["PartType0/ParticleIDs"][42] = 7
+
+    assert verify_checksums(filename, checksums) == ["PartType0 IDs 40 to 50 differ"]
+
+    with h5py.File(filename, "a") as handle:
+        del handle["PartType1"]
+
+    assert len(verify_checksums(filename, checksums)) == 2
+
+
+def test_round_trip_0(tmp_path):
+    """
+    Tests that preprocess records the checksums, and that fix_particle_ids
+    verifies the restored IDs against them.
+    """
+
+    create_test_snapshot(tmp_path / "snap.hdf5", [7, 5, 3, 2, 4, 5, 6, 2, 1, 7])
+
+    assert load_hdf5_replace_and_dump(str(tmp_path / "snap")) == StageStatus.COMPLETED
+
+    replaced = str(tmp_path / "snap_duplicated.yml")
+
+    assert set(read_checksums(replaced).keys()) == {0, 1}
+
+    # The IDs are unique now, so they do not match.
+    with pytest.raises(ChecksumError):
+        verify_snapshot(str(tmp_path / "snap.hdf5"), replaced)
+
+    assert open_fix_and_write(str(tmp_path / "snap.hdf5"), replaced) == StageStatus.COMPLETED
+    assert verify_snapshot(str(tmp_path / "snap.hdf5"), replaced)
+
+    # Now break the map of the duplicates so that the wrong IDs are restored.
+    with open(replaced, "r") as handle:
+        data = yaml.safe_load(handle)
+
+    data["old_positions"] = {position: 0 for position in data["old_positions"]}
+
+    with open(replaced, "w") as handle:
+        yaml.dump(data, handle)
+
+    with pytest.raises(ChecksumError):
+        open_fix_and_write(str(tmp_path / "snap.hdf5"), replaced)
+
+
+def test_read_checksums_0(tmp_path):
+    """
+    Tests that duplicates files from before the checksums are still accepted.
+    """
+
+    replaced = tmp_path / "old.yml"
+
+    with open(replaced, "w") as handle:
+        yaml.dump({"old_positions": {}, "new_positions": {}}, handle)
+
+    assert read_checksums(replaced) is None
+    assert not verify_snapshot(tmp_path / "missing.hdf5", replaced)
@@ -0,0 +1,82 @@
+"""
+Tests the functions in crossmatch.py
+"""
+
+from crossmatch import *
+
+
+def test_build_contingency_table_0():
+    """
+    Tests the sparse contingency table on a small hand-made case.
+    """
+
+    groups_a = np.array([0, 0, 0, 1, 1, -1, 2, 2])
+    groups_b = np.array([1, 1, 0, 0, -1, 0, 1, 3])
+
+    rows, columns, shared = build_contingency_table(groups_a, groups_b)
+
+    assert (rows == np.array([0, 0, 1, 2, 2])).all()
+    assert (columns == np.array([0, 1, 0, 1, 3])).all()
+    assert (shared == np.array([1, 2, 1, 1, 1])).all()
+
+
+def test_cross_match_0():
+    """
+    Tests the best matches, including groups with no match at all.
+    """
+
+    groups_a = np.array([0, 0, 0, 1, 1, -1, 2, 2, 3])
+    groups_b = np.array([1, 1, 0, 0, -1, 0, 1, 3, -1])
+
+    matches = cross_match(groups_a, groups_b)
+
+    best_match, shared_fraction, merit = matches["a_to_b"]
+
+    assert (best_match == np.array([1, 0, 3, -1])).all()
+    assert np.allclose(shared_fraction, [2 / 3, 1 / 2, 1 / 2, 0])
+    # Group 0 in a: 2 shared, size 3, group 1 in b has size 3.
+    assert np.isclose(merit[0], 4 / 9)
+    # Group 2 in a shares one particle each with 1 (size 3) and 3 (size 1) in b;
+    # 3 wins on merit.
+    assert np.isclose(merit[2], 1 / 2)
+    assert merit[3] == 0.0
+
+    best_match, shared_fraction, merit = matches["b_to_a"]
+
+    assert (best_match == np.array([1, 0, -1, 2])).all()
+    assert np.allclose(shared_fraction, [1 / 3, 2 / 3, 0, 1])
+
+
+def test_align_groups_by_particle_ids_0():
+    """
+    Tests matching groups between snapshots with re-ordered particles.
+    """
+
+    ids_a = np.array([10, 11, 12, 13])
+    groups_a = np.array([0, 0, 1, -1])
+
+    ids_b = np.array([13, 12, 14, 10])
+    groups_b = np.array([5, 2, 1, 2])
+
+    aligned_a, aligned_b = align_groups_by_particle_ids(ids_a, groups_a, ids_b, groups_b)
+
+    assert (aligned_a == np.array([0, 1, -1])).all()
+    assert (aligned_b == np.array([2, 2, 5])).all()
+
+
+def test_align_groups_by_particle_ids_1():
+    """
+    Tests that particles whose ID is repeated within either snapshot are left
+    out, rather than matched to the wrong particle.
+    """
+
+    ids_a = np.array([5, 5, 7, 9, 11])
+    groups_a = np.array([0, 1, 1, 2, 3])
+
+    ids_b = np.array([9, 7, 5, 5, 11, 11])
+    groups_b = np.array([4, 5, 6, 7, 8, 9])
+
+    aligned_a, aligned_b = align_groups_by_particle_ids(ids_a, groups_a, ids_b, groups_b)
+
+    assert (aligned_a == np.array([1, 2])).all()
+    assert (aligned_b == np.array([5, 4])).all()
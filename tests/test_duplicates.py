@@ -0,0 +1,102 @@
+"""
+Tests the functions in duplicates.py
+"""
+
+from duplicates import *
+from preprocess import load_hdf5_replace_and_dump
+
+
+def create_test_snapshot(filename):
+    """
+    Creates a snapshot with duplicated IDs within and across particle types.
+    """
+
+    particle_ids = {
+        0: np.array([1, 2, 3, 2, 5], dtype=np.uint64),
+        4: np.array([3, 7, 2], dtype=np.uint64),
+    }
+
+    with h5py.File(filename, "w") as handle:
+        for ptype, ids in particle_ids.items():
+            handle.create_dataset(f"PartType{ptype}/ParticleIDs", data=ids)
+
+    return particle_ids
+
+
+def test_create_duplicate_table_0():
+    """
+    The table has a row for every particle with a duplicated ID, including
+    the ones that kept it, sorted by ID.
+    """
+
+    # Positions are in the combined array: [1, 2, 3, 8, 5 | 3, 7, 2].
+    ids = [np.array([1, 2, 3, 8, 5], dtype=np.uint64), np.array([9, 7, 10], dtype=np.uint64)]
+    old_positions = {3: 2, 5: 3, 7: 2}
+    new_positions = {3: 8, 5: 9, 7: 10}
+
+    table = create_duplicate_table([0, 4], ids, old_positions, new_positions)
+
+    assert (table["OriginalID"] == [2, 2, 2, 3, 3]).all()
+    assert (table["NewID"] == [2, 8, 10, 3, 9]).all()
+    assert (table["ParticleType"] == [0, 0, 4, 0, 4]).all()
+    assert (table["Position"] == [1, 3, 2, 2, 0]).all()
+    assert (table["DuplicateIDs/OriginalID"] == [2, 3]).all()
+    assert (table["DuplicateIDs/Multiplicity"] == [3, 2]).all()
+    assert (table["DuplicateIDs/Offset"] == [0, 3]).all()
+
+    return
+
+
+def test_create_duplicate_table_1():
+    """
+    Snapshots without duplicates give an empty table.
+    """
+
+    table = create_duplicate_table([1], [np.arange(5, dtype=np.uint64)], {}, {})
+
+    assert all(column.size == 0 for column in table.values())
+
+    return
+
+
+def test_lookup_duplicates_0(tmp_path):
+    """
+    preprocess.py writes the table, which can be looked up and have the
+    groups added to it.
+    """
+
+    particle_ids = create_test_snapshot(f"{tmp_path}/snap.hdf5")
+
+    load_hdf5_replace_and_dump(f"{tmp_path}/snap")
+
+    filename = f"{tmp_path}/snap_duplicated.hdf5"
+
+    rows = lookup_duplicates(filename, [3, 1, 2, 99])
+
+    assert (rows["OriginalID"] == [2, 2, 2, 3, 3]).all()
+    assert (rows["ParticleType"] == [0, 0, 4, 0, 4]).all()
+    assert (rows["Position"] == [1, 3, 2, 2, 0]).all()
+
+    # The new IDs are the ones now in the snapshot.
+    with h5py.File(f"{tmp_path}/snap.hdf5", "r") as handle:
+        for ptype, position, new_id in zip(
+            rows["ParticleType"], rows["Position"], rows["NewID"]
+        ):
+            assert handle[f"PartType{ptype}/ParticleIDs"][position] == new_id
+
+    assert lookup_duplicates(filename, [1, 5])["OriginalID"].size == 0
+
+    groups_snapshot = {
+        0: np.array([0, 1, 2, 3, -1], dtype=np.int8),
+        4: np.array([4, 5, 6], dtype=np.int8),
+    }
+
+    add_groups_to_duplicate_table(filename, "halo", groups_snapshot)
+    add_groups_to_duplicate_table(filename, "galaxy", {0: groups_snapshot[0]})
+
+    table = read_duplicate_table(filename)
+
+    assert (table["GroupID_halo"] == [1, 3, 6, 2, 4]).all()
+    assert (table["GroupID_galaxy"] == [1, 3, -1, 2, -1]).all()
+
+    return
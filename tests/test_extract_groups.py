@@ -0,0 +1,164 @@
+"""
+Tests the functions in extract_groups.py
+"""
+
+from extract_groups import *
+
+import extract_groups
+
+from postprocess import read_ordered_groups_from_file
+from velociraptor_config import read_particle_numbers
+
+
+def create_test_snapshot(filename, groups_snapshot):
+    """
+    Creates a snapshot with a few fields per particle type (some chunked and
+    compressed, some contiguous) for the particles in groups_snapshot.
+    """
+
+    with h5py.File(filename, "w") as handle:
+        header = handle.create_group("Header")
+        particle_numbers = np.zeros(6, dtype=np.uint32)
+
+        offset = 0
+
+        for ptype, groups in groups_snapshot.items():
+            number = groups.size
+            particle_numbers[ptype] = number
+
+            current_group = handle.create_group(f"PartType{ptype}")
+            current_group.create_dataset(
+                "ParticleIDs", data=np.arange(offset, offset + number, dtype=np.uint64)
+            )
+            current_group.create_dataset(
+                "Coordinates",
+                data=np.random.rand(number, 3),
+                chunks=(min(7, number), 3),
+                compression="gzip",
+            )
+            current_group.create_dataset(
+                "Masses", data=np.random.rand(number).astype(np.float32), chunks=(2,)
+            )
+            current_group["Masses"].attrs["Units"] = "1e10 Msun"
+
+            offset += number
+
+        header.attrs["NumPart_ThisFile"] = particle_numbers
+        header.attrs["NumPart_Total"] = particle_numbers
+        header.attrs["NumPart_Total_HighWord"] = np.zeros(6, dtype=np.uint32)
+        header.attrs["NumFilesPerSnapshot"] = 1
+
+        handle.create_group("Parameters").attrs["BoxSize"] = 100.0
+
+    return
+
+
+def test_select_groups_0():
+    """
+    Tests the selection of groups by size and by ID.
+    """
+
+    group_sizes = np.array([3, 10, 0, 10, 1])
+
+    assert (select_groups(group_sizes, number=3) == [1, 3, 0]).all()
+    assert (select_groups(group_sizes, minimum_particles=3) == [1, 3, 0]).all()
+    assert (select_groups(group_sizes) == [1, 3, 0, 4]).all()
+    assert (select_groups(group_sizes, group_ids=[4, 0, 4]) == [0, 4]).all()
+
+
+def test_create_extraction_order_0():
+    """
+    Tests that the selected particles are stored grouped in the selected order.
+    """
+
+    groups = np.array([2, -1, 0, 2, 1, 0, -1, 2])
+
+    positions, order, lengths = create_extraction_order(groups, np.array([2, 0]))
+
+    assert (positions == [0, 2, 3, 5, 7]).all()
+    assert (groups[positions][order] == [2, 2, 2, 0, 0]).all()
+    assert (positions[order] == [0, 3, 7, 2, 5]).all()
+    assert (lengths == [3, 2]).all()
+
+
+def test_gather_rows_0(tmp_path, monkeypatch):
+    """
+    Tests that the block-aligned reads give the same result as indexing,
+    for chunked and contiguous datasets, with small read blocks so that
+    reads are split up.
+    """
+
+    monkeypatch.setattr(extract_groups, "READ_BLOCK_BYTES", 40)
+
+    data = np.arange(300, dtype=np.int64).reshape(100, 3)
+    positions = np.array([0, 1, 2, 13, 14, 15, 16, 50, 51, 98, 99])
+
+    with h5py.File(tmp_path / "test.hdf5", "w") as handle:
+        handle.create_dataset("contiguous", data=data)
+        handle.create_dataset("chunked", data=data, chunks=(4, 3), compression="gzip")
+
+        for name in ["contiguous", "chunked"]:
+            assert (gather_rows(handle[name], positions) == data[positions]).all()
+            assert gather_rows(handle[name], positions[:0]).shape == (0, 3)
+
+
+def test_load_data_and_extract_groups_0(tmp_path):
+    """
+    Extracts the two largest groups and checks the particles, offset table,
+    header and ordered groups of the output.
+    """
+
+    groups_snapshot = {
+        0: np.array([0, 1, 1, -1, 2, 1, 0, -1, 1, 2, 2, 0, 1]),
+        1: np.array([-1, 1, 1, 0, 0, 0, 3, 1, -1, 0]),
+        4: np.array([-1, -1]),
+    }
+
+    create_test_snapshot(tmp_path / "snap.hdf5", groups_snapshot)
+    write_ordered_groups_to_file(tmp_path / "snap.ordered_group_particles", groups_snapshot)
+
+    selected = load_data_and_extract_groups(
+        snapshot_filename=str(tmp_path / "snap"),
+        groups_filename=str(tmp_path / "snap.ordered_group_particles"),
+        output_filename=str(tmp_path / "extracted"),
+        number=2,
+    )
+
+    # Group 1 has 8 particles, group 0 has 6.
+    assert (selected == [1, 0]).all()
+
+    with h5py.File(tmp_path / "snap.hdf5", "r") as original, h5py.File(
+        tmp_path / "extracted.hdf5", "r"
+    ) as extracted:
+        assert (extracted["Groups/GroupID"][...] == [1, 0]).all()
+        assert (extracted["Groups/Length"][:, 0] == [5, 3]).all()
+        assert (extracted["Groups/Length"][:, 1] == [3, 4]).all()
+        assert (extracted["Groups/Offset"][:, 1] == [0, 3]).all()
+        assert (extracted["Groups/Length"][:, 4] == [0, 0]).all()
+
+        for ptype in [0, 1]:
+            groups = groups_snapshot[ptype]
+            expected = np.concatenate([np.where(groups == 1)[0], np.where(groups == 0)[0]])
+
+            for name in ["ParticleIDs", "Coordinates", "Masses"]:
+                assert (
+                    extracted[f"PartType{ptype}/{name}"][...]
+                    == original[f"PartType{ptype}/{name}"][...][expected]
+                ).all()
+
+        assert extracted["PartType0/Masses"].attrs["Units"] == "1e10 Msun"
+        assert extracted["PartType0/Coordinates"].compression == "gzip"
+        assert extracted["PartType4/ParticleIDs"].shape == (0,)
+        assert extracted["Parameters"].attrs["BoxSize"] == 100.0
+
+    assert (read_particle_numbers(tmp_path / "extracted.hdf5") == [8, 7, 0, 0, 0, 0]).all()
+
+    # The output can be used with the other scripts.
+    assert read_particle_ids_from_file(tmp_path / "extracted.hdf5")[1].shape == (7,)
+
+    extracted_groups = read_ordered_groups_from_file(
+        tmp_path / "extracted.ordered_group_particles"
+    )
+
+    assert (extracted_groups[0] == [1, 1, 1, 1, 1, 0, 0, 0]).all()
+    assert (extracted_groups[1] == [1, 1, 1, 0, 0, 0, 0]).all()
@@ -17,3 +17,13 @@ def test_find_and_replace_backwards_0():
     data_recreated = recreate_old_array(new_ids, oldpos)
 
     assert (data == data_recreated).all()
+
+
+def test_recreate_old_array_0():
+    """
+    Tests that an empty replacement leaves the IDs alone rather than exiting.
+    """
+
+    data = np.array([7, 5, 3, 2])
+
+    assert (recreate_old_array(data.copy(), {}) == data).all()
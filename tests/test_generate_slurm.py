@@ -0,0 +1,166 @@
+"""
+Tests the Slurm array job generation in generate_slurm.py
+"""
+
+from generate_slurm import *
+
+import h5py
+
+
+def create_test_snapshots(directory, sizes):
+    """
+    Creates empty snapshots with only a header, with sizes gas and DM particles.
+    """
+
+    for index, size in enumerate(sizes):
+        with h5py.File(f"{directory}/snap_{index:03d}.hdf5", "w") as handle:
+            handle.create_group("Header").attrs["NumPart_Total"] = np.array(
+                [size, size, 0, 0, size // 10, 0], dtype=np.uint32
+            )
+
+    # Not a snapshot; should be ignored.
+    with h5py.File(f"{directory}/snap_000.ordered_group_particles.hdf5", "w") as handle:
+        handle.create_dataset("PartType0/GroupID", data=np.arange(3))
+
+    return
+
+
+def test_format_slurm_time_0():
+    """
+    Tests the formatting of the time limits.
+    """
+
+    assert format_slurm_time(59) == "0-00:00:59"
+    assert format_slurm_time(3600 * 26 + 61) == "1-02:01:01"
+
+
+def test_bin_tasks_0():
+    """
+    Tests that tasks are binned by memory.
+    """
+
+    tasks = [TaskResources(str(x), 1, x, 1) for x in [5, 1, 4, 2, 3]]
+
+    bins = bin_tasks(tasks, 2)
+
+    assert [[task.memory_bytes for task in bin] for bin in bins] == [[1, 2], [3, 4, 5]]
+    assert len(bin_tasks(tasks, 10)) == 5
+
+
+def test_calibrate_0():
+    """
+    Tests that calibration scales the estimates up to cover past runs.
+    """
+
+    configs = [read_config("velociraptor.cfg")]
+    particle_numbers = np.array([10 ** 6, 10 ** 6, 0, 0, 0, 0])
+
+    estimate = estimate_task("", particle_numbers, configs, 4)
+
+    records = [
+        {
+            "number_of_particles": particle_numbers.tolist(),
+            "peak_memory_bytes": 3 * estimate.memory_bytes,
+            "wall_time_seconds": estimate.wall_time_seconds / 2,
+            "threads": 4,
+        }
+    ]
+
+    memory_factor, time_factor = calibrate(records, configs, 4)
+
+    assert np.isclose(memory_factor, 3.0)
+    assert time_factor == 1.0
+    assert calibrate([], configs, 4) == (1.0, 1.0)
+
+
+def test_generate_array_jobs_0(tmp_path):
+    """
+    Renders the array jobs for a directory of snapshots, and runs every task
+    through the local shell with a command that just records the snapshot.
+    """
+
+    snapshot_directory = tmp_path / "snapshots"
+    snapshot_directory.mkdir()
+    create_test_snapshots(snapshot_directory, [10, 10 ** 7, 100, 10 ** 8])
+
+    jobs = generate_array_jobs(
+        directory=str(snapshot_directory),
+        output_directory=str(tmp_path / "jobs"),
+        tools_directory=os.getcwd(),
+        config_filenames=["velociraptor.cfg", "velociraptor_galaxy.cfg"],
+        number_of_bins=2,
+        maximum_threads=8,
+        command="echo {snapshot} {threads} >> {directory}/done.txt",
+        partition="cosma",
+    )
+
+    assert len(jobs) == 2
+
+    small_script, small_tasks = jobs[0]
+    large_script, large_tasks = jobs[1]
+
+    assert [task.snapshot for task in small_tasks] == ["snap_000", "snap_002"]
+    assert [task.snapshot for task in large_tasks] == ["snap_001", "snap_003"]
+    assert max(task.memory_bytes for task in small_tasks) < min(
+        task.memory_bytes for task in large_tasks
+    )
+
+    with open(large_script, "r") as handle:
+        script = handle.read()
+
+    assert "#SBATCH --array=0-1" in script
+    assert "#SBATCH --cpus-per-task=8" in script
+    assert "#SBATCH -p cosma" in script
+
+    for script_filename, tasks in jobs:
+        for task_id in range(len(tasks)):
+            result = run_task_locally(script_filename, task_id)
+
+            assert result.returncode == 0, result.stderr
+
+    with open(snapshot_directory / "done.txt", "r") as handle:
+        done = sorted(line.split()[0] for line in handle)
+
+    assert done == ["snap_000", "snap_001", "snap_002", "snap_003"]
+
+
+def test_render_array_script_0(tmp_path):
+    """
+    The tasks run the configurations that their resources were estimated for.
+    """
+
+    halo_config = str(tmp_path / "halo.cfg")
+    galaxy_config = str(tmp_path / "galaxy.cfg")
+
+    for filename, source in [
+        (halo_config, "velociraptor.cfg"),
+        (galaxy_config, "velociraptor_galaxy.cfg"),
+    ]:
+        with open(source, "r") as handle:
+            contents = handle.read()
+
+        with open(filename, "w") as handle:
+            handle.write(contents)
+
+    snapshot_directory = tmp_path / "snapshots"
+    snapshot_directory.mkdir()
+    create_test_snapshots(snapshot_directory, [10])
+
+    [(script_filename, tasks)] = generate_array_jobs(
+        directory=str(snapshot_directory),
+        output_directory=str(tmp_path / "jobs"),
+        tools_directory="/tools",
+        config_filenames=[halo_config, galaxy_config],
+    )
+
+    with open(script_filename, "r") as handle:
+        task_line = handle.read().splitlines()[-1]
+
+    assert f"-C {halo_config} -G {galaxy_config}" in task_line
+    assert "/tools/velociraptor.cfg" not in task_line
+
+    script = render_array_script(
+        "job", "job.manifest", tasks, "/data", "/tools", config_filenames=[halo_config]
+    )
+
+    assert f"-C {halo_config} -G none --resume" in script.splitlines()[-1]
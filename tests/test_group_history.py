@@ -0,0 +1,109 @@
+"""
+Tests the functions in group_history.py
+"""
+
+from group_history import *
+from preprocess import load_hdf5_replace_and_dump
+
+
+def test_make_particle_keys_0():
+    """
+    Keys are unique for each ID and copy, and can be split again.
+    """
+
+    keys = make_particle_keys(np.array([5, 5, 7]), np.array([0, 1, 0]))
+
+    assert np.unique(keys).size == 3
+
+    particle_ids, copy_indices = split_particle_keys(keys)
+
+    assert (particle_ids == [5, 5, 7]).all()
+    assert (copy_indices == [0, 1, 0]).all()
+
+    assert (rank_within_duplicates(np.array([3, 1, 3, 2, 3, 1])) == [0, 0, 1, 0, 2, 1]).all()
+
+
+def test_create_particle_keys_0(tmp_path):
+    """
+    The keys made with the table of duplicates from a snapshot with replaced
+    IDs are the same as those made from the original IDs.
+    """
+
+    original = {
+        0: np.array([1, 2, 3, 2, 5], dtype=np.uint64),
+        4: np.array([3, 7, 2], dtype=np.uint64),
+    }
+
+    with h5py.File(f"{tmp_path}/snap.hdf5", "w") as handle:
+        for ptype, ids in original.items():
+            handle.create_dataset(f"PartType{ptype}/ParticleIDs", data=ids)
+
+    load_hdf5_replace_and_dump(f"{tmp_path}/snap")
+
+    replaced = read_particle_ids_from_file(f"{tmp_path}/snap.hdf5", mmap=False)
+
+    assert not (replaced[0] == original[0]).all()
+
+    from_table = create_particle_keys(replaced, f"{tmp_path}/snap_duplicated.hdf5")
+    from_original = create_particle_keys(original)
+
+    for ptype in original.keys():
+        assert (from_table[ptype] == from_original[ptype]).all()
+
+    # The gas particle with ID 2 that came first keeps copy 0.
+    assert (split_particle_keys(from_table[4])[1] == [1, 0, 2]).all()
+
+
+def test_append_snapshot_0(tmp_path):
+    """
+    Histories follow the particles between snapshots in which they move,
+    appear, and disappear, and snapshots can be re-appended.
+    """
+
+    filename = f"{tmp_path}/history.hdf5"
+
+    first = {0: make_particle_keys([10, 11, 12]), 1: make_particle_keys([20, 21])}
+    second = {0: make_particle_keys([12, 10, 13]), 1: make_particle_keys([21, 20])}
+
+    append_snapshot(
+        filename,
+        "snap_000",
+        first,
+        {"halo": {0: np.array([0, -1, 1]), 1: np.array([1, 1])}},
+        block_rows=2,
+    )
+    append_snapshot(
+        filename,
+        "snap_001",
+        second,
+        {
+            "halo": {0: np.array([0, 2, -1]), 1: np.array([1, 0])},
+            "galaxy": {0: np.array([3, 3, 3])},
+        },
+        block_rows=2,
+    )
+
+    history = read_particle_history(filename, make_particle_keys([10, 11, 13, 20, 99]))
+
+    assert history["Snapshots"] == ["snap_000", "snap_001"]
+    assert (
+        history["halo"] == [[0, 2], [-1, MISSING], [MISSING, -1], [1, 0], [MISSING] * 2]
+    ).all()
+    assert (
+        history["galaxy"]
+        == [[MISSING, 3], [MISSING] * 2, [MISSING, 3], [MISSING, -1], [MISSING] * 2]
+    ).all()
+
+    # Re-appending replaces the column.
+    append_snapshot(
+        filename, "snap_000", first, {"halo": {0: np.array([4, 4, 4]), 1: np.array([4, 4])}}
+    )
+
+    history = read_particle_history(filename, make_particle_keys([10, 13]))
+
+    assert history["Snapshots"] == ["snap_000", "snap_001"]
+    assert (history["halo"] == [[4, 2], [MISSING, -1]]).all()
+
+    with h5py.File(filename, "r") as handle:
+        assert handle["GroupID_halo"].shape == (6, 2)
+        assert handle["GroupID_halo"].chunks == (HISTORY_CHUNK_ROWS, HISTORY_CHUNK_SNAPSHOTS)
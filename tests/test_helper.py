@@ -0,0 +1,195 @@
+"""
+Tests the functions in helper.py
+"""
+
+from helper import *
+
+
+def create_test_snapshot(filename, chunks=None):
+    """
+    Creates a small snapshot-like file with ParticleIDs for two particle types.
+    """
+
+    with h5py.File(filename, "w") as handle:
+        handle.create_dataset("PartType0/ParticleIDs", data=np.arange(100), chunks=chunks)
+        handle.create_dataset(
+            "PartType1/ParticleIDs", data=np.arange(100, 150, dtype=np.uint32)
+        )
+
+    return
+
+
+def test_read_particle_ids_from_file_mmap_0(tmp_path):
+    """
+    Tests that contiguous datasets are memory mapped rather than read.
+    """
+
+    filename = str(tmp_path / "snapshot.hdf5")
+    create_test_snapshot(filename)
+
+    particle_ids = read_particle_ids_from_file(filename)
+
+    assert isinstance(particle_ids[0], np.memmap)
+    assert isinstance(particle_ids[1], np.memmap)
+    assert (particle_ids[0] == np.arange(100)).all()
+    assert (particle_ids[1] == np.arange(100, 150)).all()
+    assert particle_ids[1].dtype == np.uint32
+
+
+def test_read_particle_ids_from_file_mmap_1(tmp_path):
+    """
+    Tests the fallback to normal reads for chunked and compressed datasets.
+    """
+
+    filename = str(tmp_path / "snapshot.hdf5")
+    create_test_snapshot(filename, chunks=(10,))
+
+    with h5py.File(filename, "a") as handle:
+        handle.create_dataset(
+            "PartType4/ParticleIDs", data=np.arange(7), compression="gzip"
+        )
+
+    particle_ids = read_particle_ids_from_file(filename)
+
+    assert not isinstance(particle_ids[0], np.memmap)
+    assert not isinstance(particle_ids[4], np.memmap)
+    assert (particle_ids[0] == np.arange(100)).all()
+    assert (particle_ids[4] == np.arange(7)).all()
+
+
+def test_write_all_id_arrays_0(tmp_path):
+    """
+    Tests writing through both the memory-mapped and h5py paths.
+    """
+
+    filename = str(tmp_path / "snapshot.hdf5")
+    create_test_snapshot(filename, chunks=(10,))
+
+    new_ids = [np.arange(100)[::-1], np.arange(200, 250)]
+    write_all_id_arrays(filename, new_ids, [0, 1])
+
+    particle_ids = read_particle_ids_from_file(filename, mmap=False)
+
+    for written, read in zip(new_ids, particle_ids.values()):
+        assert (written == read).all()
+
+
+def test_lazy_particle_ids_0(tmp_path):
+    """
+    Tests that the lazy container only reads particle types on access.
+    """
+
+    filename = str(tmp_path / "snapshot.hdf5")
+    create_test_snapshot(filename)
+
+    particle_ids = LazyParticleIDs(filename)
+
+    assert list(particle_ids.keys()) == [0, 1]
+    assert get_particle_id_shapes(particle_ids) == {0: (100,), 1: (50,)}
+    assert not particle_ids.is_loaded(0)
+    assert not particle_ids.is_loaded(1)
+
+    assert (particle_ids[1] == np.arange(100, 150)).all()
+
+    assert not particle_ids.is_loaded(0)
+    assert particle_ids.is_loaded(1)
+
+    filtered = LazyParticleIDs(filename, particle_types=[1])
+
+    assert list(filtered.keys()) == [1]
+
+
+def test_patch_dataset_0(tmp_path, monkeypatch):
+    """
+    Tests that only the blocks that differ are written, for chunked and
+    contiguous datasets.
+    """
+
+    import helper
+
+    monkeypatch.setattr(helper, "PATCH_BLOCK_ROWS", 10)
+
+    data = np.arange(100)
+    new_data = data.copy()
+    new_data[[5, 55, 99]] = -1
+
+    with h5py.File(tmp_path / "test.hdf5", "w") as handle:
+        handle.create_dataset("contiguous", data=data)
+        handle.create_dataset("chunked", data=data, chunks=(20,))
+
+        assert patch_dataset(handle["contiguous"], new_data) == 30
+        assert patch_dataset(handle["chunked"], new_data, current=data) == 60
+        assert patch_dataset(handle["chunked"], new_data) == 0
+
+        for name in ["contiguous", "chunked"]:
+            assert (handle[name][...] == new_data).all()
+
+
+def test_get_hyperslabs_0(tmp_path):
+    """
+    Tests that the hyperslabs cover the dataset and are aligned to chunks.
+    """
+
+    filename = str(tmp_path / "snapshot.hdf5")
+    create_test_snapshot(filename, chunks=(7,))
+
+    with h5py.File(filename, "r") as handle:
+        hyperslabs = get_hyperslabs(handle["PartType0/ParticleIDs"], 4)
+        assert hyperslabs[0][0] == 0 and hyperslabs[-1][1] == 100
+        assert all(start % 7 == 0 for start, _ in hyperslabs)
+        assert all(end == start for (_, end), (start, _) in zip(hyperslabs[:-1], hyperslabs[1:]))
+
+        assert get_hyperslabs(handle["PartType1/ParticleIDs"], 100)[-1] == (49, 50)
+
+
+def test_parallel_read_and_write_0(tmp_path):
+    """
+    Tests reading and writing with several workers, for contiguous (threads)
+    and compressed (processes) datasets.
+    """
+
+    filename = str(tmp_path / "snapshot.hdf5")
+    create_test_snapshot(filename)
+
+    with h5py.File(filename, "a") as handle:
+        handle.create_dataset(
+            "PartType4/ParticleIDs",
+            data=np.arange(1000).reshape(500, 2),
+            chunks=(16, 2),
+            compression="gzip",
+        )
+
+    particle_ids = read_particle_ids_from_file(filename, mmap=False, workers=3)
+
+    assert (particle_ids[0] == np.arange(100)).all()
+    assert (particle_ids[4] == np.arange(1000).reshape(500, 2)).all()
+    assert not isinstance(particle_ids[4], np.memmap)
+
+    write_dataset_parallel(filename, "PartType1/ParticleIDs", np.arange(50)[::-1], workers=3)
+    write_dataset_parallel(filename, "PartType4/ParticleIDs", -particle_ids[4], workers=3)
+
+    with h5py.File(filename, "r") as handle:
+        assert (handle["PartType1/ParticleIDs"][...] == np.arange(50)[::-1]).all()
+        assert handle["PartType1/ParticleIDs"].dtype == np.uint32
+        assert (handle["PartType4/ParticleIDs"][...] == -np.arange(1000).reshape(500, 2)).all()
+
+
+def test_find_in_sorted_0():
+    """
+    Tests the binary search, including IDs beyond either end of the sorted
+    array and an empty sorted array.
+    """
+
+    sorted_ids = np.array([2, 4, 6])
+    ids = np.array([6, 1, 4, 7, 5])
+
+    positions, found = find_in_sorted(ids, sorted_ids)
+
+    assert (found == [True, False, True, False, False]).all()
+    assert (positions[found] == [2, 1]).all()
+    assert (is_in_sorted(ids, sorted_ids) == found).all()
+
+    positions, found = find_in_sorted(ids, sorted_ids[:0])
+
+    assert positions.shape == ids.shape
+    assert not found.any()
@@ -0,0 +1,166 @@
+"""
+Tests the functions in layout.py, and the layouts of the files written
+with them.
+"""
+
+from layout import *
+
+import pytest
+
+from add_info_to_snapshots import write_to_hdf_file
+from benchmark_layout import run_benchmark
+from postprocess import write_ordered_groups_to_file, read_ordered_groups_from_file
+
+
+def test_parse_output_layout_0():
+    """
+    Tests the parsing of the layout descriptions.
+    """
+
+    assert parse_output_layout("none") == OutputLayout(compression=None)
+    assert parse_output_layout("gzip") == OutputLayout(compression="gzip")
+    assert parse_output_layout("GZIP:6") == OutputLayout(compression="gzip", compression_opts=6)
+    assert parse_output_layout("shuffle+lzf") == OutputLayout(compression="lzf", shuffle=True)
+
+    for description in ["none", "gzip", "gzip:6", "lzf", "shuffle+gzip:4", "shuffle+none"]:
+        assert parse_output_layout(description).describe() == description
+
+    for description in ["zstd", "gzip:10", "gzip:fast", "lzf:2"]:
+        with pytest.raises(LayoutError):
+            parse_output_layout(description)
+
+
+def test_smallest_group_dtype_0():
+    """
+    Tests the choice of the narrowest signed dtype.
+    """
+
+    assert smallest_group_dtype(0) == np.int8
+    assert smallest_group_dtype(128) == np.int8
+    assert smallest_group_dtype(129) == np.int16
+    assert smallest_group_dtype(2 ** 31) == np.int32
+    assert smallest_group_dtype(2 ** 31 + 1) == np.int64
+
+    groups = np.array([-1, 5, 300])
+
+    assert narrow_group_ids(groups).dtype == np.int16
+    assert (narrow_group_ids(groups) == groups).all()
+
+
+def test_get_dataset_options_0():
+    """
+    Tests that the chunks follow the reference, but fit in the dataset.
+    """
+
+    assert get_dataset_options(OutputLayout(compression=None), (100,)) == {}
+    assert get_dataset_options(OutputLayout(compression=None), (100,), (10,)) == {
+        "chunks": (10,)
+    }
+    assert get_dataset_options(OutputLayout(), (100,), (1000,)) == {
+        "chunks": (100,),
+        "compression": "gzip",
+    }
+    assert get_dataset_options(parse_output_layout("shuffle+gzip:2"), (100,)) == {
+        "chunks": True,
+        "compression": "gzip",
+        "compression_opts": 2,
+        "shuffle": True,
+    }
+    assert get_dataset_options(OutputLayout(match_chunks=False), (100,), (10,))["chunks"]
+    assert get_dataset_options(OutputLayout(), (0,), (10,)) == {}
+
+
+def test_write_ordered_groups_to_file_0(tmp_path):
+    """
+    Tests that the ordered groups are written narrow and aligned.
+    """
+
+    groups_snapshot = {0: np.array([-1, 0, 1, 1, 199, -1] * 10), 1: np.array([], dtype=int)}
+
+    write_ordered_groups_to_file(
+        tmp_path / "groups.hdf5",
+        groups_snapshot,
+        layout=parse_output_layout("shuffle+lzf"),
+        reference_chunks={0: (8,), 1: (8,)},
+    )
+
+    with h5py.File(tmp_path / "groups.hdf5", "r") as handle:
+        dataset = handle["PartType0/GroupID"]
+
+        assert dataset.dtype == np.int16
+        assert dataset.chunks == (8,)
+        assert dataset.compression == "lzf"
+        assert dataset.shuffle
+
+    read = read_ordered_groups_from_file(tmp_path / "groups.hdf5")
+
+    assert (read[0] == groups_snapshot[0]).all()
+    assert read[1].size == 0
+
+
+def test_write_to_hdf_file_0(tmp_path):
+    """
+    Tests that datasets added to the snapshot follow the ParticleIDs chunks,
+    and are re-created when the old dtype is too narrow.
+    """
+
+    filename = tmp_path / "snapshot.hdf5"
+
+    with h5py.File(filename, "w") as handle:
+        handle.create_dataset("PartType0/ParticleIDs", data=np.arange(100), chunks=(16,))
+        handle.create_dataset("PartType1/ParticleIDs", data=np.arange(100))
+
+    write_to_hdf_file(filename, "PartType0/VRHaloID", np.full(100, 3, dtype=np.int8))
+    write_to_hdf_file(filename, "PartType1/VRHaloID", np.full(100, 3, dtype=np.int8))
+
+    with h5py.File(filename, "r") as handle:
+        assert handle["PartType0/VRHaloID"].chunks == (16,)
+        assert handle["PartType0/VRHaloID"].compression is None
+        assert handle["PartType1/VRHaloID"].chunks is None
+
+    write_to_hdf_file(filename, "PartType0/VRHaloID", np.full(100, 1000, dtype=np.int16))
+
+    with h5py.File(filename, "r") as handle:
+        assert handle["PartType0/VRHaloID"].dtype == np.int16
+        assert (handle["PartType0/VRHaloID"][...] == 1000).all()
+
+
+def test_run_benchmark_0(tmp_path):
+    """
+    Runs a tiny benchmark, checking that every policy is measured.
+    """
+
+    results = run_benchmark(
+        1000, 10, policies=["none", "gzip"], chunk_size=64, directory=tmp_path, repeats=1
+    )
+
+    assert [result.policy for result in results] == ["gzip (auto chunks)", "none", "gzip"]
+    assert [result.dtype for result in results] == ["int64", "int8", "int8"]
+    assert all(result.file_bytes > 0 for result in results)
+
+
+@pytest.mark.parametrize("policy", ["gzip", "gzip:1", "shuffle+gzip:6"])
+def test_create_dataset_with_layout_0(tmp_path, policy):
+    """
+    Tests that chunks compressed on threads and written directly give the
+    same dataset as letting HDF5 compress them, including the edge chunks
+    of multi-dimensional datasets.
+    """
+
+    layout = parse_output_layout(policy)
+    groups = np.random.default_rng(1).integers(-1, 3000, size=1003).astype(np.int16)
+    coordinates = np.arange(3009, dtype=np.float64).reshape(1003, 3)
+
+    for workers, filename in [(1, "hdf5.hdf5"), (3, "threads.hdf5")]:
+        with h5py.File(tmp_path / filename, "w") as handle:
+            create_dataset_with_layout(handle, "GroupID", groups, layout, (100,), workers)
+            create_dataset_with_layout(handle, "Coordinates", coordinates, layout, (64, 2), workers)
+
+    with h5py.File(tmp_path / "hdf5.hdf5", "r") as a, h5py.File(tmp_path / "threads.hdf5", "r") as b:
+        for name in ["GroupID", "Coordinates"]:
+            assert a[name].dtype == b[name].dtype
+            assert a[name].chunks == b[name].chunks
+            assert a[name].compression == b[name].compression == "gzip"
+            assert a[name].compression_opts == b[name].compression_opts
+            assert a[name].shuffle == b[name].shuffle
+            assert (a[name][...] == b[name][...]).all()
@@ -0,0 +1,176 @@
+"""
+Tests the functions in mpi_backend.py against the serial scripts, both on
+one rank and (if mpirun is available) on four.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("mpi4py")
+
+from mpi_backend import *
+from duplicates import read_duplicate_table, read_particle_id_ranges
+from fix_particle_ids import read_yaml_file
+from postprocess import load_data_and_write_new_catalog, read_ordered_groups_from_file
+from preprocess import load_hdf5_replace_and_dump
+
+
+def create_test_snapshot(directory, seed=4):
+    """
+    Creates a snapshot with IDs that are duplicated within and across the
+    particle types.
+    """
+
+    random = np.random.default_rng(seed)
+
+    os.makedirs(directory, exist_ok=True)
+
+    with h5py.File(f"{directory}/snap.hdf5", "w") as handle:
+        for ptype, number in [(0, 300), (1, 250), (4, 80)]:
+            handle.create_dataset(
+                f"PartType{ptype}/ParticleIDs",
+                data=random.integers(1, 500, size=number).astype(np.uint64),
+            )
+
+    return
+
+
+def create_test_catalogue(directory, seed=5):
+    """
+    Creates a catalogue over (some of) the IDs now in the snapshot, with the
+    unbound particles in the same groups as the bound ones.
+    """
+
+    random = np.random.default_rng(seed)
+
+    particle_ids = np.concatenate(
+        list(read_particle_ids_from_file(f"{directory}/snap.hdf5", mmap=False).values())
+    )
+    particle_ids = random.permutation(particle_ids)[:400]
+
+    os.makedirs(f"{directory}/halo", exist_ok=True)
+
+    with h5py.File(f"{directory}/halo/snap.catalog_particles", "w") as handle:
+        handle.create_dataset("Particle_IDs", data=particle_ids[:300])
+
+    with h5py.File(f"{directory}/halo/snap.catalog_particles.unbound", "w") as handle:
+        handle.create_dataset("Particle_IDs", data=particle_ids[300:])
+
+    with h5py.File(f"{directory}/halo/snap.catalog_groups", "w") as handle:
+        handle.create_dataset("Offset", data=np.array([0, 0, 40, 100, 180, 290]))
+        handle.create_dataset("Offset_unbound", data=np.array([0, 10, 10, 60, 80, 90]))
+
+    return
+
+
+def run_serial(directory):
+    load_hdf5_replace_and_dump(f"{directory}/snap")
+    create_test_catalogue(directory)
+    load_data_and_write_new_catalog(f"{directory}/snap.hdf5", f"{directory}/halo/snap", True)
+
+    return
+
+
+def check_outputs_match(serial, distributed):
+    """
+    Checks that all of the outputs in the two directories hold the same data.
+    """
+
+    assert read_yaml_file(f"{serial}/snap_duplicated.yml") == read_yaml_file(
+        f"{distributed}/snap_duplicated.yml"
+    )
+
+    for name, column in read_duplicate_table(f"{serial}/snap_duplicated.hdf5").items():
+        other = read_duplicate_table(f"{distributed}/snap_duplicated.hdf5")[name]
+
+        assert column.dtype == other.dtype
+        assert (column == other).all()
+
+    assert read_particle_id_ranges(f"{serial}/snap_duplicated.hdf5") == read_particle_id_ranges(
+        f"{distributed}/snap_duplicated.hdf5"
+    )
+
+    for serial_ids, distributed_ids in zip(
+        read_particle_ids_from_file(f"{serial}/snap.hdf5", mmap=False).values(),
+        read_particle_ids_from_file(f"{distributed}/snap.hdf5", mmap=False).values(),
+    ):
+        assert (serial_ids == distributed_ids).all()
+
+    filename = "halo/snap.ordered_group_particles"
+
+    serial_groups = read_ordered_groups_from_file(f"{serial}/{filename}")
+    distributed_groups = read_ordered_groups_from_file(f"{distributed}/{filename}")
+
+    assert serial_groups.keys() == distributed_groups.keys()
+
+    for ptype, groups in serial_groups.items():
+        assert groups.dtype == distributed_groups[ptype].dtype
+        assert (groups == distributed_groups[ptype]).all()
+
+    with h5py.File(f"{serial}/{filename}", "r") as a, h5py.File(f"{distributed}/{filename}", "r") as b:
+        for name in ["GroupHash", "GroupSize"]:
+            assert (a[f"Catalogue/{name}"][...] == b[f"Catalogue/{name}"][...]).all()
+
+    return
+
+
+def test_get_range_boundaries_0():
+    assert list(get_range_boundaries(10, 4)) == [0, 2, 5, 7, 10]
+    assert list(get_range_boundaries(2, 4)) == [0, 0, 1, 1, 2]
+
+
+def test_postprocess_distributed_0(tmp_path):
+    """
+    On one rank, the outputs are the same as those of the serial scripts.
+    """
+
+    for name in ["serial", "distributed"]:
+        create_test_snapshot(f"{tmp_path}/{name}")
+
+    run_serial(f"{tmp_path}/serial")
+
+    assert preprocess_distributed(f"{tmp_path}/distributed/snap") == StageStatus.COMPLETED
+
+    create_test_catalogue(f"{tmp_path}/distributed")
+    postprocess_distributed(
+        f"{tmp_path}/distributed/snap.hdf5", f"{tmp_path}/distributed/halo/snap", True
+    )
+
+    check_outputs_match(f"{tmp_path}/serial", f"{tmp_path}/distributed")
+
+
+@pytest.mark.skipif(shutil.which("mpirun") is None, reason="mpirun is not available")
+def test_postprocess_distributed_1(tmp_path):
+    """
+    On four ranks, the outputs are the same as those of the serial scripts.
+    """
+
+    for name in ["serial", "distributed"]:
+        create_test_snapshot(f"{tmp_path}/{name}")
+
+    run_serial(f"{tmp_path}/serial")
+
+    script = os.path.join(os.path.dirname(os.path.dirname(__file__)), "mpi_backend.py")
+    environment = dict(
+        os.environ, OMPI_ALLOW_RUN_AS_ROOT="1", OMPI_ALLOW_RUN_AS_ROOT_CONFIRM="1"
+    )
+
+    def run(*arguments):
+        subprocess.run(
+            ["mpirun", "-n", "4", "--oversubscribe", sys.executable, script]
+            + ["-i", "snap", "-d", f"{tmp_path}/distributed"]
+            + list(arguments),
+            check=True,
+            env=environment,
+            timeout=300,
+        )
+
+    run("--stage", "preprocess")
+    create_test_catalogue(f"{tmp_path}/distributed")
+    run("--stage", "postprocess")
+
+    check_outputs_match(f"{tmp_path}/serial", f"{tmp_path}/distributed")
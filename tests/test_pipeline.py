@@ -0,0 +1,206 @@
+"""
+Tests the in-memory pipeline in pipeline.py against the scripts.
+"""
+
+from pipeline import *
+
+import os
+import sys
+import h5py
+import pytest
+
+
+def create_test_snapshot(directory):
+    """
+    Creates a small snapshot with duplicated IDs in gas and stars.
+    """
+
+    with h5py.File(f"{directory}/snap.hdf5", "w") as handle:
+        handle.create_group("Header").attrs["NumPart_Total"] = [6, 3, 0, 0, 4, 0]
+        handle.create_dataset("PartType0/ParticleIDs", data=np.array([7, 5, 3, 2, 4, 5]))
+        handle.create_dataset("PartType1/ParticleIDs", data=np.array([11, 12, 13]))
+        handle.create_dataset("PartType4/ParticleIDs", data=np.array([6, 2, 1, 7]))
+
+    return
+
+
+def create_test_catalogue(catalogue_path):
+    """
+    Creates a fake velociraptor catalogue over the unique IDs (i.e. after
+    preprocessing, 5 -> 14, 2 -> 15 and 7 -> 16 for the repeats).
+    """
+
+    os.makedirs(os.path.dirname(catalogue_path), exist_ok=True)
+
+    with h5py.File(f"{catalogue_path}.catalog_particles", "w") as handle:
+        handle.create_dataset("Particle_IDs", data=np.array([14, 3, 11, 6, 15, 1]))
+
+    with h5py.File(f"{catalogue_path}.catalog_particles.unbound", "w") as handle:
+        handle.create_dataset("Particle_IDs", data=np.array([16, 12]))
+
+    with h5py.File(f"{catalogue_path}.catalog_groups", "w") as handle:
+        handle.create_dataset("Offset", data=np.array([0, 3]))
+        handle.create_dataset("Offset_unbound", data=np.array([0, 1]))
+
+    return
+
+
+def test_pipeline_0(tmp_path):
+    """
+    Runs the stages of the pipeline (apart from VELOCIraptor itself) and
+    checks that the results are the same as those of the scripts.
+    """
+
+    directory = str(tmp_path)
+    create_test_snapshot(directory)
+
+    pipeline = Pipeline("snap", directory=directory)
+
+    assert pipeline.preprocess() == StageStatus.COMPLETED
+
+    unique_ids = read_particle_ids_from_file(f"{directory}/snap.hdf5")
+
+    assert (unique_ids[0] == np.array([7, 5, 3, 2, 4, 14])).all()
+    assert (unique_ids[4] == np.array([6, 15, 1, 16])).all()
+
+    create_test_catalogue(pipeline.catalogue_path("halo"))
+
+    groups = pipeline.postprocess("halo")
+
+    expected = {
+        0: np.array([-1, -1, 0, -1, -1, 0]),
+        1: np.array([0, 1, -1]),
+        4: np.array([1, 1, 1, 0]),
+    }
+
+    for ptype, expected_groups in expected.items():
+        assert (groups[ptype] == expected_groups).all()
+
+    # The script reads everything from file again; it must agree.
+    postprocess.load_data_and_write_new_catalog(
+        snapshot_filename=f"{directory}/snap.hdf5",
+        catalogue_path=pipeline.catalogue_path("halo"),
+        include_unbound=True,
+    )
+
+    with h5py.File(f"{pipeline.catalogue_path('halo')}.ordered_group_particles", "r") as handle:
+        for ptype, expected_groups in expected.items():
+            assert (handle[f"PartType{ptype}/GroupID"][...] == expected_groups).all()
+
+    assert pipeline.fix_particle_ids() == StageStatus.COMPLETED
+
+    original_ids = read_particle_ids_from_file(f"{directory}/snap.hdf5")
+
+    assert (original_ids[0] == np.array([7, 5, 3, 2, 4, 5])).all()
+    assert (original_ids[4] == np.array([6, 2, 1, 7])).all()
+
+    pipeline.add_info_to_snapshot()
+
+    with h5py.File(f"{directory}/snap.hdf5", "r") as handle:
+        for ptype, expected_groups in expected.items():
+            assert (handle[f"PartType{ptype}/VRHaloID"][...] == expected_groups).all()
+            assert f"PartType{ptype}/VRGalID" not in handle
+
+
+def create_fake_velociraptor(directory):
+    """
+    Creates a fake stf binary that puts every other particle of the snapshot
+    into one of two groups (bound) and writes no unbound particles.
+    """
+
+    path = f"{directory}/stf"
+
+    with open(path, "w") as handle:
+        handle.write(
+            f"""#!{sys.executable}
+import sys
+import h5py
+import numpy as np
+
+arguments = sys.argv[1:]
+snapshot = arguments[arguments.index("-i") + 1]
+output = arguments[arguments.index("-o") + 1]
+
+with h5py.File(f"{{snapshot}}.hdf5", "r") as handle:
+    ids = np.concatenate(
+        [handle[f"PartType{{ptype}}/ParticleIDs"][...] for ptype in [0, 1, 4]]
+    )
+
+assert np.unique(ids).size == ids.size, "stf needs unique IDs"
+
+members = ids[::2]
+
+with h5py.File(f"{{output}}.catalog_particles", "w") as handle:
+    handle.create_dataset("Particle_IDs", data=members)
+
+with h5py.File(f"{{output}}.catalog_particles.unbound", "w") as handle:
+    handle.create_dataset("Particle_IDs", data=np.array([], dtype=ids.dtype))
+
+with h5py.File(f"{{output}}.catalog_groups", "w") as handle:
+    handle.create_dataset("Offset", data=np.array([0, members.size // 2]))
+    handle.create_dataset("Offset_unbound", data=np.array([0, 0]))
+"""
+        )
+
+    os.chmod(path, 0o755)
+
+    return path
+
+
+def test_pipeline_resume_0(tmp_path):
+    """
+    Tests that a run that is interrupted half way through can be resumed,
+    skipping the stages that were already completed.
+    """
+
+    directory = str(tmp_path)
+    create_test_snapshot(directory)
+    velociraptor_path = create_fake_velociraptor(directory)
+
+    configs = {"halo": "velociraptor.cfg", "galaxy": "velociraptor_galaxy.cfg"}
+
+    pipeline = Pipeline("snap", directory=directory, velociraptor_path=velociraptor_path)
+
+    def interrupted(catalogue, include_unbound):
+        raise KeyboardInterrupt
+
+    original_postprocess = pipeline.postprocess
+    pipeline.postprocess = lambda catalogue, include_unbound: (
+        interrupted(catalogue, include_unbound)
+        if catalogue == "galaxy"
+        else original_postprocess(catalogue, include_unbound)
+    )
+
+    with pytest.raises(KeyboardInterrupt):
+        pipeline.run(configs=configs)
+
+    assert pipeline.read_completed_stages() == [
+        "preprocess",
+        "velociraptor_halo",
+        "velociraptor_galaxy",
+        "postprocess_halo",
+    ]
+
+    # The snapshot still has the unique IDs in it.
+    assert (read_particle_ids_from_file(f"{directory}/snap.hdf5")[0][-1] == 14)
+
+    resumed = Pipeline("snap", directory=directory, velociraptor_path=velociraptor_path)
+    resumed.preprocess = None
+    resumed.run_velociraptor = None
+
+    resumed.run(configs=configs, resume=True)
+
+    assert resumed.read_completed_stages()[-3:] == [
+        "postprocess_galaxy",
+        "fix_particle_ids",
+        "add_info",
+    ]
+
+    original_ids = read_particle_ids_from_file(f"{directory}/snap.hdf5")
+
+    assert (original_ids[0] == np.array([7, 5, 3, 2, 4, 5])).all()
+    assert (original_ids[4] == np.array([6, 2, 1, 7])).all()
+
+    with h5py.File(f"{directory}/snap.hdf5", "r") as handle:
+        assert (handle["PartType0/VRHaloID"][...] == np.array([0, -1, 0, -1, 0, -1])).all()
+        assert (handle["PartType0/VRGalID"][...] == handle["PartType0/VRHaloID"][...]).all()
@@ -3,6 +3,7 @@ Tests the functions in postprocess.py
 """
 
 from postprocess import *
+from preprocess import load_hdf5_replace_and_dump
 
 
 def test_create_group_array_0():
@@ -52,3 +53,297 @@ def test_create_positions_roups_correspondance_0():
 
     for g, e_g in zip(groups_snapshot.values(), expected_group_array.values()):
         assert (g == e_g).all()
+
+
+def test_create_positions_groups_correspondance_1(tmp_path):
+    """
+    Tests that particle types that are filtered out are never read and keep
+    a group of -1.
+    """
+
+    filename = str(tmp_path / "snapshot.hdf5")
+
+    with h5py.File(filename, "w") as handle:
+        handle.create_dataset("PartType0/ParticleIDs", data=np.array([2, 5, 11, 9]))
+        handle.create_dataset("PartType1/ParticleIDs", data=np.array([17, 1, 3]))
+        handle.create_dataset("PartType4/ParticleIDs", data=np.array([100, 101]))
+
+    particle_ids_velociraptor = np.array([1, 2, 5, 3, 9, 17])
+    group_array_velociraptor = np.array([0, 7, 7, 4, 2, 1])
+
+    particle_ids_snapshot = LazyParticleIDs(filename)
+    groups_snapshot = initialise_groups_dictionary(particle_ids_snapshot)
+
+    groups_snapshot = create_positions_groups_correspondance(
+        particle_ids_velociraptor,
+        group_array_velociraptor,
+        particle_ids_snapshot,
+        groups_snapshot,
+        particle_types={0, 4},
+    )
+
+    assert (groups_snapshot[0] == np.array([7, 7, -1, 2])).all()
+    assert (groups_snapshot[1] == np.array([-1, -1, -1])).all()
+    assert (groups_snapshot[4] == np.array([-1, -1])).all()
+    assert not particle_ids_snapshot.is_loaded(1)
+
+
+def test_select_particle_types_by_id_range_0(tmp_path):
+    """
+    Tests that the ranges recorded by preprocess skip the particle types that
+    cannot be in the catalogue before their IDs are read.
+    """
+
+    snapshot = str(tmp_path / "snap")
+
+    with h5py.File(f"{snapshot}.hdf5", "w") as handle:
+        handle.create_dataset("PartType0/ParticleIDs", data=np.array([2, 5, 11, 9]))
+        handle.create_dataset("PartType1/ParticleIDs", data=np.array([100, 101, 100]))
+        handle.create_dataset("PartType4/ParticleIDs", data=np.array([13, 3]))
+
+    load_hdf5_replace_and_dump(snapshot)
+
+    particle_id_ranges = read_particle_id_ranges(f"{snapshot}_duplicated.hdf5")
+
+    # The repeated 100 is replaced by 102.
+    assert particle_id_ranges == {0: (2, 11), 1: (100, 102), 4: (3, 13)}
+
+    catalogue = select_particle_types_by_id_range(
+        [
+            (np.array([3, 9, 12]), np.array([0, 0, 1]), None),
+            (np.array([101]), np.array([1]), {0, 1}),
+            (np.array([], dtype=np.int64), np.array([], dtype=np.int64), None),
+        ],
+        particle_id_ranges,
+    )
+
+    assert [particle_types for _, _, particle_types in catalogue] == [{0, 4}, {1}, set()]
+
+    particle_ids_snapshot = LazyParticleIDs(f"{snapshot}.hdf5")
+    groups_snapshot = match_catalogue_to_snapshot(catalogue[:1], particle_ids_snapshot)
+
+    assert (groups_snapshot[0] == np.array([-1, -1, -1, 0])).all()
+    assert (groups_snapshot[4] == np.array([-1, 0])).all()
+    assert not particle_ids_snapshot.is_loaded(1)
+
+
+def test_select_particle_types_0():
+    """
+    Tests combining the catalogue and requested particle types.
+    """
+
+    assert select_particle_types(None, None) is None
+    assert select_particle_types({0, 4, 5}, None) == {0, 4, 5}
+    assert select_particle_types(None, [0, 1]) == [0, 1]
+    assert select_particle_types({0, 4, 5}, [0, 1]) == {0}
+
+
+def test_create_positions_groups_correspondance_from_index_0():
+    """
+    Tests that matching against the pre-sorted index gives the same result
+    as the original matching.
+    """
+
+    particle_ids_velociraptor = np.array([1, 2, 5, 3, 4, 9, 8, 10, 17])
+
+    group_array_velociraptor = np.array([0, 7, 7, 7, 4, 2, 1, 1, 1])
+
+    particle_ids_snapshot = {
+        0: np.array([2, 5, 11, 15, 26, 9, 8]),
+        1: np.array([17, 1, 3, 6, 4, 10]),
+        4: np.array([], dtype=int),
+    }
+
+    particle_id_index = {
+        ptype: create_particle_id_index(ids) for ptype, ids in particle_ids_snapshot.items()
+    }
+
+    expected_group_array = {
+        0: np.array([7, 7, -1, -1, -1, 2, 1]),
+        1: np.array([1, 0, 7, -1, 4, 1]),
+        4: np.array([], dtype=int),
+    }
+
+    groups_snapshot = create_positions_groups_correspondance_from_index(
+        particle_ids_velociraptor,
+        group_array_velociraptor,
+        particle_id_index,
+        initialise_groups_dictionary(particle_ids_snapshot),
+    )
+
+    for g, e_g in zip(groups_snapshot.values(), expected_group_array.values()):
+        assert (g == e_g).all()
+
+
+def test_load_data_and_write_new_catalog_batch_0(tmp_path):
+    """
+    Tests that the batch mode writes the same catalogues as running the
+    snapshots one at a time.
+    """
+
+    snapshot_filenames = []
+    catalogue_paths = []
+
+    for index in range(3):
+        snapshot_filename = str(tmp_path / f"snap_{index}.hdf5")
+        catalogue_path = str(tmp_path / f"halo_{index}")
+
+        with h5py.File(snapshot_filename, "w") as handle:
+            handle.create_dataset("PartType0/ParticleIDs", data=np.arange(10) + index)
+            handle.create_dataset("PartType1/ParticleIDs", data=np.arange(10, 15))
+
+        with h5py.File(f"{catalogue_path}.catalog_particles", "w") as handle:
+            handle.create_dataset("Particle_IDs", data=np.array([3, 4, 11, 5, 12]))
+
+        with h5py.File(f"{catalogue_path}.catalog_particles.unbound", "w") as handle:
+            handle.create_dataset("Particle_IDs", data=np.array([8, 9]))
+
+        with h5py.File(f"{catalogue_path}.catalog_groups", "w") as handle:
+            handle.create_dataset("Offset", data=np.array([0, 3]))
+            handle.create_dataset("Offset_unbound", data=np.array([0, 1]))
+
+        snapshot_filenames.append(snapshot_filename)
+        catalogue_paths.append(catalogue_path)
+
+    load_data_and_write_new_catalog_batch(
+        snapshot_filenames, catalogue_paths, include_unbound=True, max_prefetch=2
+    )
+
+    for snapshot_filename, catalogue_path in zip(snapshot_filenames, catalogue_paths):
+        with h5py.File(f"{catalogue_path}.ordered_group_particles", "r") as handle:
+            batch = {ptype: handle[f"PartType{ptype}/GroupID"][...] for ptype in [0, 1]}
+
+        load_data_and_write_new_catalog(snapshot_filename, catalogue_path, True)
+
+        with h5py.File(f"{catalogue_path}.ordered_group_particles", "r") as handle:
+            for ptype in [0, 1]:
+                assert (handle[f"PartType{ptype}/GroupID"][...] == batch[ptype]).all()
+
+    assert (batch[0] == np.array([-1, 0, 0, 1, -1, -1, 0, 1, -1, 0])).all()
+
+
+def create_test_catalogue(catalogue_path, bound_groups, unbound_groups, types=False):
+    """
+    Writes a velociraptor catalogue with the given lists of particle IDs for
+    each group (bound and unbound). If types is True, the catalog_parttypes
+    files are written too, with the type of each particle its ID modulo 2.
+    """
+
+    for extension, groups in [
+        ("catalog_particles", bound_groups),
+        ("catalog_particles.unbound", unbound_groups),
+    ]:
+        particle_ids = np.concatenate([np.array(x, dtype=np.int64) for x in groups])
+
+        with h5py.File(f"{catalogue_path}.{extension}", "w") as handle:
+            handle.create_dataset("Particle_IDs", data=particle_ids)
+
+        if types:
+            types_extension = extension.replace("particles", "parttypes")
+
+            with h5py.File(f"{catalogue_path}.{types_extension}", "w") as handle:
+                handle.create_dataset("Particle_types", data=particle_ids % 2)
+
+    with h5py.File(f"{catalogue_path}.catalog_groups", "w") as handle:
+        for name, groups in [("Offset", bound_groups), ("Offset_unbound", unbound_groups)]:
+            sizes = np.array([len(x) for x in groups])
+            handle.create_dataset(name, data=np.cumsum(sizes) - sizes)
+
+    return
+
+
+def test_calculate_catalogue_hashes_0():
+    """
+    Tests that the hashes depend on the particles in the groups, but not on
+    their order or on whether they are bound.
+    """
+
+    catalogue_a = [
+        (np.array([1, 2, 3, 4]), np.array([0, 0, 1, 1]), None),
+        (np.array([5]), np.array([1]), None),
+    ]
+    catalogue_b = [(np.array([2, 1, 5, 3, 4]), np.array([0, 0, 1, 1, 1]), None)]
+    catalogue_c = [(np.array([1, 2, 3, 6, 4]), np.array([0, 0, 1, 1, 1]), None)]
+
+    hashes_a = calculate_catalogue_hashes(catalogue_a, True)
+    hashes_b = calculate_catalogue_hashes(catalogue_b, True)
+    hashes_c = calculate_catalogue_hashes(catalogue_c, True)
+
+    assert (hashes_a.hashes == hashes_b.hashes).all()
+    assert (hashes_a.sizes == [2, 3]).all()
+    assert hashes_a.hashes[0] == hashes_c.hashes[0]
+    assert hashes_a.hashes[1] != hashes_c.hashes[1]
+
+
+def test_match_unchanged_groups_0():
+    """
+    Tests the matching of groups between catalogues by hash.
+    """
+
+    old = GroupHashes(
+        hashes=np.array([10, 20, 30, 0], dtype=np.uint64),
+        sizes=np.array([1, 2, 3, 0]),
+        include_unbound=True,
+    )
+    new = GroupHashes(
+        hashes=np.array([30, 21, 10, 0], dtype=np.uint64),
+        sizes=np.array([3, 2, 1, 0]),
+        include_unbound=True,
+    )
+
+    assert (match_unchanged_groups(old, new) == [2, -1, 0, -1]).all()
+
+
+def test_load_data_and_update_catalog_0(tmp_path):
+    """
+    Tests that updating the output for a re-created catalogue gives the same
+    result as postprocessing it from scratch, and that only the changed
+    chunks are written.
+    """
+
+    snapshot_filename = str(tmp_path / "snap.hdf5")
+
+    with h5py.File(snapshot_filename, "w") as handle:
+        handle.create_dataset(
+            "PartType0/ParticleIDs", data=np.arange(0, 40)[::-1], chunks=(8,)
+        )
+        handle.create_dataset("PartType1/ParticleIDs", data=np.arange(40, 60), chunks=(8,))
+
+    old_bound = [[0, 1, 2, 3], [10, 11, 41], [20, 21], [50, 51, 52]]
+    old_unbound = [[4], [], [22], []]
+
+    # Groups 0 and 3 are unchanged (but swap places), group 2 is split, and
+    # group 1 loses a particle to a new group.
+    new_bound = [[50, 52, 51], [10, 11], [20], [21, 30], [1, 3, 0, 2], [41, 42]]
+    new_unbound = [[], [], [22], [], [4], []]
+
+    catalogue_path = str(tmp_path / "halo")
+    create_test_catalogue(catalogue_path, old_bound, old_unbound)
+    load_data_and_write_new_catalog(snapshot_filename, catalogue_path, True)
+
+    # No previous output, so this runs in full.
+    reference_path = str(tmp_path / "reference")
+    create_test_catalogue(reference_path, new_bound, new_unbound)
+    assert load_data_and_update_catalog(snapshot_filename, reference_path, True) is None
+
+    create_test_catalogue(catalogue_path, new_bound, new_unbound)
+    changes = load_data_and_update_catalog(snapshot_filename, catalogue_path, True)
+
+    assert changes["unchanged_groups"] == 2
+    assert changes["changed_groups"] == 4
+    assert changes["matched_particles"] == 8
+
+    updated = read_ordered_groups_from_file(f"{catalogue_path}.ordered_group_particles")
+    expected = read_ordered_groups_from_file(f"{reference_path}.ordered_group_particles")
+
+    for ptype in [0, 1]:
+        assert (updated[ptype] == expected[ptype]).all()
+
+    # Of the 40 + 20 rows in chunks of 8, the chunks of PartType0 with IDs
+    # 32-39 and 8-15 and the last chunk of PartType1 did not change.
+    assert changes["rows_written"] == 40
+
+    updated_hashes = read_group_hashes_from_file(f"{catalogue_path}.ordered_group_particles")
+    expected_hashes = read_group_hashes_from_file(f"{reference_path}.ordered_group_particles")
+
+    assert (updated_hashes.hashes == expected_hashes.hashes).all()
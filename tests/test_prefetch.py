@@ -0,0 +1,78 @@
+"""
+Tests the prefetching reader and background writer in prefetch.py
+"""
+
+from prefetch import *
+
+import threading
+import pytest
+
+
+def test_prefetcher_0():
+    """
+    Tests that items come back in order, with their data.
+    """
+
+    items = list(range(10))
+
+    prefetcher = Prefetcher(items, lambda x: x * x, max_prefetch=3)
+
+    assert [(item, data) for item, data in prefetcher] == [(x, x * x) for x in items]
+
+
+def test_prefetcher_memory_limit_0():
+    """
+    Tests that the memory limit bounds the items that are read but not
+    released, and that releasing them lets the reads continue.
+    """
+
+    lock = threading.Lock()
+    state = {"read": 0, "released": 0, "maximum": 0}
+
+    def read(item):
+        with lock:
+            state["read"] += 1
+            state["maximum"] = max(state["maximum"], state["read"] - state["released"])
+
+        return item
+
+    prefetcher = Prefetcher(
+        list(range(20)), read, max_prefetch=5, memory_limit=30, size=lambda x: 10
+    )
+
+    with BackgroundWriter(max_pending=2) as writer:
+        for item, _ in prefetcher:
+
+            def release(item=item):
+                with lock:
+                    state["released"] += 1
+
+                prefetcher.release(item)
+
+            writer.submit(lambda: None, callback=release)
+
+    assert state["read"] == 20
+    assert state["maximum"] <= 3
+
+
+def test_background_writer_0():
+    """
+    Tests that writes happen in order, and that errors are re-raised.
+    """
+
+    written = []
+
+    with BackgroundWriter(max_pending=2) as writer:
+        for x in range(10):
+            writer.submit(written.append, x)
+
+    assert written == list(range(10))
+
+    def fail():
+        raise ValueError("Disk full")
+
+    writer = BackgroundWriter()
+    writer.submit(fail)
+
+    with pytest.raises(ValueError):
+        writer.close()
@@ -107,7 +107,7 @@ def test_write_data_0():
 
     # Let's load it back in
     with open("test.yml", "r") as f:
-        data = yaml.load(f)
+        data = yaml.load(f, Loader=yaml.Loader)
 
     # Delete our friendly neighbourhood test file
     os.remove("test.yml")
@@ -130,3 +130,71 @@ def test_combine_and_split_0():
         assert (d_in == d_out).all()
 
     return
+
+
+def test_has_duplicate_ids_0():
+    """
+    Tests the duplicate pre-check on a compact range of IDs.
+    """
+
+    assert not has_duplicate_ids(np.array([0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10])[::-1])
+    assert has_duplicate_ids(np.array([7, 5, 3, 2, 4, 5, 6, 2, 1, 7]))
+    assert has_duplicate_ids(np.array([1234132, 1234132]))
+    assert not has_duplicate_ids(np.array([1234132]))
+
+    return
+
+
+def test_has_duplicate_ids_1():
+    """
+    Tests the hashed duplicate pre-check on sparse IDs, across many blocks.
+    """
+
+    data = np.random.default_rng(1234).choice(2 ** 40, size=10000, replace=False)
+
+    assert not has_duplicate_ids(data)
+    assert not has_duplicate_ids_hashed(data, block_size=1000)
+
+    data[7777] = data[12]
+
+    assert has_duplicate_ids(data)
+    assert has_duplicate_ids_hashed(data, block_size=1000)
+
+    return
+
+
+def test_load_hdf5_replace_and_dump_batch_0(tmp_path):
+    """
+    Tests that the batch mode gives the same result as running the snapshots
+    one at a time.
+    """
+
+    data = [
+        np.array([7, 5, 3, 2, 4, 5, 6, 2, 1, 7]),
+        np.arange(10),
+        np.array([1, 1, 1, 2]),
+    ]
+
+    for index, ids in enumerate(data):
+        for prefix in ["batch", "single"]:
+            with h5py.File(tmp_path / f"{prefix}_{index}.hdf5", "w") as handle:
+                handle.create_dataset("PartType0/ParticleIDs", data=ids)
+
+    statuses = load_hdf5_replace_and_dump_batch(
+        [str(tmp_path / f"batch_{index}") for index in range(3)],
+        max_prefetch=2,
+        memory_limit=100,
+    )
+
+    assert statuses[1] == StageStatus.NOTHING_TO_DO
+
+    for index in range(3):
+        status = load_hdf5_replace_and_dump(str(tmp_path / f"single_{index}"))
+
+        assert status == statuses[index]
+
+        batch = read_particle_ids_from_file(str(tmp_path / f"batch_{index}.hdf5"))
+        single = read_particle_ids_from_file(str(tmp_path / f"single_{index}.hdf5"))
+
+        assert (batch[0] == single[0]).all()
+        assert (batch[0] != data[index]).any() == (status == StageStatus.COMPLETED)
@@ -0,0 +1,132 @@
+"""
+Tests the functions in reorder_snapshot.py
+"""
+
+from reorder_snapshot import *
+
+from test_extract_groups import create_test_snapshot
+
+
+def test_create_group_order_0():
+    """
+    Particles are sorted by group, stably, with those not in a group last.
+    """
+
+    groups = np.array([2, -1, 0, 2, 1, 0, -1, 2])
+
+    order, lengths = create_group_order(groups, 4)
+
+    assert (order == [2, 5, 4, 0, 3, 7, 1, 6]).all()
+    assert (lengths == [2, 1, 3, 0]).all()
+    assert (invert_permutation(order)[order] == np.arange(8)).all()
+
+
+def test_copy_dataset_reordered_0(tmp_path, monkeypatch):
+    """
+    Scattered groups are copied with a single pass over the source, reading
+    each of its chunks once, in order.
+    """
+
+    random = np.random.default_rng(5)
+
+    groups = random.integers(-1, 20, size=1000)
+    coordinates = random.random((1000, 3))
+
+    order, _ = create_group_order(groups, 20)
+
+    with h5py.File(tmp_path / "source.hdf5", "w") as handle:
+        handle.create_dataset(
+            "Coordinates", data=coordinates, chunks=(50, 3), compression="gzip"
+        )
+
+    reads = []
+    getitem = h5py.Dataset.__getitem__
+
+    def record_read(dataset, selection, *args, **kwargs):
+        if dataset.name == "/Coordinates" and dataset.file.mode == "r":
+            reads.append((selection.start, selection.stop))
+
+        return getitem(dataset, selection, *args, **kwargs)
+
+    with h5py.File(tmp_path / "source.hdf5", "r") as source, h5py.File(
+        tmp_path / "output.hdf5", "w"
+    ) as output:
+        monkeypatch.setattr(h5py.Dataset, "__getitem__", record_read)
+        copy_dataset_reordered(
+            source["Coordinates"], output, order, block_rows=100, temporary_directory=tmp_path
+        )
+        monkeypatch.undo()
+
+        assert reads == [(start, start + 100) for start in range(0, 1000, 100)]
+        assert (output["Coordinates"][...] == coordinates[order]).all()
+
+    # The spill files are removed.
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["output.hdf5", "source.hdf5"]
+
+
+def test_reorder_snapshot_0(tmp_path):
+    """
+    Every field is permuted in the same way, each group can be read in one
+    slice, and the permutations map between the two snapshots.
+    """
+
+    random = np.random.default_rng(3)
+
+    groups_snapshot = {
+        0: random.integers(-1, 5, size=40).astype(np.int8),
+        1: random.integers(-1, 5, size=23).astype(np.int8),
+        # Not in the catalogue, so copied as it is.
+        4: np.full(9, -1, dtype=np.int8),
+    }
+
+    snapshot_filename = str(tmp_path / "snap.hdf5")
+    output_filename = str(tmp_path / "reordered.hdf5")
+
+    create_test_snapshot(snapshot_filename, groups_snapshot)
+
+    # Small blocks, so that each field is written in several.
+    reordered_groups = reorder_snapshot(
+        snapshot_filename,
+        {ptype: groups_snapshot[ptype] for ptype in [0, 1]},
+        output_filename,
+        block_rows=7,
+    )
+
+    with h5py.File(snapshot_filename, "r") as source, h5py.File(
+        output_filename, "r"
+    ) as output:
+        assert (
+            output["Header"].attrs["NumPart_Total"] == source["Header"].attrs["NumPart_Total"]
+        ).all()
+
+        for ptype, groups in groups_snapshot.items():
+            name = f"PartType{ptype}"
+            order = output[f"Reordering/{name}/OriginalIndex"][...]
+            inverse = output[f"Reordering/{name}/NewIndex"][...]
+
+            sort_keys = np.where(reordered_groups[ptype] < 0, 99, reordered_groups[ptype])
+            assert (np.diff(sort_keys) >= 0).all()
+
+            for field in ["ParticleIDs", "Coordinates", "Masses"]:
+                original = source[f"{name}/{field}"][...]
+                reordered = output[f"{name}/{field}"][...]
+
+                assert output[f"{name}/{field}"].chunks == source[f"{name}/{field}"].chunks
+                assert (reordered == original[order]).all()
+                assert (reordered[inverse] == original).all()
+
+            assert output[f"{name}/Masses"].attrs["Units"] == "1e10 Msun"
+
+            for group_id in range(5):
+                ids = read_group_particles(output_filename, group_id, ptype, "ParticleIDs")
+                expected = source[f"{name}/ParticleIDs"][...][groups == group_id]
+
+                assert (ids == expected).all()
+
+        lengths = output["Groups/Length"][...]
+
+        assert lengths.shape == (5, 6)
+        assert (lengths[:, 4] == 0).all()
+        assert (output["PartType4/ParticleIDs"][...] == source["PartType4/ParticleIDs"][...]).all()
+
+    return
@@ -0,0 +1,114 @@
+"""
+Tests the functions in repack_catalogue.py
+"""
+
+import os
+
+from repack_catalogue import *
+from postprocess import (
+    load_catalogue,
+    load_data_and_write_new_catalog,
+    read_group_hashes_from_file,
+    read_ordered_groups_from_file,
+)
+from test_postprocess import create_test_catalogue
+
+
+def test_repack_catalogue_0(tmp_path):
+    """
+    The archive holds the sorted IDs with their groups, whether they are
+    bound, and their types, with narrow dtypes on disk.
+    """
+
+    catalogue_path = str(tmp_path / "halo")
+    create_test_catalogue(
+        catalogue_path, [[7, 3], [9], [1, 4]], [[2], [], [8, 5]], types=True
+    )
+
+    filename = repack_catalogue(catalogue_path)
+
+    repacked = read_repacked_catalogue(filename)
+
+    assert (repacked.particle_ids == [1, 2, 3, 4, 5, 7, 8, 9]).all()
+    assert (repacked.group_ids == [2, 0, 0, 2, 2, 0, 2, 1]).all()
+    assert (repacked.bound == [1, 0, 1, 1, 0, 1, 0, 1]).all()
+    assert (repacked.particle_types == [1, 0, 1, 0, 1, 1, 0, 1]).all()
+    assert (repacked.bound_sizes == [2, 1, 2]).all()
+    assert (repacked.unbound_sizes == [1, 0, 2]).all()
+    assert repacked.bound_types == {0, 1}
+    assert repacked.particle_ids.dtype == np.int64
+
+    with h5py.File(filename, "r") as handle:
+        assert handle["Particles/ParticleIDs"].dtype == np.uint8
+        assert handle["Particles/GroupID"].dtype == np.int8
+        assert handle["Groups/BoundSize"].dtype == np.uint8
+
+    bound = read_repacked_catalogue(filename, include_unbound=False)
+
+    assert (bound.particle_ids == [1, 3, 4, 7, 9]).all()
+    assert (bound.group_ids == [2, 0, 2, 0, 1]).all()
+
+    return
+
+
+def test_load_repacked_catalogue_0(tmp_path):
+    """
+    postprocess.py gives the same output from the archive (even once the raw
+    files are gone) as from the raw files, and ignores an out of date archive.
+    """
+
+    snapshot_filename = str(tmp_path / "snap.hdf5")
+
+    with h5py.File(snapshot_filename, "w") as handle:
+        handle.create_dataset("PartType0/ParticleIDs", data=np.array([8, 2, 4, 6, 10]))
+        handle.create_dataset("PartType1/ParticleIDs", data=np.array([9, 1, 3, 5, 7, 11]))
+
+    raw_path = str(tmp_path / "raw")
+    repacked_path = str(tmp_path / "repacked")
+
+    for catalogue_path in [raw_path, repacked_path]:
+        create_test_catalogue(
+            catalogue_path, [[7, 3], [9], [1, 4]], [[2], [], [8, 5]], types=True
+        )
+
+    repack_catalogue(repacked_path)
+
+    for include_unbound in [True, False]:
+        catalogue, hashes = load_repacked_catalogue(
+            get_repacked_filename(repacked_path), include_unbound
+        )
+        raw_hashes = calculate_catalogue_hashes(
+            load_catalogue(raw_path, include_unbound), include_unbound
+        )
+
+        assert (hashes.hashes == raw_hashes.hashes).all()
+        assert (hashes.sizes == raw_hashes.sizes).all()
+
+    for extension in ["catalog_particles", "catalog_particles.unbound", "catalog_groups"]:
+        os.remove(f"{repacked_path}.{extension}")
+
+    for catalogue_path in [raw_path, repacked_path]:
+        load_data_and_write_new_catalog(snapshot_filename, catalogue_path, True)
+
+    raw = read_ordered_groups_from_file(f"{raw_path}.ordered_group_particles")
+    repacked = read_ordered_groups_from_file(f"{repacked_path}.ordered_group_particles")
+
+    for ptype in [0, 1]:
+        assert (raw[ptype] == repacked[ptype]).all()
+
+    assert (raw[0] == [2, 0, 2, -1, -1]).all()
+
+    assert (
+        read_group_hashes_from_file(f"{raw_path}.ordered_group_particles").hashes
+        == read_group_hashes_from_file(f"{repacked_path}.ordered_group_particles").hashes
+    ).all()
+
+    # A raw file newer than the archive means VELOCIraptor has been re-run.
+    assert find_repacked_catalogue(repacked_path) is not None
+
+    modified = os.path.getmtime(get_repacked_filename(repacked_path))
+    os.utime(f"{repacked_path}.catalog_parttypes", (modified + 10, modified + 10))
+
+    assert find_repacked_catalogue(repacked_path) is None
+
+    return
@@ -1,5 +1,5 @@
 """
-Tests the path functions in run_velociraptor.
+Tests the path functions and the watched runs in run_velociraptor.
 """
 
 from run_velociraptor import *
@@ -28,3 +28,123 @@ def test_parse_output_path_1():
 
     assert file == "hsdf.hdf5"
     assert directory == "gonna/do/some/things"
+
+
+def create_fake_velociraptor(directory, allocate_mb=0, sleep=0.0, exit_code=0, write=True):
+    """
+    Creates a fake stf binary that logs its stages, allocates (and touches)
+    allocate_mb of memory, sleeps, and then writes the catalogue files (if
+    write) and exits with exit_code.
+    """
+
+    path = f"{directory}/stf"
+
+    with open(path, "w") as handle:
+        handle.write(
+            f"""#!{sys.executable}
+import sys
+import time
+
+output = sys.argv[sys.argv.index("-o") + 1]
+
+print("Reading input data", flush=True)
+memory = bytearray({allocate_mb} * 1024 * 1024)
+print("Searching for FOF groups", flush=True)
+time.sleep({sleep})
+print("Writing catalogue", flush=True)
+
+if {write}:
+    for extension in ["catalog_particles", "catalog_groups", "properties"]:
+        with open(f"{{output}}.{{extension}}", "wb") as handle:
+            handle.write(bytes(1024))
+
+sys.exit({exit_code})
+"""
+        )
+
+    os.chmod(path, 0o755)
+
+    return path
+
+
+def run_fake_velociraptor(tmp_path, **kwargs):
+    limits = {
+        name: kwargs.pop(name)
+        for name in ["memory_limit", "time_limit", "stall_limit"]
+        if name in kwargs
+    }
+
+    samples = []
+
+    result = run_velociraptor(
+        snapshot_filename=str(tmp_path / "snap"),
+        velociraptor_path=create_fake_velociraptor(str(tmp_path), **kwargs),
+        output_path=str(tmp_path / "halo"),
+        omp_num_threads=2,
+        sample_interval=0.05,
+        progress=samples.append,
+        **limits,
+    )
+
+    return result, samples
+
+
+def test_run_velociraptor_0(tmp_path):
+    """
+    A successful run reports its stages, memory and outputs.
+    """
+
+    result, samples = run_fake_velociraptor(tmp_path, allocate_mb=64, sleep=0.5)
+
+    assert result.succeeded
+    assert result.return_code == 0
+    assert result.stage == "writing output"
+    assert result.peak_memory_bytes > 64 * 1024 * 1024
+    assert result.output_bytes == 3 * 1024
+    assert result.missing_outputs == []
+
+    assert "finding groups" in [sample.stage for sample in samples]
+    assert max(sample.rss_bytes for sample in samples) > 64 * 1024 * 1024
+
+    with open(result.log_filename, "r") as handle:
+        assert "Searching" in handle.read()
+
+
+def test_run_velociraptor_1(tmp_path):
+    """
+    Failed runs, and runs that do not write their outputs, are reported.
+    """
+
+    result, _ = run_fake_velociraptor(tmp_path, exit_code=3)
+
+    assert result.status == "failed"
+    assert result.return_code == 3
+
+    os.makedirs(tmp_path / "missing")
+    result, _ = run_fake_velociraptor(tmp_path / "missing", write=False)
+
+    assert result.status == "failed"
+    assert result.return_code == 0
+    assert result.missing_outputs == ["catalog_particles", "catalog_groups"]
+
+
+def test_run_velociraptor_2(tmp_path):
+    """
+    Runs that go over the memory or wall-clock limits, or stop making
+    progress, are stopped early.
+    """
+
+    for limits, status in [
+        (dict(allocate_mb=256, sleep=30, memory_limit=128 * 1024 * 1024), "memory_limit"),
+        (dict(sleep=30, time_limit=0.5), "time_limit"),
+        (dict(sleep=30, stall_limit=0.5), "stalled"),
+    ]:
+        os.makedirs(tmp_path / status)
+        result, _ = run_fake_velociraptor(tmp_path / status, **limits)
+
+        assert result.status == status
+        assert result.stage in ["reading snapshot", "finding groups"]
+        assert result.missing_outputs == ["catalog_particles", "catalog_groups"]
+        assert result.return_code == -signal.SIGTERM
+        assert result.wall_time_seconds < 10
+        assert not result.succeeded
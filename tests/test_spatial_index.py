@@ -0,0 +1,144 @@
+"""
+Tests the functions in spatial_index.py
+"""
+
+from spatial_index import *
+
+
+def create_test_snapshot(filename, particle_numbers, box_size=10.0, seed=42):
+    """
+    Creates a snapshot with randomly placed particles of each type.
+    """
+
+    random = np.random.default_rng(seed)
+
+    with h5py.File(filename, "w") as handle:
+        header = handle.create_group("Header")
+        header.attrs["BoxSize"] = box_size
+        header.attrs["MassTable"] = np.array([0.0, 2.0, 0.0, 0.0, 0.0, 0.0])
+
+        for ptype, number in particle_numbers.items():
+            current_group = handle.create_group(f"PartType{ptype}")
+            current_group.create_dataset(
+                "Coordinates", data=random.uniform(0, box_size, size=(number, 3))
+            )
+
+            if ptype != 1:
+                current_group.create_dataset("Masses", data=random.uniform(1, 2, size=number))
+
+    return
+
+
+def brute_force_query(coordinates, centre, radius, box_size):
+    """
+    The particles within radius of centre, checking every particle.
+    """
+
+    separations = wrap_separations(coordinates - centre, box_size)
+
+    return np.where(np.sum(separations ** 2, axis=1) <= radius ** 2)[0]
+
+
+def test_wrap_separations_0():
+    """
+    Tests the periodic wrapping of separations.
+    """
+
+    separations = np.array([0.5, 6.0, -6.0, 4.9, -9.5])
+
+    assert np.allclose(wrap_separations(separations, 10.0), [0.5, -4.0, 4.0, 4.9, 0.5])
+
+
+def test_query_0(tmp_path):
+    """
+    Tests the aperture queries against a brute-force search, including
+    centres near the edges of the box and radii larger than a cell.
+    """
+
+    create_test_snapshot(tmp_path / "snap.hdf5", {0: 2000, 1: 3000})
+
+    index = SpatialIndex.from_snapshot(tmp_path / "snap.hdf5")
+
+    assert index.cells_per_dimension == 8
+
+    centres = np.array([[5.0, 5.0, 5.0], [0.1, 9.9, 0.2], [9.99, 0.0, 5.0], [3.0, 3.0, 3.0]])
+    radii = np.array([1.0, 1.5, 0.3, 6.0])
+
+    apertures = index.query_apertures(centres, radii, threads=2)
+
+    with h5py.File(tmp_path / "snap.hdf5", "r") as handle:
+        for ptype in [0, 1]:
+            coordinates = handle[f"PartType{ptype}/Coordinates"][...]
+
+            for centre, radius, found in zip(centres, radii, apertures[ptype]):
+                expected = brute_force_query(coordinates, centre, radius, index.box_size)
+
+                assert (found == expected).all()
+
+    assert apertures[0][1].size > 0
+
+
+def test_load_or_build_index_0(tmp_path):
+    """
+    Tests that the index is persisted, re-used, and rebuilt when the
+    snapshot changes.
+    """
+
+    create_test_snapshot(tmp_path / "snap.hdf5", {0: 100, 4: 10})
+
+    index = load_or_build_index(str(tmp_path / "snap"))
+
+    assert index.particle_types == [0, 4]
+    assert is_up_to_date(tmp_path / "snap.spatial_index", tmp_path / "snap.hdf5")
+
+    built = SpatialIndex.from_snapshot(tmp_path / "snap.hdf5")
+
+    for ptype in [0, 4]:
+        assert (index.order[ptype] == built.order[ptype]).all()
+        assert (index.cell_offsets[ptype] == built.cell_offsets[ptype]).all()
+        assert (index.coordinates[ptype] == built.coordinates[ptype]).all()
+
+    create_test_snapshot(tmp_path / "snap.hdf5", {0: 200}, seed=1)
+    os.utime(tmp_path / "snap.hdf5", (0, 0))
+
+    assert not is_up_to_date(tmp_path / "snap.spatial_index", tmp_path / "snap.hdf5")
+    assert load_or_build_index(str(tmp_path / "snap")).particle_types == [0]
+
+
+def test_calculate_group_centres_0():
+    """
+    Tests the centres of mass, for a group straddling the box edge.
+    """
+
+    box_size = np.array([10.0, 10.0, 10.0])
+
+    coordinates = {
+        0: np.array([[9.5, 5.0, 5.0], [1.0, 1.0, 1.0], [0.5, 5.0, 5.0]]),
+        1: np.array([[3.0, 1.0, 1.0], [7.0, 7.0, 7.0]]),
+    }
+    masses = {0: np.array([1.0, 1.0, 3.0]), 1: np.array([1.0, 1.0])}
+    groups_snapshot = {0: np.array([2, 0, 2]), 1: np.array([0, -1])}
+
+    group_ids, centres = calculate_group_centres(coordinates, masses, groups_snapshot, box_size)
+
+    assert (group_ids == [0, 2]).all()
+    assert np.allclose(centres[0], [2.0, 1.0, 1.0])
+    assert np.allclose(centres[1], [0.25, 5.0, 5.0])
+
+
+def test_write_apertures_to_file_0(tmp_path):
+    """
+    Tests the layout of the aperture output.
+    """
+
+    apertures = {0: [np.array([1, 5]), np.array([], dtype=np.int64), np.array([3])]}
+
+    write_apertures_to_file(
+        tmp_path / "apertures.hdf5", np.arange(3), np.zeros((3, 3)), 1.0, apertures
+    )
+
+    with h5py.File(tmp_path / "apertures.hdf5", "r") as handle:
+        assert (handle["PartType0/Offset"][...] == [0, 2, 2]).all()
+        assert (handle["PartType0/Length"][...] == [2, 0, 1]).all()
+        assert (handle["PartType0/Index"][...] == [1, 5, 3]).all()
+        assert (handle["Radii"][...] == 1.0).all()
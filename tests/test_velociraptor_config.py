@@ -0,0 +1,111 @@
+"""
+Tests the functions in velociraptor_config.py
+"""
+
+from velociraptor_config import *
+
+
+def test_parse_config_line_0():
+    """
+    Tests parsing values, comments and blank lines.
+    """
+
+    assert parse_config_line("Minimum_size=32 #min 20 particles\n") == (
+        "Minimum_size",
+        "32",
+    )
+    assert parse_config_line("MPI_particle_total_buf_size=100000000\n") == (
+        "MPI_particle_total_buf_size",
+        "100000000",
+    )
+    assert parse_config_line("#MPI_particle_total_buf_size=100000000\n") is None
+    assert parse_config_line("\n") is None
+
+
+def test_read_config_0():
+    """
+    Tests reading the configuration files shipped with the toolkit.
+    """
+
+    config = read_config("velociraptor.cfg")
+    galaxy_config = read_config("velociraptor_galaxy.cfg")
+
+    assert config["MPI_particle_total_buf_size"] == "100000000"
+    assert config["Particle_search_type"] == "1"
+    assert "MPI_particle_total_buf_size" not in galaxy_config
+    assert galaxy_config["Particle_search_type"] == "3"
+
+
+def test_write_config_0(tmp_path):
+    """
+    Tests that overrides replace existing values and are added otherwise, and
+    that everything else is left alone.
+    """
+
+    for template in ["velociraptor.cfg", "velociraptor_galaxy.cfg"]:
+        output = str(tmp_path / "tuned.cfg")
+
+        write_config(
+            template, output, {"MPI_particle_total_buf_size": 1234, "Minimum_size": 50}
+        )
+
+        original = read_config(template)
+        tuned = read_config(output)
+
+        assert tuned["MPI_particle_total_buf_size"] == "1234"
+        assert tuned["Minimum_size"] == "50"
+
+        for key, value in original.items():
+            if key not in ["MPI_particle_total_buf_size", "Minimum_size"]:
+                assert tuned[key] == value
+
+        with open(output, "r") as handle:
+            assert "Minimum_size=50 #min 20 particles\n" in handle.readlines()
+
+
+def test_estimate_resources_0():
+    """
+    Tests that the estimates grow with the size of the snapshot, and that
+    only the searched particles count towards the threads.
+    """
+
+    config = {"Particle_search_type": "1"}
+    galaxy_config = {"Particle_search_type": "3", "Search_for_substructure": "1"}
+
+    small = estimate_resources(np.array([1000, 1000, 0, 0, 10, 0]), config, 16)
+    large = estimate_resources(np.array([10 ** 9, 10 ** 9, 0, 0, 10 ** 8, 0]), config, 16)
+    galaxy = estimate_resources(
+        np.array([10 ** 9, 10 ** 9, 0, 0, 10 ** 8, 0]), galaxy_config, 16
+    )
+
+    assert small.threads == 1
+    assert large.threads == 16
+    assert small.memory_bytes < large.memory_bytes
+    assert small.wall_time_seconds < large.wall_time_seconds
+    assert small.buffer_size_bytes < large.buffer_size_bytes
+
+    assert galaxy.number_of_searched_particles == 10 ** 8
+    assert galaxy.memory_bytes < large.memory_bytes
+
+
+def test_create_tuned_config_0(tmp_path):
+    """
+    Tests reading the particle numbers from a snapshot and writing the config.
+    """
+
+    snapshot = str(tmp_path / "snap.hdf5")
+
+    with h5py.File(snapshot, "w") as handle:
+        header = handle.create_group("Header")
+        header.attrs["NumPart_Total"] = np.array([5, 10, 0, 0, 1, 0], dtype=np.uint32)
+        header.attrs["NumPart_Total_HighWord"] = np.array([0, 1, 0, 0, 0, 0], dtype=np.uint32)
+
+    assert (read_particle_numbers(snapshot) == [5, 10 + 2 ** 32, 0, 0, 1, 0]).all()
+
+    output = str(tmp_path / "tuned.cfg")
+    estimate = create_tuned_config(snapshot, "velociraptor.cfg", output, maximum_threads=4)
+
+    assert estimate.threads == 4
+    assert read_config(output)["MPI_particle_total_buf_size"] == str(
+        estimate.buffer_size_bytes
+    )
@@ -0,0 +1,323 @@
+"""
+Reads and writes VELOCIraptor configuration files, and tunes them (and the
+resources requested for the run) to the size of the snapshot.
+
+The resource model is deliberately simple: memory and run time scale
+linearly with the number of particles loaded and searched, with the
+constants below. They are rough defaults for SIMBA-like hydro runs.
+
+For usage information, use python3 velociraptor_config.py -h
+"""
+
+import os
+import h5py
+import numpy as np
+
+from typing import NamedTuple
+
+# Memory per particle that VELOCIraptor reads in (particle data, tree, and
+# group bookkeeping), and per particle that is actually searched.
+BYTES_PER_PARTICLE = 250
+BYTES_PER_SEARCHED_PARTICLE = 200
+# Fixed memory overhead of a run.
+BASE_MEMORY_BYTES = 2 * 1024 ** 3
+# Headroom on top of the estimated memory.
+MEMORY_SAFETY_FACTOR = 1.5
+
+# Single-threaded run time per searched particle, and the fraction of the run
+# that does not parallelise (mostly reading and writing).
+SECONDS_PER_SEARCHED_PARTICLE = 2e-5
+SERIAL_FRACTION = 0.15
+# Substructure searches take about this much longer again.
+SUBSTRUCTURE_TIME_FACTOR = 2.0
+# Fixed run time, and headroom on top of the estimated run time.
+BASE_WALL_TIME_SECONDS = 300
+WALL_TIME_SAFETY_FACTOR = 2.0
+
+# There is little point in using more threads than this for small runs.
+PARTICLES_PER_THREAD = 1_000_000
+
+# MPI_particle_total_buf_size is in bytes; VELOCIraptor's own default is
+# equivalent to 1e6 particles, which is far too much for small boxes.
+BUFFER_BYTES_PER_PARTICLE = 100
+MAXIMUM_BUFFER_PARTICLES = 1_000_000
+MINIMUM_BUFFER_PARTICLES = 10_000
+
+# Particle_search_type -> the particle types that are searched.
+SEARCHED_PARTICLE_TYPES = {1: [0, 1, 2, 3, 4, 5], 2: [1], 3: [4], 4: [0], 5: [5]}
+
+
+class ResourceEstimate(NamedTuple):
+    """
+    The resources estimated for a VELOCIraptor run on one snapshot.
+    """
+
+    number_of_particles: int
+    number_of_searched_particles: int
+    threads: int
+    memory_bytes: int
+    wall_time_seconds: int
+    buffer_size_bytes: int
+
+
+def parse_config_line(line: str):
+    """
+    Parses one line of a configuration file, returning (key, value), or None
+    if the line is blank or a comment. Values are returned as strings with
+    any inline comment removed.
+    """
+
+    content = line.split("#", 1)[0].strip()
+
+    if "=" not in content:
+        return None
+
+    key, value = content.split("=", 1)
+
+    return key.strip(), value.strip()
+
+
+def read_config(filename: str) -> dict:
+    """
+    Reads the VELOCIraptor configuration file into a dictionary of
+    {key: value}, with the values as strings.
+    """
+
+    config = {}
+
+    with open(filename, "r") as handle:
+        for line in handle:
+            parsed = parse_config_line(line)
+
+            if parsed is not None:
+                config[parsed[0]] = parsed[1]
+
+    return config
+
+
+def write_config(template_filename: str, output_filename: str, overrides: dict):
+    """
+    Writes a copy of the configuration file at template_filename to
+    output_filename, with the values of the keys in overrides replaced.
+    Inline comments are kept. Keys that are not set in the template are
+    added at the end.
+    """
+
+    remaining = dict(overrides)
+    lines = []
+
+    with open(template_filename, "r") as handle:
+        for line in handle:
+            parsed = parse_config_line(line)
+
+            if parsed is not None and parsed[0] in remaining:
+                key = parsed[0]
+                comment = line[line.index("#") :].rstrip("\n") if "#" in line else ""
+                separator = " " if comment else ""
+
+                line = f"{key}={remaining.pop(key)}{separator}{comment}\n"
+
+            lines.append(line)
+
+    if remaining:
+        lines.append("\n#Set by velociraptor_config.py for this snapshot\n")
+        lines.extend(f"{key}={value}\n" for key, value in remaining.items())
+
+    with open(output_filename, "w") as handle:
+        handle.writelines(lines)
+
+    return
+
+
+def read_particle_numbers(snapshot_filename: str) -> np.array:
+    """
+    Reads the total number of particles of each type from the snapshot
+    header, including the high words for very large runs.
+    """
+
+    with h5py.File(snapshot_filename, "r") as handle:
+        attributes = handle["Header"].attrs
+
+        particle_numbers = np.array(attributes["NumPart_Total"], dtype=np.int64)
+
+        if "NumPart_Total_HighWord" in attributes:
+            high_word = np.array(attributes["NumPart_Total_HighWord"], dtype=np.int64)
+            particle_numbers += high_word << 32
+
+    return particle_numbers
+
+
+def get_available_cpus() -> int:
+    """
+    The number of CPUs that this process may run on.
+    """
+
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def estimate_resources(
+    particle_numbers: np.array, config: dict, maximum_threads=None
+) -> ResourceEstimate:
+    """
+    Estimates the resources for running VELOCIraptor with config (as read by
+    read_config) on a snapshot with particle_numbers particles of each type.
+    The number of threads is limited to maximum_threads (default: the number
+    of CPUs available).
+    """
+
+    if maximum_threads is None:
+        maximum_threads = get_available_cpus()
+
+    search_type = int(config.get("Particle_search_type", 1))
+    searched_types = SEARCHED_PARTICLE_TYPES.get(search_type, range(6))
+
+    number_of_particles = int(np.sum(particle_numbers))
+    number_of_searched_particles = int(
+        sum(particle_numbers[ptype] for ptype in searched_types if ptype < len(particle_numbers))
+    )
+
+    threads = int(
+        np.clip(number_of_searched_particles // PARTICLES_PER_THREAD, 1, maximum_threads)
+    )
+
+    memory_bytes = MEMORY_SAFETY_FACTOR * (
+        BASE_MEMORY_BYTES
+        + BYTES_PER_PARTICLE * number_of_particles
+        + BYTES_PER_SEARCHED_PARTICLE * number_of_searched_particles
+    )
+
+    single_thread_time = SECONDS_PER_SEARCHED_PARTICLE * number_of_searched_particles
+
+    if int(config.get("Search_for_substructure", 0)):
+        single_thread_time *= SUBSTRUCTURE_TIME_FACTOR
+
+    # Amdahl's law.
+    wall_time_seconds = WALL_TIME_SAFETY_FACTOR * (
+        BASE_WALL_TIME_SECONDS
+        + single_thread_time * (SERIAL_FRACTION + (1 - SERIAL_FRACTION) / threads)
+    )
+
+    buffer_particles = int(
+        np.clip(number_of_particles // 10, MINIMUM_BUFFER_PARTICLES, MAXIMUM_BUFFER_PARTICLES)
+    )
+
+    return ResourceEstimate(
+        number_of_particles=number_of_particles,
+        number_of_searched_particles=number_of_searched_particles,
+        threads=threads,
+        memory_bytes=int(memory_bytes),
+        wall_time_seconds=int(wall_time_seconds),
+        buffer_size_bytes=buffer_particles * BUFFER_BYTES_PER_PARTICLE,
+    )
+
+
+def create_tuned_config(
+    snapshot_filename: str,
+    template_filename: str,
+    output_filename: str,
+    maximum_threads=None,
+) -> ResourceEstimate:
+    """
+    Estimates the resources for running VELOCIraptor with the configuration
+    file at template_filename on the snapshot (including the .hdf5), and
+    writes a copy of the configuration tuned for it to output_filename.
+
+    Returns the estimate, so that the caller can use the thread count and
+    e.g. request the memory and wall time from the scheduler.
+    """
+
+    estimate = estimate_resources(
+        read_particle_numbers(snapshot_filename),
+        read_config(template_filename),
+        maximum_threads=maximum_threads,
+    )
+
+    write_config(
+        template_filename,
+        output_filename,
+        {"MPI_particle_total_buf_size": estimate.buffer_size_bytes},
+    )
+
+    return estimate
+
+
+def format_estimate(estimate: ResourceEstimate) -> str:
+    """
+    Formats the estimate for printing.
+    """
+
+    return "\n".join(
+        [
+            f"Particles (searched): {estimate.number_of_particles} ({estimate.number_of_searched_particles})",
+            f"Threads: {estimate.threads}",
+            f"Memory: {estimate.memory_bytes / 1024 ** 3:.1f} GB",
+            f"Wall time: {estimate.wall_time_seconds / 3600:.2f} hours",
+            f"MPI_particle_total_buf_size: {estimate.buffer_size_bytes}",
+        ]
+    )
+
+
+if __name__ == "__main__":
+    # Run in script mode!
+    import argparse as ap
+
+    PARSER = ap.ArgumentParser(
+        description="""
+        Writes a VELOCIraptor configuration file tuned to the size of the given
+        snapshot, and prints the estimated threads, memory and wall time for the
+        run.
+        """
+    )
+
+    PARSER.add_argument(
+        "-s",
+        "--snapshot",
+        help="""
+        Snapshot filename (including path and .hdf5). Required.
+        """,
+        required=True,
+    )
+
+    PARSER.add_argument(
+        "-C",
+        "--config",
+        help="""
+        Velociraptor configuration file to start from. Defaults to velociraptor.cfg.
+        """,
+        required=False,
+        default="velociraptor.cfg",
+    )
+
+    PARSER.add_argument(
+        "-o",
+        "--output",
+        help="""
+        Filename for the tuned configuration file. Required.
+        """,
+        required=True,
+    )
+
+    PARSER.add_argument(
+        "-t",
+        "--max-threads",
+        help="""
+        Maximal number of threads to use. Defaults to the number of CPUs available.
+        """,
+        required=False,
+        type=int,
+        default=None,
+    )
+
+    ARGS = vars(PARSER.parse_args())
+
+    estimate = create_tuned_config(
+        snapshot_filename=ARGS["snapshot"],
+        template_filename=ARGS["config"],
+        output_filename=ARGS["output"],
+        maximum_threads=ARGS["max_threads"],
+    )
+
+    print(format_estimate(estimate))